@@ -0,0 +1,13 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+
+"""Convenience wrapper for running the wrapper benchmarks directly from source tree."""
+
+import sys
+
+from bleSuiteCLI.benchmark import main
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,160 @@
+import os
+import struct
+import threading
+import time
+from operationStats import stats
+import logging
+
+logger = logging.getLogger(__name__)
+logger.addHandler(logging.NullHandler())
+
+SYSFS_BLUETOOTH = "/sys/class/bluetooth"
+#Number of connections opened on each adapter at once. Most controllers handle
+#several LE connections, but many USB dongles become unreliable beyond a few.
+DEFAULT_CONNECTIONS_PER_ADAPTER = 3
+#Weight given to the latest result in each adapter's error rate (exponential moving average)
+ERROR_RATE_WEIGHT = 0.2
+#Error rate above which an adapter only receives work when no healthy adapter has a free slot
+UNHEALTHY_ERROR_RATE = 0.5
+#ioctl returning a controller's struct hci_dev_info, and the layout of that struct (statistics skipped)
+HCIGETDEVINFO = 0x800448d3
+_HCI_DEV_INFO = struct.Struct("=H8s6sIB8s3xIIIHHHH40x")
+_AF_BLUETOOTH = 31
+_BTPROTO_HCI = 1
+
+
+def listAdapters():
+    """
+    List the local HCI controllers (ie hci0, hci1).
+
+    :return: sorted list of adapter names
+    :rtype: list of str
+    """
+    try:
+        names = os.listdir(SYSFS_BLUETOOTH)
+    except OSError:
+        return []
+    #skip per-connection entries such as hci0:64
+    return sorted((name for name in names if name.startswith("hci") and ":" not in name),
+                  key=lambda name: int(name[3:]) if name[3:].isdigit() else name)
+
+
+def controllerBuffers(adapter):
+    """
+    Ask an adapter's controller how many ACL data packets (and of what size) it can
+    buffer, the credits the host may have outstanding before the controller reports
+    packets completed. Controllers with separate LE buffers usually size them
+    similarly, so this is used as an estimate of LE credits.
+
+    :param adapter: Adapter name (ie hci0, "" for hci0)
+    :return: (ACL MTU, ACL packets), or None if the controller can not be queried
+    :rtype: (int, int)
+    """
+    import fcntl
+    import socket
+    devId = int(adapter[3:]) if adapter and adapter.startswith("hci") and adapter[3:].isdigit() else 0
+    try:
+        sock = socket.socket(getattr(socket, 'AF_BLUETOOTH', _AF_BLUETOOTH), socket.SOCK_RAW,
+                             getattr(socket, 'BTPROTO_HCI', _BTPROTO_HCI))
+    except socket.error as e:
+        logger.debug("Could not open an HCI socket: %s" % e)
+        return None
+    try:
+        info = fcntl.ioctl(sock.fileno(), HCIGETDEVINFO,
+                           struct.pack("=H", devId) + "\x00" * (_HCI_DEV_INFO.size - 2))
+    except IOError as e:
+        logger.debug("Could not read the buffer sizes of hci%d: %s" % (devId, e))
+        return None
+    finally:
+        sock.close()
+    fields = _HCI_DEV_INFO.unpack(info)
+    aclMTU, aclPackets = fields[-4], fields[-3]
+    return aclMTU, aclPackets
+
+
+class AdapterScheduler(object):
+    """
+    Hands out local Bluetooth adapters to device workers. Each adapter is given at most
+    connectionsPerAdapter connections at once, work goes to the adapter with the lowest
+    load, and adapters whose recent error rate rises above UNHEALTHY_ERROR_RATE are
+    only used when every healthy adapter is busy.
+
+    :param adapters: Adapter names to schedule across ("" uses the host's default adapter)
+    :param connectionsPerAdapter: Maximum concurrent connections per adapter. Default: 3
+    :type adapters: list of str
+    :type connectionsPerAdapter: int
+    """
+    def __init__(self, adapters, connectionsPerAdapter=DEFAULT_CONNECTIONS_PER_ADAPTER):
+        if not adapters:
+            raise ValueError("No Bluetooth adapters available to schedule work on.")
+        if connectionsPerAdapter < 1:
+            raise ValueError("%s is not a valid number of connections per adapter. "
+                             "Please supply a value of at least 1" % connectionsPerAdapter)
+        self.adapters = list(adapters)
+        self.connectionsPerAdapter = connectionsPerAdapter
+        self._condition = threading.Condition()
+        self._active = dict((adapter, 0) for adapter in self.adapters)
+        self._errorRate = dict((adapter, 0.0) for adapter in self.adapters)
+
+    @property
+    def capacity(self):
+        """
+        Total number of connections the scheduler will allow at once.
+        """
+        return len(self.adapters) * self.connectionsPerAdapter
+
+    def _pick(self):
+        free = [adapter for adapter in self.adapters if self._active[adapter] < self.connectionsPerAdapter]
+        if not free:
+            return None
+        healthy = [adapter for adapter in free if self._errorRate[adapter] < UNHEALTHY_ERROR_RATE]
+        candidates = healthy or free
+        return min(candidates, key=lambda adapter: (self._active[adapter], self._errorRate[adapter]))
+
+    def acquire(self):
+        """
+        Block until an adapter has a free connection slot and reserve it.
+
+        :return: adapter name
+        :rtype: str
+        """
+        with self._condition:
+            while True:
+                adapter = self._pick()
+                if adapter is not None:
+                    self._active[adapter] += 1
+                    return adapter
+                self._condition.wait()
+
+    def release(self, adapter, success=True):
+        """
+        Return a connection slot and record whether the work on it succeeded.
+
+        :param adapter: Adapter returned by acquire()
+        :param success: Whether the work completed without error
+        :type success: bool
+        """
+        with self._condition:
+            self._active[adapter] -= 1
+            self._errorRate[adapter] += ERROR_RATE_WEIGHT * ((0.0 if success else 1.0) - self._errorRate[adapter])
+            if not success:
+                logger.debug("Adapter %s error rate now %.2f" % (adapter, self._errorRate[adapter]))
+            self._condition.notify()
+
+    def run(self, task):
+        """
+        Run task on the next available adapter.
+
+        :param task: Function called with an adapter name
+        :return: value returned by task
+        """
+        waitStart = time.time()
+        adapter = self.acquire()
+        stats.record("adapter.wait", time.time() - waitStart)
+        success = False
+        try:
+            result = task(adapter)
+            success = True
+            return result
+        finally:
+            self.release(adapter, success)
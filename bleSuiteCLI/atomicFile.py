@@ -0,0 +1,39 @@
+import errno
+import os
+import tempfile
+import logging
+
+logger = logging.getLogger(__name__)
+logger.addHandler(logging.NullHandler())
+
+
+def atomicWrite(path, data):
+    """
+    Write data to path through a temporary file in the same directory that is
+    renamed into place, so readers (ie a concurrent run) never see a partial file.
+    The directory is created if needed, and the temporary file is removed if the
+    write fails.
+
+    :param path: File to write
+    :param data: Contents of the file
+    :type path: str
+    :type data: str
+    """
+    directory = os.path.dirname(path)
+    if directory:
+        try:
+            os.makedirs(directory)
+        except OSError as e:
+            if e.errno != errno.EEXIST:
+                raise
+    fd, tmpPath = tempfile.mkstemp(dir=directory or None)
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            f.write(data)
+        os.rename(tmpPath, path)
+    except BaseException:
+        try:
+            os.remove(tmpPath)
+        except OSError as e:
+            logger.debug("Unable to remove temporary file %s: %s" % (tmpPath, e))
+        raise
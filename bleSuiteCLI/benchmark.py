@@ -0,0 +1,532 @@
+import argparse
+import collections
+import json
+import os
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import logging
+
+logger = logging.getLogger(__name__)
+logger.addHandler(logging.NullHandler())
+
+#Metrics compared against the baseline, and whether a higher value is better
+COMPARED_METRICS = {'opsPerSec': True, 'p50Ms': False, 'p99Ms': False, 'cpuSeconds': False,
+                    'startupMs': False, 'importMs': False}
+
+#Times a scan benchmark runs a scan that keeps failing before giving up on it
+SCAN_ATTEMPTS = 20
+#Command lines timed by the startup benchmark (none of them need a Bluetooth adapter)
+STARTUP_COMMANDS = collections.OrderedDict([
+    ('bleSuite --version', ['--version']),
+    ('bleSuite --help', ['--help']),
+    ('bleSuite exportCapture', ['exportCapture', '--output', 'jsonl', '--record', '{capture}']),
+])
+#Modules the command line entry point must leave for the commands that use them
+DEFERRED_MODULES = ['gattlib', 'bleSuite', 'ctypes', 'socket', 'bleSuiteCLI.cmdLineToolWrappers',
+                    'bleSuiteCLI.sessionRunner', 'bleSuiteCLI.connectionPool', 'bleSuiteCLI.captureFile',
+                    'bleSuiteCLI.gattCache', 'bleSuiteCLI.uuidHandleCache']
+#Runs CLI main() with the remaining arguments
+_RUN_CLI = "import sys; sys.argv[0] = 'bleSuite'; from bleSuiteCLI.bleSuiteCLI import main; main()"
+#Imports a module in a fresh interpreter and prints the time spent loading each module it pulls in
+#(excluding the modules that one imports) as JSON
+_IMPORT_PROBE = '''
+import sys, time, __builtin__
+_import = __builtin__.__import__
+_children = []
+_selfTimes = {}
+def _timedImport(name, *args, **kwargs):
+    loaded = set(sys.modules)
+    start = time.time()
+    _children.append(0.0)
+    try:
+        return _import(name, *args, **kwargs)
+    finally:
+        elapsed = time.time() - start
+        childTime = _children.pop()
+        if _children:
+            _children[-1] += elapsed
+        new = [m for m in set(sys.modules) - loaded if sys.modules[m] is not None]
+        if new:
+            #implicit relative imports load bleSuiteCLI.<name> for <name>
+            target = ([m for m in new if m == name or m.endswith("." + name)] or [name])[0]
+            _selfTimes[target] = _selfTimes.get(target, 0.0) + elapsed - childTime
+__builtin__.__import__ = _timedImport
+_start = time.time()
+__import__(sys.argv[1])
+_total = time.time() - _start
+__builtin__.__import__ = _import
+import json
+json.dump({"total": _total, "modules": _selfTimes,
+           "loaded": sorted(m for m, module in sys.modules.items() if module is not None)}, sys.stdout)
+'''
+
+
+class LatencyRecorder(object):
+    """
+    Collects per-operation latency from the time a request reaches the
+    simulated device to the time the wrapper hands back its result.
+    Latency is approximate for operations that had to be retried.
+
+    :param device: SimulatedDevice (with trace enabled) the operations run against
+    """
+    def __init__(self, device):
+        self.device = device
+        self.latencies = []
+        self.results = 0
+        self._lock = threading.Lock()
+
+    def onResult(self, kind, result):
+        now = time.time()
+        with self._lock:
+            self.results += 1
+            try:
+                if kind == 'uuid':
+                    handle = self.device._findUUID(result[0])
+                else:
+                    handle = int(result[0], 16)
+                self.latencies.append(now - self.device.issued[handle].popleft())
+            except (IndexError, RuntimeError):
+                pass
+
+
+def percentile(values, fraction):
+    """
+    :param values: Sorted list of values
+    :param fraction: Percentile as a fraction (ie 0.99)
+    :return: value at the percentile (None if values is empty)
+    """
+    if not values:
+        return None
+    return values[int(round(fraction * (len(values) - 1)))]
+
+
+def _runReads(device, recorder, options, async, batch=True):
+    from cmdLineToolWrappers import bleServiceRead, bleServiceReadAsync
+    from valueLengthCache import ValueLengthCache
+    handles = ["%04x" % (1 + i % len(device.attributes)) for i in range(options.operations)]
+    if async:
+        bleServiceReadAsync("00:00:00:00:00:00", "", "public", "low", handles, [None],
+                            options.maxTries, options.timeout, onResult=recorder.onResult)
+    else:
+        bleServiceRead("00:00:00:00:00:00", "", "public", "low", handles, [None],
+                       options.maxTries, onResult=recorder.onResult, batch=batch,
+                       #no lengths are known at the start, as in a first CLI run
+                       lengthCache=ValueLengthCache(None))
+
+
+def _runSweep(device, recorder, options):
+    from cmdLineToolWrappers import bleHandleSweep
+    #each sweep reads every attribute, so repeat it until the operation count is reached
+    for i in range(max(1, options.operations // len(device.attributes))):
+        bleHandleSweep("00:00:00:00:00:00", "", "public", "low", 0x0001, 0xffff, options.maxTries, options.timeout,
+                       onResult=recorder.onResult)
+
+
+def _runSmartScan(device, recorder, options, pipelined=True):
+    import cmdLineToolWrappers
+    checkpointDir = tempfile.mkdtemp(prefix="bleSuite-benchmark-")
+    try:
+        #each scan reads every attribute, so repeat it until the operation count is reached
+        for i in range(max(1, options.operations // len(device.attributes))):
+            resume = False
+            #a scan that fails (ie with --disconnectRate) is run again, as a user would
+            for attempt in range(SCAN_ATTEMPTS):
+                try:
+                    if pipelined:
+                        cmdLineToolWrappers.bleRunSmartScan("00:00:00:00:00:00", "", "public", "low",
+                                                            printStructure=False, maxTries=options.maxTries,
+                                                            timeout=options.timeout, resume=resume,
+                                                            checkpointDir=checkpointDir)
+                    else:
+                        #the library scan used when the requester can not discover the device itself
+                        connectionManager = cmdLineToolWrappers.bleConnectionManager.BLEConnectionManager(
+                            "00:00:00:00:00:00", "", "public", "low", createRequester=False)
+                        cmdLineToolWrappers.bleSmartScan.bleSmartScan("00:00:00:00:00:00", connectionManager)
+                    break
+                except RuntimeError as e:
+                    logger.debug("Scan failed, running it again: %s" % e)
+                    resume = True
+            else:
+                logger.debug("Scan failed %d times, giving up" % SCAN_ATTEMPTS)
+                return
+            recorder.results += len(device.attributes)
+    finally:
+        shutil.rmtree(checkpointDir, ignore_errors=True)
+
+
+def _runServiceScan(device, recorder, options, incremental=False):
+    import cmdLineToolWrappers
+    from gattCache import GATTCache, DATABASE_HASH_UUID
+    from simulatedDevice import SimulatedAttribute
+    #the Database Hash lets incremental scans of the unchanged device use the structure cached by the first
+    device.attributes[max(device.attributes) + 1] = SimulatedAttribute(DATABASE_HASH_UUID, "\0" * 16, writable=False,
+                                                                       writeWithoutResponse=False)
+    cacheDir = tempfile.mkdtemp(prefix="bleSuite-benchmark-")
+    try:
+        cache = GATTCache(cacheDir)
+        #each scan covers every attribute, so repeat it until the operation count is reached
+        for i in range(max(1, options.operations // len(device.attributes))):
+            for attempt in range(SCAN_ATTEMPTS):
+                try:
+                    cmdLineToolWrappers.bleServiceScan("00:00:00:00:00:00", "", "public", "low",
+                                                       cache if incremental else None, printStructure=False,
+                                                       maxTries=options.maxTries, checkpointDir=cacheDir,
+                                                       incremental=incremental)
+                    break
+                except RuntimeError as e:
+                    logger.debug("Scan failed, running it again: %s" % e)
+            else:
+                logger.debug("Scan failed %d times, giving up" % SCAN_ATTEMPTS)
+                return
+            recorder.results += len(device.attributes)
+    finally:
+        shutil.rmtree(cacheDir, ignore_errors=True)
+
+
+def _runWrites(device, recorder, options, async, window=None):
+    from cmdLineToolWrappers import bleServiceWrite, bleServiceWriteAsync
+    payloads = ("payload%d" % i for i in range(options.operations))
+    if async:
+        bleServiceWriteAsync("00:00:00:00:00:00", "", "public", "low", ["0001"], payloads,
+                             options.maxTries, options.timeout, window, onResult=recorder.onResult)
+    else:
+        bleServiceWrite("00:00:00:00:00:00", "", "public", "low", ["0001"], payloads,
+                        options.maxTries, onResult=recorder.onResult)
+
+
+def _runWriteCommands(device, recorder, options):
+    from cmdLineToolWrappers import bleServiceWriteNoResponse, DEFAULT_WRITE_CREDITS
+    payloads = ("payload%d" % i for i in range(options.operations))
+    #a fixed batch size so results do not depend on the host's controller
+    bleServiceWriteNoResponse("00:00:00:00:00:00", "", "public", "low", ["0001"], payloads,
+                              options.maxTries, options.timeout, DEFAULT_WRITE_CREDITS, onResult=recorder.onResult)
+
+
+def _runContinuousScan(device, recorder, options):
+    import random
+    import struct
+    from continuousScan import DeviceTable, parseAdvertisingReports, HCI_EVENT_PKT, EVT_LE_META_EVENT, \
+        EVT_LE_ADVERTISING_REPORT
+    #advertisements from ten times as many devices as the table keeps, so eviction is exercised
+    rng = random.Random(0)
+    table = DeviceTable(options.attributes)
+    for i in range(options.operations):
+        report = (chr(0) + chr(1) + struct.pack("<Q", rng.randint(0, options.attributes * 10))[:6] + chr(3) +
+                  "\x02\x01\x06" + struct.pack("b", -rng.randint(30, 90)))
+        body = chr(EVT_LE_ADVERTISING_REPORT) + chr(1) + report
+        for report in parseAdvertisingReports(chr(HCI_EVENT_PKT) + chr(EVT_LE_META_EVENT) + chr(len(body)) + body):
+            table.update(report)
+            recorder.results += 1
+
+
+def _runSubscribe(device, recorder, options):
+    from cmdLineToolWrappers import bleHandleSubscribe
+    from captureFile import readCapture
+    captureDir = tempfile.mkdtemp()
+    try:
+        capturePath = os.path.join(captureDir, "subscribe.cap")
+
+        def subscribe():
+            try:
+                bleHandleSubscribe("00:00:00:00:00:00", ["0001"], "", "public", "low", 1, capturePath)
+            except RuntimeError:
+                #raised once the device is shut down
+                pass
+        subscriber = threading.Thread(target=subscribe)
+        subscriber.daemon = True
+        subscriber.start()
+        duration = options.operations / float(options.notifyRate)
+        stop = device.notify([1], options.notifyRate)
+        time.sleep(duration)
+        stop.set()
+        device.shutdown()
+        #the recorder closes the capture once subscribe gives up reconnecting
+        subscriber.join()
+        recorder.results = sum(1 for record in readCapture(capturePath))
+    finally:
+        shutil.rmtree(captureDir)
+
+
+def _runFuzz(device, recorder, options):
+    import itertools
+    import random
+    from cmdLineToolWrappers import bleFuzzWrite
+    from payloadMutators import fuzzPayloads
+    payloads = itertools.islice(fuzzPayloads(["\x01\x02\x03\x04"], ['random'], random.Random(0)), options.operations)
+    recorder.results, crashes = bleFuzzWrite("00:00:00:00:00:00", "", "public", "low", ["0001"], payloads,
+                                             options.maxTries, options.timeout, 16)
+
+
+BENCHMARKS = collections.OrderedDict([
+    ('readVal', lambda device, recorder, options: _runReads(device, recorder, options, False)),
+    ('readVal --noBatch', lambda device, recorder, options: _runReads(device, recorder, options, False, False)),
+    ('readVal --async', lambda device, recorder, options: _runReads(device, recorder, options, True)),
+    ('readVal --handleRange 0001:ffff', _runSweep),
+    ('smartScan', _runSmartScan),
+    ('smartScan --serial', lambda device, recorder, options: _runSmartScan(device, recorder, options, False)),
+    ('serviceScan', _runServiceScan),
+    ('serviceScan --incremental', lambda device, recorder, options: _runServiceScan(device, recorder, options, True)),
+    ('writeVal', lambda device, recorder, options: _runWrites(device, recorder, options, False)),
+    ('writeVal --async', lambda device, recorder, options: _runWrites(device, recorder, options, True)),
+    ('writeVal --async --window 16',
+     lambda device, recorder, options: _runWrites(device, recorder, options, True, 16)),
+    ('writeVal --noResponse', _runWriteCommands),
+    ('subscribe --record', _runSubscribe),
+    ('leScan --continuous', _runContinuousScan),
+    ('fuzz --window 16', _runFuzz),
+])
+
+
+def runBenchmark(name, options):
+    """
+    Run a single benchmark against a fresh simulated device.
+
+    :param name: Key of BENCHMARKS
+    :param options: Parsed benchmark options
+    :return: metrics (ops/sec, p50/p99 latency, CPU seconds, peak memory growth)
+    :rtype: dict
+    """
+    from simulatedDevice import SimulatedDevice, LatencyModel, simulate
+    device = SimulatedDevice.withAttributes(options.attributes, options.valueSize,
+                                            latency=LatencyModel(options.latency / 1000.0, options.distribution,
+                                                                 options.jitter / 1000.0),
+                                            disconnectRate=options.disconnectRate, dropRate=options.dropRate,
+                                            serviceSize=options.serviceSize)
+    device.trace = True
+    recorder = LatencyRecorder(device)
+    usageStart = resource.getrusage(resource.RUSAGE_SELF)
+    start = time.time()
+    with simulate(device):
+        BENCHMARKS[name](device, recorder, options)
+    elapsed = time.time() - start
+    usageEnd = resource.getrusage(resource.RUSAGE_SELF)
+    latencies = sorted(recorder.latencies)
+    return {'operations': recorder.results,
+            'seconds': elapsed,
+            'opsPerSec': recorder.results / elapsed if elapsed else None,
+            'p50Ms': percentile(latencies, 0.5) * 1000 if latencies else None,
+            'p99Ms': percentile(latencies, 0.99) * 1000 if latencies else None,
+            'cpuSeconds': (usageEnd.ru_utime - usageStart.ru_utime) + (usageEnd.ru_stime - usageStart.ru_stime),
+            #ru_maxrss is the process peak (KB on Linux), so this is how far the peak grew
+            'peakMemoryGrowthKB': usageEnd.ru_maxrss - usageStart.ru_maxrss,
+            'reconnects': device.counters['connect'] - 1}
+
+
+def _cliEnvironment():
+    #the child interpreters import the package this benchmark belongs to
+    environment = dict(os.environ)
+    packageParent = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    environment['PYTHONPATH'] = os.pathsep.join([packageParent] + filter(None, [environment.get('PYTHONPATH')]))
+    return environment
+
+
+def runStartupBenchmark(argv, runs):
+    """
+    Time a command line from interpreter start to exit.
+
+    :param argv: CLI arguments
+    :param runs: Number of times to run it
+    :return: metrics (median and p90 wall time)
+    :rtype: dict
+    """
+    environment = _cliEnvironment()
+    durations = []
+    with open(os.devnull, 'w') as devnull:
+        for i in range(runs):
+            start = time.time()
+            subprocess.call([sys.executable, '-c', _RUN_CLI] + argv, stdout=devnull, stderr=devnull,
+                            env=environment)
+            durations.append(time.time() - start)
+    durations.sort()
+    return {'runs': runs,
+            'startupMs': percentile(durations, 0.5) * 1000,
+            'p90Ms': percentile(durations, 0.9) * 1000}
+
+
+def importBreakdown(module, runs):
+    """
+    Measure how long importing module takes in a fresh interpreter, broken down by the modules it loads.
+
+    :param module: Module to import (ie bleSuiteCLI.bleSuiteCLI)
+    :param runs: Number of fresh interpreters to measure in (the run with the median total is reported)
+    :return: metrics (total import time, per module self time in ms, modules loaded)
+    :rtype: dict
+    """
+    environment = _cliEnvironment()
+    probes = []
+    for i in range(runs):
+        output = subprocess.check_output([sys.executable, '-c', _IMPORT_PROBE, module], env=environment)
+        probes.append(json.loads(output))
+    probes.sort(key=lambda probe: probe['total'])
+    probe = probes[len(probes) // 2]
+    return {'importMs': probe['total'] * 1000,
+            'modulesMs': dict((name, seconds * 1000) for name, seconds in probe['modules'].items()),
+            'loaded': probe['loaded']}
+
+
+def runStartupBenchmarks(options):
+    """
+    Run the startup benchmarks and print a report.
+
+    :param options: Parsed benchmark options
+    :return: (results, whether the CLI entry point loaded a DEFERRED_MODULES module)
+    """
+    from captureFile import CaptureWriter
+    results = collections.OrderedDict()
+    captureDir = tempfile.mkdtemp()
+    try:
+        capturePath = os.path.join(captureDir, "startup.cap")
+        CaptureWriter(capturePath).close()
+        print "%-30s %10s %10s %10s" % ("startup", "runs", "median ms", "p90 ms")
+        for name, argv in STARTUP_COMMANDS.items():
+            metrics = runStartupBenchmark([arg.format(capture=capturePath) for arg in argv], options.runs)
+            results[name] = metrics
+            print "%-30s %10d %10.1f %10.1f" % (name, metrics['runs'], metrics['startupMs'], metrics['p90Ms'])
+    finally:
+        shutil.rmtree(captureDir)
+
+    breakdown = importBreakdown('bleSuiteCLI.bleSuiteCLI', options.runs)
+    results['import bleSuiteCLI'] = {'importMs': breakdown['importMs']}
+    print "\nimport bleSuiteCLI.bleSuiteCLI: %.1f ms" % breakdown['importMs']
+    print "%-40s %10s" % ("module", "self ms")
+    for name, milliseconds in sorted(breakdown['modulesMs'].items(), key=lambda item: -item[1])[:options.top]:
+        print "%-40s %10.2f" % (name, milliseconds)
+    eager = [name for name in breakdown['loaded']
+             if any(name == deferred or name.startswith(deferred + ".") for deferred in DEFERRED_MODULES)]
+    if eager:
+        print "\nLoaded at start up (should be imported by the commands that use them): %s" % ", ".join(eager)
+    return results, bool(eager)
+
+
+def compareToBaseline(results, baseline, threshold):
+    """
+    Compare benchmark results with a stored baseline.
+
+    :param results: Results from this run (name: metrics)
+    :param baseline: Results from the baseline run (name: metrics)
+    :param threshold: Allowed relative change before a metric counts as a regression (ie 0.1)
+    :return: list of (name, metric, baseline value, current value, change, regressed)
+    """
+    comparisons = []
+    for name, metrics in results.items():
+        if name not in baseline:
+            continue
+        for metric, higherIsBetter in sorted(COMPARED_METRICS.items()):
+            old = baseline[name].get(metric)
+            new = metrics.get(metric)
+            if not old or new is None:
+                continue
+            change = (new - old) / float(old)
+            regressed = change < -threshold if higherIsBetter else change > threshold
+            comparisons.append((name, metric, old, new, change, regressed))
+    return comparisons
+
+
+def parseCommand(argv=None):
+    parser = argparse.ArgumentParser(prog="bleSuite-benchmark",
+                                     description='Benchmark the BLESuite command line wrappers against a '
+                                                 'simulated GATT device (no Bluetooth hardware required).')
+    parser.add_argument('--benchmarks', nargs='+', choices=BENCHMARKS.keys(), default=BENCHMARKS.keys(),
+                        help='Benchmarks to run. (Default: all)')
+    parser.add_argument('--operations', type=int, default=2000,
+                        help='Number of operations (or notifications) per benchmark. (Default: 2000)')
+    parser.add_argument('--attributes', type=int, default=64,
+                        help='Number of attributes on the simulated device. (Default: 64)')
+    parser.add_argument('--serviceSize', type=int, default=16,
+                        help='Number of attributes in each primary service of the simulated device. (Default: 16)')
+    parser.add_argument('--valueSize', type=int, default=20,
+                        help='Size (bytes) of each simulated attribute value. Read Multiple only groups values '
+                             'that fit several to a 23 byte MTU. (Default: 20)')
+    parser.add_argument('--latency', type=float, default=2.0,
+                        help='Mean response time of the simulated device (ms). (Default: 2)')
+    parser.add_argument('--distribution', default='constant',
+                        choices=['constant', 'uniform', 'exponential', 'lognormal'],
+                        help='Response time distribution. (Default: constant)')
+    parser.add_argument('--jitter', type=float, default=0.0,
+                        help='Spread of the uniform distribution, or sigma of the lognormal distribution (ms).')
+    parser.add_argument('--disconnectRate', type=float, default=0.0,
+                        help='Probability each operation drops the connection. (Default: 0)')
+    parser.add_argument('--dropRate', type=float, default=0.0,
+                        help='Probability an async operation never receives a response. (Default: 0)')
+    parser.add_argument('--notifyRate', type=int, default=2000,
+                        help='Notifications per second for the subscribe benchmark. (Default: 2000)')
+    parser.add_argument('--maxTries', type=int, default=5, help='maxTries passed to the wrappers. (Default: 5)')
+    parser.add_argument('--timeout', type=int, default=1,
+                        help='Async timeout (seconds) passed to the wrappers. (Default: 1)')
+    parser.add_argument('--baseline', metavar='FILE',
+                        help='Baseline results to compare against.')
+    parser.add_argument('--saveBaseline', metavar='FILE',
+                        help='Write this run\'s results to FILE for later comparisons.')
+    parser.add_argument('--threshold', type=float, default=10.0,
+                        help='Change (percent) that counts as a regression. (Default: 10)')
+    parser.add_argument('--startup', action='store_true',
+                        help='Measure CLI start up (time to run commands that need no adapter, and import time '
+                             'broken down by module) instead of the wrappers.')
+    parser.add_argument('--runs', type=int, default=20,
+                        help='Interpreters started per start up measurement. (Default: 20)')
+    parser.add_argument('--top', type=int, default=15,
+                        help='Slowest modules listed in the import breakdown. (Default: 15)')
+    return parser.parse_args(argv)
+
+
+def runWrapperBenchmarks(options):
+    """
+    Run the wrapper benchmarks and print a report.
+
+    :param options: Parsed benchmark options
+    :return: results (name: metrics)
+    """
+    results = collections.OrderedDict()
+    #keep wrapper output (ie subscribe status messages) out of the report
+    stdout = sys.stdout
+    print "%-30s %10s %10s %10s %10s %10s %12s" % ("benchmark", "ops", "ops/sec", "p50 ms", "p99 ms",
+                                                 "cpu s", "peak +KB")
+    for name in options.benchmarks:
+        sys.stdout = open(os.devnull, 'w')
+        try:
+            metrics = runBenchmark(name, options)
+        finally:
+            sys.stdout.close()
+            sys.stdout = stdout
+        results[name] = metrics
+        print "%-30s %10d %10.1f %10s %10s %10.2f %12d" % (
+            name, metrics['operations'], metrics['opsPerSec'] or 0,
+            "%.2f" % metrics['p50Ms'] if metrics['p50Ms'] is not None else "-",
+            "%.2f" % metrics['p99Ms'] if metrics['p99Ms'] is not None else "-",
+            metrics['cpuSeconds'], metrics['peakMemoryGrowthKB'])
+    return results
+
+
+def main(argv=None):
+    """
+    Run the benchmarks and print a report.
+
+    :return: 1 if a metric regressed against the baseline (or start up loaded a deferred module), otherwise 0
+    """
+    options = parseCommand(argv)
+    regressed = False
+    if options.startup:
+        results, regressed = runStartupBenchmarks(options)
+    else:
+        results = runWrapperBenchmarks(options)
+
+    if options.saveBaseline:
+        with open(options.saveBaseline, 'w') as f:
+            json.dump(results, f, indent=2)
+        print "\nSaved baseline to %s" % options.saveBaseline
+
+    if options.baseline:
+        with open(options.baseline, 'r') as f:
+            baseline = json.load(f)
+        print "\nComparison with %s" % options.baseline
+        for name, metric, old, new, change, isRegression in compareToBaseline(results, baseline,
+                                                                             options.threshold / 100.0):
+            regressed = regressed or isRegression
+            print "%-30s %-12s %10.2f -> %10.2f (%+.1f%%)%s" % (name, metric, old, new, change * 100,
+                                                              "  REGRESSION" if isRegression else "")
+    return 1 if regressed else 0
@@ -0,0 +1,171 @@
+import errno
+import json
+import os
+import Queue
+import socket
+import SocketServer
+import sys
+import threading
+import traceback
+from daemonProtocol import FrameConnection, FrameWriter, FRAME_REQUEST, FRAME_STDOUT, FRAME_STDERR, FRAME_STDIN, \
+    FRAME_EXIT
+from outputSinks import ThreadOutput
+import logging
+
+logger = logging.getLogger(__name__)
+logger.addHandler(logging.NullHandler())
+
+#Queue.get() without a timeout can not be interrupted with Ctrl-C in Python 2
+_BLOCK_TIMEOUT = 60 * 60 * 24 * 365
+
+
+class StdinLines(object):
+    """
+    File-like iterator over the stdin lines a client forwards, ending at the
+    client's end of input (or when it disconnects).
+    """
+    def __init__(self):
+        self._lines = Queue.Queue()
+        self._finished = False
+
+    def put(self, line):
+        """
+        :param line: Line received from the client (None ends the input)
+        """
+        self._lines.put(line)
+
+    def __iter__(self):
+        return self
+
+    def next(self):
+        if self._finished:
+            raise StopIteration
+        line = self._lines.get(True, _BLOCK_TIMEOUT)
+        if line is None:
+            self._finished = True
+            raise StopIteration
+        return line
+
+    def readline(self):
+        try:
+            return self.next()
+        except StopIteration:
+            return ""
+
+    def close(self):
+        pass
+
+
+class _RequestHandler(SocketServer.BaseRequestHandler):
+    def handle(self):
+        connection = FrameConnection(self.request)
+        try:
+            frameType, payload = connection.receive()
+        except (EOFError, ValueError, socket.error):
+            return
+        if frameType != FRAME_REQUEST:
+            logger.debug("Ignoring client that did not start with a request frame")
+            return
+        request = json.loads(payload)
+        cancelled = threading.Event()
+        stdin = StdinLines() if request.get('stdin') else None
+        worker = threading.Thread(target=self.server.execute, args=(connection, request, cancelled, stdin),
+                                  name="bleSuite-daemon-request")
+        worker.daemon = True
+        worker.start()
+        #route the client's stdin to the command and notice if the client goes away (ie Ctrl-C)
+        while True:
+            try:
+                frameType, payload = connection.receive()
+            except (EOFError, ValueError, socket.error):
+                break
+            if frameType == FRAME_STDIN and stdin is not None:
+                stdin.put(payload or None)
+        cancelled.set()
+        if stdin is not None:
+            stdin.put(None)
+        worker.join(_BLOCK_TIMEOUT)
+
+
+class BLEDaemon(SocketServer.ThreadingMixIn, SocketServer.UnixStreamServer):
+    """
+    Unix domain socket server that runs bleSuite commands for thin clients (see
+    daemonClient.forwardCommand) so repeated commands skip interpreter start up,
+    imports and, through the connection pool, connection set up.
+
+    Each request runs runCommand(args, cwd, stdin, cancelled), a function that
+    parses the client's argv and runs it, with the requesting thread's stdout and
+    stderr sent back to the client.
+
+    :param socketPath: Path of the socket to listen on. Default: ~/.bleSuite/daemon.sock
+    :param runCommand: Function called with (argv, cwd, stdin, cancelled) that returns an exit code
+    :type socketPath: str
+    """
+    daemon_threads = True
+
+    def __init__(self, socketPath, runCommand):
+        self.socketPath = socketPath
+        self.runCommand = runCommand
+        directory = os.path.dirname(socketPath)
+        if directory and not os.path.isdir(directory):
+            os.makedirs(directory, 0700)
+        self._removeStaleSocket()
+        SocketServer.UnixStreamServer.__init__(self, socketPath, _RequestHandler)
+        os.chmod(socketPath, 0600)
+        #print statements from every request thread go through these
+        if not isinstance(sys.stdout, ThreadOutput):
+            sys.stdout = ThreadOutput(sys.stdout)
+        if not isinstance(sys.stderr, ThreadOutput):
+            sys.stderr = ThreadOutput(sys.stderr)
+
+    def _removeStaleSocket(self):
+        if not os.path.exists(self.socketPath):
+            return
+        probe = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            probe.connect(self.socketPath)
+        except socket.error as e:
+            if e.errno not in (errno.ECONNREFUSED, errno.ENOENT):
+                raise
+            logger.debug("Removing stale socket %s" % self.socketPath)
+            os.unlink(self.socketPath)
+            return
+        finally:
+            probe.close()
+        raise RuntimeError("A daemon is already listening on %s" % self.socketPath)
+
+    def execute(self, connection, request, cancelled, stdin):
+        stdout = FrameWriter(connection, FRAME_STDOUT)
+        stderr = FrameWriter(connection, FRAME_STDERR)
+        previousOut = sys.stdout.redirect(stdout)
+        previousErr = sys.stderr.redirect(stderr)
+        code = 0
+        error = None
+        try:
+            code = self.runCommand(request.get('argv', []), request.get('cwd'), stdin, cancelled) or 0
+        except SystemExit as e:
+            #argparse exits on bad arguments
+            code = e.code if isinstance(e.code, int) else 1
+        except Exception as e:
+            logger.debug("Request %s failed: %s" % (request.get('argv'), traceback.format_exc()))
+            code = 1
+            error = str(e)
+        finally:
+            sys.stdout.redirect(previousOut)
+            sys.stderr.redirect(previousErr)
+            try:
+                stdout.flush()
+                stderr.flush()
+                connection.send(FRAME_EXIT, json.dumps({'code': code, 'error': error}))
+            except socket.error as e:
+                logger.debug("Client went away before the result was sent: %s" % e)
+
+    def close(self):
+        """
+        Stop listening and remove the socket.
+        """
+        self.server_close()
+        try:
+            os.unlink(self.socketPath)
+        except OSError:
+            pass
@@ -1,14 +1,16 @@
 import argparse
-from bleSuite import bleScan
-from bleSuite import bleSmartScan
-from cmdLineToolWrappers import bleServiceRead, bleServiceReadAsync, bleServiceWrite, \
-    bleHandleSubscribe, bleServiceScan, bleServiceWriteAsync, bleRunSmartScan
-from bleSuite import utils
-from bleSuite import validators
+#Only lightweight modules are imported here. bleSuite, gattlib and the modules built on them are
+#imported by the commands that use them, so --help, --version and forwarded (daemon) commands start quickly
+from deviceFanOut import runForDevices, readAddressFile
+from adapterScheduler import AdapterScheduler, listAdapters
+from outputSinks import createSink, ProgressLine, OUTPUT_FORMATS
+from payloadSource import filePayloads
+from operationStats import stats
 import logging
-from logging.config import fileConfig
-import binascii
 import os
+import signal
+import sys
+import time
 
 #import bdaddr
 
@@ -17,11 +19,74 @@ __version__ = "0.1"
 logger = logging.getLogger(__name__)
 logger.addHandler(logging.NullHandler())
 
+#Commands that run against each address supplied with --addr/--addrFile, and the banner printed for each
+DEVICE_COMMANDS = {'smartScan': "BTLE Smart Scan beginning",
+                   'serviceScan': "BTLE Scanning Services",
+                   'readVal': "Reading value from handle or UUID",
+                   'writeVal': "Writing value to handle",
+                   'fuzz': "Fuzzing handle"}
+SCAN_COMMANDS = ['smartScan', 'serviceScan']
+#Fields of the records written by --output
+RESULT_FIELDS = ['device', 'command', 'handle', 'uuid', 'name', 'input', 'output', 'error', 'errorCode']
+CAPTURE_FIELDS = ['timestamp', 'handle', 'kind', 'payload']
+SCAN_FIELDS = ['timestamp', 'kind', 'device', 'addressType', 'name', 'firstSeen', 'lastSeen', 'count', 'rssiMin',
+               'rssiAvg', 'rssiMax', 'payload', 'scanResponse']
+QUERY_FIELDS = ['device', 'addressType', 'name', 'adapters', 'firstSeen', 'lastSeen', 'count']
+CHANGE_FIELDS = RESULT_FIELDS + ['kind', 'change', 'attribute', 'previousUuid']
+FUZZ_FIELDS = RESULT_FIELDS + ['original', 'reproduced', 'file']
+SESSION_FIELDS = RESULT_FIELDS[:2] + ['step'] + RESULT_FIELDS[2:] + ['timestamp', 'kind', 'payload']
+#Kind of result record each session step produces
+#Commands a running daemon can run on the CLI's behalf
+DAEMON_COMMANDS = ['leScan', 'smartScan', 'serviceScan', 'readVal', 'writeVal', 'subscribe', 'session', 'fuzz']
+#Arguments holding paths, which the daemon resolves against the client's working directory
+PATH_ARGUMENTS = ['script', 'out', 'addrFile', 'record', 'files', 'statsFile', 'crashDir', 'historyFile']
+SESSION_STEP_COMMANDS = {'read': 'readVal', 'readUUID': 'readVal', 'write': 'writeVal', 'subscribe': 'subscribe'}
+#Fields holding raw data sent to or received from a device
+BINARY_FIELDS = ['input', 'output', 'payload', 'original', 'scanResponse']
+#Writes kept outstanding by fuzz when --window is not supplied
+FUZZ_WINDOW = 16
+#Factor an --adaptiveWindow may grow past --window by when --maxWindow is not supplied
+ADAPTIVE_WINDOW_GROWTH = 4
+#Seconds fuzz waits for a crashed device to answer again
+FUZZ_RECOVERY_TIMEOUT = 30
+#Progress of the smart scans running at once, shared so their workers do not overwrite each other
+_progressLine = ProgressLine()
 
-def parseCommand():
+
+def checkValidBTAddr(address):
+    """
+    argparse type for --addr, deferring the bleSuite import until an address is supplied.
+
+    :param address: Bluetooth address
+    :return: validated address
+    """
+    from bleSuite import validators
+    return validators.checkValidBTAddr(address)
+
+def checkHandleRange(handleRange):
+    """
+    argparse type for --handleRange.
+
+    :param handleRange: Hexadecimal start:end
+    :return: (start, end)
+    :rtype: (int, int)
+    """
+    import argparse
+    try:
+        start, end = [int(handle, 16) for handle in handleRange.split(":")]
+    except ValueError:
+        raise argparse.ArgumentTypeError("%s is not a handle range. Please use start:end (ie 0001:ffff)"
+                                         % handleRange)
+    if not 1 <= start <= end <= 0xffff:
+        raise argparse.ArgumentTypeError("%s is not a valid handle range. Please use 0001:ffff or a part of it"
+                                         % handleRange)
+    return start, end
+
+def parseCommand(argv=None):
     """
     Creates parser and parses command line tool call.
 
+    :param argv: Arguments to parse (None parses sys.argv)
     :return: parsed arguments
     """
     #cmd = None
@@ -37,7 +102,19 @@ def parseCommand():
                               "(data submitted using the data flag takes precedence over data in files).",
                   'subscribe': "Write specified value (0000,0100,0200,0300) to chosen handle and initiate listener.",
                   'spoof': 'Modify your Bluetooth adapter\'s BT_ADDR. Use --addr to set the address. Some chipsets'
-                           ' may not be supported.'}
+                           ' may not be supported.',
+                  'exportCapture': "Decode a capture file written by subscribe --record and export it (see --output). "
+                                   "Use --handles and --captureKind to filter the records exported.",
+                  'session': "Run a script of read, readUUID, write, subscribe and sleep steps (see --script) over "
+                             "one connection per device, writing each step's results as it completes.",
+                  'fuzz': "Write generated payloads (see --mutators) to the --handles of a device through the "
+                          "asynchronous write path, seeded with --data or --files. Writes that go unanswered or drop "
+                          "the connection are replayed to find the crashing case, which is minimized and saved to "
+                          "--crashDir (replay it with writeVal --files).",
+                  'query': "List the devices recorded by --history that match --addr, --adapter, --since, "
+                           "--until, --services and --characteristics, most recently seen first.",
+                  'daemon': "Run in the background, keeping connections to devices open between commands. While "
+                            "it runs, other bleSuite commands are forwarded to it (see --socket, --noDaemon)."}
 
     addressTypeChoices = ['public', 'random']
     securityLevelChoices = ['low', 'medium', 'high']
@@ -63,21 +140,122 @@ def parseCommand():
                                                             'for a characteristic configuration descriptor.'
                                                             '0=off,1=notifications,2=indications,'
                                                             '3=notifications and inidications')
+    parser.add_argument('--record', metavar='record', default=[None],
+                        type=str, nargs=1, required=False, action='store',
+                        help='\033[1m<subscribe, exportCapture>\033[0m '
+                             'Capture file. subscribe appends each notification/indication to it as a '
+                             'binary record instead of printing it (creating the file if needed, and refusing '
+                             'files that are not captures); exportCapture reads it.')
+
+    parser.add_argument('--output', metavar='output', default=['text'],
+                        type=str, nargs=1, required=False, action='store', choices=OUTPUT_FORMATS,
+                        help='\033[1m<leScan, smartScan, serviceScan, readVal, writeVal, exportCapture>\033[0m '
+                             'Format results are written in [text | jsonl | csv]. Binary data is hex encoded '
+                             'in jsonl and csv output. (Default: text)')
+
+    parser.add_argument('--out', metavar='out', default=[None],
+                        type=str, nargs=1, required=False, action='store',
+                        help='\033[1m<leScan, smartScan, serviceScan, readVal, writeVal, exportCapture>\033[0m '
+                             'File to write results to. (Default: stdout)')
+
+    parser.add_argument('--captureKind', metavar='captureKind', default=[None],
+                        type=str, nargs=1, required=False, action='store',
+                        choices=['notification', 'indication'],
+                        help='\033[1m<exportCapture>\033[0m '
+                             'Only export records of this kind [notification | indication].')
+
+    parser.add_argument('--script', metavar='script', default=["-"],
+                        type=str, nargs=1, required=False, action='store',
+                        help='\033[1m<session>\033[0m '
+                             'Script to run, one step per line (- reads steps from stdin as they arrive): '
+                             '"read <handle>...", "readUUID <uuid>...", "write <handle> <data>..." '
+                             '(hex:0a0b for binary data), "subscribe <handle>... [for=<seconds>] [mode=<0-3>]", '
+                             '"sleep <seconds>". Lines starting with # are ignored. (Default: -)')
+
     parser.add_argument('--asyncTimeout', metavar='asyncTimeout', default=[5],
                         type=int, nargs=1,
                         required=False, action='store',
-                        help='\033[1m<readVal, writeVal>\033[0m '
+                        help='\033[1m<readVal, writeVal, smartScan>\033[0m '
                              'Timeout for attempting to retrieve data from a device '
-                             '(ie reading from a device handle). (Default: 5 seconds)')
+                             '(ie reading from a device handle). (Default: 5 seconds) smartScan waits at '
+                             'most 1 second for each descriptor, as gattlib does not report descriptors that '
+                             'can\'t be read asynchronously, and reads the descriptors that timed out again '
+                             'one at a time.')
 
     parser.add_argument('--maxTries', metavar='maxTries', default=[5],
                         type=int, nargs=1,
                         required=False, action='store',
                         help='\033[1m<readVal, writeVal>\033[0m '
-                             'The amount of times to try each read/write operation before giving up. '
+                             'The amount of times to retry each read/write operation before giving up (the '
+                             'operation is attempted at most maxTries + 1 times). '
                              'If a operation fails and we continue, a re-connection is performed'
                              '(if applicable) and the operation is repeated. (Default: 5)')
 
+    parser.add_argument('--retryBackoff', metavar='retryBackoff', default=[None],
+                        type=float, nargs=1,
+                        required=False, action='store',
+                        help='\033[1m<readVal, writeVal>\033[0m '
+                             'Base delay (seconds) before retrying a failed operation. The delay doubles '
+                             'with each attempt (up to 2 seconds) and is randomized so operations that '
+                             'failed together do not retry together. 0 retries immediately. (Default: 0.05)')
+
+    parser.add_argument('--window', metavar='window', default=[None],
+                        type=int, nargs=1,
+                        required=False, action='store',
+                        help='\033[1m<readVal, writeVal, smartScan>\033[0m '
+                             'Maximum number of asynchronous writes outstanding at once. A new write is '
+                             'sent as each one completes or times out. Requires --async. '
+                             '(Default: all writes are sent at once) For readVal --handleRange and '
+                             'smartScan, the number of reads outstanding at once. (Default: 16)')
+
+    parser.add_argument('--serial', action='store_true',
+                        help='\033[1m<serviceScan, smartScan>\033[0m '
+                             'Scan the device with the BLESuite service discovery or smart scan (one request '
+                             'at a time, without checkpoints) instead of discovering it one service range at '
+                             'a time and pipelining the value and descriptor reads.')
+
+    parser.add_argument('--resume', action='store_true',
+                        help='\033[1m<serviceScan, smartScan>\033[0m '
+                             'Continue the last scan of the device that failed (ie the device kept dropping '
+                             'the link) from its checkpoint instead of starting over. Services, '
+                             'characteristics, descriptors and values already found are not requested again.')
+
+    parser.add_argument('--adaptiveWindow', action='store_true',
+                        help='\033[1m<writeVal, fuzz>\033[0m '
+                             'Start with --window writes outstanding, grow the window by one after each '
+                             'successful write and halve it on a timeout or disconnect, never exceeding '
+                             '--maxWindow.')
+
+    parser.add_argument('--maxWindow', metavar='maxWindow', default=[None],
+                        type=int, nargs=1,
+                        required=False, action='store',
+                        help='\033[1m<writeVal, fuzz>\033[0m '
+                             'Largest number of writes an --adaptiveWindow grows to. Must be at least '
+                             '--window. (Default: 4 times --window)')
+
+    parser.add_argument('--noBatch', action='store_true',
+                        help='\033[1m<readVal>\033[0m '
+                             'Read each handle with its own request instead of grouping handles into ATT '
+                             'Read Multiple requests. Only handles whose value length is known from earlier '
+                             'reads (remembered in ~/.bleSuite/valueLengths.cache) are grouped, and only when '
+                             'they fit in one response. Grouping only takes effect with a requester that '
+                             'provides Read Multiple, which the gattlib GATTRequester does not.')
+
+    parser.add_argument('--noResponse', action='store_true',
+                        help='\033[1m<writeVal>\033[0m '
+                             'Send Write Commands (Write Without Response) for bulk transfers. Each '
+                             'characteristic must permit them. Writes are sent in batches of --credits and each '
+                             'batch is confirmed before more than one further batch is sent. Unconfirmed '
+                             'batches are resent after a disconnect, so a value may be written twice. '
+                             'Takes precedence over --async.')
+
+    parser.add_argument('--credits', metavar='credits', default=[None],
+                        type=int, nargs=1,
+                        required=False, action='store',
+                        help='\033[1m<writeVal>\033[0m '
+                             'Write Commands per batch with --noResponse. '
+                             '(Default: the number of ACL packets the adapter\'s controller buffers, or 8)')
+
     #using default [5] since parsed values are placed in a list
     parser.add_argument('--scanTimeout', metavar='scanTimeout', default=[5],
                         type=int, nargs=1,
@@ -85,19 +263,70 @@ def parseCommand():
                         help='\033[1m<leScan>\033[0m '
                         'Device discovery timeout (seconds) for BTLE scan. (Default: 5 seconds Maximum: 15 seconds)')
 
+    parser.add_argument('--continuous', action='store_true',
+                        help='\033[1m<leScan>\033[0m '
+                             'Scan until interrupted, printing each device as soon as it is first seen and a '
+                             'snapshot of every device (advertisement count, RSSI min/avg/max, latest '
+                             'advertising data) each --snapshotInterval. Uses a raw HCI socket, so it needs '
+                             'root (CAP_NET_RAW) and a Python with Bluetooth socket support.')
+    parser.add_argument('--passive', action='store_true',
+                        help='\033[1m<leScan>\033[0m '
+                             'With --continuous, do not request scan responses.')
+    parser.add_argument('--snapshotInterval', metavar='snapshotInterval', default=[60],
+                        type=int, nargs=1,
+                        required=False, action='store',
+                        help='\033[1m<leScan>\033[0m '
+                             'Seconds between --continuous snapshots, 0 for a single snapshot when the '
+                             'scan ends. (Default: 60)')
+    parser.add_argument('--maxDevices', metavar='maxDevices', default=[4096],
+                        type=int, nargs=1,
+                        required=False, action='store',
+                        help='\033[1m<leScan>\033[0m '
+                             'Devices a --continuous scan keeps track of. The least recently seen are '
+                             'forgotten first. (Default: 4096)')
+    parser.add_argument('--staleAfter', metavar='staleAfter', default=[300],
+                        type=int, nargs=1,
+                        required=False, action='store',
+                        help='\033[1m<leScan>\033[0m '
+                             'Seconds without an advertisement after which a --continuous scan forgets a '
+                             'device (it is reported as new if it comes back). (Default: 300)')
+
     #Device for discovery service can be specified
     parser.add_argument('--adapter', metavar='adapter', default=[""],
-                        type=str, nargs=1,
+                        type=str, nargs="+",
                         required=False, action='store',
                         help='\033[1m<all commands>\033[0m '
                              'Specify which Bluetooth adapter should be used. '
-                             'These can be found by running (hcitool dev).')
+                             'These can be found by running (hcitool dev). smartScan, serviceScan, '
+                             'readVal and writeVal accept several adapters (or \'all\') and spread '
+                             'devices across them; other commands use the first adapter.')
+
+    parser.add_argument('--adapterConnections', metavar='adapterConnections', default=[3],
+                        type=int, nargs=1,
+                        required=False, action='store',
+                        help='\033[1m<smartScan, serviceScan, readVal, writeVal>\033[0m '
+                             'Maximum number of devices connected through each adapter at once. (Default: 3)')
 
 
-    parser.add_argument('--addr', metavar='deviceAddress', type=validators.checkValidBTAddr, nargs=1,
+    parser.add_argument('--addr', metavar='deviceAddress', type=checkValidBTAddr, nargs="+",
                         required=False, action='store',
                         help='\033[1m<all commands>\033[0m '
-                             'Bluetooth address (BD_ADDR) of the target Bluetooth device')
+                             'Bluetooth address (BD_ADDR) of the target Bluetooth device. '
+                             'smartScan, serviceScan, readVal and writeVal accept several addresses '
+                             '(separated by spaces) and run against each device in parallel.')
+
+    parser.add_argument('--addrFile', metavar='addrFile', type=str, nargs=1,
+                        required=False, action='store', default=[None],
+                        help='\033[1m<smartScan, serviceScan, readVal, writeVal>\033[0m '
+                             'File containing target Bluetooth addresses, one per line. '
+                             'Used in addition to any addresses supplied with --addr.')
+
+    parser.add_argument('--workers', metavar='workers', default=[None],
+                        type=int, nargs=1,
+                        required=False, action='store',
+                        help='\033[1m<smartScan, serviceScan, readVal, writeVal>\033[0m '
+                             'Maximum number of devices worked on at once when several addresses '
+                             'are supplied. (Default: number of adapters * --adapterConnections)')
 
     parser.add_argument('--handles', metavar='handles', type=str, nargs="+",
                         required=False, action='store', default=[None],
@@ -105,6 +334,19 @@ def parseCommand():
                              'Hexadecimal handel list of characteristics to access (ex: 005a 006b). If '
                              'you want to access the value of a characteristic, use the handle_value '
                              'value from the service scan.')
+    parser.add_argument('--handleRange', metavar='handleRange', type=checkHandleRange, nargs=1,
+                        required=False, action='store', default=[None],
+                        help='\033[1m<readVal>\033[0m '
+                             'Read every attribute between two hexadecimal handles (ex: 0001:ffff) over one '
+                             'connection, printing one line per attribute found. The attributes present are '
+                             'discovered first where possible; otherwise every handle is tried until '
+                             '--sweepGap handles in a row are missing. Reads are pipelined (see --window). '
+                             'Replaces --handles and --uuids.')
+    parser.add_argument('--sweepGap', metavar='sweepGap', type=int, nargs=1,
+                        required=False, action='store', default=[64],
+                        help='\033[1m<readVal>\033[0m '
+                             'Number of missing handles after the last attribute found at which a '
+                             '--handleRange sweep without attribute discovery stops. (Default: 64)')
     parser.add_argument('--uuids', metavar='uuids', type=str, nargs="+",
                         required=False, action='store', default=[None],
                         help='\033[1m<readVal>\033[0m '
@@ -131,6 +373,108 @@ def parseCommand():
                          'of a file sent. (Default: EOF)')
 
 
+    parser.add_argument('--mutators', metavar='mutators', type=str, nargs="+",
+                        required=False, action='store', default=['seeds', 'bitflip', 'length'],
+                        choices=['seeds', 'bitflip', 'length', 'random'],
+                        help='\033[1m<fuzz>\033[0m '
+                             'Payload generators run over the seeds, in order: seeds (the seeds and a dictionary '
+                             'of boundary values), bitflip (every single bit flip), length (lengths around MTU '
+                             'and attribute size limits), random (endless random mutations, stop with '
+                             '--fuzzCases or Ctrl-C). (Default: seeds bitflip length)')
+
+    parser.add_argument('--fuzzCases', metavar='fuzzCases', default=[None],
+                        type=int, nargs=1, required=False, action='store',
+                        help='\033[1m<fuzz>\033[0m '
+                             'Stop after this many payloads. (Default: every payload the mutators generate)')
+
+    parser.add_argument('--fuzzSeed', metavar='fuzzSeed', default=[None],
+                        type=int, nargs=1, required=False, action='store',
+                        help='\033[1m<fuzz>\033[0m '
+                             'Seed for the random mutator, to repeat a run. (Default: a new seed each run)')
+
+    parser.add_argument('--crashDir', metavar='crashDir', default=["crashes"],
+                        type=str, nargs=1, required=False, action='store',
+                        help='\033[1m<fuzz>\033[0m '
+                             'Directory minimized crashing payloads are saved to. (Default: crashes)')
+
+    parser.add_argument('--minimizeTries', metavar='minimizeTries', default=[64],
+                        type=int, nargs=1, required=False, action='store',
+                        help='\033[1m<fuzz>\033[0m '
+                             'Maximum number of replays spent shrinking each crashing payload (0 saves it as '
+                             'generated). (Default: 64)')
+
+    parser.add_argument('--recoveryTimeout', metavar='recoveryTimeout', default=[FUZZ_RECOVERY_TIMEOUT],
+                        type=float, nargs=1, required=False, action='store',
+                        help='\033[1m<fuzz>\033[0m '
+                             'Time (in seconds) to wait for a crashed device to answer again before the crash '
+                             'is saved as it is and fuzzing stops. (Default: 30)')
+
+    parser.add_argument('--cached', action='store_true',
+                        help='\033[1m<serviceScan, smartScan, readVal>\033[0m '
+                             'Use a previously cached device structure if it has not expired and the '
+                             'device\'s Database Hash has not changed. New scan results are cached. '
+                             'For readVal, read --uuids directly from the handles they previously '
+                             'resolved to (falling back to a read by UUID if that fails).')
+
+    parser.add_argument('--refresh', action='store_true',
+                        help='\033[1m<serviceScan, smartScan, readVal>\033[0m '
+                             'Ignore any cached device structure (or UUID handles), rescan the device '
+                             'and update the cache.')
+
+    parser.add_argument('--incremental', action='store_true',
+                        help='\033[1m<serviceScan, smartScan>\033[0m '
+                             'Rescan the device against its cached structure (even if expired), which is '
+                             'returned as it is when the device\'s Database Hash has not changed. Otherwise '
+                             'only the services in the handle ranges of a Service Changed indication are '
+                             'discovered (and read) again, or the whole device when none is indicated. '
+                             'Devices only indicate Service Changed to bonded clients, so with --security low '
+                             'any change leads to a full rescan. '
+                             'Services, characteristics and descriptors added, removed or changed since the '
+                             'last scan are reported. New scan results are cached.')
+
+    parser.add_argument('--cacheTTL', metavar='cacheTTL', default=[None],
+                        type=int, nargs=1,
+                        required=False, action='store',
+                        help='\033[1m<serviceScan, smartScan>\033[0m '
+                             'Time (seconds) a cached device structure remains valid. (Default: 86400 seconds)')
+
+    parser.add_argument('--history', action='store_true',
+                        help='\033[1m<leScan, serviceScan, smartScan>\033[0m '
+                             'Record the devices seen (with advertising data and RSSI when known) and the '
+                             'GATT tables discovered in the history database (see --historyFile, query).')
+
+    parser.add_argument('--historyFile', metavar='historyFile', default=[None],
+                        type=str, nargs=1, required=False, action='store',
+                        help='\033[1m<leScan, serviceScan, smartScan, query>\033[0m '
+                             'History database written by --history and searched by query. '
+                             '(Default: ~/.bleSuite/history.db)')
+
+    parser.add_argument('--since', metavar='since', default=[None],
+                        type=str, nargs=1, required=False, action='store',
+                        help='\033[1m<query>\033[0m '
+                             'Only devices seen at or after this time: a duration before now (ex: 12h, 7d) or a '
+                             'date (YYYY-MM-DD [HH:MM[:SS]]).')
+
+    parser.add_argument('--until', metavar='until', default=[None],
+                        type=str, nargs=1, required=False, action='store',
+                        help='\033[1m<query>\033[0m '
+                             'Only devices seen at or before this time (same format as --since).')
+
+    parser.add_argument('--services', metavar='services', default=[],
+                        type=str, nargs="+", required=False, action='store',
+                        help='\033[1m<query>\033[0m '
+                             'Only devices that exposed all of these service UUIDs in a recorded scan.')
+
+    parser.add_argument('--characteristics', metavar='characteristics', default=[],
+                        type=str, nargs="+", required=False, action='store',
+                        help='\033[1m<query>\033[0m '
+                             'Only devices that exposed all of these characteristic UUIDs in a recorded scan.')
+
+    parser.add_argument('--limit', metavar='limit', default=[None],
+                        type=int, nargs=1, required=False, action='store',
+                        help='\033[1m<query>\033[0m '
+                             'Maximum number of devices listed.')
+
     parser.add_argument('--addrType', metavar='addrType', type=str, nargs=1,
                     required=False, action='store', default=['public'], choices=addressTypeChoices,
                     help='\033[1m<all commands>\033[0m '
@@ -141,24 +485,778 @@ def parseCommand():
                     help='\033[1m<all commands>\033[0m '
                          'Level of security for connection to BLE device [low | medium | high]')
 
+    parser.add_argument('--socket', metavar='socket', default=[None],
+                        type=str, nargs=1, required=False, action='store',
+                        help='\033[1m<all commands>\033[0m '
+                             'Unix domain socket the daemon listens on and commands are forwarded to. '
+                             '(Default: ~/.bleSuite/daemon.sock)')
+
+    parser.add_argument('--noDaemon', action='store_true',
+                        help='\033[1m<all commands>\033[0m '
+                             'Run the command in this process even if a daemon is running.')
+
+    parser.add_argument('--idleTimeout', metavar='idleTimeout', default=[None],
+                        type=float, nargs=1, required=False, action='store',
+                        help='\033[1m<daemon>\033[0m '
+                             'Time (seconds) the daemon keeps an unused device connection open. (Default: 300)')
+
+    parser.add_argument('--stats', action='store_true',
+                        help='\033[1m<all commands>\033[0m '
+                             'Print connect, read/write, async completion and adapter wait latencies '
+                             '(mean, min, p50, p90, p99, max) and retry/timeout counters to stderr once the '
+                             'command finishes. The daemon runs one --stats request at a time and also counts '
+                             'operations of requests without --stats running alongside it.')
+
+    parser.add_argument('--statsFile', metavar='statsFile', type=str, nargs=1,
+                        required=False, action='store', default=[None],
+                        help='\033[1m<all commands>\033[0m '
+                             'Write the statistics collected for --stats (including the raw histogram '
+                             'buckets) to a JSON file.')
+
     parser.add_argument('--version', action='version', version='%(prog)s ' + __version__)
 
     parser.add_argument('--debug', action='store_true', help='\033[1m<all commands>\033[0m '
                                                              'Enable logging for debug statements.')
 
-    return parser.parse_args()
+    return parser.parse_args(argv)
+
+def getGATTCache(args):
+    """
+    Build the GATT cache requested by the --cached/--refresh/--incremental options.
+
+    :param args: parser.parse_args()
+    :return: GATTCache or None if caching was not requested
+    """
+    if not (args.cached or args.refresh or args.incremental):
+        return None
+    from gattCache import GATTCache, DEFAULT_TTL
+    return GATTCache(ttl=args.cacheTTL[0] if args.cacheTTL[0] is not None else DEFAULT_TTL)
+
+def getUUIDHandleCache(args, addresses):
+    """
+    Build the UUID to handle cache requested by the --cached/--refresh options.
+
+    :param args: parser.parse_args()
+    :param addresses: Addresses the command will run against
+    :return: UUIDHandleCache or None if caching was not requested
+    """
+    if not (args.cached or args.refresh):
+        return None
+    from uuidHandleCache import UUIDHandleCache
+    handleCache = UUIDHandleCache()
+    if args.refresh:
+        for address in addresses:
+            for UUID in args.uuids:
+                if UUID is not None:
+                    handleCache.discard(address, args.addrType[0], UUID)
+    return handleCache
+
+def getValueLengthCache(command, args):
+    """
+    Build the cache of value lengths Read Multiple requests are sized from, unless
+    the command reads nothing singly or --noBatch disables batching.
+
+    :param command: Command being run
+    :param args: parser.parse_args()
+    :return: ValueLengthCache or None
+    """
+    if command != 'readVal' or args.async or args.noBatch or args.handleRange[0] is not None:
+        return None
+    from valueLengthCache import ValueLengthCache
+    return ValueLengthCache()
+
+def getMaxWindow(args, window):
+    """
+    Size an --adaptiveWindow may grow to.
+
+    :param args: parser.parse_args()
+    :param window: Starting window size (None when writes are not windowed)
+    :return: maximum window size, or None when the window does not grow
+    """
+    if not args.adaptiveWindow or window is None:
+        return None
+    if args.maxWindow[0] is not None:
+        return args.maxWindow[0]
+    return window * ADAPTIVE_WINDOW_GROWTH
+
+def getHistoryStore(args, required=False):
+    """
+    Open the history database requested by the --history option.
+
+    :param args: parser.parse_args()
+    :param required: Open it even without --history (query). Default: False
+    :return: HistoryStore or None if recording was not requested
+    """
+    if not (args.history or required):
+        return None
+    from historyStore import HistoryStore, DEFAULT_HISTORY_PATH
+    return HistoryStore(args.historyFile[0] if args.historyFile[0] is not None else DEFAULT_HISTORY_PATH)
+
+def getAdapters(args):
+    """
+    Collect the adapters supplied with --adapter, expanding 'all' to every
+    local HCI controller.
+
+    :param args: parser.parse_args()
+    :return: list of adapter names
+    :rtype: list of str
+    """
+    if 'all' in args.adapter:
+        adapters = listAdapters()
+        if not adapters:
+            raise ValueError("No local Bluetooth adapters were found.")
+        return adapters
+    return args.adapter
+
+def getAddresses(args):
+    """
+    Collect the target addresses supplied with --addr and --addrFile.
+
+    :param args: parser.parse_args()
+    :return: list of addresses ([None] if no address was supplied)
+    :rtype: list of str
+    """
+    addresses = list(args.addr) if args.addr is not None else []
+    if args.addrFile[0] is not None:
+        addresses.extend(checkValidBTAddr(address) for address in readAddressFile(args.addrFile[0]))
+    if not addresses:
+        return [None]
+    return addresses
+
+def getRetryPolicy(args):
+    """
+    Build the RetryPolicy requested by --maxTries/--retryBackoff.
+
+    :param args: parser.parse_args()
+    :return: RetryPolicy
+    """
+    from retryEngine import RetryPolicy, DEFAULT_BASE_DELAY
+    baseDelay = args.retryBackoff[0] if args.retryBackoff[0] is not None else DEFAULT_BASE_DELAY
+    return RetryPolicy(args.maxTries[0], baseDelay)
+
+def getSocketPath(args):
+    """
+    :param args: parser.parse_args()
+    :return: the daemon socket selected with --socket
+    """
+    from daemonProtocol import DEFAULT_SOCKET_PATH
+    return args.socket[0] if args.socket[0] is not None else DEFAULT_SOCKET_PATH
+
+def progressPrinter(args, address):
+    """
+    Build the function that reports a smart scan's progress on stderr. Progress is
+    only shown for text output to a terminal, on a single line shared by every
+    device being scanned (see ProgressLine).
+
+    :param args: parser.parse_args()
+    :param address: Device being scanned
+    :return: function called with (reads finished, total reads), or None
+    """
+    if args.output[0] != 'text' or not sys.stderr.isatty():
+        return None
+
+    def onProgress(finished, total):
+        _progressLine.update(address, "%s: read %d/%d attributes" % (address, finished, total), finished == total)
+    return onProgress
+
+def runDeviceCommand(command, args, address, adapter, gattCache=None, handleCache=None, onResult=None,
+                     engine=None, lengthCache=None):
+    """
+    Run a command that targets a single device without printing its results.
+
+    :param command: smartScan, serviceScan, readVal, writeVal or fuzz
+    :param args: parser.parse_args()
+    :param address: Address of target BTLE device
+    :param adapter: Host adapter to connect through
+    :param gattCache: GATTCache for scans (None disables)
+    :param handleCache: UUIDHandleCache for readVal (None disables)
+    :param onResult: Function called with (kind, result) for each readVal/writeVal result (or fuzz crash,
+    or change found by an incremental scan) as it is produced
+    :param engine: RetryEngine of an open (ie pooled) connection to use instead of connecting
+    :param lengthCache: ValueLengthCache for batched readVal (None keeps lengths in memory)
+    :return: device structure for scans, otherwise the (empty when onResult is supplied) result lists
+    """
+    from cmdLineToolWrappers import bleServiceRead, bleServiceReadAsync, bleServiceWrite, bleServiceWriteAsync, \
+        bleServiceWriteNoResponse, bleHandleSweep, bleServiceScan, bleRunSmartScan, bleFuzzWrite, SWEEP_WINDOW, \
+        SMART_SCAN_WINDOW
+    #changes found by incremental scans are written as results of their own
+    onChange = (lambda change: onResult('change', change)) if onResult is not None else None
+    if command == 'smartScan':
+        return bleRunSmartScan(address, adapter,
+                               args.addrType[0], args.security[0],
+                               gattCache, args.refresh, printStructure=False, engine=engine,
+                               maxTries=args.maxTries[0], timeout=args.asyncTimeout[0],
+                               window=args.window[0] if args.window[0] is not None else SMART_SCAN_WINDOW,
+                               onProgress=progressPrinter(args, address), retryPolicy=getRetryPolicy(args),
+                               pipelined=not args.serial, resume=args.resume, incremental=args.incremental,
+                               onChange=onChange)
+
+    if command == 'serviceScan':
+        return bleServiceScan(address, adapter,
+                              args.addrType[0], args.security[0],
+                              gattCache, args.refresh, printStructure=False, engine=engine,
+                              maxTries=args.maxTries[0], retryPolicy=getRetryPolicy(args),
+                              pipelined=not args.serial, resume=args.resume, incremental=args.incremental,
+                              onChange=onChange)
+
+    retryPolicy = getRetryPolicy(args)
+
+    if command == 'readVal':
+        if args.handleRange[0] is not None:
+            start, end = args.handleRange[0]
+            return bleHandleSweep(address, adapter,
+                                  args.addrType[0], args.security[0], start, end,
+                                  args.maxTries[0], args.asyncTimeout[0],
+                                  args.window[0] if args.window[0] is not None else SWEEP_WINDOW,
+                                  args.sweepGap[0], onResult, retryPolicy, engine)
+        if args.async:
+            return bleServiceReadAsync(address, adapter,
+                                       args.addrType[0], args.security[0],
+                                       args.handles, args.uuids,
+                                       args.maxTries[0], args.asyncTimeout[0],
+                                       handleCache, onResult, retryPolicy, engine)
+        return bleServiceRead(address, adapter,
+                              args.addrType[0], args.security[0],
+                              args.handles, args.uuids, args.maxTries[0],
+                              handleCache, onResult, retryPolicy, engine, not args.noBatch, lengthCache)
+
+    if command == 'writeVal':
+        if args.data != [None]:
+            dataSet = args.data
+        else:
+            logger.debug("Payload Delimiter: %s", args.payloadDelimiter[0])
+            #payloads are read from the files as they are written, not up front
+            dataSet = filePayloads(args.files, args.payloadDelimiter[0])
+        if args.noResponse:
+            logger.debug("Write Without Response")
+            return bleServiceWriteNoResponse(address, adapter,
+                                             args.addrType[0], args.security[0],
+                                             args.handles, dataSet, args.maxTries[0],
+                                             args.asyncTimeout[0], args.credits[0], True,
+                                             onResult, retryPolicy, engine)
+        if args.async:
+            logger.debug("Async Write")
+            return bleServiceWriteAsync(address, adapter,
+                                        args.addrType[0], args.security[0],
+                                        args.handles, dataSet, args.maxTries[0],
+                                        args.asyncTimeout[0], args.window[0], args.adaptiveWindow,
+                                        onResult, retryPolicy, engine,
+                                        getMaxWindow(args, args.window[0]))
+        logger.debug("Sync Write")
+        return bleServiceWrite(address, adapter,
+                               args.addrType[0], args.security[0],
+                               args.handles, dataSet, args.maxTries[0], onResult, retryPolicy, engine)
+
+    if command == 'fuzz':
+        import itertools
+        import random
+        from payloadMutators import fuzzPayloads
+        handles = [handle for handle in args.handles if handle is not None]
+        if not handles:
+            raise ValueError("Please specify the handle(s) to fuzz with --handles.")
+        if args.data != [None]:
+            seeds = args.data
+        elif args.files != [None]:
+            seeds = list(filePayloads(args.files, args.payloadDelimiter[0]))
+        else:
+            seeds = []
+        payloads = fuzzPayloads(seeds, args.mutators,
+                                random.Random(args.fuzzSeed[0]) if args.fuzzSeed[0] is not None else None)
+        if args.fuzzCases[0] is not None:
+            payloads = itertools.islice(payloads, args.fuzzCases[0])
+
+        def onCrash(kind, crash):
+            onResult(kind, (crash, saveFuzzCrash(args.crashDir[0], address, crash)))
+        window = args.window[0] if args.window[0] is not None else FUZZ_WINDOW
+        return bleFuzzWrite(address, adapter, args.addrType[0], args.security[0], handles, payloads,
+                            args.maxTries[0], args.asyncTimeout[0], window, args.adaptiveWindow,
+                            args.minimizeTries[0], onCrash if onResult is not None else None, retryPolicy, engine,
+                            args.recoveryTimeout[0], getMaxWindow(args, window))
+
+def saveFuzzCrash(crashDir, address, crash):
+    """
+    Save a crashing fuzz payload, named after the device, handle and payload hash.
+
+    :param crashDir: Directory to save the payload in (created if needed)
+    :param address: Address of the device that crashed
+    :param crash: FuzzCrash
+    :return: path of the saved payload (None if there was no payload to save)
+    """
+    import errno
+    import hashlib
+    if crash.payload is None:
+        return None
+    #devices fuzzed side by side save to the same directory
+    try:
+        os.makedirs(crashDir)
+    except OSError as e:
+        if e.errno != errno.EEXIST:
+            raise
+    name = "%s-%s-%s%s.bin" % (address.replace(":", ""), crash.handle or "unknown",
+                               hashlib.sha1(crash.payload).hexdigest()[:12], "" if crash.reproduced else "-unconfirmed")
+    path = os.path.join(crashDir, name)
+    with open(path, 'wb') as f:
+        f.write(crash.payload)
+    return path
 
-def processArgs(args):
+def _formatHandle(handle, raw=False):
+    """
+    Format a handle as 0x0000.
+
+    :param handle: Handle as an int or hex string or, when raw, two big-endian bytes
+    :param raw: Whether a str handle was resolved by a read by UUID (see handleToInt). Default: False
+    """
+    if handle is None:
+        return None
+    from uuidHandleCache import handleToInt
+    try:
+        return format(handleToInt(handle, raw), "#06x")
+    except (TypeError, ValueError):
+        return str(handle)
+
+def _responseData(command, args, value):
+    """
+    Split a wrapper's data field into (output, error).
+    """
+    if command == 'writeVal' and args.noResponse:
+        #Write Commands have no response, only confirmed writes are reported
+        return value, None
+    if args.async:
+        #if value[0] is a string, it means our cmdLineToolWrapper removed the GattResponse object
+        #due to an error or timeout, else we grab the GattResponse and its response data
+        if isinstance(value[0], str):
+            return None, value[0]
+        return value[1].received(), None
+    if value == -1:
+        return None, "Invalid handle"
+    if value == -2:
+        return None, "Attribute can't be read" if command == 'readVal' else "Attribute can't be written to"
+    return value, None
+
+def resultRecord(command, args, address, kind, result):
+    """
+    Convert a result tuple produced by a read/write wrapper into an output record.
+
+    :param command: readVal, writeVal, fuzz, serviceScan or smartScan
+    :param args: parser.parse_args()
+    :param address: Address of the device the result came from
+    :param kind: handle, uuid, sweep or change
+    :param result: Result tuple produced by the wrapper
+    :return: output record
+    :rtype: dict
+    """
+    record = {'device': address, 'command': command}
+    if kind == 'change':
+        record.update({'kind': kind, 'change': result['change'], 'attribute': result['attribute'],
+                       'handle': _formatHandle(result['handle']), 'uuid': result['uuid'],
+                       'previousUuid': result['previousUuid']})
+        return record
+    if kind == 'sweep':
+        handle, uuid, data = result
+        isError = not isinstance(data, list)
+        record.update({'handle': "0x" + handle, 'uuid': uuid, 'output': None if isError else data,
+                       'error': data if isError else None})
+        return record
+    if command == 'fuzz':
+        crash, path = result
+        record.update({'handle': "0x" + crash.handle if crash.handle is not None else None,
+                       'input': crash.payload, 'original': crash.original, 'error': crash.reason,
+                       'errorCode': crash.code, 'reproduced': crash.reproduced, 'file': path})
+        return record
+    if command == 'writeVal':
+        record['handle'] = "0x" + result[0]
+        inputVal = result[2]
+        record['input'] = inputVal[0] if isinstance(inputVal, list) else inputVal
+        value = result[1]
+    elif kind == 'uuid':
+        record['uuid'] = result[0]
+        if args.async:
+            value = result[1]
+            record['handle'] = _formatHandle(result[2], raw=True) if len(result) > 2 else None
+        else:
+            record['handle'] = _formatHandle(result[1], raw=True)
+            value = result[2]
+    else:
+        record['handle'] = "0x" + result[0]
+        value = result[1]
+    record['output'], record['error'] = _responseData(command, args, value)
+    return record
+
+def textFormatter(command, multiDevice=False, compact=False):
+    """
+    Build the function that prints a single record in text output mode.
+
+    :param command: Command the records are produced by
+    :param multiDevice: Label each record with the device it came from
+    :param compact: Print readVal records on one line each (handle, UUID, hex and printable value)
+    :type multiDevice: bool
+    :type compact: bool
+    :return: function that prints a record
+    """
+    from bleSuite import utils
+    lastDevice = [None]
+    lastSnapshot = [None]
+
+    def formatRecord(record):
+        #session records carry the kind of step that produced them
+        recordCommand = record['command'] if command == 'session' else command
+        #results from several devices can interleave, so label each run of records from one device
+        if multiDevice and (command in DEVICE_COMMANDS or command == 'session') and \
+                record['device'] != lastDevice[0]:
+            lastDevice[0] = record['device']
+            print "\n======================="
+            print "Device:", record['device']
+            print "======================="
+        if record.get('error') is not None and (recordCommand in SCAN_COMMANDS or
+                                                 (record.get('handle') is None and record.get('uuid') is None)):
+            #errors for a whole device or session step
+            if record.get('step') is not None:
+                print "\nLine %s:" % record['step'],
+            print "Error:", record['error']
+        elif recordCommand == 'leScan' and record.get('kind') == 'new':
+            print("{}\t{}\t{} dBm".format(record['name'] or "Unavailable", record['device'], record['rssiMax']))
+        elif recordCommand == 'leScan' and record.get('kind') == 'snapshot':
+            if record['timestamp'] != lastSnapshot[0]:
+                lastSnapshot[0] = record['timestamp']
+                print "\nSnapshot %s" % time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(record['timestamp']))
+                print "Address\t\t\tSeen\tRSSI min/avg/max\tLast seen\tName"
+            print "%s\t%d\t%d/%.0f/%d\t\t%.0fs ago\t%s" % (record['device'], record['count'], record['rssiMin'],
+                                                        record['rssiAvg'], record['rssiMax'],
+                                                        record['timestamp'] - record['lastSeen'],
+                                                        record['name'] or "Unavailable")
+        elif recordCommand == 'leScan':
+            print("{}\t{}".format(record['name'] or "Unavailable", record['device']))
+        elif recordCommand == 'query':
+            print "%s\t%s\t%s\t%s\t%d\t%s" % (record['device'], record['addressType'] or "-",
+                                               record['adapters'] or "-",
+                                               time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(record['lastSeen'])),
+                                               record['count'], record['name'] or "Unavailable")
+        elif recordCommand in SCAN_COMMANDS and record.get('kind') == 'change':
+            print "%s %s %s %s%s" % (record['change'].capitalize(), record['attribute'], record['handle'],
+                                     record['uuid'], " (was %s)" % record['previousUuid']
+                                     if record['change'] == 'changed' and record['previousUuid'] != record['uuid']
+                                     else "")
+        elif recordCommand == 'smartScan':
+            from cmdLineToolWrappers import printSmartScanResults
+            printSmartScanResults(record['output'])
+        elif recordCommand == 'serviceScan':
+            record['output'].printDeviceStructure()
+        elif recordCommand == 'readVal' and compact:
+            if record['error'] is not None:
+                print "%s\t%s\tError: %s" % (record['handle'], record.get('uuid') or "-", record['error'])
+            else:
+                value = "".join(record['output'] or [])
+                print "%s\t%s\t%s\t%s" % (record['handle'], record.get('uuid') or "-", value.encode('hex'),
+                                         "".join(c if " " <= c <= "~" else "." for c in value))
+        elif recordCommand == 'readVal':
+            if record.get('uuid') is not None:
+                print "\nUUID:", record['uuid']
+                if record.get('handle') is not None:
+                    print "Handle:", record['handle']
+            else:
+                print "\nHandle:", record['handle']
+            if record['error'] is not None:
+                utils.printHelper.printDataAndHex([record['error']], False)
+            else:
+                utils.printHelper.printDataAndHex(record['output'], False)
+        elif recordCommand == 'writeVal':
+            print "\nHandle:", record['handle']
+            print "Input:"
+            utils.printHelper.printDataAndHex([record['input']], False, prefix="\t")
+            print "Output:"
+            if record['error'] is not None:
+                utils.printHelper.printDataAndHex([record['error']], False, prefix="\t")
+            else:
+                utils.printHelper.printDataAndHex(record['output'], False, prefix="\t")
+        elif recordCommand == 'fuzz':
+            print "\n%s crash on Handle: %s" % ("Reproduced" if record['reproduced'] else "Unconfirmed",
+                                                record['handle'] or "unknown")
+            print "Reason:", record['error']
+            if record['file'] is not None:
+                print "Saved to:", record['file']
+            utils.printHelper.printDataAndHex([record['input']], False)
+        elif recordCommand in ('exportCapture', 'subscribe'):
+            print "\n%s on Handle" % record['kind'].capitalize()
+            print "======================="
+            print "%.6f" % record['timestamp'], record['handle']
+            utils.printHelper.printDataAndHex([record['payload']], False)
+    return formatRecord
+
+def createResultSink(command, args, multiDevice=False):
+    """
+    Create the output sink selected with --output/--out for a command.
+
+    :param command: Command the results are produced by
+    :param args: parser.parse_args()
+    :param multiDevice: Whether results from several devices are written to the sink
+    :type multiDevice: bool
+    :return: OutputSink
+    """
+    if command == 'exportCapture':
+        fields = CAPTURE_FIELDS
+    elif command == 'leScan' and args.continuous:
+        fields = SCAN_FIELDS
+    elif command == 'query':
+        fields = QUERY_FIELDS
+    elif command == 'fuzz':
+        fields = FUZZ_FIELDS
+    elif command in SCAN_COMMANDS and args.incremental:
+        fields = CHANGE_FIELDS
+    elif command in ('session', 'subscribe'):
+        fields = SESSION_FIELDS
+    else:
+        fields = RESULT_FIELDS
+    #the text formatter imports the bleSuite print helpers, so it is only built for text output
+    compact = command == 'readVal' and args.handleRange[0] is not None
+    formatter = textFormatter(command, multiDevice, compact) if args.output[0] == 'text' else None
+    return createSink(args.output[0], fields, formatter, args.out[0], BINARY_FIELDS)
+
+def scanRecord(kind, entry, timestamp):
+    """
+    Output record for a device in a continuous scan.
+
+    :param kind: new (first time the device is seen) or snapshot
+    :param entry: continuousScan.DeviceEntry
+    :param timestamp: Time of the record
+    :rtype: dict
+    """
+    return {'timestamp': timestamp, 'kind': kind, 'device': entry.address, 'addressType': entry.addressType,
+            'name': entry.name, 'firstSeen': entry.firstSeen, 'lastSeen': entry.lastSeen, 'count': entry.count,
+            'rssiMin': entry.rssiMin, 'rssiAvg': round(entry.rssiAvg, 1), 'rssiMax': entry.rssiMax,
+            'payload': entry.data, 'scanResponse': entry.scanResponse}
+
+def runContinuousScan(args, cancelled=None, scanner=None):
+    """
+    leScan --continuous: stream each device as it is first seen, and a snapshot of
+    every device being tracked each --snapshotInterval, until interrupted.
+
+    :param args: parser.parse_args()
+    :param cancelled: threading.Event that ends the scan (daemon requests). Default: None
+    :param scanner: Opened source of advertising reports (None scans with continuousScan.HCIScanner). Default: None
+    :return: number of devices seen
+    """
+    from continuousScan import HCIScanner, DeviceTable
+    table = DeviceTable(args.maxDevices[0], args.staleAfter[0])
+    interval = args.snapshotInterval[0]
+    adapter = getAdapters(args)[0]
+    sink = createResultSink('leScan', args)
+    history = getHistoryStore(args)
+    if scanner is None:
+        scanner = HCIScanner(adapter, not args.passive)
+        scanner.open()
+    seen = 0
+    lastSnapshot = [0]
+
+    def record(entry):
+        if history is not None:
+            history.recordSighting(entry.address, entry.addressType, adapter, entry.name, int(round(entry.rssiAvg)),
+                                   entry.data, entry.scanResponse, entry.lastSeen)
+
+    def snapshot(now):
+        table.evict(now)
+        for entry in table:
+            sink.write(scanRecord('snapshot', entry, now))
+            #one sighting per device per snapshot keeps the history compact; devices silent since the last are skipped
+            if entry.lastSeen > lastSnapshot[0]:
+                record(entry)
+        lastSnapshot[0] = now
+        sink.flush()
+
+    try:
+        nextSnapshot = time.time() + interval
+        try:
+            for report in scanner.reports(cancelled):
+                now = time.time()
+                if report is not None:
+                    entry, isNew = table.update(report)
+                    if isNew:
+                        seen += 1
+                        sink.write(scanRecord('new', entry, now))
+                        sink.flush()
+                        record(entry)
+                if interval and now >= nextSnapshot:
+                    snapshot(now)
+                    nextSnapshot = now + interval
+        except KeyboardInterrupt:
+            pass
+        snapshot(time.time())
+        logger.debug("Continuous scan saw %d devices, %d evicted" % (seen, table.evicted))
+    finally:
+        scanner.close()
+        sink.close()
+        if history is not None:
+            history.close()
+    return seen
+
+def runSessionCommand(args, pool=None, stdin=None):
+    """
+    Run the --script steps over a persistent connection to each device.
+
+    :param args: parser.parse_args()
+    :param pool: ConnectionPool to take connections from (None opens and closes them here). Default: None
+    :param stdin: Script lines read when --script is - (Default: sys.stdin)
+    :return: number of failed steps
+    """
+    from sessionRunner import DeviceSession, readSteps, runSession
+    from captureFile import monotonic, KIND_NAMES
+    addresses = getAddresses(args)
+    if addresses == [None]:
+        raise ValueError("Please specify the device(s) to run the session against with --addr or --addrFile.")
+    stdin = stdin if stdin is not None else sys.stdin
+    script = stdin if args.script[0] == "-" else open(args.script[0], 'r')
+    steps = readSteps(script)
+    if len(addresses) > 1:
+        #every device runs the whole script, so it can not be consumed as a stream
+        steps = list(steps)
+    retryPolicy = getRetryPolicy(args)
+    scheduler = AdapterScheduler(getAdapters(args), args.adapterConnections[0])
+    sink = createResultSink('session', args, len(addresses) > 1)
+
+    def deviceTask(address):
+        def onResult(step, kind, result):
+            record = resultRecord(SESSION_STEP_COMMANDS[step.command], args, address, kind, result)
+            record['step'] = step.line
+            sink.write(record)
+
+        def onEvent(step, kind, handle, data, timestamp):
+            sink.write({'device': address, 'command': 'subscribe', 'step': step.line,
+                        'timestamp': time.time() - (monotonic() - timestamp), 'handle': _formatHandle(handle),
+                        'kind': KIND_NAMES.get(kind, kind), 'payload': data})
+
+        def onError(step, error):
+            sink.write({'device': address, 'command': step.command if step is not None else 'session',
+                        'step': step.line if step is not None else getattr(error, 'line', None),
+                        'error': str(error),
+                        'errorCode': getattr(error, 'code', None)})
+
+        def run(adapter):
+            if pool is not None:
+                with pool.lease(address, adapter, args.addrType[0], args.security[0], retryPolicy) as deviceSession:
+                    return runSession(deviceSession, steps, onResult, onEvent, onError, args.async,
+                                      args.asyncTimeout[0])
+            deviceSession = DeviceSession(address, adapter, args.addrType[0], args.security[0], retryPolicy)
+            try:
+                return runSession(deviceSession, steps, onResult, onEvent, onError, args.async,
+                                  args.asyncTimeout[0])
+            finally:
+                deviceSession.close()
+        return scheduler.run(run)
+
+    failed = 0
+    try:
+        if len(addresses) == 1:
+            failed = deviceTask(addresses[0])
+        else:
+            workers = args.workers[0] if args.workers[0] is not None else scheduler.capacity
+            for address, result, error in runForDevices(addresses, deviceTask, workers):
+                if error is not None:
+                    failed += 1
+                    sink.write({'device': address, 'command': 'session', 'error': str(error),
+                                'errorCode': getattr(error, 'code', None)})
+                else:
+                    failed += result
+    finally:
+        sink.close()
+        if script is not stdin:
+            script.close()
+    return failed
+
+def runPooledSubscribe(args, pool, cancelled):
+    """
+    subscribe for daemon requests: events are received over a pooled connection and
+    written to the --output sink (or the --record capture file) until the client disconnects.
+
+    :param args: parser.parse_args()
+    :param pool: ConnectionPool to take the connection from
+    :param cancelled: threading.Event set when the client disconnects
+    """
+    from captureFile import monotonic, CaptureWriter, KIND_NAMES
+    address = args.addr[0]
+    writer = CaptureWriter(args.record[0]) if args.record[0] is not None else None
+    sink = createResultSink('subscribe', args) if writer is None else None
+
+    def onEvent(kind, handle, data, timestamp):
+        if writer is not None:
+            writer.write(kind, handle, data, timestamp)
+            return
+        sink.write({'device': address, 'command': 'subscribe',
+                    'timestamp': time.time() - (monotonic() - timestamp), 'handle': _formatHandle(handle),
+                    'kind': KIND_NAMES.get(kind, kind), 'payload': data})
+    try:
+        with pool.lease(address, getAdapters(args)[0], args.addrType[0], args.security[0],
+                        getRetryPolicy(args)) as deviceSession:
+            print "Listening for communications"
+            deviceSession.subscribe(args.handles, onEvent, None, args.mode[0], cancelled)
+    finally:
+        if writer is not None:
+            writer.close()
+        else:
+            sink.close()
+
+def serveDaemon(args):
+    """
+    Run the daemon until interrupted.
+
+    :param args: parser.parse_args()
+    """
+    import threading
+    from connectionPool import ConnectionPool, DEFAULT_IDLE_TIMEOUT
+    from bleDaemon import BLEDaemon
+    socketPath = getSocketPath(args)
+    pool = ConnectionPool(args.idleTimeout[0] if args.idleTimeout[0] is not None else DEFAULT_IDLE_TIMEOUT)
+    statsLock = threading.Lock()
+
+    def runRequest(argv, cwd, stdin, cancelled):
+        requestArgs = parseCommand(argv)
+        if requestArgs.command[0] not in DAEMON_COMMANDS:
+            raise ValueError("%s can not be run by the daemon." % requestArgs.command[0])
+        for name in PATH_ARGUMENTS:
+            values = getattr(requestArgs, name)
+            setattr(requestArgs, name, [os.path.join(cwd, value) if value not in (None, "-") and cwd is not None
+                                        else value for value in values])
+        if not requestArgs.stats and requestArgs.statsFile[0] is None:
+            return runCommand(requestArgs, pool, cancelled, stdin)
+        #statistics are process-wide, so only one request at a time collects them, from a clean slate
+        if not statsLock.acquire(False):
+            raise RuntimeError("Another request is collecting statistics, retry --stats once it finishes.")
+        try:
+            stats.reset()
+            return runCommand(requestArgs, pool, cancelled, stdin)
+        finally:
+            stats.disable()
+            statsLock.release()
+
+    server = BLEDaemon(socketPath, runRequest)
+    print "bleSuite daemon listening on %s" % socketPath
+
+    def terminate(signum, frame):
+        raise KeyboardInterrupt
+    #kill/service managers stop the daemon with SIGTERM, clean up as for Ctrl-C
+    signal.signal(signal.SIGTERM, terminate)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.close()
+        pool.close()
+
+def processArgs(args, pool=None, cancelled=None, stdin=None):
     """
     Process command line tool arguments parsed by argparse
     and call appropriate bleSuite functions.
 
     :param args: parser.parse_args()
-    :return:
+    :param pool: ConnectionPool device commands take their connections from (daemon requests). Default: None
+    :param cancelled: threading.Event set when a daemon client disconnects. Default: None
+    :param stdin: Input used in place of sys.stdin (daemon requests). Default: None
+    :return: exit code (None for success)
     """
     command = args.command[0]
     if args.debug:
         logging.basicConfig(level=logging.DEBUG)
+    #Status messages are left out of structured output so it can be parsed
+    textOutput = args.output[0] == 'text'
 
 
 
@@ -168,184 +1266,165 @@ def processArgs(args):
             print "Please specify an address to spoof."
         else:
             logger.debug("About to spoof to address %s", args.addr[0])
-            ret = bdaddr.bdaddr(args.adapter[0], args.addr[0])
+            ret = bdaddr.bdaddr(getAdapters(args)[0], args.addr[0])
             logger.debug("bdaddr return value: %d", ret)
             if ret == -1:
                 raise ValueError('Spoofing failed. Your device may not be supported.')
 
 
 
-    if command == 'leScan':
-        print "BTLE Scan beginning"
-        devices = bleScan.bleScanMain(args.scanTimeout[0], args.adapter[0])
-        print "Name\tAddress"
-        print "================"
-        for address, name in devices.items():
-            if name == '':
-                name = "Unavailable"
-            print("{}\t{}".format(name, address))
-
-    if command == 'smartScan':
-        print "BTLE Smart Scan beginning"
-        device = bleRunSmartScan(args.addr[0], args.adapter[0],
-                                           args.addrType[0], args.security[0])
-        #print device mac and info from deviceInformationQueryList
+    if command == 'leScan' and args.continuous:
+        if textOutput:
+            print "Continuous BTLE Scan beginning (Ctrl-C to stop)"
+            print "Name\tAddress\tRSSI"
+            print "================"
+        runContinuousScan(args, cancelled)
+    elif command == 'leScan':
+        if textOutput:
+            print "BTLE Scan beginning"
+        from bleSuite import bleScan
+        devices = bleScan.bleScanMain(args.scanTimeout[0], getAdapters(args)[0])
+        sink = createResultSink(command, args)
+        history = getHistoryStore(args)
+        if textOutput:
+            print "Name\tAddress"
+            print "================"
+        try:
+            for address, name in devices.items():
+                sink.write({'device': address, 'command': command, 'name': name})
+                if history is not None:
+                    history.recordSighting(address, adapter=getAdapters(args)[0], name=name)
+        finally:
+            sink.close()
+            if history is not None:
+                history.close()
 
+    if command in DEVICE_COMMANDS:
+        if textOutput:
+            print DEVICE_COMMANDS[command]
+        addresses = getAddresses(args)
+        gattCache = getGATTCache(args)
+        handleCache = getUUIDHandleCache(args, [i for i in addresses if i is not None])
+        lengthCache = getValueLengthCache(command, args)
+        scheduler = AdapterScheduler(getAdapters(args), args.adapterConnections[0])
+        sink = createResultSink(command, args, len(addresses) > 1)
+        history = getHistoryStore(args) if command in SCAN_COMMANDS else None
 
-    if command == 'serviceScan':
-        print "BTLE Scanning Services"
-        bleServiceScan(args.addr[0], args.adapter[0],
-                       args.addrType[0], args.security[0])
+        def deviceTask(address):
+            #results are written to the sink as soon as the wrappers produce them
+            def onResult(kind, result):
+                sink.write(resultRecord(command, args, address, kind, result))
 
-    if command == 'readVal':
-        print "Reading value from handle or UUID"
-        if args.async:
-            uuidData, handleData = bleServiceReadAsync(args.addr[0], args.adapter[0],
-                                                       args.addrType[0], args.security[0],
-                                                       args.handles, args.uuids,
-                                                       args.asyncTimeout[0], args.maxTries[0])
-            for dataTuple in handleData:
-                print "\nHandle:", "0x" + dataTuple[0]
-                #"".join("{:02x}".format(ord(c)) for c in handle)
-                if isinstance(dataTuple[1][0], str):
-                    utils.printHelper.printDataAndHex(dataTuple[1], False)
+            def run(adapter):
+                if pool is None:
+                    results = runDeviceCommand(command, args, address, adapter, gattCache, handleCache, onResult,
+                                               lengthCache=lengthCache)
                 else:
-                    utils.printHelper.printDataAndHex(dataTuple[1][1].received(), False)
-            for dataTuple in uuidData:
-                print "\nUUID:", dataTuple[0]
-                if isinstance(dataTuple[2][0], str):
-                    utils.printHelper.printDataAndHex(dataTuple[1], False)
-                else:
-                    utils.printHelper.printDataAndHex(dataTuple[1][1].received(), False)
-        else:
-            uuidData, handleData = bleServiceRead(args.addr[0], args.adapter[0],
-                                                  args.addrType[0], args.security[0],
-                                                  args.handles, args.uuids, args.maxTries[0])
-            for dataTuple in handleData:
-                print "\nHandle:", "0x" + dataTuple[0]
-                #"".join("{:02x}".format(ord(c)) for c in handle)
-                utils.printHelper.printDataAndHex(dataTuple[1], False)
-            for dataTuple in uuidData:
-                print "\nUUID:", dataTuple[0]
-                utils.printHelper.printDataAndHex(dataTuple[1], False, handle=dataTuple[2])
+                    with pool.lease(address, adapter, args.addrType[0], args.security[0],
+                                    getRetryPolicy(args)) as deviceSession:
+                        results = runDeviceCommand(command, args, address, adapter, gattCache, handleCache,
+                                                   onResult, deviceSession.engine, lengthCache)
+                #the adapter the scan ran on is only known here
+                if history is not None:
+                    history.recordScan(address, args.addrType[0], adapter, command, results)
+                return results
+            start = time.time()
+            results = scheduler.run(run)
+            if command in SCAN_COMMANDS:
+                sink.write({'device': address, 'command': command, 'output': results})
+            elif command == 'fuzz' and textOutput:
+                cases, crashes = results
+                elapsed = time.time() - start
+                print "\n%s: %d cases in %.1f seconds (%.0f cases/sec)" % (address, cases, elapsed,
+                                                                         cases / elapsed if elapsed else 0)
 
-    if command == 'writeVal':
-        print "Writing value to handle"
-        if args.async:
-            logger.debug("Async Write")
-            if args.data != [None]:
-                handleData = bleServiceWriteAsync(args.addr[0], args.adapter[0],
-                                                  args.addrType[0], args.security[0],
-                                                  args.handles, args.data, args.maxTries[0],
-                                                  args.asyncTimeout[0])
-            elif args.payloadDelimiter[0] == 'EOF':
-                logger.debug("Payload Delimiter: EOF")
-                dataSet = []
-                for dataFile in args.files:
-                    if dataFile is None:
-                        continue
-                    logger.debug("Reading file: %s", dataFile)
-                    f = open(dataFile, 'r')
-                    dataSet.append(f.read())
-                    f.close()
-                logger.debug("Sending data set: %s" % dataSet)
-                handleData = bleServiceWriteAsync(args.addr[0], args.adapter[0],
-                                                  args.addrType[0], args.security[0],
-                                                  args.handles, dataSet, args.maxTries[0],
-                                                  args.asyncTimeout[0])
-                logger.debug("Received data: %s" % handleData)
-                '''for dataTuple in handleData:
-                    print "\nHandle:", "0x" + dataTuple[0]
-                    utils.printHelper.printDataAndHex(dataTuple[1], False)'''
-            else:
-                logger.debug("Payload Delimiter: %s", args.payloadDelimiter[0])
-                dataSet = []
-                for dataFile in args.files:
-                    if dataFile is None:
-                        continue
-                    f = open(dataFile, 'r')
-                    data = f.read()
-                    f.close()
-                    data = data.split(args.payloadDelimiter[0])
-                    dataSet.extend(data)
-
-                logger.debug("Sending dataSet: %s" % dataSet)
-
-                handleData = bleServiceWriteAsync(args.addr[0], args.adapter[0],
-                                                  args.addrType[0], args.security[0],
-                                                  args.handles, dataSet, args.maxTries[0],
-                                                  args.asyncTimeout[0])
-            for dataTuple in handleData:
-                print "\nHandle:", "0x" + dataTuple[0]
-                #"".join("{:02x}".format(ord(c)) for c in handle)
-                print "Input:"
-                utils.printHelper.printDataAndHex(dataTuple[2], False, prefix="\t")
-                print "Output:"
-                #if tuple[1][0] is a string, it means our cmdLineToolWrapper removed the GattResponse object
-                #due to a timeout, else we grab the GattResponse and its response data
-                if isinstance(dataTuple[1][0], str):
-                    utils.printHelper.printDataAndHex(dataTuple[1], False, prefix="\t")
-                else:
-                    utils.printHelper.printDataAndHex(dataTuple[1][1].received(), False, prefix="\t")
-        else:
-            logger.debug("Sync Write")
-            if args.data != [None]:
-                #bleServiceWrite(args.deviceAddr[0], args.adapter[0], args.handle[0], args.data[0])
-                handleData = bleServiceWrite(args.addr[0], args.adapter[0],
-                                             args.addrType[0], args.security[0],
-                                             args.handles, args.data, args.maxTries[0])
-
-                '''for dataTuple in handleData:
-                    print "\nHandle:", "0x" + dataTuple[0]
-                    utils.printHelper.printDataAndHex(dataTuple[1], False)'''
-
-            elif args.payloadDelimiter[0] == 'EOF':
-                logger.debug("Payload Delimiter: EOF")
-                dataSet = []
-                for dataFile in args.files:
-                    if dataFile is None:
-                        continue
-                    logger.debug("Reading file: %s", dataFile)
-                    f = open(dataFile, 'r')
-                    dataSet.append(f.read())
-                    f.close()
-                logger.debug("Sending data set: %s" % dataSet)
-                handleData = bleServiceWrite(args.addr[0], args.adapter[0],
-                                             args.addrType[0], args.security[0],
-                                             args.handles, dataSet, args.maxTries[0])
-                logger.debug("Received data: %s" % handleData)
-                '''for dataTuple in handleData:
-                    print "\nHandle:", "0x" + dataTuple[0]
-                    utils.printHelper.printDataAndHex(dataTuple[1], False)'''
+        try:
+            if len(addresses) == 1:
+                deviceTask(addresses[0])
             else:
-                logger.debug("Payload Delimiter: %s", args.payloadDelimiter[0])
-                dataSet = []
-                for dataFile in args.files:
-                    if dataFile is None:
-                        continue
-                    f = open(dataFile, 'r')
-                    data = f.read()
-                    f.close()
-                    data = data.split(args.payloadDelimiter[0])
-                    dataSet.extend(data)
-                logger.debug("Sending dataSet: %s" % dataSet)
-                handleData = bleServiceWrite(args.addr[0], args.adapter[0],
-                                             args.addrType[0], args.security[0],
-                                             args.handles, dataSet, args.maxTries[0])
-            for dataTuple in handleData:
-                print "\nHandle:", "0x" + dataTuple[0]
-                print "Input:"
-                utils.printHelper.printDataAndHex([dataTuple[2]], False, prefix="\t")
-                print "Output:"
-                utils.printHelper.printDataAndHex(dataTuple[1], False, prefix="\t")
-
-    if command == 'subscribe':
+                workers = args.workers[0] if args.workers[0] is not None else scheduler.capacity
+                for address, results, error in runForDevices(addresses, deviceTask, workers):
+                    if error is not None:
+                        sink.write({'device': address, 'command': command, 'error': str(error),
+                                    'errorCode': getattr(error, 'code', None)})
+        finally:
+            sink.close()
+            if history is not None:
+                history.close()
+
+    if command == 'session':
+        #failed steps are reported in the output, the exit code tells scripts whether there were any
+        return 1 if runSessionCommand(args, pool, stdin) > 0 else 0
+
+    if command == 'query':
+        from historyStore import parseTime
+        adapters = [adapter for adapter in args.adapter if adapter]
+        history = getHistoryStore(args, True)
+        sink = createResultSink(command, args)
+        if textOutput:
+            print "Address\t\t\tType\tAdapters\tLast seen\t\tSeen\tName"
+        try:
+            for record in history.devices(args.addr, adapters,
+                                          parseTime(args.since[0]) if args.since[0] is not None else None,
+                                          parseTime(args.until[0]) if args.until[0] is not None else None,
+                                          args.services, args.characteristics, args.limit[0]):
+                sink.write(record)
+        finally:
+            sink.close()
+            history.close()
+
+    if command == 'daemon':
+        serveDaemon(args)
+
+    if command == 'subscribe' and pool is not None:
+        print "Subscribing to device"
+        runPooledSubscribe(args, pool, cancelled)
+    elif command == 'subscribe':
+        from cmdLineToolWrappers import bleHandleSubscribe
         print "Subscribing to device"
-        bleHandleSubscribe(args.addr[0], args.handles, args.adapter[0],
-                           args.addrType[0], args.security[0], args.mode[0])
+        bleHandleSubscribe(args.addr[0], args.handles, getAdapters(args)[0],
+                           args.addrType[0], args.security[0], args.mode[0], args.record[0])
+
+    if command == 'exportCapture':
+        from captureFile import readCapture, KIND_NAMES
+        if args.record[0] is None:
+            raise ValueError("Please specify the capture file to export with --record.")
+        handles = None
+        if args.handles != [None]:
+            handles = set(int(handle, 16) for handle in args.handles)
+        kinds = None
+        if args.captureKind[0] is not None:
+            kinds = set(kind for kind, name in KIND_NAMES.items() if name == args.captureKind[0])
+        sink = createResultSink(command, args)
+        try:
+            for record in readCapture(args.record[0], handles, kinds):
+                sink.write({'timestamp': record.timestamp, 'handle': _formatHandle(record.handle),
+                            'kind': KIND_NAMES.get(record.kind, record.kind), 'payload': record.payload})
+        finally:
+            sink.close()
 
     return
 
+def runCommand(args, pool=None, cancelled=None, stdin=None):
+    """
+    Run a parsed command, collecting and reporting statistics when --stats/--statsFile is given.
+
+    :param args: parser.parse_args()
+    :param pool: See processArgs. Default: None
+    :param cancelled: See processArgs. Default: None
+    :param stdin: See processArgs. Default: None
+    :return: exit code (see processArgs)
+    """
+    if (args.stats or args.statsFile[0] is not None) and not stats.enabled:
+        stats.enable()
+    try:
+        return processArgs(args, pool, cancelled, stdin)
+    finally:
+        if args.stats:
+            stats.printReport()
+        if args.statsFile[0] is not None:
+            stats.export(args.statsFile[0])
+
 def main():
     """
     Main loop for BLESuite command line tool.
@@ -353,8 +1432,17 @@ def main():
     :return:
     """
     args = parseCommand()
-    processArgs(args)
+    if args.command[0] in DAEMON_COMMANDS and not args.noDaemon:
+        #hand the command to a running daemon, which may already be connected to the device
+        from daemonClient import forwardCommand
+        stdin = sys.stdin if args.command[0] == 'session' and args.script[0] == "-" else None
+        code = forwardCommand(sys.argv[1:], getSocketPath(args), stdin)
+        if code is not None:
+            sys.exit(code)
+    code = runCommand(args)
 
     logger.debug("Args: %s" % args)
+    if code:
+        sys.exit(code)
 
 
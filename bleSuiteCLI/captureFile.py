@@ -0,0 +1,198 @@
+import collections
+import ctypes
+import ctypes.util
+import os
+import struct
+import time
+import logging
+
+logger = logging.getLogger(__name__)
+logger.addHandler(logging.NullHandler())
+
+#File layout:
+#   header: MAGIC, then <dd (wall clock time, monotonic time) when the capture started
+#   records: <I body length, then body = <dHB (monotonic time, handle, kind) + payload
+MAGIC = "BLECAP\x00\x01"
+HEADER = struct.Struct("<dd")
+RECORD_LENGTH = struct.Struct("<I")
+RECORD_HEADER = struct.Struct("<dHB")
+
+KIND_NOTIFICATION = 1
+KIND_INDICATION = 2
+KIND_NAMES = {KIND_NOTIFICATION: "notification", KIND_INDICATION: "indication"}
+
+#Default amount of buffered data before it is handed to the OS
+WRITE_BUFFER_SIZE = 1024 * 1024
+#Defaults for how often buffered records are flushed and fsync'd
+SYNC_INTERVAL = 1.0
+SYNC_RECORDS = 4096
+
+CaptureRecord = collections.namedtuple('CaptureRecord', ['timestamp', 'handle', 'kind', 'payload'])
+
+
+class _Timespec(ctypes.Structure):
+    _fields_ = [('tv_sec', ctypes.c_long), ('tv_nsec', ctypes.c_long)]
+
+
+def _loadMonotonic():
+    CLOCK_MONOTONIC = 1
+    try:
+        #find_library runs ldconfig/gcc in a subprocess, so it is only used when the usual soname is missing
+        try:
+            librt = ctypes.CDLL('librt.so.1', use_errno=True)
+        except OSError:
+            librt = ctypes.CDLL(ctypes.util.find_library('rt'), use_errno=True)
+        clockGettime = librt.clock_gettime
+    except (OSError, AttributeError):
+        logger.debug("clock_gettime unavailable, capture timestamps fall back to time.time()")
+        return time.time
+    clockGettime.argtypes = [ctypes.c_int, ctypes.POINTER(_Timespec)]
+
+    def monotonic():
+        t = _Timespec()
+        clockGettime(CLOCK_MONOTONIC, ctypes.byref(t))
+        return t.tv_sec + t.tv_nsec * 1e-9
+    return monotonic
+
+#Python 2 has no time.monotonic
+monotonic = _loadMonotonic()
+
+
+class CaptureWriter(object):
+    """
+    Appends notification/indication records to a binary capture file. Records are
+    packed with struct and written through a large buffer; the file is flushed and
+    fsync'd every syncRecords records or syncInterval seconds, whichever comes first.
+
+    A new file starts with the header. Records appended to an existing capture have
+    their timestamps moved onto the clock in its header (the monotonic clock restarts
+    with the host), and a truncated final record left by an interrupted capture is
+    dropped first so the new records stay readable.
+
+    :param path: Capture file to create or append to
+    :param syncInterval: Maximum time (seconds) between fsyncs. Default: 1.0
+    :param syncRecords: Maximum number of records between fsyncs. Default: 4096
+    :type path: str
+    :type syncInterval: float
+    :type syncRecords: int
+    """
+    def __init__(self, path, syncInterval=SYNC_INTERVAL, syncRecords=SYNC_RECORDS):
+        self.path = path
+        self.syncInterval = syncInterval
+        self.syncRecords = syncRecords
+        self.records = 0
+        #added to each record's timestamp to express it on the header's clock
+        self._offset = 0.0
+        self._f = open(path, 'ab', WRITE_BUFFER_SIZE)
+        try:
+            if os.fstat(self._f.fileno()).st_size == 0:
+                self._f.write(MAGIC + HEADER.pack(time.time(), monotonic()))
+            else:
+                self._resume()
+        except Exception:
+            self._f.close()
+            raise
+        self.sync()
+
+    def _resume(self):
+        with open(self.path, 'rb') as f:
+            if f.read(len(MAGIC)) != MAGIC:
+                raise ValueError("%s is not a bleSuite capture file, refusing to append to it." % self.path)
+            header = f.read(HEADER.size)
+            if len(header) < HEADER.size:
+                raise ValueError("%s has a truncated capture header, refusing to append to it." % self.path)
+            wallStart, monotonicStart = HEADER.unpack(header)
+            end = f.tell()
+            while True:
+                length = f.read(RECORD_LENGTH.size)
+                if len(length) < RECORD_LENGTH.size:
+                    break
+                length, = RECORD_LENGTH.unpack(length)
+                f.seek(length, os.SEEK_CUR)
+                if f.tell() > os.fstat(f.fileno()).st_size:
+                    break
+                end = f.tell()
+        if end < os.fstat(self._f.fileno()).st_size:
+            logger.debug("Dropping truncated record at end of %s" % self.path)
+            self._f.truncate(end)
+        self._offset = (wallStart - monotonicStart) - (time.time() - monotonic())
+
+    def write(self, kind, handle, payload, timestamp=None):
+        """
+        Append a record.
+
+        :param kind: KIND_NOTIFICATION or KIND_INDICATION
+        :param handle: Handle the event originated from
+        :param payload: Raw event data
+        :param timestamp: Monotonic time of the event (Default: now)
+        :type kind: int
+        :type handle: int
+        :type payload: str
+        :type timestamp: float
+        """
+        if timestamp is None:
+            timestamp = monotonic()
+        body = RECORD_HEADER.pack(timestamp - self._offset, handle, kind) + payload
+        self._f.write(RECORD_LENGTH.pack(len(body)) + body)
+        self.records += 1
+        self._unsynced += 1
+        if self._unsynced >= self.syncRecords or timestamp - self._lastSync >= self.syncInterval:
+            self.sync()
+
+    def sync(self):
+        """
+        Flush buffered records and fsync them to disk.
+        """
+        self._f.flush()
+        os.fsync(self._f.fileno())
+        self._unsynced = 0
+        self._lastSync = monotonic()
+
+    def syncIfPending(self):
+        """
+        Sync records written since the last sync (ie once the event stream goes idle).
+        """
+        if self._unsynced:
+            self.sync()
+
+    def close(self):
+        if not self._f.closed:
+            self.sync()
+            self._f.close()
+
+
+def readCapture(path, handles=None, kinds=None):
+    """
+    Generator that decodes a capture file one record at a time. Timestamps
+    are converted to wall clock time using the capture's header. A truncated
+    final record (ie from a capture interrupted mid write) is ignored.
+
+    :param path: Capture file to read
+    :param handles: Only return records from these handles (None returns all)
+    :param kinds: Only return records of these kinds (None returns all)
+    :type path: str
+    :type handles: set of int
+    :type kinds: set of int
+    :return: generator of CaptureRecord
+    """
+    with open(path, 'rb') as f:
+        if f.read(len(MAGIC)) != MAGIC:
+            raise ValueError("%s is not a bleSuite capture file." % path)
+        wallStart, monotonicStart = HEADER.unpack(f.read(HEADER.size))
+        while True:
+            length = f.read(RECORD_LENGTH.size)
+            if len(length) < RECORD_LENGTH.size:
+                return
+            length, = RECORD_LENGTH.unpack(length)
+            body = f.read(length)
+            if len(body) < length:
+                logger.debug("Ignoring truncated record at end of %s" % path)
+                return
+            timestamp, handle, kind = RECORD_HEADER.unpack_from(body)
+            if handles is not None and handle not in handles:
+                continue
+            if kinds is not None and kind not in kinds:
+                continue
+            yield CaptureRecord(wallStart + (timestamp - monotonicStart), handle, kind,
+                                body[RECORD_HEADER.size:])
+
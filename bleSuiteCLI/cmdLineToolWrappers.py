@@ -1,25 +1,342 @@
+import collections
+import struct
 import sys
+import Queue
+import threading
+import time
 from gattlib import GATTRequester
 from bleSuite import bleConnectionManager
 from bleSuite import bleServiceManager
 from bleSuite import bleSmartScan
 from bleSuite import utils
+from gattCache import readDatabaseHash
+from pendingOperations import PendingOperationTable, InFlightWindow
+from uuidHandleCache import handleToInt
+from valueLengthCache import ValueLengthCache
+from gattStructure import GATTDevice, GATTService, GATTCharacteristic, GATTDescriptor, diffDevices
+from scanCheckpoint import ScanCheckpoint, DEFAULT_CHECKPOINT_DIR
+from captureFile import CaptureWriter, monotonic, KIND_NOTIFICATION, KIND_INDICATION, KIND_NAMES
+from operationStats import stats
+from retryEngine import RetryEngine, RetryPolicy, ConnectionSession, BLEOperationError, deviceBreaker, \
+    ERROR_INVALID_HANDLE, ERROR_NOT_PERMITTED, ERROR_INSUFFICIENT_SECURITY, ERROR_DISCONNECTED, ERROR_TIMEOUT, \
+    ERROR_UNKNOWN
+from payloadMutators import minimizePayload
 import logging
 
 logger = logging.getLogger(__name__)
 logger.addHandler(logging.NullHandler())
 
-def bleServiceRead(address, adapter, addressType, securityLevel, handles, UUIDS, maxTries=5):
+#Maximum number of notifications/indications waiting to be printed before new ones are dropped
+NOTIFICATION_QUEUE_SIZE = 4096
+#Interval (seconds) the subscribe listener confirms the link is still up
+LINK_CHECK_INTERVAL = 1.0
+#Queue.get() without a timeout can not be interrupted with Ctrl-C in Python 2
+_BLOCK_TIMEOUT = 60 * 60 * 24 * 365
+#Result stored in place of data for async operations that received no response
+TIMEOUT_MESSAGE = "Error: Timeout reached for action"
+#Characteristic property bit permitting Write Without Response (ATT Write Command)
+PROPERTY_WRITE_WITHOUT_RESPONSE = 0x04
+#Write Commands per batch when the controller's buffer count can not be read
+DEFAULT_WRITE_CREDITS = 8
+#ATT_MTU Read Multiple requests are sized for (gattlib does not expose the negotiated MTU)
+DEFAULT_ATT_MTU = 23
+#Lengths recorded in a ValueLengthCache for handles whose reads are refused, and for those whose
+#value length has changed between reads
+_UNREADABLE = -1
+_VARYING = -2
+#Lengths learned by reads run without a ValueLengthCache
+_valueLengths = ValueLengthCache(None)
+#Addresses that rejected a Read Multiple Variable request
+_noVariableReads = set()
+#Reads outstanding at once during a handle sweep, and the number of missing handles after the last
+#attribute found at which a sweep without attribute discovery stops
+SWEEP_WINDOW = 16
+SWEEP_GAP = 64
+#Messages reported in place of data for reads the device refuses
+_READ_ERROR_MESSAGES = {ERROR_NOT_PERMITTED: "Attribute can't be read",
+                        ERROR_INSUFFICIENT_SECURITY: "Insufficient security to read attribute"}
+#Characteristic property bit permitting reads
+PROPERTY_READ = 0x02
+#Time (in seconds) fuzz waits for a crashed device to answer again
+FUZZ_RECOVERY_TIMEOUT = 30
+#Reads outstanding at once during a pipelined smart scan
+SMART_SCAN_WINDOW = 16
+#Seconds a pipelined smart scan waits for each descriptor read. gattlib does not report refused
+#asynchronous reads, so unreadable descriptors only time out (and are then read synchronously)
+DESCRIPTOR_TIMEOUT = 1
+#Requester methods a smart scan needs to discover the device itself and pipeline its reads
+_SMART_SCAN_DISCOVERY = ['discover_primary', 'discover_characteristics', 'discover_descriptors']
+#Service Changed characteristic, the descriptor configuring its indications and the value enabling them
+SERVICE_CHANGED_UUID = "00002a05-0000-1000-8000-00805f9b34fb"
+CLIENT_CONFIGURATION_UUID = "00002902-0000-1000-8000-00805f9b34fb"
+_ENABLE_INDICATIONS = str(bytearray([02, 00]))
+#Time (in seconds) an incremental scan waits for a Service Changed indication
+SERVICE_CHANGED_WAIT = 1.0
+
+
+class ResultList(list):
+    """
+    List of result tuples returned by the read/write wrappers. When onResult is
+    supplied, each result is passed to onResult(kind, result) as soon as it is
+    produced instead of being stored, so large runs can stream their output.
+
+    :param onResult: Function called with each result (None stores results). Default: None
+    :param kind: Passed to onResult to tell results apart [handle | uuid | sweep]. Default: handle
+    :type kind: str
+    """
+    def __init__(self, onResult=None, kind='handle'):
+        list.__init__(self)
+        self.onResult = onResult
+        self.kind = kind
+
+    def append(self, result):
+        if self.onResult is None:
+            list.append(self, result)
+        else:
+            self.onResult(self.kind, result)
+
+
+#Values the synchronous wrappers return in place of data for errors reported by the device
+_ERROR_DATA = {ERROR_INVALID_HANDLE: -1, ERROR_NOT_PERMITTED: -2}
+
+
+class EventRequester(GATTRequester):
+    """
+    Requester that queues notifications and indications as (kind, handle, data, monotonic time)
+    tuples instead of handling them on the GATT callback thread, and flags disconnects.
+
+    :param events: Queue.Queue events are put on (events are dropped and counted when it is full)
+    :param disconnected: threading.Event set when gattlib reports a disconnect
+    """
+    def __init__(self, events, disconnected, *args):
+        GATTRequester.__init__(self, *args)
+        self.events = events
+        self.disconnected = disconnected
+        self.dropped = 0
+
+    def queueEvent(self, kind, originHandle, data):
+        #Runs on the GATT callback thread, so hand the event off instead of printing here
+        stats.increment(KIND_NAMES[kind])
+        try:
+            self.events.put_nowait((kind, originHandle, data, monotonic()))
+        except Queue.Full:
+            stats.increment(KIND_NAMES[kind] + ".dropped")
+            self.dropped += 1
+
+    def on_notification(self, originHandle, data):
+        self.queueEvent(KIND_NOTIFICATION, originHandle, data)
+
+    def on_indication(self, originHandle, data):
+        self.queueEvent(KIND_INDICATION, originHandle, data)
+
+    def on_disconnect(self, *args):
+        #Only called by gattlib builds that report disconnects; listeners should
+        #also check the link every LINK_CHECK_INTERVAL seconds
+        self.disconnected.set()
+
+
+def _openSession(address, adapter, addressType, securityLevel, maxTries, retryPolicy):
+    """
+    Connect to a device and build the RetryEngine its operations are run through.
+    """
+    connectionManager = bleConnectionManager.BLEConnectionManager(address, adapter, addressType, securityLevel)
+    session = ConnectionSession(connectionManager)
+    session.connect()
+    if retryPolicy is None:
+        retryPolicy = RetryPolicy(maxTries)
+    return RetryEngine(session, retryPolicy, deviceBreaker(address))
+
+
+def _errorData(error):
+    """
+    Value stored in place of data for a failed synchronous operation (see _ERROR_DATA),
+    re-raising errors that should abort the command.
+    """
+    if error.code not in _ERROR_DATA:
+        raise error
+    return _ERROR_DATA[error.code]
+
+
+def _rememberLength(lengths, address, handle, data):
+    """
+    Record the length of a value read from handle in lengths, marking the handle as
+    _VARYING once a read returns a different length, or as _UNREADABLE when the
+    read was refused, so either is kept out of Read Multiple requests.
+    """
+    if data in (-1, -2):
+        lengths.put(address, handle, _UNREADABLE)
+        return
+    if not isinstance(data, list) or not data or not isinstance(data[0], str):
+        return
+    length = len(data[0])
+    if lengths.get(address, handle) not in (None, length, _UNREADABLE):
+        lengths.put(address, handle, _VARYING)
+    else:
+        lengths.put(address, handle, length)
+
+
+def _readMultiple(connectionManager, handles, variable):
+    """
+    Send an ATT Read Multiple (or Read Multiple Variable) request through the
+    connection's requester.
+
+    :return: the response's value list: values concatenated, or each prefixed with its
+    little-endian 2 byte length for Read Multiple Variable
+    """
+    method = 'read_multiple_variable' if variable else 'read_multiple'
+    response = _requesterMethod(connectionManager, method)(handles)
+    return "".join(response) if isinstance(response, list) else response
+
+
+def _readMultipleGroups(lengths, address, handles, mtu, variable):
+    """
+    Lazily split handles into the positions to read with each Read Multiple request.
+    Only handles of known, unchanging length are grouped, and every group has at
+    least two handles, no repeats and a response that fits in the MTU. A handle of
+    unknown length ends the group being built, so it is read singly (and its length
+    learned) before any later position is grouped.
+
+    :return: generator of (last position covered, positions to read together, empty to only read
+    singly up to the position covered)
+    """
+    maxHandles = (mtu - 1) // 2
+    group = []
+    size = 0
+    for index, handle in enumerate(handles):
+        length = lengths.get(address, handle)
+        if length is None:
+            if len(group) > 1:
+                yield group[-1], group
+            group = []
+            size = 0
+            yield index, []
+            continue
+        if length in (_UNREADABLE, _VARYING):
+            continue
+        need = length + (2 if variable else 0)
+        if group and (len(group) >= maxHandles or size + need > mtu - 1 or
+                      any(handles[other] == handle for other in group)):
+            if len(group) > 1:
+                yield group[-1], group
+            group = []
+            size = 0
+        if need <= mtu - 1:
+            group.append(index)
+            size += need
+    if len(group) > 1:
+        yield group[-1], group
+
+
+def _splitReadMultiple(lengths, address, handles, response, variable):
+    """
+    Split a Read Multiple response into per-handle data.
+
+    :return: dict of position in handles: data, omitting values that were truncated
+    """
+    values = {}
+    offset = 0
+    for handle in handles:
+        if variable:
+            if offset + 2 > len(response):
+                break
+            length = ord(response[offset]) | ord(response[offset + 1]) << 8
+            value = response[offset + 2:offset + 2 + length]
+            offset += 2 + length
+            if len(value) < length:
+                #the response was cut at the MTU, but the full length is still worth knowing
+                lengths.put(address, handle, length)
+                break
+        else:
+            length = lengths.get(address, handle)
+            value = response[offset:offset + length]
+            offset += length
+        values[handle] = [value]
+    return values
+
+
+def _readHandlesBatched(engine, address, handles, lengths, mtu=DEFAULT_ATT_MTU):
+    """
+    Read as many handles of known length (see _readMultipleGroups) as possible with
+    Read Multiple Variable requests, or with Read Multiple requests when the
+    requester (or the device) does not support the variable form. Failed requests
+    are not retried, their handles are left to single reads, as are all handles
+    when the requester supports neither (ie gattlib's GATTRequester), which is
+    logged and counted as read.multipleUnsupported.
+
+    :return: generator of (last position in handles covered, dict of position: data for each handle
+    read) after each request. Positions up to the last covered one not in any dict are never batched.
+    """
+    requester = getattr(engine.connectionManager, 'requester', None)
+    variable = hasattr(requester, 'read_multiple_variable') and address not in _noVariableReads
+    if not variable and not hasattr(requester, 'read_multiple'):
+        #gattlib's GATTRequester has neither, so every handle is read singly
+        logger.debug("Requester %s does not support Read Multiple, reading %d handles singly" %
+                     (type(requester).__name__, len(handles)))
+        stats.increment("read.multipleUnsupported")
+        return
+    once = RetryEngine(engine.session, RetryPolicy(0, 0))
+    for covered, group in _readMultipleGroups(lengths, address, handles, mtu, variable):
+        if not group:
+            yield covered, {}
+            continue
+        groupHandles = [handles[index] for index in group]
+        try:
+            response = once.call("read.multiple", _readMultiple, [int(handle, 16) for handle in groupHandles],
+                                 variable)
+        except BLEOperationError as e:
+            logger.debug("Read Multiple of %s failed (%s), reading them singly" % (", ".join(groupHandles), e))
+            stats.increment("read.multipleFallback")
+            if variable and e.code == ERROR_UNKNOWN:
+                #most likely a device without Read Multiple Variable support
+                _noVariableReads.add(address)
+                return
+            yield group[-1], {}
+            continue
+        if not variable and len(response) != sum(lengths.get(address, handle) for handle in groupHandles):
+            logger.debug("Read Multiple response of unexpected length, reading %s singly" % ", ".join(groupHandles))
+            stats.increment("read.multipleFallback")
+            for handle in groupHandles:
+                lengths.put(address, handle, _VARYING)
+            yield group[-1], {}
+            continue
+        values = _splitReadMultiple(lengths, address, groupHandles, response, variable)
+        results = {}
+        for index in group:
+            if handles[index] in values:
+                results[index] = values[handles[index]]
+                _rememberLength(lengths, address, handles[index], results[index])
+        yield group[-1], results
+
+
+def bleServiceRead(address, adapter, addressType, securityLevel, handles, UUIDS, maxTries=5, handleCache=None,
+                   onResult=None, retryPolicy=None, engine=None, batch=True, lengthCache=None):
     """
     Used by command line tool to read data from device by handle
 
+    With batch, handles whose value length is known from earlier reads are grouped
+    into Read Multiple (Variable) requests where the requester supports them, and
+    read singly when a request fails or a value's length is unknown (see
+    _readHandlesBatched). gattlib's GATTRequester does not provide Read Multiple,
+    so batching only takes effect with a requester that does.
+
     :param address: Address of target BTLE device
     :param adapter: Host adapter (Empty string to use host's default adapter)
     :param addressType: Type of address you want to connect to [public | random]
     :param securityLevel: Security level [low | medium | high]
     :param handles: List of handles to read from
     :param UUIDS: List of UUIDs to read from
-    :param maxTries: Maximum number of times to attempt each write operation. Default: 5
+    :param maxTries: Maximum number of times to attempt each read operation. Default: 5
+    :param handleCache: UUIDHandleCache used to read UUIDs by their previously resolved handle,
+    falling back to a read by UUID if the handle read fails (None disables). Default: None
+    :param onResult: Function called with (kind, result) as each result is produced. When supplied,
+    results are not stored in the returned lists. Default: None
+    :param retryPolicy: RetryPolicy for failed operations (None retries maxTries times with the
+    default backoff). Default: None
+    :param engine: RetryEngine of an open connection to run on instead of connecting (the connection
+    is left open). Default: None
+    :param batch: Read several handles per request with Read Multiple. Default: True
+    :param lengthCache: ValueLengthCache the lengths of values read are recorded in and Read Multiple
+    requests are sized from (None keeps them in memory for the life of the process). Default: None
     :type address: str
     :type adapter: str
     :type addressType: str
@@ -27,66 +344,77 @@ def bleServiceRead(address, adapter, addressType, securityLevel, handles, UUIDS,
     :type handles: list of base 10 ints
     :type UUIDS: list of strings
     :type maxTries: int
+    :type handleCache: UUIDHandleCache
+    :type onResult: function
+    :type retryPolicy: RetryPolicy
+    :type engine: RetryEngine
+    :type batch: bool
+    :type lengthCache: ValueLengthCache
     :return: uuidData, handleData
     :rtype: list of (UUID, data) tuples and list of (handle, data) tuples
     """
-    connectionManager = bleConnectionManager.BLEConnectionManager(address, adapter, addressType, securityLevel)
-    connectionManager.connect()
-    uuidData = []
-    handleData = []
-    for handle in handles:
-        if handle is not None:
-            tries = 0
-            while True:
+    if engine is None:
+        engine = _openSession(address, adapter, addressType, securityLevel, maxTries, retryPolicy)
+    uuidData = ResultList(onResult, 'uuid')
+    handleData = ResultList(onResult, 'handle')
+    handles = [handle for handle in handles if handle is not None]
+    lengths = lengthCache if lengthCache is not None else _valueLengths
+
+    def readHandles(start, end, batched):
+        for index in range(start, end):
+            handle = handles[index]
+            if index in batched:
+                data = batched[index]
+            else:
                 try:
-                    if not connectionManager.isConnected():
-                        connectionManager.connect()
-                    data = bleServiceManager.bleServiceReadByHandle(connectionManager, int(handle, 16))
-                    break
-                except RuntimeError as e:
-                    if "Invalid handle" in str(e):
-                        data = -1
-                        break
-                    elif "Attribute can't be read" in str(e):
-                        data = -2
-                        break
-                    else:
-                        if tries >= maxTries:
-                            raise RuntimeError(e)
-                        else:
-                            tries += 1
-                #print "\nHandle:", format(ord(binascii.unhexlify(handle)), "#8x")
-                #printDataAndHex(data, 10)
+                    data = engine.call("read.handle", bleServiceManager.bleServiceReadByHandle, int(handle, 16))
+                except BLEOperationError as e:
+                    data = _errorData(e)
+                    #print "\nHandle:", format(ord(binascii.unhexlify(handle)), "#8x")
+                    #printDataAndHex(data, 10)
+                _rememberLength(lengths, address, handle, data)
             handleData.append((handle, data))
+
+    #results are produced in order, each as soon as the request covering it has been answered
+    readTo = 0
+    if batch and len(handles) > 1:
+        for covered, batched in _readHandlesBatched(engine, address, handles, lengths):
+            readHandles(readTo, covered + 1, batched)
+            readTo = covered + 1
+    readHandles(readTo, len(handles), {})
     for UUID in UUIDS:
         if UUID is not None:
-            tries = 0
-            while True:
-                try:
-                    if not connectionManager.isConnected():
-                        connectionManager.connect()
-                    data, handle = bleServiceManager.bleServiceReadByUUID(connectionManager, UUID)
-                    break
-                except RuntimeError as e:
-                    if "Invalid handle" in str(e):
-                        data = -1
-                        break
-                    elif "Attribute can't be read" in str(e):
-                        data = -2
-                        break
-                    else:
-                        if tries >= maxTries:
-                            raise RuntimeError(e)
-                        else:
-                            tries += 1
+            if handleCache is not None:
+                handle = handleCache.get(address, addressType, UUID)
+                if handle is not None:
+                    try:
+                        data = engine.call("read.cachedHandle", bleServiceManager.bleServiceReadByHandle,
+                                           handleToInt(handle, raw=True))
+                        uuidData.append((UUID, handle, data))
+                        continue
+                    except BLEOperationError as e:
+                        logger.debug("Cached handle read for %s failed (%s), reading by UUID" % (UUID, e))
+                        stats.increment("cache.handleFallback")
+                        handleCache.discard(address, addressType, UUID)
+            try:
+                data, handle = engine.call("read.uuid", bleServiceManager.bleServiceReadByUUID, UUID)
+                if handleCache is not None:
+                    handleCache.put(address, addressType, UUID, handle)
+            except BLEOperationError as e:
+                data = _errorData(e)
+                handle = None
             #print "\nUUID:", UUID
             #printDataAndHex(data, 10)
             uuidData.append((UUID, handle, data))
+    if handleCache is not None:
+        handleCache.save()
+    lengths.save()
     #returns list of tuples (handle, data)
     return uuidData, handleData
 
 
-def bleServiceReadAsync(address, adapter, addressType, securityLevel, handles, UUIDS, maxTries=5, timeout=5):
+def bleServiceReadAsync(address, adapter, addressType, securityLevel, handles, UUIDS, maxTries=5, timeout=5,
+                        handleCache=None, onResult=None, retryPolicy=None, engine=None):
     """
     Used by command line tool to read data from device by handle using the async
     method. As of now, errors are not returned when reading asynchronously, so a
@@ -100,8 +428,16 @@ def bleServiceReadAsync(address, adapter, addressType, securityLevel, handles, U
     :param securityLevel: Security level [low | medium | high]
     :param handles: List of handles to read from
     :param UUIDS: List of UUIDs to read from
-    :param maxTries: Maximum number of times to attempt each write operation. Default: 5
+    :param maxTries: Maximum number of times to attempt each read operation. Default: 5
     :param timeout: Time (in seconds) until each read times out if there's an issue. Default: 5
+    :param handleCache: UUIDHandleCache used to read UUIDs by their previously resolved handle,
+    falling back to a read by UUID if the handle read fails (None disables). Default: None
+    :param onResult: Function called with (kind, result) as each result is produced. When supplied,
+    results are not stored in the returned lists. Default: None
+    :param retryPolicy: RetryPolicy for requests that fail to send (None retries maxTries times with
+    the default backoff). Default: None
+    :param engine: RetryEngine of an open connection to run on instead of connecting (the connection
+    is left open). Default: None
     :type address: str
     :type adapter: str
     :type addressType: str
@@ -110,114 +446,222 @@ def bleServiceReadAsync(address, adapter, addressType, securityLevel, handles, U
     :type UUIDS: list of strings
     :type maxTries: int
     :type timeout: int
+    :type handleCache: UUIDHandleCache
+    :type onResult: function
+    :type retryPolicy: RetryPolicy
+    :type engine: RetryEngine
     :return: uuidData, handleData
     :rtype: list of (UUID, data) tuples and list of (handle, data) tuples
     """
-    import time
-
-    def asyncHandleCallback(data):
-        #print "\nHandle:", "0x" + handle
-        #"".join("{:02x}".format(ord(c)) for c in handle)
-        logger.debug("Raw callback data: %s" % data)
-        utils.printHelper.printDataAndHex([data], False)
     logger.debug("Creating connection manager")
-    connectionManager = bleConnectionManager.BLEConnectionManager(address, adapter, addressType, securityLevel)
-    #connectionManager.createResponse(responseFunction=asyncHandleCallback)
-    #connectionManager.createResponse()
-    connectionManager.connect()
+    if engine is None:
+        engine = _openSession(address, adapter, addressType, securityLevel, maxTries, retryPolicy)
     logger.debug("Connected")
-    uuidResponses = []
-    handleResponses = []
+    uuidResponses = ResultList(onResult, 'uuid')
+    handleResponses = ResultList(onResult, 'handle')
+    errorMessages = {ERROR_INVALID_HANDLE: "Invalid handle", ERROR_NOT_PERMITTED: "Attribute can't be read"}
 
-    handleResponseQueue = []
-    uuidResponseQueue = []
+    pendingOperations = PendingOperationTable()
     for handle in handles:
         if handle is not None:
-            tries = 0
-            while True:
-                try:
-                    if not connectionManager.isConnected():
-                        connectionManager.connect()
-                    resp = bleServiceManager.bleServiceReadByHandleAsync(connectionManager, int(handle, 16), None)
-                    handleResponseQueue.append((handle, resp, time.time()))
-                    break
-                except RuntimeError as e:
-                        if "Invalid handle" in str(e):
-                            handleResponses.append((handle, ["Invalid handle"]))
-                            break
-                        elif "Attribute can't" in str(e):
-                            handleResponses.append((handle, ["Attribute can't be read"]))
-                            break
-                        else:
-                            if tries >= maxTries:
-                                logger.debug("%s Tries exceeded, throwing Runtime error and aborting write" % maxTries)
-                                raise RuntimeError(e)
-                            else:
-                                logger.debug("Error: %s Trying Again" % e)
-                                tries += 1
+            opId = pendingOperations.reserve()
+            try:
+                resp = engine.call("send.read.handle", bleServiceManager.bleServiceReadByHandleAsync, int(handle, 16),
+                                   pendingOperations.completionCallback(opId))
+            except BLEOperationError as e:
+                if e.code not in errorMessages:
+                    raise
+                handleResponses.append((handle, [errorMessages[e.code]]))
+                continue
+            pendingOperations.add(opId, handle, resp, timeout)
+
+    def readUUID(UUID):
+        opId = pendingOperations.reserve()
+        try:
+            resp = engine.call("send.read.uuid", bleServiceManager.bleServiceReadByUUIDAsync, UUID)
+        except BLEOperationError as e:
+            if e.code not in errorMessages:
+                raise
+            uuidResponses.append((UUID, ["Invalid UUID" if e.code == ERROR_INVALID_HANDLE else
+                                         errorMessages[e.code]]))
+            return
+        #read by UUID does not take a response function, so the table checks these for data
+        pendingOperations.add(opId, UUID, resp, timeout, context=(UUID, None), hooked=False)
+
+    def readCachedHandle(UUID, handle):
+        opId = pendingOperations.reserve()
+        try:
+            resp = engine.call("send.read.cachedHandle", bleServiceManager.bleServiceReadByHandleAsync,
+                               handleToInt(handle, raw=True), pendingOperations.completionCallback(opId))
+        except BLEOperationError as e:
+            logger.debug("Cached handle read for %s failed (%s), reading by UUID" % (UUID, e))
+            stats.increment("cache.handleFallback")
+            handleCache.discard(address, addressType, UUID)
+            return False
+        pendingOperations.add(opId, UUID, resp, timeout, context=(UUID, handle))
+        return True
+
     for UUID in UUIDS:
         if UUID is not None:
-            tries = 0
-            while True:
-                try:
-                    if not connectionManager.isConnected():
-                        connectionManager.connect()
-                    resp = bleServiceManager.bleServiceReadByUUIDAsync(connectionManager, UUID)
-                    uuidResponseQueue.append((UUID, resp, time.time()))
-                    break
-                except RuntimeError as e:
-                        if "Invalid handle" in str(e):
-                            uuidResponses.append((UUID, ["Invalid UUID"]))
-                            break
-                        elif "Attribute can't" in str(e):
-                            uuidResponses.append((UUID, ["Attribute can't be read"]))
-                            break
-                        else:
-                            if tries >= maxTries:
-                                logger.debug("%s Tries exceeded, throwing Runtime error and aborting write" % maxTries)
-                                raise RuntimeError(e)
-                            else:
-                                logger.debug("Error: %s Trying Again" % e)
-                                tries += 1
+            if handleCache is not None:
+                cachedHandle = handleCache.get(address, addressType, UUID)
+                if cachedHandle is not None and readCachedHandle(UUID, cachedHandle):
+                    continue
+            readUUID(UUID)
     #returns list of tuples (handle, data)
-    while True:
-        for i in handleResponseQueue:
-            if i[1][1].received():
-                data = i[1][1].received()
-                logger.debug("Handle: %s Received data: %s" % (i[0], data))
-                handleResponses.append((i[0], i[1]))
-                handleResponseQueue.remove(i)
-            elif time.time() - i[2] >= timeout:
-                handleResponses.append((i[0], ["Error: Timeout reached for action"]))
-                handleResponseQueue.remove(i)
-            logger.debug("Response creation time: %s current time: %s" % (i[2], time.time()))
-                #utils.printHelper.printDataAndHex()
-                #handleResponses.remove(i)
-                #connectionManager.responses.remove(i[1])
-            #if not i.is_alive():
-            #    handleThreads.remove(i)
-        for i in uuidResponseQueue:
-            if i[1][1].received():
-                data = i[1][1].received()
-                handle = data[:2][::-1]
-                data = data[2:]
-                logger.debug("UUID: %s HANDLE: %s Received data: %s" % (i[0], handle, data))
-                uuidResponses.append((i[0], i[1], handle))
-                uuidResponseQueue.remove(i)
-            elif time.time() - i[2] >= timeout:
-                uuidResponses.append((i[0], ["Error: Timeout reached for action"]))
-                uuidResponseQueue.remove(i)
-            logger.debug("Response creation time: %s current time: %s" % (i[2], time.time()))
-        if len(handleResponseQueue) <= 0 and len(uuidResponseQueue) <= 0:
-            logger.debug("Out of responses")
-            break
-        logger.debug("Number of responses that haven't received: %s" % (len(handleResponseQueue) + len(uuidResponseQueue)))
-        time.sleep(0.1)
+    for op in pendingOperations.drain():
+        isUUID = op.context is not None
+        if isUUID:
+            cachedHandle = op.context[1]
+        if not isUUID:
+            operation = "async.read.handle"
+        else:
+            operation = "async.read.uuid" if cachedHandle is None else "async.read.cachedHandle"
+        if op.timedOut:
+            logger.debug("%s: %s timed out" % ("UUID" if isUUID else "Handle", op.key))
+            stats.increment(operation + ".timeout")
+            if isUUID and cachedHandle is not None:
+                #fall back to a read by UUID, the drain picks up the new request
+                handleCache.discard(address, addressType, op.key)
+                readUUID(op.key)
+            elif isUUID:
+                uuidResponses.append((op.key, [TIMEOUT_MESSAGE]))
+            else:
+                handleResponses.append((op.key, [TIMEOUT_MESSAGE]))
+            continue
+        stats.record(operation, op.latency)
+        if isUUID and cachedHandle is not None:
+            logger.debug("UUID: %s Cached HANDLE: %s Received data: %s" % (op.key, cachedHandle, op.received()))
+            uuidResponses.append((op.key, op.response, cachedHandle))
+        elif isUUID:
+            data = op.received()
+            handle = data[:2][::-1]
+            logger.debug("UUID: %s HANDLE: %s Received data: %s" % (op.key, handle, data[2:]))
+            if handleCache is not None:
+                handleCache.put(address, addressType, op.key, handle)
+            uuidResponses.append((op.key, op.response, handle))
+        else:
+            logger.debug("Handle: %s Received data: %s" % (op.key, op.received()))
+            handleResponses.append((op.key, op.response))
+    if handleCache is not None:
+        handleCache.save()
 
     return uuidResponses, handleResponses
 
 
-def bleServiceWrite(address, adapter, addressType, securityLevel, handles, inputs, maxTries=5):
+def _discoverAttributes(connectionManager, start, end):
+    """
+    Every attribute between start and end (ATT Find Information), as dicts with
+    handle and uuid keys.
+    """
+    return _requesterMethod(connectionManager, 'discover_descriptors')(start, end)
+
+
+def bleHandleSweep(address, adapter, addressType, securityLevel, start, end, maxTries=5, timeout=5,
+                   window=SWEEP_WINDOW, gap=SWEEP_GAP, onResult=None, retryPolicy=None, engine=None):
+    """
+    Used by command line tool to read every attribute in a handle range over a
+    single connection.
+
+    Where the requester supports it, the attributes present are discovered first
+    (ATT Find Information) and only those are read. Otherwise every handle is tried,
+    stopping once gap handles in a row past the last attribute found do not exist.
+    Reads are pipelined, at most window at once, and each result is produced as
+    its response arrives. Handles that do not exist are not reported.
+
+    :param address: Address of target BTLE device
+    :param adapter: Host adapter (Empty string to use host's default adapter)
+    :param addressType: Type of address you want to connect to [public | random]
+    :param securityLevel: Security level [low | medium | high]
+    :param start: First handle of the range
+    :param end: Last handle of the range
+    :param maxTries: Maximum number of times to attempt sending each read. Default: 5
+    :param timeout: Time (in seconds) until each read times out. Default: 5
+    :param window: Maximum number of outstanding reads. Default: 16
+    :param gap: Number of missing handles after the last attribute found at which a sweep without
+    discovery stops. Default: 64
+    :param onResult: Function called with (kind, result) as each result is produced. When supplied,
+    results are not stored in the returned lists. Default: None
+    :param retryPolicy: RetryPolicy for requests that fail to send (None retries maxTries times with
+    the default backoff). Default: None
+    :param engine: RetryEngine of an open connection to run on instead of connecting (the connection
+    is left open). Default: None
+    :type address: str
+    :type adapter: str
+    :type addressType: str
+    :type securityLevel: str
+    :type start: int
+    :type end: int
+    :type maxTries: int
+    :type timeout: int
+    :type window: int
+    :type gap: int
+    :type onResult: function
+    :type retryPolicy: RetryPolicy
+    :type engine: RetryEngine
+    :return: list of (handle, uuid, data) tuples, where uuid is None unless attributes were discovered
+    and data is the list of values read or an error message
+    :rtype: list of (str, str, list) tuples
+    """
+    if not 1 <= start <= end <= 0xffff:
+        raise ValueError("%04x:%04x is not a valid handle range. Please use 0001:ffff or a part of it"
+                         % (start, end))
+    if engine is None:
+        engine = _openSession(address, adapter, addressType, securityLevel, maxTries, retryPolicy)
+    results = ResultList(onResult, 'sweep')
+
+    attributes = None
+    if hasattr(getattr(engine.connectionManager, 'requester', None), 'discover_descriptors'):
+        try:
+            attributes = sorted((attribute['handle'], attribute['uuid']) for attribute in
+                                engine.call("discover.attributes", _discoverAttributes, start, end))
+            logger.debug("Discovered %d attributes between %04x and %04x" % (len(attributes), start, end))
+        except BLEOperationError as e:
+            logger.debug("Attribute discovery failed (%s), trying every handle" % e)
+    candidates = attributes if attributes is not None else ((handle, None) for handle in xrange(start, end + 1))
+
+    pendingOperations = PendingOperationTable()
+    inFlight = InFlightWindow(window)
+    #highest handle known to hold an attribute
+    lastFound = [start - 1]
+
+    def collect(finished):
+        for op in finished:
+            handle, uuid = op.context
+            if op.timedOut:
+                stats.increment("async.read.sweep.timeout")
+                results.append(("%04x" % handle, uuid, TIMEOUT_MESSAGE))
+            else:
+                stats.record("async.read.sweep", op.latency)
+                lastFound[0] = max(lastFound[0], handle)
+                results.append(("%04x" % handle, uuid, op.received()))
+
+    for handle, uuid in candidates:
+        if attributes is None and handle - lastFound[0] > gap:
+            logger.debug("No attributes in the %d handles after %04x, stopping" % (gap, lastFound[0]))
+            break
+        while not inFlight.hasRoom(len(pendingOperations)):
+            collect(pendingOperations.waitCompleted())
+        opId = pendingOperations.reserve()
+        try:
+            resp = engine.call("send.read.sweep", bleServiceManager.bleServiceReadByHandleAsync, handle,
+                               pendingOperations.completionCallback(opId))
+        except BLEOperationError as e:
+            if e.code == ERROR_INVALID_HANDLE:
+                continue
+            if e.code not in _READ_ERROR_MESSAGES:
+                raise
+            lastFound[0] = max(lastFound[0], handle)
+            results.append(("%04x" % handle, uuid, _READ_ERROR_MESSAGES[e.code]))
+            continue
+        pendingOperations.add(opId, handle, resp, timeout, context=(handle, uuid))
+    for op in pendingOperations.drain():
+        collect([op])
+    return results
+
+
+def bleServiceWrite(address, adapter, addressType, securityLevel, handles, inputs, maxTries=5, onResult=None,
+                    retryPolicy=None, engine=None):
     """
     Used by command line tool to wrtie data to a device handle
 
@@ -228,6 +672,12 @@ def bleServiceWrite(address, adapter, addressType, securityLevel, handles, input
     :param handles: List of handles to write to
     :param inputs: List of strings to write to handles
     :param maxTries: Maximum number of times to attempt each write operation. Default: 5
+    :param onResult: Function called with (kind, result) as each result is produced. When supplied,
+    results are not stored in the returned lists. Default: None
+    :param retryPolicy: RetryPolicy for failed operations (None retries maxTries times with the
+    default backoff). Default: None
+    :param engine: RetryEngine of an open connection to run on instead of connecting (the connection
+    is left open). Default: None
     :type address: str
     :type adapter: str
     :type addressType: str
@@ -235,41 +685,29 @@ def bleServiceWrite(address, adapter, addressType, securityLevel, handles, input
     :type handles: list of base 10 ints
     :type inputs: list of strings
     :type maxTries: int
+    :type onResult: function
+    :type retryPolicy: RetryPolicy
+    :type engine: RetryEngine
     :return: list of (handle, data, input)
     :rtype: list of tuples (int, str, str)
     """
-    connectionManager = bleConnectionManager.BLEConnectionManager(address, adapter, addressType, securityLevel)
-    connectionManager.connect()
+    if engine is None:
+        engine = _openSession(address, adapter, addressType, securityLevel, maxTries, retryPolicy)
     #print "Input:",input
-    handleData = []
+    handleData = ResultList(onResult, 'handle')
     for inputVal in inputs:
         for handle in handles:
             if handle is not None:
-                tries = 0
-                while True:
-                    try:
-                        if not connectionManager.isConnected():
-                            connectionManager.connect()
-                        data = bleServiceManager.bleServiceWriteToHandle(connectionManager, int(handle, 16), inputVal)
-                        break
-                    except RuntimeError as e:
-                        if "Invalid handle" in str(e):
-                            data = -1
-                            break
-                        elif "Attribute can't" in str(e):
-                            data = -2
-                            break
-                        else:
-                            if tries >= maxTries:
-                                logger.debug("%s Tries exceeded, throwing Runtime error and aborting write" % maxTries)
-                                raise RuntimeError(e)
-                            else:
-                                logger.debug("Error: %s Trying Again" % e)
-                                tries += 1
+                try:
+                    data = engine.call("write", bleServiceManager.bleServiceWriteToHandle, int(handle, 16), inputVal)
+                except BLEOperationError as e:
+                    data = _errorData(e)
                 handleData.append((handle, data, inputVal))
     return handleData
 
-def bleServiceWriteAsync(address, adapter, addressType, securityLevel, handles, inputs, maxTries=5, timeout=5):
+def bleServiceWriteAsync(address, adapter, addressType, securityLevel, handles, inputs, maxTries=5, timeout=5,
+                         window=None, adaptiveWindow=False, onResult=None, retryPolicy=None, engine=None,
+                         maxWindow=None):
     """
     Used by command line tool to write data to device by handle using the async
     method. As of now, errors are not returned when reading asynchronously, so a
@@ -277,6 +715,10 @@ def bleServiceWriteAsync(address, adapter, addressType, securityLevel, handles,
     from a device. (Note: This call is blocking until responses are received or a timeout
     is reached).
 
+    When a window is supplied, at most that many writes are outstanding at once and
+    a new write is sent as each one completes or times out. An adaptive window starts
+    at window and grows up to maxWindow while writes are answered.
+
     :param address: Address of target BTLE device
     :param adapter: Host adapter (Empty string to use host's default adapter)
     :param addressType: Type of address you want to connect to [public | random]
@@ -285,6 +727,15 @@ def bleServiceWriteAsync(address, adapter, addressType, securityLevel, handles,
     :param inputs: List of input strings to send
     :param maxTries: Maximum number of times to attempt each write operation. Default: 5
     :param timeout: Time (in seconds) until each read times out if there's an issue. Default: 5
+    :param window: Maximum number of outstanding writes (None sends every write at once). Default: None
+    :param adaptiveWindow: Grow the window on success and shrink it on timeout or disconnect. Default: False
+    :param onResult: Function called with (kind, result) as each result is produced. When supplied,
+    results are not stored in the returned lists. Default: None
+    :param retryPolicy: RetryPolicy for requests that fail to send (None retries maxTries times with
+    the default backoff). Default: None
+    :param engine: RetryEngine of an open connection to run on instead of connecting (the connection
+    is left open). Default: None
+    :param maxWindow: Largest size an adaptive window grows to (None never grows past window). Default: None
     :type address: str
     :type adapter: str
     :type addressType: str
@@ -293,81 +744,451 @@ def bleServiceWriteAsync(address, adapter, addressType, securityLevel, handles,
     :type inputs: list of str
     :type maxTries: int
     :type timeout: int
+    :type window: int
+    :type adaptiveWindow: bool
+    :type onResult: function
+    :type retryPolicy: RetryPolicy
+    :type engine: RetryEngine
+    :type maxWindow: int
     :return: list of (handle, data, inputVal) tuples
     :rtype: list of (int, str, str) tuples
     """
-    import time
-
-    def asyncHandleCallback(data):
-        #print "\nHandle:", "0x" + handle
-        #"".join("{:02x}".format(ord(c)) for c in handle)
-        logger.debug("Raw callback data: %s" % data)
-        utils.printHelper.printDataAndHex([data], False)
     logger.debug("Creating connection manager")
-    connectionManager = bleConnectionManager.BLEConnectionManager(address, adapter, addressType, securityLevel)
-    #connectionManager.createResponse(responseFunction=asyncHandleCallback)
-    #connectionManager.createResponse()
-    connectionManager.connect()
+    if engine is None:
+        engine = _openSession(address, adapter, addressType, securityLevel, maxTries, retryPolicy)
     logger.debug("Connected")
-    handleResponses = []
+    handleResponses = ResultList(onResult, 'handle')
+    errorMessages = {ERROR_INVALID_HANDLE: "Invalid handle", ERROR_NOT_PERMITTED: "Attribute can't be written to"}
 
-    handleResponseQueue = []
+    pendingOperations = PendingOperationTable()
+    inFlight = InFlightWindow(window, adaptiveWindow, maxSize=maxWindow) if window is not None else None
+
+    def collect(finished):
+        for op in finished:
+            if op.timedOut:
+                stats.increment("async.write.timeout")
+                if inFlight is not None:
+                    inFlight.onFailure()
+                handleResponses.append((op.key, [TIMEOUT_MESSAGE], op.context))
+            else:
+                stats.record("async.write", op.latency)
+                if inFlight is not None:
+                    inFlight.onSuccess()
+                logger.debug("Handle: %s Received data: %s" % (op.key, op.received()))
+                handleResponses.append((op.key, op.response, op.context))
 
     for inputVal in inputs:
         for handle in handles:
             if handle is not None:
-                while True:
-                    tries = 0
-                    try:
-                        if not connectionManager.isConnected():
-                            connectionManager.connect()
-                        logger.debug("Attempting to send %s to handle %s" % (inputVal, handle))
-                        resp = bleServiceManager.bleServiceWriteToHandleAsync(connectionManager, int(handle, 16),
-                                                                              inputVal, None)
-                        handleResponseQueue.append((handle, resp, time.time(), [inputVal]))
-                        break
-                    except RuntimeError as e:
-                        if "Invalid handle" in str(e):
-                            handleResponses.append((handle, ["Invalid handle"], inputVal))
-                            break
-                        elif "Attribute can't" in str(e):
-                            handleResponses.append((handle, ["Attribute can't be written to"], inputVal))
-                            break
-                        else:
-                            if tries >= maxTries:
-                                logger.debug("%s Tries exceeded, throwing Runtime error and aborting write" % maxTries)
-                                raise RuntimeError(e)
-                            else:
-                                logger.debug("Error: %s Trying Again" % e)
-                                tries += 1
+                if inFlight is not None:
+                    while not inFlight.hasRoom(len(pendingOperations)):
+                        collect(pendingOperations.waitCompleted())
+                logger.debug("Attempting to send %s to handle %s" % (inputVal, handle))
+                generation = engine.session.generation
+                opId = pendingOperations.reserve()
+                try:
+                    resp = engine.call("send.write", bleServiceManager.bleServiceWriteToHandleAsync,
+                                       int(handle, 16), inputVal, pendingOperations.completionCallback(opId))
+                except BLEOperationError as e:
+                    if e.code not in errorMessages:
+                        raise
+                    handleResponses.append((handle, [errorMessages[e.code]], inputVal))
+                    continue
+                finally:
+                    #a reconnect while sending means the link is struggling
+                    if inFlight is not None and engine.session.generation != generation:
+                        inFlight.onFailure()
+                pendingOperations.add(opId, handle, resp, timeout, context=[inputVal])
 
     #returns list of tuples (handle, data)
     while True:
-        for i in handleResponseQueue:
-            if i[1][1].received():
-                data = i[1][1].received()
-                logger.debug("Handle: %s Received data: %s" % (i[0], data))
-                handleResponses.append((i[0], i[1], i[3]))
-                handleResponseQueue.remove(i)
-            elif time.time() - i[2] >= timeout:
-                handleResponses.append((i[0], ["Error: Timeout reached for action"], i[3]))
-                handleResponseQueue.remove(i)
-            logger.debug("Response creation time: %s current time: %s" % (i[2], time.time()))
-                #utils.printHelper.printDataAndHex()
-                #handleResponses.remove(i)
-                #connectionManager.responses.remove(i[1])
-            #if not i.is_alive():
-            #    handleThreads.remove(i)
-        if len(handleResponseQueue) <= 0:
-            logger.debug("Out of responses")
+        finished = pendingOperations.waitCompleted()
+        if not finished:
             break
-        logger.debug("Number of responses that haven't received: %s" % len(handleResponseQueue))
-        time.sleep(0.1)
+        collect(finished)
+
+    return handleResponses
+
+
+def _requesterMethod(connectionManager, name):
+    """
+    Method of the connection's GATTRequester that bleServiceManager has no wrapper for.
+    """
+    method = getattr(getattr(connectionManager, 'requester', None), name, None)
+    if method is None:
+        raise ValueError("The connection has no GATTRequester supporting %s (is the installed gattlib too old?)"
+                         % name)
+    return method
+
+
+def _writeCommand(connectionManager, handle, data):
+    """
+    Send an ATT Write Command (Write Without Response) through the connection's requester.
+    """
+    _requesterMethod(connectionManager, 'write_cmd')(handle, data)
+
+
+def _discoverCharacteristics(connectionManager, start, end):
+    """
+    Characteristic declarations between start and end, as dicts with handle,
+    properties, value_handle and uuid keys.
+    """
+    return _requesterMethod(connectionManager, 'discover_characteristics')(start, end)
+
+
+def _characteristicDeclarations(engine, handles):
+    """
+    Find the declaration of the characteristic each value handle belongs to and
+    confirm it permits Write Without Response.
+
+    :return: dict of value handle: declaration handle
+    :raises ValueError: when a handle is not a characteristic value or does not permit Write Without Response
+    """
+    declarations = {}
+    for handle in handles:
+        valueHandle = int(handle, 16)
+        #the declaration immediately precedes its value
+        characteristics = engine.call("discover.characteristics", _discoverCharacteristics,
+                                      max(valueHandle - 1, 1), valueHandle)
+        characteristic = None
+        for candidate in characteristics:
+            if candidate['value_handle'] == valueHandle:
+                characteristic = candidate
+        if characteristic is None:
+            raise ValueError("Handle %s is not a characteristic value handle" % handle)
+        if not characteristic['properties'] & PROPERTY_WRITE_WITHOUT_RESPONSE:
+            raise ValueError("Characteristic at handle %s does not permit Write Without Response (properties 0x%02x)"
+                             % (handle, characteristic['properties']))
+        declarations[handle] = characteristic['handle']
+    return declarations
+
+
+def bleServiceWriteNoResponse(address, adapter, addressType, securityLevel, handles, inputs, maxTries=5, timeout=5,
+                              credits=None, checkProperties=True, onResult=None, retryPolicy=None, engine=None):
+    """
+    Used by command line tool to stream data to device handles with ATT Write Commands
+    (Write Without Response), which the device does not acknowledge, so writes are not
+    limited to one per connection event round trip.
+
+    Writes are sent in batches of credits commands, roughly the number of packets the
+    controller can buffer. Each batch is followed by a read of the characteristic
+    declaration: ATT is ordered on the link, so its response confirms the batch left the
+    controller. One batch is sent while the previous one is being confirmed. Writes whose
+    batch is not confirmed (timeout or disconnect) are sent again, so a value may be
+    written more than once.
+
+    :param address: Address of target BTLE device
+    :param adapter: Host adapter (Empty string to use host's default adapter)
+    :param addressType: Type of address you want to connect to [public | random]
+    :param securityLevel: Security level [low | medium | high]
+    :param handles: List of handles to write to
+    :param inputs: List of strings to write to handles
+    :param maxTries: Maximum number of times to attempt each batch. Default: 5
+    :param timeout: Time (in seconds) to wait for a batch to be confirmed. Default: 5
+    :param credits: Number of writes per batch (None asks the adapter's controller, see
+    adapterScheduler.controllerBuffers). Default: None
+    :param checkProperties: Refuse handles whose characteristic does not permit Write Without Response. Default: True
+    :param onResult: Function called with (kind, result) as each result is produced. When supplied,
+    results are not stored in the returned lists. Default: None
+    :param retryPolicy: RetryPolicy for failed operations (None retries maxTries times with the
+    default backoff). Default: None
+    :param engine: RetryEngine of an open connection to run on instead of connecting (the connection
+    is left open). Default: None
+    :type address: str
+    :type adapter: str
+    :type addressType: str
+    :type securityLevel: str
+    :type handles: list of base 10 ints
+    :type inputs: list of strings
+    :type maxTries: int
+    :type timeout: int
+    :type credits: int
+    :type checkProperties: bool
+    :type onResult: function
+    :type retryPolicy: RetryPolicy
+    :type engine: RetryEngine
+    :return: list of (handle, [], input) for each confirmed write
+    :rtype: list of tuples (int, list, str)
+    """
+    handles = [handle for handle in handles if handle is not None]
+    if not handles:
+        return ResultList(onResult, 'handle')
+    if engine is None:
+        engine = _openSession(address, adapter, addressType, securityLevel, maxTries, retryPolicy)
+    if checkProperties:
+        barrierHandle = _characteristicDeclarations(engine, handles)[handles[0]]
+    else:
+        barrierHandle = max(int(handles[0], 16) - 1, 1)
+    if credits is None:
+        from adapterScheduler import controllerBuffers
+        buffers = controllerBuffers(adapter)
+        credits = buffers[1] if buffers and buffers[1] else DEFAULT_WRITE_CREDITS
+    credits = max(1, credits)
+    logger.debug("Sending Write Commands in batches of %d" % credits)
+    handleResponses = ResultList(onResult, 'handle')
+    #batches sent but not yet confirmed, oldest first: (barrier response event, [(handle, inputVal)])
+    pending = collections.deque()
+    generation = [engine.session.generation]
+
+    def send(handle, inputVal):
+        engine.call("write.command", _writeCommand, int(handle, 16), inputVal)
+
+    def barrier(batch):
+        confirmed = threading.Event()
+        engine.call("write.barrier", bleServiceManager.bleServiceReadByHandleAsync, barrierHandle,
+                    lambda data: confirmed.set())
+        pending.append((confirmed, batch))
 
+    def confirm():
+        for attempt in range(1, maxTries + 2):
+            confirmed, batch = pending[0]
+            waitStart = time.time()
+            arrived = confirmed.wait(timeout)
+            if arrived and engine.session.generation == generation[0]:
+                stats.record("write.confirm", time.time() - waitStart)
+                pending.popleft()
+                for handle, inputVal in batch:
+                    handleResponses.append((handle, [], inputVal))
+                return
+            #the link dropped or stalled under an unconfirmed batch, resend everything after the last confirmation
+            stats.increment("retry.write.batch")
+            unconfirmed = [write for sent in pending for write in sent[1]]
+            pending.clear()
+            logger.debug("Batch not confirmed (attempt %d), resending %d writes" % (attempt, len(unconfirmed)))
+            engine.session.ensureConnected(generation[0], force=not arrived)
+            generation[0] = engine.session.generation
+            for start in range(0, len(unconfirmed), credits):
+                for handle, inputVal in unconfirmed[start:start + credits]:
+                    send(handle, inputVal)
+                barrier(unconfirmed[start:start + credits])
+        raise BLEOperationError(ERROR_TIMEOUT, "Write Commands to %s were not confirmed after %d tries" %
+                                (address, maxTries + 1), maxTries + 1)
+
+    batch = []
+    for inputVal in inputs:
+        for handle in handles:
+            send(handle, inputVal)
+            batch.append((handle, inputVal))
+            if len(batch) >= credits:
+                barrier(batch)
+                batch = []
+                #keep one batch in the controller while the previous one is confirmed
+                while len(pending) > 1:
+                    confirm()
+    if batch:
+        barrier(batch)
+    while pending:
+        confirm()
     return handleResponses
 
 
-def bleHandleSubscribe(address, handles, adapter, addressType, securityLevel, mode):
+class FuzzCrash(object):
+    """
+    A fuzz case after which the device dropped the connection or stopped responding.
+
+    :param handle: Handle the case was written to (None if no suspect case reproduced the crash)
+    :param payload: Minimized payload that still triggers the crash
+    :param original: Payload as it was generated
+    :param reason: Description of how the crash showed itself
+    :param code: ERROR_DISCONNECTED or ERROR_TIMEOUT (or the code of the error that ended the run)
+    :param reproduced: Whether replaying the case on its own crashed the device again
+    :type handle: str
+    :type payload: str
+    :type original: str
+    :type reason: str
+    :type code: str
+    :type reproduced: bool
+    """
+    __slots__ = ('handle', 'payload', 'original', 'reason', 'code', 'reproduced')
+
+    def __init__(self, handle, payload, original, reason, code, reproduced):
+        self.handle = handle
+        self.payload = payload
+        self.original = original
+        self.reason = reason
+        self.code = code
+        self.reproduced = reproduced
+
+
+class _CrashSuspected(Exception):
+    def __init__(self, reason, code):
+        Exception.__init__(self, reason)
+        self.code = code
+
+
+def _deviceAlive(probe, handle):
+    #any ATT response, including an error, shows the device is still running
+    try:
+        probe.call("fuzz.probe", bleServiceManager.bleServiceReadByHandle, int(handle, 16))
+    except BLEOperationError as e:
+        return e.permanent
+    return True
+
+
+def _awaitDevice(engine, probe, handle, recoveryTimeout):
+    """
+    Wait up to recoveryTimeout seconds (probing with the engine's backoff) for a
+    crashed device to answer again, reconnecting as needed.
+    """
+    deadline = time.time() + recoveryTimeout
+    attempt = 0
+    while True:
+        if _deviceAlive(probe, handle):
+            return
+        attempt += 1
+        if time.time() >= deadline:
+            raise BLEOperationError(ERROR_DISCONNECTED, "Device did not recover within %s seconds of a crash"
+                                    % recoveryTimeout, attempt)
+        try:
+            engine.session.ensureConnected(force=True)
+        except RuntimeError as e:
+            logger.debug("Reconnect after crash failed: %s" % e)
+        time.sleep(max(0, min(engine.policy.delay(attempt), deadline - time.time())))
+
+
+def bleFuzzWrite(address, adapter, addressType, securityLevel, handles, payloads, maxTries=5, timeout=5,
+                 window=16, adaptiveWindow=False, minimizeTries=64, onResult=None, retryPolicy=None, engine=None,
+                 recoveryTimeout=FUZZ_RECOVERY_TIMEOUT, maxWindow=None):
+    """
+    Used by command line tool to fuzz handles with generated payloads. Payloads are
+    written through the asynchronous write path with at most window writes outstanding
+    and are consumed from payloads as they are sent, so memory use does not depend on
+    the number of cases.
+
+    A write that times out or a dropped connection is treated as a crash. The cases
+    sent just before it are replayed one at a time (with a synchronous write followed
+    by a read to check the device still answers) until one crashes the device again;
+    that case is minimized by replaying smaller versions of it and reported as a
+    FuzzCrash. Fuzzing then continues with the next case once the device answers again.
+    A device that does not answer within recoveryTimeout seconds ends the run, after
+    the case replayed last (or the last case sent) is reported as it is.
+
+    :param address: Address of target BTLE device
+    :param adapter: Host adapter (Empty string to use host's default adapter)
+    :param addressType: Type of address you want to connect to [public | random]
+    :param securityLevel: Security level [low | medium | high]
+    :param handles: List of handles to write each payload to
+    :param payloads: Iterable of payloads (ie payloadMutators.fuzzPayloads())
+    :param maxTries: Maximum number of attempts to connect to the device. Default: 5
+    :param timeout: Time (in seconds) a write may go unanswered before it counts as a crash. Default: 5
+    :param window: Maximum number of outstanding writes. Default: 16
+    :param adaptiveWindow: Grow the window on success and shrink it on timeout or disconnect. Default: False
+    :param minimizeTries: Maximum number of replays spent minimizing each crash (0 disables). Default: 64
+    :param onResult: Function called with ('crash', FuzzCrash) for each crash as it is found. When supplied,
+    crashes are not stored in the returned list. Default: None
+    :param retryPolicy: RetryPolicy for reconnecting to a crashed device (None retries maxTries times with
+    the default backoff). Default: None
+    :param engine: RetryEngine of an open connection to run on instead of connecting (the connection
+    is left open). Default: None
+    :param recoveryTimeout: Time (in seconds) to wait for a crashed device to answer again. Default: 30
+    :param maxWindow: Largest size an adaptive window grows to (None never grows past window). Default: None
+    :type handles: list of str
+    :type maxTries: int
+    :type timeout: int
+    :type window: int
+    :type minimizeTries: int
+    :type recoveryTimeout: float
+    :type maxWindow: int
+    :return: (number of cases written, list of FuzzCrash)
+    :rtype: (int, list of FuzzCrash)
+    """
+    if engine is None:
+        engine = _openSession(address, adapter, addressType, securityLevel, maxTries, retryPolicy)
+    #Cases are written without retries, so the first failure is noticed instead of the crashing case being
+    #resent, and crashes (what we are looking for) do not trip the device's circuit breaker
+    probe = RetryEngine(engine.session, RetryPolicy(0, 0))
+    crashes = ResultList(onResult, 'crash')
+    #cases written just before a crash (the outstanding window and those answered shortly before)
+    recent = collections.deque(maxlen=2 * (maxWindow or window))
+    #minimized payloads already reported, so a crash found again by later cases is reported once
+    reported = set()
+    state = {'cases': 0, 'generation': engine.session.generation}
+
+    def sent():
+        for payload in payloads:
+            recent.append(payload)
+            state['cases'] += len(handles)
+            stats.increment("fuzz.case", len(handles))
+            yield payload
+    cases = sent()
+
+    def onCase(kind, result):
+        if result[1] == [TIMEOUT_MESSAGE]:
+            raise _CrashSuspected("No response to a write within %s seconds" % timeout, ERROR_TIMEOUT)
+        if engine.session.generation != state['generation']:
+            raise _CrashSuspected("Connection dropped", ERROR_DISCONNECTED)
+
+    def reproduces(handle, payload):
+        _awaitDevice(engine, probe, handle, recoveryTimeout)
+        stats.increment("fuzz.replay")
+        try:
+            probe.call("fuzz.replay", bleServiceManager.bleServiceWriteToHandle, int(handle, 16), payload)
+        except BLEOperationError as e:
+            if not e.permanent:
+                return True
+        return not _deviceAlive(probe, handle)
+
+    def triage(suspects, reason, code):
+        #suspect case replayed last (as generated) and whether its replay crashed the device
+        replayed = {'handle': None, 'payload': suspects[-1] if suspects else None, 'crashed': False}
+
+        def replay(handle, payload, candidate):
+            crashed = reproduces(handle, candidate)
+            replayed.update(handle=handle, payload=payload, crashed=crashed)
+            return crashed
+
+        try:
+            #the case sent last is the most likely culprit
+            for payload in reversed(suspects):
+                for handle in handles:
+                    if replay(handle, payload, payload):
+                        logger.debug("Crash reproduced on handle %s, minimizing %d byte payload" %
+                                     (handle, len(payload)))
+                        minimized, tests = minimizePayload(
+                            payload, lambda candidate: replay(handle, payload, candidate), minimizeTries)
+                        if (handle, minimized) in reported:
+                            stats.increment("fuzz.crash.duplicate")
+                            return
+                        reported.add((handle, minimized))
+                        stats.increment("fuzz.crash")
+                        crashes.append(FuzzCrash(handle, minimized, payload, reason, code, True))
+                        return
+        except BLEOperationError as e:
+            if e.permanent:
+                raise
+            #the device stayed down, which is worth more than the minimized payload: report what is known
+            logger.debug("Device stopped answering during triage: %s" % e)
+            stats.increment("fuzz.crash.unrecovered")
+            crashes.append(FuzzCrash(replayed['handle'], replayed['payload'], replayed['payload'],
+                                     "%s, then %s" % (reason, e), code, replayed['crashed']))
+            raise
+        logger.debug("None of the %d suspect cases reproduced the crash" % len(suspects))
+        stats.increment("fuzz.crash.unconfirmed")
+        last = suspects[-1] if suspects else None
+        crashes.append(FuzzCrash(None, last, last, reason, code, False))
+
+    while True:
+        try:
+            bleServiceWriteAsync(address, adapter, addressType, securityLevel, handles, cases, 1, timeout,
+                                 window, adaptiveWindow, onCase, engine=probe, maxWindow=maxWindow)
+            break
+        except _CrashSuspected as e:
+            reason, code = str(e), e.code
+        except BLEOperationError as e:
+            if e.permanent:
+                raise
+            reason, code = str(e), e.code
+        logger.debug("Suspected crash (%s) after %d cases" % (reason, state['cases']))
+        suspects = list(recent)
+        recent.clear()
+        triage(suspects, reason, code)
+        _awaitDevice(engine, probe, handles[0], recoveryTimeout)
+        state['generation'] = engine.session.generation
+
+    return state['cases'], crashes
+
+
+def bleHandleSubscribe(address, handles, adapter, addressType, securityLevel, mode, recordFile=None):
     """
     Used by command line tool to enable specified handles' notify mode
     and listen until user interrupts.
@@ -379,12 +1200,14 @@ def bleHandleSubscribe(address, handles, adapter, addressType, securityLevel, mo
     :param securityLevel: Security level [low | medium | high]
     :param mode: Mode to set for characteristic configuration (0=off,1=notifications,2=indications,
     3=notifications and inidications)
+    :param recordFile: Capture file to record events to instead of printing them (None prints). Default: None
     :type address: str
     :type handles: list of base 10 ints
     :type adapter: str
     :type addressType: str
     :type securityLevel: str
     :type mode: int
+    :type recordFile: str
     :return:
     """
     logger.debug("Beginning Subscribe Function")
@@ -404,28 +1227,39 @@ def bleHandleSubscribe(address, handles, adapter, addressType, securityLevel, mo
 
 
 
-    class Requester(GATTRequester):
-        def __init__(self, *args):
-            GATTRequester.__init__(self, *args)
-
-        def on_notification(self, originHandle, data):
-            print "\nNotification on Handle"
+    def printEvents(events):
+        while True:
+            event = events.get(True, _BLOCK_TIMEOUT)
+            if event is None:
+                return
+            kind, originHandle, data, timestamp = event
+            print "\n%s on Handle" % ("Notification" if kind == KIND_NOTIFICATION else "Indication")
             print "======================="
             print format(originHandle, "#8x")
             utils.printHelper.printDataAndHex([data], False)
-            #self.wakeup.set()
 
-        def on_indication(self, originHandle, data):
-            print "\nIndication on Handle"
-            print "======================="
-            print format(originHandle, "#8x")
-            utils.printHelper.printDataAndHex([data], False)
-            #self.wakeup.set()
+    def recordEvents(events, writer):
+        #Events are packed straight into the capture file, syncing whenever the stream goes idle
+        try:
+            while True:
+                try:
+                    event = events.get(True, writer.syncInterval)
+                except Queue.Empty:
+                    writer.syncIfPending()
+                    continue
+                if event is None:
+                    return
+                kind, originHandle, data, timestamp = event
+                writer.write(kind, originHandle, data, timestamp)
+        finally:
+            writer.close()
 
     class ReceiveNotification(object):
-        def __init__(self, connectionManager, handles, configVal):
+        def __init__(self, engine, requester, handles, configVal):
             logger.debug("Initializing receiver")
-            self.connectionManager = connectionManager
+            self.engine = engine
+            self.connectionManager = engine.connectionManager
+            self.requester = requester
             self.configVal = configVal
             self.handles = handles
             self.wait_notification()
@@ -434,92 +1268,665 @@ def bleHandleSubscribe(address, handles, adapter, addressType, securityLevel, mo
             logger.debug("Connecting...")
             sys.stdout.flush()
 
-            self.connectionManager.connect()
+            try:
+                #the link may still be reported up after a disconnect, so reconnect regardless
+                self.engine.session.ensureConnected(force=True)
+            except RuntimeError as e:
+                #the configuration writes below keep retrying the connection with backoff
+                logger.debug("Reconnect failed: %s" % e)
             #self.requester.connect(True)
             logger.debug("OK!")
 
         def wait_notification(self):
             print "Listening for communications"
             logger.debug("Listening for communications")
-            #self.received.wait()
+            dropped = 0
             while True:
-                if self.connectionManager.isConnected():
+                #Block until the requester reports a disconnect, confirming the link is still
+                #up every LINK_CHECK_INTERVAL seconds
+                self.requester.disconnected.wait(LINK_CHECK_INTERVAL)
+                if self.requester.dropped != dropped:
+                    dropped = self.requester.dropped
+                    logger.debug("Notification queue full, %s events dropped so far" % dropped)
+                if not self.requester.disconnected.is_set() and self.connectionManager.isConnected():
                     continue
+                self.requester.disconnected.clear()
                 logger.debug("Connection Lost, re-connecting subscribe")
-                self.connectionManager.connect()
+                self.connect()
                 for i in self.handles:
-                    bleServiceManager.bleServiceWriteToHandle(connectionManager, int(i, 16), self.configVal)
+                    try:
+                        self.engine.call("write", bleServiceManager.bleServiceWriteToHandle, int(i, 16),
+                                         self.configVal)
+                    except BLEOperationError as e:
+                        if not e.permanent:
+                            raise
+                        logger.debug("Could not configure handle %s: %s" % (i, e))
     #print "About to try to receive"
 
+    events = Queue.Queue(NOTIFICATION_QUEUE_SIZE)
+    if recordFile is not None:
+        writer = CaptureWriter(recordFile)
+        consumer = threading.Thread(target=recordEvents, args=(events, writer), name="bleSuite-subscribe-recorder")
+    else:
+        consumer = threading.Thread(target=printEvents, args=(events,), name="bleSuite-subscribe-printer")
+    consumer.daemon = True
+    consumer.start()
 
     connectionManager = bleConnectionManager.BLEConnectionManager(address, adapter, addressType, securityLevel,
                                                                   createRequester=False)
     #Special requester that has an overridden on_notification handler
-    requester = Requester(address, False)
+    requester = EventRequester(events, threading.Event(), address, False)
     connectionManager.setRequester(requester)
-    connectionManager.connect()
+    session = ConnectionSession(connectionManager)
+    session.connect()
+    engine = RetryEngine(session, RetryPolicy(), deviceBreaker(address))
     for handle in handles:
         logger.debug("Writing %s to handle %s" % (configVal, handle))
         try:
-            bleServiceManager.bleServiceWriteToHandle(connectionManager, int(handle, 16), configVal)
-        except RuntimeError as e:
-            if "Invalid handle" in str(e):
-                data = -1
-            elif "Attribute can't be read" in str(e):
-                data = -2
+            engine.call("write", bleServiceManager.bleServiceWriteToHandle, int(handle, 16), configVal)
+        except BLEOperationError as e:
+            #invalid or unwritable handles are skipped
+            if not e.permanent:
+                raise
+            logger.debug("Could not configure handle %s: %s" % (handle, e))
+
+
+    try:
+        ReceiveNotification(engine, requester, handles, configVal)
+    finally:
+        #let the consumer finish queued events (and close any capture file) before exiting
+        events.put(None)
+        consumer.join(LINK_CHECK_INTERVAL * 5)
+
+
+def _cachedScan(scanType, scanFunction, address, addressType, connectionManager, cache, refresh):
+    """
+    Run scanFunction unless an up to date device structure is in the cache, storing
+    fresh results (along with the device's Database Hash) when a cache is supplied.
+    """
+    bleDevice = None
+    if cache is not None and not refresh:
+        bleDevice = cache.lookup(address, addressType, scanType, connectionManager)
+        stats.increment("cache.scan." + ("miss" if bleDevice is None else "hit"))
+    if bleDevice is None:
+        with stats.timed(scanType):
+            bleDevice = scanFunction(address, connectionManager)
+        if cache is not None:
+            cache.store(address, addressType, scanType, bleDevice, readDatabaseHash(connectionManager))
+    return bleDevice
+
+
+def _discoverPrimary(connectionManager):
+    """
+    Primary services of the device, as dicts with start, end and uuid keys.
+    """
+    return _requesterMethod(connectionManager, 'discover_primary')()
+
+
+def _discoverDevice(engine, checkpoint, descriptors=True):
+    """
+    Discover the services, characteristics and (optionally) descriptors of a
+    device without reading any values, one service range at a time. Parts the
+    checkpoint records as complete are not discovered again. Descriptors are only
+    looked for between a characteristic's value and the next declaration, so
+    characteristics without any cost nothing.
+
+    :param engine: RetryEngine of an open connection to the device
+    :param checkpoint: ScanCheckpoint the structure is built in
+    :param descriptors: Discover descriptors. Default: True
+    :return: GATTDevice
+    """
+    device = checkpoint.device
+    if not checkpoint.servicesDiscovered:
+        device.services = [GATTService(service['start'], service['end'], service['uuid']) for service in
+                           sorted(engine.call("discover.services", _discoverPrimary), key=lambda i: i['start'])]
+        checkpoint.servicesDiscovered = True
+        checkpoint.update()
+    for service in device.services:
+        if service.start not in checkpoint.characteristicsDiscovered:
+            declarations = engine.call("discover.characteristics", _discoverCharacteristics, service.start,
+                                       service.end)
+            service.characteristics = [GATTCharacteristic(declaration['handle'], declaration['value_handle'],
+                                                          declaration['uuid'], declaration['properties'])
+                                       for declaration in sorted(declarations, key=lambda i: i['handle'])
+                                       if service.start <= declaration['handle'] <= service.end]
+            checkpoint.characteristicsDiscovered.add(service.start)
+            checkpoint.update()
+        if not descriptors:
+            continue
+        for i, characteristic in enumerate(service.characteristics):
+            if characteristic.handle in checkpoint.descriptorsDiscovered:
+                continue
+            if i + 1 < len(service.characteristics):
+                end = service.characteristics[i + 1].handle - 1
             else:
-                raise RuntimeError(e)
+                end = service.end
+            if characteristic.valueHandle < end:
+                characteristic.descriptors = [GATTDescriptor(attribute['handle'], attribute['uuid']) for attribute in
+                                              sorted(engine.call("discover.descriptors", _discoverAttributes,
+                                                                 characteristic.valueHandle + 1, end),
+                                                     key=lambda i: i['handle'])
+                                              if characteristic.valueHandle < attribute['handle'] <= end]
+            checkpoint.descriptorsDiscovered.add(characteristic.handle)
+            checkpoint.update()
+    logger.debug("Discovered %d services and %d attributes on %s" % (len(device.services), device.attributes(),
+                                                                     device.address))
+    return device
+
+
+def _readAttributesPipelined(engine, attributes, timeout, window, onProgress=None, descriptorTimeout=None):
+    """
+    Read (handle, attribute) pairs through the asynchronous read path, at most
+    window at once, storing the data received (or the reason the read failed) in
+    each attribute's value (or error).
 
+    :param onProgress: Function called with (reads finished, total reads) after each read. Default: None
+    :param descriptorTimeout: Time (in seconds) until each descriptor read times out (None uses timeout).
+    Default: None
+    """
+    pendingOperations = PendingOperationTable()
+    inFlight = InFlightWindow(window)
+    finished = [0]
+
+    def finish():
+        finished[0] += 1
+        if onProgress is not None:
+            onProgress(finished[0], len(attributes))
 
-    ReceiveNotification(connectionManager, handles, configVal)
+    def collect(completed):
+        for op in completed:
+            if op.timedOut:
+                stats.increment("async.read.smartScan.timeout")
+                op.context.error = TIMEOUT_MESSAGE
+            else:
+                stats.record("async.read.smartScan", op.latency)
+                op.context.value = op.received()
+            finish()
+
+    for handle, attribute in attributes:
+        while not inFlight.hasRoom(len(pendingOperations)):
+            collect(pendingOperations.waitCompleted())
+        opId = pendingOperations.reserve()
+        try:
+            resp = engine.call("send.read.smartScan", bleServiceManager.bleServiceReadByHandleAsync, handle,
+                               pendingOperations.completionCallback(opId))
+        except BLEOperationError as e:
+            if e.code not in _READ_ERROR_MESSAGES:
+                #keep the responses that arrived before the failure so a resumed scan need not repeat them
+                collect(pendingOperations.takeCompleted())
+                raise
+            attribute.error = _READ_ERROR_MESSAGES[e.code]
+            finish()
+            continue
+        if descriptorTimeout is not None and isinstance(attribute, GATTDescriptor):
+            pendingOperations.add(opId, handle, resp, min(timeout, descriptorTimeout), context=attribute)
+        else:
+            pendingOperations.add(opId, handle, resp, timeout, context=attribute)
+    for op in pendingOperations.drain():
+        collect([op])
 
 
-def bleServiceScan(address, adapter, addressType, securityLevel):
+def _readDescriptorsSync(engine, reads):
+    """
+    Read the descriptors among (handle, attribute) pairs whose asynchronous read
+    went unanswered on a link that stayed up with synchronous reads, which report
+    why a descriptor can't be read where gattlib's asynchronous reads do not.
+    """
+    for handle, attribute in reads:
+        if not isinstance(attribute, GATTDescriptor):
+            continue
+        stats.increment("smartScan.descriptorFallback")
+        try:
+            attribute.value = engine.call("read.smartScan.descriptor", bleServiceManager.bleServiceReadByHandle,
+                                          handle)
+            attribute.error = None
+        except BLEOperationError as e:
+            if e.code not in _READ_ERROR_MESSAGES:
+                raise
+            attribute.error = _READ_ERROR_MESSAGES[e.code]
+
+
+def blePipelinedSmartScan(engine, address, timeout=5, window=SMART_SCAN_WINDOW, onProgress=None, checkpoint=None,
+                          descriptorTimeout=DESCRIPTOR_TIMEOUT):
+    """
+    Smart scan that discovers the whole device first and then reads every
+    readable characteristic value and every descriptor through the asynchronous
+    read path, keeping up to window reads outstanding instead of waiting for each
+    response in turn. Characteristics whose properties do not permit reads are
+    not read.
+
+    Descriptors carry no properties saying whether they can be read, and gattlib
+    does not answer asynchronous reads the device refuses, so descriptor reads
+    time out after descriptorTimeout and those that timed out on a link that
+    stayed up are read again synchronously to find out why.
+
+    Progress is kept in checkpoint: discovery and reads it records as complete are
+    not repeated, and reads that timed out because the link dropped are sent again
+    once it is back (up to the engine's maxTries more passes).
+
+    :param engine: RetryEngine of an open connection to the device
+    :param address: Address of target BTLE device
+    :param timeout: Time (in seconds) until each read times out. Default: 5
+    :param window: Maximum number of outstanding reads. Default: 16
+    :param onProgress: Function called with (reads finished, total reads) after each read. Default: None
+    :param checkpoint: ScanCheckpoint to continue from and record progress in (None starts afresh, in memory).
+    Default: None
+    :param descriptorTimeout: Time (in seconds) until each descriptor read times out (None uses timeout).
+    Default: 1
+    :type engine: RetryEngine
+    :type address: str
+    :type timeout: int
+    :type window: int
+    :type onProgress: function
+    :type checkpoint: ScanCheckpoint
+    :type descriptorTimeout: float
+    :return: discovered device structure
+    :rtype: GATTDevice
+    """
+    if checkpoint is None:
+        checkpoint = ScanCheckpoint(address, None, 'smartScan', None)
+    device = _discoverDevice(engine, checkpoint)
+    reads = []
+    skipped = 0
+    for service in device.services:
+        for characteristic in service.characteristics:
+            if characteristic.properties & PROPERTY_READ:
+                reads.append((characteristic.valueHandle, characteristic))
+            else:
+                skipped += 1
+            reads.extend((descriptor.handle, descriptor) for descriptor in characteristic.descriptors)
+    total = len(reads)
+    #attributes read before the checkpoint was taken are kept
+    reads = [(handle, attribute) for handle, attribute in reads
+             if attribute.value is None and attribute.error in (None, TIMEOUT_MESSAGE)]
+    logger.debug("Reading %d attributes of %s (%d already read, %d characteristics are not readable)"
+                 % (len(reads), address, total - len(reads), skipped))
+
+    def progress(finished, outstanding):
+        checkpoint.update()
+        if onProgress is not None:
+            onProgress(total - outstanding + finished, total)
+
+    for attempt in range(engine.policy.maxTries + 1):
+        generation = engine.session.generation
+        for handle, attribute in reads:
+            attribute.error = None
+        _readAttributesPipelined(engine, reads, timeout, window, progress, descriptorTimeout)
+        reads = [(handle, attribute) for handle, attribute in reads if attribute.error == TIMEOUT_MESSAGE]
+        #timeouts on a link that stayed up are the device's answer; those on a dropped link are read again
+        if not reads or (engine.session.generation == generation and engine.connectionManager.isConnected()):
+            _readDescriptorsSync(engine, reads)
+            checkpoint.update()
+            break
+        logger.debug("Connection to %s dropped, reading %d timed out attributes again" % (address, len(reads)))
+        stats.increment("smartScan.reread")
+    return device
+
+
+def _scanEngine(engine, connectionManager, address, maxTries, retryPolicy):
+    """
+    RetryEngine a pipelined scan runs on: engine if supplied, otherwise one built
+    on connectionManager (which the cache lookup may already have connected).
+    """
+    if engine is not None:
+        return engine
+    session = ConnectionSession(connectionManager)
+    if not connectionManager.isConnected():
+        session.connect()
+    return RetryEngine(session, retryPolicy if retryPolicy is not None else RetryPolicy(maxTries),
+                       deviceBreaker(address))
+
+
+def _checkpointedScan(scanType, scan, address, addressType, resume, checkpointDir):
+    """
+    Run scan(checkpoint), continuing from the checkpoint left by an earlier scan
+    when resume is set. The checkpoint is written if the scan fails and removed
+    once it completes.
+    """
+    checkpoint = None
+    if resume:
+        checkpoint = ScanCheckpoint.load(address, addressType, scanType, checkpointDir)
+        stats.increment("checkpoint." + ("resumed" if checkpoint is not None else "missing"))
+    if checkpoint is None:
+        checkpoint = ScanCheckpoint(address, addressType, scanType, checkpointDir)
+    try:
+        device = scan(checkpoint)
+    except (Exception, KeyboardInterrupt):
+        checkpoint.save()
+        logger.debug("%s of %s interrupted, progress saved for --resume" % (scanType, address))
+        raise
+    checkpoint.discard()
+    return device
+
+
+def _supportsDiscovery(connectionManager):
+    return all(hasattr(getattr(connectionManager, 'requester', None), name) for name in _SMART_SCAN_DISCOVERY)
+
+
+def _eventConnection(address, adapter, addressType, securityLevel):
+    """
+    BLEConnectionManager whose requester queues the indications it receives (see
+    EventRequester), so an incremental scan can hear Service Changed.
+    """
+    connectionManager = bleConnectionManager.BLEConnectionManager(address, adapter, addressType, securityLevel,
+                                                                  createRequester=False)
+    connectionManager.setRequester(EventRequester(Queue.Queue(NOTIFICATION_QUEUE_SIZE), threading.Event(),
+                                                  address, False))
+    return connectionManager
+
+
+def _queuedServiceChanged(events, valueHandle, wait=0):
+    """
+    Handle ranges of the Service Changed indications queued in events, waiting up
+    to wait seconds for the first one.
+    """
+    ranges = []
+    deadline = time.time() + wait
+    while True:
+        try:
+            #once one indication has arrived (or when not waiting), only take those already queued
+            if ranges or not wait:
+                kind, originHandle, data, timestamp = events.get_nowait()
+            else:
+                kind, originHandle, data, timestamp = events.get(True, max(0, deadline - time.time()))
+        except Queue.Empty:
+            return ranges
+        if kind == KIND_INDICATION and originHandle == valueHandle and len(data) >= 4:
+            #gattlib may hand over the whole PDU, so the range is taken from the last 4 bytes
+            ranges.append(struct.unpack("<HH", data[-4:]))
+
+
+def _serviceChangedRanges(engine, prior, bonded, wait=SERVICE_CHANGED_WAIT):
+    """
+    Collect the handle ranges the device indicates have changed on the Service
+    Changed characteristic found by the prior scan.
+
+    A bonded device keeps Service Changed indications enabled between connections
+    and indicates its changes on reconnecting, so those already queued are taken
+    first. Otherwise, when bonded, indications are enabled and the first one is
+    waited for up to wait seconds. An unbonded client's configuration is reset on
+    every connection, so the device has nothing to indicate to it and no wait is
+    spent.
+
+    :param bonded: Whether the link is bonded (encrypted)
+    :return: list of (start, end) handle ranges, or None if the device did not indicate any
+    """
+    events = getattr(engine.connectionManager.requester, 'events', None)
+    serviceChanged = [characteristic for service in prior.services for characteristic in service.characteristics
+                      if characteristic.uuid.lower() == SERVICE_CHANGED_UUID]
+    if events is None or not serviceChanged:
+        return None
+    characteristic = serviceChanged[0]
+    ranges = _queuedServiceChanged(events, characteristic.valueHandle)
+    if not ranges and bonded:
+        configuration = [descriptor.handle for descriptor in characteristic.descriptors
+                         if descriptor.uuid.lower() == CLIENT_CONFIGURATION_UUID]
+        #serviceScan does not discover descriptors, and the configuration descriptor normally follows the value
+        handle = configuration[0] if configuration else characteristic.valueHandle + 1
+        try:
+            engine.call("write", bleServiceManager.bleServiceWriteToHandle, handle, _ENABLE_INDICATIONS)
+        except BLEOperationError as e:
+            logger.debug("Could not enable Service Changed indications on %s: %s" % (prior.address, e))
+            return None
+        ranges = _queuedServiceChanged(events, characteristic.valueHandle, wait)
+    if not ranges:
+        logger.debug("%s did not indicate Service Changed" % prior.address)
+        return None
+    logger.debug("%s indicated Service Changed for %s" % (prior.address, ", ".join("%04x-%04x" % i for i in ranges)))
+    return ranges
+
+
+def _incrementalCheckpoint(engine, address, addressType, scanType, prior, ranges):
+    """
+    Checkpoint to scan a device from when only the handle ranges in ranges have
+    changed: its services are discovered again, and those lying outside every
+    range are taken from the prior scan (with their characteristics, descriptors
+    and values) instead of being discovered again.
+    """
+    checkpoint = ScanCheckpoint(address, addressType, scanType, None)
+    priorServices = dict(((service.start, service.end, service.uuid), service) for service in prior.services)
+    for discovered in sorted(engine.call("discover.services", _discoverPrimary), key=lambda i: i['start']):
+        service = priorServices.get((discovered['start'], discovered['end'], discovered['uuid']))
+        if service is None or any(start <= service.end and service.start <= end for start, end in ranges):
+            service = GATTService(discovered['start'], discovered['end'], discovered['uuid'])
+        else:
+            checkpoint.characteristicsDiscovered.add(service.start)
+            checkpoint.descriptorsDiscovered.update(characteristic.handle
+                                                    for characteristic in service.characteristics)
+        checkpoint.device.services.append(service)
+    checkpoint.servicesDiscovered = True
+    logger.debug("Rediscovering %d of %d services on %s" % (
+        len(checkpoint.device.services) - len(checkpoint.characteristicsDiscovered), len(checkpoint.device.services),
+        address))
+    return checkpoint
+
+
+def _scanConnection(engine, address, adapter, addressType, securityLevel, cache, pipelined, resume, incremental):
+    """
+    Connection manager a scan runs on: engine's if supplied, otherwise a new one
+    (able to receive Service Changed for incremental scans).
+    """
+    if incremental:
+        if cache is None:
+            raise ValueError("Incremental scans need a GATTCache to compare the device with.")
+        if resume or not pipelined:
+            raise ValueError("Incremental scans can not be resumed or run serially.")
+    if engine is not None:
+        connectionManager = engine.connectionManager
+    elif incremental:
+        connectionManager = _eventConnection(address, adapter, addressType, securityLevel)
+    else:
+        connectionManager = bleConnectionManager.BLEConnectionManager(address, adapter, addressType, securityLevel)
+    if incremental and not _supportsDiscovery(connectionManager):
+        raise ValueError("Incremental scans need a requester that supports GATT discovery.")
+    return connectionManager
+
+
+def _incrementalScan(scanType, scan, address, addressType, engine, cache, onChange=None, bonded=False):
+    """
+    Rescan a device against the structure cached by its last scan (whether or not
+    the entry has expired). The cached structure is returned as it is while the
+    device's Database Hash matches the one cached with it. Otherwise only the
+    services in the handle ranges of a Service Changed indication are discovered
+    again, or the whole device when it indicates none (as it always does to an
+    unbonded client). The changes found (see
+    diffDevices) are passed to onChange.
+
+    :param scan: Function run with the ScanCheckpoint to continue the scan from
+    :param bonded: Whether the link is bonded, so Service Changed can be indicated (see _serviceChangedRanges)
+    :return: device structure
+    """
+    entry = cache.load(address, addressType, scanType, expire=False)
+    databaseHash = readDatabaseHash(engine.connectionManager)
+    if entry is not None and entry['databaseHash'] is not None and entry['databaseHash'] == databaseHash:
+        stats.increment("incremental.unchanged")
+        logger.debug("Database Hash of %s unchanged, using cached device structure" % address)
+        return entry['device']
+    prior = entry['device'] if entry is not None and isinstance(entry['device'], GATTDevice) else None
+    ranges = _serviceChangedRanges(engine, prior, bonded) if prior is not None else None
+    if ranges is not None:
+        stats.increment("incremental.partial")
+        checkpoint = _incrementalCheckpoint(engine, address, addressType, scanType, prior, ranges)
+    else:
+        stats.increment("incremental.full")
+        checkpoint = ScanCheckpoint(address, addressType, scanType, None)
+    with stats.timed(scanType):
+        bleDevice = scan(checkpoint)
+    cache.store(address, addressType, scanType, bleDevice, databaseHash)
+    if prior is not None and onChange is not None:
+        for change in diffDevices(prior, bleDevice):
+            onChange(change)
+    return bleDevice
+
+
+def bleServiceScan(address, adapter, addressType, securityLevel, cache=None, refresh=False, printStructure=True,
+                   engine=None, maxTries=5, retryPolicy=None, pipelined=True, resume=False,
+                   checkpointDir=DEFAULT_CHECKPOINT_DIR, incremental=False, onChange=None):
     """
     Used by command line tool to initiate and print results for
     a scan of all services and
     characteristics present on a BTLE device.
 
+    When pipelined and the connection's requester supports GATT discovery, the
+    device is discovered one service range at a time with progress checkpointed
+    (see ScanCheckpoint); otherwise bleServiceDiscovery discovers it in one go.
+    Incremental scans only discover what changed since the device was last
+    scanned (see _incrementalScan).
+
     :param address: Address of target BTLE device
     :param adapter: Host adapter (Empty string to use host's default adapter)
     :param addressType: Type of address you want to connect to [public | random]
     :param securityLevel: Security level [low | medium | high]
+    :param cache: GATTCache to load results from and store results in (None disables caching). Default: None
+    :param refresh: Ignore any cached results and rediscover the device. Default: False
+    :param printStructure: Print the discovered device structure. Default: True
+    :param engine: RetryEngine of an open connection to scan over instead of connecting. Default: None
+    :param maxTries: Maximum number of times to attempt sending each discovery request. Default: 5
+    :param retryPolicy: RetryPolicy for discovery requests that fail (None retries maxTries times with
+    the default backoff). Default: None
+    :param pipelined: Discover the device with checkpoints where the requester supports it. Default: True
+    :param resume: Continue from the checkpoint left by an earlier scan that failed. Default: False
+    :param checkpointDir: Directory checkpoints are written to. Default: ~/.bleSuite/checkpoints
+    :param incremental: Rescan the device against the structure in cache, only discovering the services
+    that changed. Default: False
+    :param onChange: Function called with each change (see diffDevices) an incremental scan finds. Default: None
     :type address: str
     :type adapter: str
     :type addressType: str
     :type securityLevel: str
-    :return:
+    :type cache: GATTCache
+    :type refresh: bool
+    :type printStructure: bool
+    :type engine: RetryEngine
+    :type maxTries: int
+    :type retryPolicy: RetryPolicy
+    :type pipelined: bool
+    :type resume: bool
+    :type checkpointDir: str
+    :type incremental: bool
+    :type onChange: function
+    :return: discovered device structure
     """
     if address is None:
         raise Exception("%s Bluetooth address is not valid. Please supply a valid Bluetooth address value." % address)
 
-    connectionManager = bleConnectionManager.BLEConnectionManager(address, adapter, addressType, securityLevel)
-    bleDevice = bleServiceManager.bleServiceDiscovery(address, connectionManager)
-    bleDevice.printDeviceStructure()
+    connectionManager = _scanConnection(engine, address, adapter, addressType, securityLevel, cache, pipelined,
+                                        resume, incremental)
+    if incremental:
+        scanEngine = _scanEngine(engine, connectionManager, address, maxTries, retryPolicy)
+        bleDevice = _incrementalScan('serviceScan', lambda checkpoint: _discoverDevice(scanEngine, checkpoint, False),
+                                     address, addressType, scanEngine, cache, onChange, securityLevel != "low")
+        if printStructure:
+            bleDevice.printDeviceStructure()
+        return bleDevice
+    if pipelined and _supportsDiscovery(connectionManager):
+        def scanFunction(address, connectionManager):
+            scanEngine = _scanEngine(engine, connectionManager, address, maxTries, retryPolicy)
+            return _checkpointedScan('serviceScan', lambda checkpoint: _discoverDevice(scanEngine, checkpoint, False),
+                                     address, addressType, resume, checkpointDir)
+    else:
+        scanFunction = bleServiceManager.bleServiceDiscovery
+    bleDevice = _cachedScan('serviceScan', scanFunction, address, addressType,
+                            connectionManager, cache, refresh)
+    if printStructure:
+        bleDevice.printDeviceStructure()
+    return bleDevice
 
 
-def bleRunSmartScan(address, adapter, addressType, securityLevel):
+def bleRunSmartScan(address, adapter, addressType, securityLevel, cache=None, refresh=False, printStructure=True,
+                    engine=None, maxTries=5, timeout=5, window=SMART_SCAN_WINDOW, onProgress=None, retryPolicy=None,
+                    pipelined=True, resume=False, checkpointDir=DEFAULT_CHECKPOINT_DIR, incremental=False,
+                    onChange=None):
     """
     Used by command line tool to initiate and print results for
     a scan of all services,
     characteristics, and descriptors present on a BTLE device.
 
+    When pipelined and the connection's requester supports GATT discovery, the
+    scan is pipelined and checkpointed (see blePipelinedSmartScan, ScanCheckpoint);
+    otherwise bleSmartScan walks the device one request at a time. Incremental
+    scans only discover and read the services that changed since the device was
+    last scanned (see _incrementalScan), so the values of the others are those
+    read by earlier scans.
+
     :param address: Address of target BTLE device
     :param adapter: Host adapter (Empty string to use host's default adapter)
     :param addressType: Type of address you want to connect to [public | random]
     :param securityLevel: Security level [low | medium | high]
+    :param cache: GATTCache to load results from and store results in (None disables caching). Default: None
+    :param refresh: Ignore any cached results and rediscover the device. Default: False
+    :param printStructure: Print the smart scan results. Default: True
+    :param engine: RetryEngine of an open connection to scan over instead of connecting. Default: None
+    :param maxTries: Maximum number of times to attempt sending each request of a pipelined scan. Default: 5
+    :param timeout: Time (in seconds) until each read of a pipelined scan times out. Default: 5
+    :param window: Maximum number of outstanding reads in a pipelined scan. Default: 16
+    :param onProgress: Function called with (reads finished, total reads) as a pipelined scan progresses.
+    Default: None
+    :param retryPolicy: RetryPolicy for requests of a pipelined scan that fail to send (None retries
+    maxTries times with the default backoff). Default: None
+    :param pipelined: Pipeline the scan where the requester supports it. Default: True
+    :param resume: Continue from the checkpoint left by an earlier pipelined scan that failed. Default: False
+    :param checkpointDir: Directory checkpoints are written to. Default: ~/.bleSuite/checkpoints
+    :param incremental: Rescan the device against the structure in cache, only discovering and reading the
+    services that changed. Default: False
+    :param onChange: Function called with each change (see diffDevices) an incremental scan finds. Default: None
     :type address: str
     :type adapter: str
     :type addressType: str
     :type securityLevel: str
-    :return:
+    :type cache: GATTCache
+    :type refresh: bool
+    :type printStructure: bool
+    :type engine: RetryEngine
+    :type maxTries: int
+    :type timeout: int
+    :type window: int
+    :type onProgress: function
+    :type retryPolicy: RetryPolicy
+    :type pipelined: bool
+    :type resume: bool
+    :type checkpointDir: str
+    :type incremental: bool
+    :type onChange: function
+    :return: discovered device structure
     """
     if address is None:
         raise Exception("%s Bluetooth address is not valid. Please supply a valid Bluetooth address value." % address)
 
-    connectionManager = bleConnectionManager.BLEConnectionManager(address, adapter, addressType, securityLevel)
-    bleDevice = bleSmartScan.bleSmartScan(address, connectionManager)
+    connectionManager = _scanConnection(engine, address, adapter, addressType, securityLevel, cache, pipelined,
+                                        resume, incremental)
+    if incremental:
+        scanEngine = _scanEngine(engine, connectionManager, address, maxTries, retryPolicy)
+        bleDevice = _incrementalScan('smartScan',
+                                     lambda checkpoint: blePipelinedSmartScan(scanEngine, address, timeout, window,
+                                                                              onProgress, checkpoint),
+                                     address, addressType, scanEngine, cache, onChange, securityLevel != "low")
+        if printStructure:
+            printSmartScanResults(bleDevice)
+        return bleDevice
+    if pipelined and _supportsDiscovery(connectionManager):
+        def scanFunction(address, connectionManager):
+            scanEngine = _scanEngine(engine, connectionManager, address, maxTries, retryPolicy)
+            return _checkpointedScan('smartScan',
+                                     lambda checkpoint: blePipelinedSmartScan(scanEngine, address, timeout, window,
+                                                                              onProgress, checkpoint),
+                                     address, addressType, resume, checkpointDir)
+    else:
+        scanFunction = bleSmartScan.bleSmartScan
+    bleDevice = _cachedScan('smartScan', scanFunction, address, addressType,
+                            connectionManager, cache, refresh)
+    if printStructure:
+        printSmartScanResults(bleDevice)
+    return bleDevice
 
+
+def printSmartScanResults(bleDevice):
+    """
+    Print the device structure produced by a smart scan.
+
+    :param bleDevice: Device structure returned by bleRunSmartScan
+    :return:
+    """
     print "**********************"
     print "Smart Scan Results"
     print "**********************"
@@ -0,0 +1,113 @@
+import contextlib
+import threading
+import time
+from sessionRunner import DeviceSession
+from operationStats import stats
+import logging
+
+logger = logging.getLogger(__name__)
+logger.addHandler(logging.NullHandler())
+
+#Time (seconds) an unused connection is kept open
+DEFAULT_IDLE_TIMEOUT = 300
+#Longest time between checks for idle connections
+_EVICT_INTERVAL = 10.0
+
+
+class ConnectionPool(object):
+    """
+    Warm connections to devices, keyed by (address, addressType, securityLevel).
+    A connection is only reused through the adapter it was opened on (it is
+    reopened when a lease asks for another adapter). A connection is leased by one request at a time (others wanting the same
+    device wait for it) and is closed once it has gone unused for idleTimeout seconds.
+
+    :param idleTimeout: Time (seconds) an unused connection is kept open. Default: 300
+    :type idleTimeout: float
+    """
+    def __init__(self, idleTimeout=DEFAULT_IDLE_TIMEOUT):
+        self.idleTimeout = idleTimeout
+        self._condition = threading.Condition()
+        self._idle = {}
+        self._busy = set()
+        self._closed = False
+        evictor = threading.Thread(target=self._evictIdle, name="bleSuite-pool-evictor")
+        evictor.daemon = True
+        evictor.start()
+
+    def __len__(self):
+        with self._condition:
+            return len(self._idle) + len(self._busy)
+
+    @contextlib.contextmanager
+    def lease(self, address, adapter, addressType, securityLevel, retryPolicy=None):
+        """
+        Context manager providing the pooled DeviceSession for a device, connecting
+        (through adapter) if there is none.
+
+        :param address: Address of target BTLE device
+        :param adapter: Host adapter the connection must go through
+        :param addressType: Type of address you want to connect to [public | random]
+        :param securityLevel: Security level [low | medium | high]
+        :param retryPolicy: RetryPolicy for this lease's operations (None keeps the session's). Default: None
+        :return: DeviceSession
+        """
+        key = (address, addressType, securityLevel)
+        with self._condition:
+            while key in self._busy:
+                self._condition.wait(_EVICT_INTERVAL)
+            if self._closed:
+                raise RuntimeError("Connection pool is closed")
+            self._busy.add(key)
+            deviceSession, lastUsed = self._idle.pop(key, (None, None))
+        try:
+            if deviceSession is not None and deviceSession.adapter != adapter:
+                #the adapter scheduler accounts the work to the adapter it asked for, so do not reuse another's
+                logger.debug("Reopening connection to %s on adapter %s" % (address, adapter or "default"))
+                stats.increment("pool.adapterChanged")
+                deviceSession.close()
+                deviceSession = None
+            if deviceSession is None:
+                stats.increment("pool.miss")
+                logger.debug("Opening pooled connection to %s" % address)
+                deviceSession = DeviceSession(address, adapter, addressType, securityLevel, retryPolicy)
+            else:
+                stats.increment("pool.hit")
+                if retryPolicy is not None:
+                    deviceSession.retryPolicy = retryPolicy
+                    deviceSession.engine.policy = retryPolicy
+            yield deviceSession
+        finally:
+            with self._condition:
+                self._busy.discard(key)
+                if deviceSession is not None:
+                    self._idle[key] = (deviceSession, time.time())
+                self._condition.notify_all()
+
+    def _evictIdle(self):
+        while True:
+            time.sleep(min(self.idleTimeout, _EVICT_INTERVAL))
+            expired = []
+            with self._condition:
+                if self._closed:
+                    return
+                now = time.time()
+                for key, (deviceSession, lastUsed) in self._idle.items():
+                    if now - lastUsed >= self.idleTimeout:
+                        expired.append(deviceSession)
+                        del self._idle[key]
+            for deviceSession in expired:
+                logger.debug("Closing idle connection to %s" % deviceSession.address)
+                stats.increment("pool.evicted")
+                deviceSession.close()
+
+    def close(self):
+        """
+        Close every idle connection and refuse further leases.
+        """
+        with self._condition:
+            self._closed = True
+            idle = [deviceSession for deviceSession, lastUsed in self._idle.values()]
+            self._idle.clear()
+            self._condition.notify_all()
+        for deviceSession in idle:
+            deviceSession.close()
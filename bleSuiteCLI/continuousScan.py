@@ -0,0 +1,290 @@
+import collections
+import errno
+import struct
+import time
+import logging
+
+logger = logging.getLogger(__name__)
+logger.addHandler(logging.NullHandler())
+
+#HCI packet types, events and LE controller commands used for scanning
+HCI_COMMAND_PKT = 0x01
+HCI_EVENT_PKT = 0x04
+EVT_CMD_COMPLETE = 0x0e
+EVT_CMD_STATUS = 0x0f
+EVT_LE_META_EVENT = 0x3e
+EVT_LE_ADVERTISING_REPORT = 0x02
+OGF_LE_CTL = 0x08
+OCF_LE_SET_SCAN_PARAMETERS = 0x000b
+OCF_LE_SET_SCAN_ENABLE = 0x000c
+SOL_HCI = 0
+HCI_FILTER = 2
+#Advertising report event type of a scan response
+ADV_SCAN_RSP = 0x04
+#Advertising data types holding the device name
+AD_SHORT_NAME = 0x08
+AD_COMPLETE_NAME = 0x09
+ADDRESS_TYPES = {0: 'public', 1: 'random', 2: 'public', 3: 'random'}
+#Scan interval and window (units of 0.625ms): scan continuously, 10ms at a time
+DEFAULT_SCAN_INTERVAL = 0x0010
+DEFAULT_SCAN_WINDOW = 0x0010
+#Devices tracked at once, and time (seconds) after which a device that has not advertised is forgotten
+DEFAULT_MAX_DEVICES = 4096
+DEFAULT_STALE_AFTER = 300
+#Weight of each new RSSI sample in a device's rolling average
+RSSI_SMOOTHING = 0.1
+#How long (seconds) to wait for the controller to answer a command
+COMMAND_TIMEOUT = 2.0
+
+AdvertisingReport = collections.namedtuple('AdvertisingReport', ['address', 'addressType', 'eventType', 'rssi',
+                                                                 'data', 'timestamp'])
+
+
+def parseAdvertisingReports(packet, timestamp=None):
+    """
+    Decode the reports in an HCI LE Advertising Report event. Reports are laid out
+    one after another, as BlueZ reads them.
+
+    :param packet: HCI event packet (starting with the packet type byte)
+    :param timestamp: Time the packet was received. Default: now
+    :type packet: str
+    :return: list of AdvertisingReport (empty for any other packet)
+    """
+    if len(packet) < 5 or ord(packet[0]) != HCI_EVENT_PKT or ord(packet[1]) != EVT_LE_META_EVENT or \
+            ord(packet[3]) != EVT_LE_ADVERTISING_REPORT:
+        return []
+    timestamp = timestamp if timestamp is not None else time.time()
+    reports = []
+    offset = 5
+    for i in range(ord(packet[4])):
+        if offset + 9 > len(packet):
+            break
+        eventType, addressType = ord(packet[offset]), ord(packet[offset + 1])
+        address = ":".join("%02X" % ord(byte) for byte in reversed(packet[offset + 2:offset + 8]))
+        length = ord(packet[offset + 8])
+        data = packet[offset + 9:offset + 9 + length]
+        if offset + 9 + length >= len(packet):
+            break
+        rssi = struct.unpack("b", packet[offset + 9 + length])[0]
+        reports.append(AdvertisingReport(address, ADDRESS_TYPES.get(addressType, addressType), eventType, rssi,
+                                         data, timestamp))
+        offset += 10 + length
+    return reports
+
+
+def advertisedName(data):
+    """
+    :param data: Advertising (or scan response) data
+    :return: the complete (or else shortened) local name in data, None if it has none
+    :rtype: str
+    """
+    names = {}
+    offset = 0
+    while offset < len(data):
+        length = ord(data[offset])
+        if length == 0 or offset + 1 + length > len(data):
+            break
+        adType = ord(data[offset + 1])
+        if adType in (AD_SHORT_NAME, AD_COMPLETE_NAME):
+            names[adType] = data[offset + 2:offset + 1 + length]
+        offset += 1 + length
+    return names.get(AD_COMPLETE_NAME, names.get(AD_SHORT_NAME))
+
+
+class HCIScanner(object):
+    """
+    Continuous LE scan on a raw HCI socket, producing every advertising report as
+    it arrives (duplicate filtering is left off so RSSI can be followed). Requires
+    a Python built with Bluetooth socket support and CAP_NET_RAW (ie root).
+
+    :param adapter: Adapter name (ie hci0, "" for hci0)
+    :param active: Request scan responses (which often carry the name). Default: True
+    :param interval: Scan interval (units of 0.625ms). Default: 10ms
+    :param window: Scan window (units of 0.625ms). Default: 10ms
+    :type adapter: str
+    :type active: bool
+    """
+    def __init__(self, adapter="", active=True, interval=DEFAULT_SCAN_INTERVAL, window=DEFAULT_SCAN_WINDOW):
+        self.devId = int(adapter[3:]) if adapter and adapter.startswith("hci") and adapter[3:].isdigit() else 0
+        self.active = active
+        self.interval = interval
+        self.window = window
+        self.sock = None
+
+    def open(self):
+        """
+        Open the HCI socket and start scanning.
+        """
+        import socket
+        if not hasattr(socket, 'AF_BLUETOOTH'):
+            raise RuntimeError("Continuous scanning needs a Python built with Bluetooth socket support")
+        self.sock = socket.socket(socket.AF_BLUETOOTH, socket.SOCK_RAW, socket.BTPROTO_HCI)
+        try:
+            self.sock.bind((self.devId,))
+            self.sock.setsockopt(SOL_HCI, HCI_FILTER,
+                                 struct.pack("<IIIH", 1 << HCI_EVENT_PKT,
+                                             (1 << EVT_CMD_COMPLETE) | (1 << EVT_CMD_STATUS),
+                                             1 << (EVT_LE_META_EVENT - 32), 0))
+            #a scan left running (ie by bluetoothd) has to be stopped before its parameters change
+            self._command(OCF_LE_SET_SCAN_ENABLE, struct.pack("<BB", 0, 0), False)
+            self._command(OCF_LE_SET_SCAN_PARAMETERS,
+                          struct.pack("<BHHBB", 1 if self.active else 0, self.interval, self.window, 0, 0))
+            self._command(OCF_LE_SET_SCAN_ENABLE, struct.pack("<BB", 1, 0))
+        except socket.error as e:
+            self.sock.close()
+            self.sock = None
+            if e.errno == errno.EPERM:
+                raise RuntimeError("Continuous scanning needs CAP_NET_RAW (ie run as root)")
+            raise RuntimeError("Unable to scan on hci%d: %s" % (self.devId, e))
+        except RuntimeError:
+            self.sock.close()
+            self.sock = None
+            raise
+
+    def _command(self, ocf, parameters, check=True):
+        opcode = (OGF_LE_CTL << 10) | ocf
+        self.sock.send(struct.pack("<BHB", HCI_COMMAND_PKT, opcode, len(parameters)) + parameters)
+        deadline = time.time() + COMMAND_TIMEOUT
+        while time.time() < deadline:
+            self.sock.settimeout(max(deadline - time.time(), 0.01))
+            try:
+                packet = self.sock.recv(260)
+            except IOError:
+                break
+            if len(packet) >= 7 and ord(packet[1]) == EVT_CMD_COMPLETE and \
+                    struct.unpack("<H", packet[4:6])[0] == opcode:
+                status = ord(packet[6])
+            elif len(packet) >= 7 and ord(packet[1]) == EVT_CMD_STATUS and \
+                    struct.unpack("<H", packet[5:7])[0] == opcode:
+                status = ord(packet[3])
+            else:
+                continue
+            if status and check:
+                raise RuntimeError("hci%d refused LE command 0x%04x (status 0x%02x)" % (self.devId, ocf, status))
+            return status
+        if check:
+            raise RuntimeError("hci%d did not answer LE command 0x%04x" % (self.devId, ocf))
+
+    def reports(self, cancelled=None, idle=1.0):
+        """
+        Generator of AdvertisingReport as they arrive, yielding None after each idle
+        period without any so callers can do periodic work.
+
+        :param cancelled: threading.Event that ends the scan when set. Default: None
+        :param idle: Seconds without a report after which None is yielded. Default: 1
+        """
+        import socket
+        self.sock.settimeout(idle)
+        while cancelled is None or not cancelled.is_set():
+            try:
+                packet = self.sock.recv(260)
+            except socket.timeout:
+                yield None
+                continue
+            for report in parseAdvertisingReports(packet):
+                yield report
+
+    def close(self):
+        """
+        Stop scanning and close the socket.
+        """
+        if self.sock is None:
+            return
+        try:
+            self._command(OCF_LE_SET_SCAN_ENABLE, struct.pack("<BB", 0, 0), False)
+        except IOError as e:
+            logger.debug("Could not stop scanning: %s" % e)
+        self.sock.close()
+        self.sock = None
+
+
+class DeviceEntry(object):
+    """
+    What has been seen of a single advertiser.
+    """
+    __slots__ = ('address', 'addressType', 'name', 'firstSeen', 'lastSeen', 'count', 'rssiMin', 'rssiMax',
+                 'rssiAvg', 'data', 'scanResponse')
+
+    def __init__(self, report):
+        self.address = report.address
+        self.addressType = report.addressType
+        self.name = None
+        self.firstSeen = report.timestamp
+        self.count = 0
+        self.rssiMin = self.rssiMax = self.rssiAvg = report.rssi
+        self.data = None
+        self.scanResponse = None
+
+
+class DeviceTable(object):
+    """
+    Per-device summary of a continuous scan (first/last seen, advertisement count,
+    RSSI minimum, maximum and rolling average, latest advertising data). Devices
+    are kept in least recently seen order so those that stop advertising for
+    staleAfter seconds, or the oldest beyond maxDevices, are evicted cheaply. An
+    evicted device that advertises again is treated as new.
+
+    :param maxDevices: Maximum number of devices kept. Default: 4096
+    :param staleAfter: Seconds without an advertisement after which a device is evicted. Default: 300
+    :type maxDevices: int
+    :type staleAfter: float
+    """
+    def __init__(self, maxDevices=DEFAULT_MAX_DEVICES, staleAfter=DEFAULT_STALE_AFTER):
+        if maxDevices < 1:
+            raise ValueError("%s is not a valid device limit. Please supply a value of at least 1" % maxDevices)
+        self.maxDevices = maxDevices
+        self.staleAfter = staleAfter
+        self.evicted = 0
+        self._entries = collections.OrderedDict()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __iter__(self):
+        return iter(self._entries.values())
+
+    def update(self, report):
+        """
+        Add an advertising report to its device's entry.
+
+        :param report: AdvertisingReport
+        :return: (DeviceEntry, whether the device is new)
+        :rtype: (DeviceEntry, bool)
+        """
+        entry = self._entries.pop(report.address, None)
+        isNew = entry is None
+        if isNew:
+            entry = DeviceEntry(report)
+        entry.lastSeen = report.timestamp
+        entry.count += 1
+        entry.rssiMin = min(entry.rssiMin, report.rssi)
+        entry.rssiMax = max(entry.rssiMax, report.rssi)
+        entry.rssiAvg += (report.rssi - entry.rssiAvg) * RSSI_SMOOTHING
+        if report.eventType == ADV_SCAN_RSP:
+            entry.scanResponse = report.data
+        else:
+            entry.data = report.data
+        entry.name = advertisedName(report.data) or entry.name
+        self._entries[report.address] = entry
+        self.evict(report.timestamp)
+        return entry, isNew
+
+    def evict(self, now=None):
+        """
+        Drop devices not seen for staleAfter seconds, and the least recently seen
+        ones beyond maxDevices.
+
+        :param now: Current time. Default: now
+        :return: number of devices evicted
+        :rtype: int
+        """
+        now = now if now is not None else time.time()
+        evicted = 0
+        while self._entries:
+            oldest = next(self._entries.itervalues())
+            if len(self._entries) <= self.maxDevices and now - oldest.lastSeen <= self.staleAfter:
+                break
+            self._entries.popitem(last=False)
+            evicted += 1
+        self.evicted += evicted
+        return evicted
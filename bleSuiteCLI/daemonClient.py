@@ -0,0 +1,69 @@
+import json
+import os
+import socket
+import sys
+import threading
+from daemonProtocol import FrameConnection, DEFAULT_SOCKET_PATH, FRAME_REQUEST, FRAME_STDOUT, FRAME_STDERR, \
+    FRAME_STDIN, FRAME_EXIT
+import logging
+
+logger = logging.getLogger(__name__)
+logger.addHandler(logging.NullHandler())
+
+
+def _forwardStdin(connection, stdin):
+    try:
+        for line in iter(stdin.readline, ""):
+            connection.send(FRAME_STDIN, line)
+        connection.send(FRAME_STDIN, "")
+    except (socket.error, ValueError):
+        #the command finished (and the connection closed) before input ran out
+        pass
+
+
+def forwardCommand(argv, socketPath=DEFAULT_SOCKET_PATH, stdin=None):
+    """
+    Run a command in a running daemon (see bleSuite daemon), copying its output
+    to stdout/stderr as it arrives.
+
+    :param argv: Command line arguments (without the program name)
+    :param socketPath: Daemon socket. Default: ~/.bleSuite/daemon.sock
+    :param stdin: File-like object whose lines are forwarded as the command's stdin (None sends none). Default: None
+    :type argv: list of str
+    :type socketPath: str
+    :return: the command's exit code, or None if no daemon is listening on socketPath
+    :rtype: int
+    """
+    if not os.path.exists(socketPath):
+        return None
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        sock.connect(socketPath)
+    except socket.error as e:
+        logger.debug("No daemon listening on %s (%s)" % (socketPath, e))
+        sock.close()
+        return None
+    connection = FrameConnection(sock)
+    try:
+        connection.send(FRAME_REQUEST, json.dumps({'argv': argv, 'cwd': os.getcwd(), 'stdin': stdin is not None}))
+        if stdin is not None:
+            pump = threading.Thread(target=_forwardStdin, args=(connection, stdin), name="bleSuite-stdin")
+            pump.daemon = True
+            pump.start()
+        while True:
+            frameType, payload = connection.receive()
+            if frameType == FRAME_STDOUT:
+                sys.stdout.write(payload)
+                sys.stdout.flush()
+            elif frameType == FRAME_STDERR:
+                sys.stderr.write(payload)
+            elif frameType == FRAME_EXIT:
+                result = json.loads(payload)
+                if result.get('error'):
+                    sys.stderr.write("Error: %s\n" % result['error'])
+                return result.get('code', 0)
+    except EOFError:
+        sys.stderr.write("Error: daemon closed the connection\n")
+        return 1
+    finally:
+        connection.close()
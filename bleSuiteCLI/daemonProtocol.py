@@ -0,0 +1,117 @@
+import os
+import socket
+import struct
+import threading
+import logging
+
+logger = logging.getLogger(__name__)
+logger.addHandler(logging.NullHandler())
+
+DEFAULT_SOCKET_PATH = os.path.join(os.path.expanduser("~"), ".bleSuite", "daemon.sock")
+
+#Frames are a type byte and a big-endian payload length, followed by the payload
+FRAME_HEADER = struct.Struct(">BI")
+#JSON request: {"argv": [...], "cwd": "...", "stdin": bool}
+FRAME_REQUEST = 1
+#Raw output for the client's stdout/stderr
+FRAME_STDOUT = 2
+FRAME_STDERR = 3
+#A line of the client's stdin (an empty payload marks the end of input)
+FRAME_STDIN = 4
+#JSON result, the last frame of a response: {"code": int, "error": str or null}
+FRAME_EXIT = 5
+#Largest payload accepted, guards against reading garbage as a length
+MAX_FRAME_SIZE = 64 * 1024 * 1024
+
+
+class FrameConnection(object):
+    """
+    Framed messages over a connected Unix domain socket. send() may be
+    called from several threads at once.
+
+    :param sock: Connected socket
+    :type sock: socket.socket
+    """
+    def __init__(self, sock):
+        self.sock = sock
+        self._sendLock = threading.Lock()
+
+    def send(self, frameType, payload=""):
+        """
+        :param frameType: One of the FRAME_* types
+        :param payload: Frame body
+        :type payload: str
+        """
+        with self._sendLock:
+            self.sock.sendall(FRAME_HEADER.pack(frameType, len(payload)) + payload)
+
+    def _receiveExactly(self, size):
+        chunks = []
+        while size:
+            chunk = self.sock.recv(min(size, 65536))
+            if not chunk:
+                raise EOFError("Connection closed")
+            chunks.append(chunk)
+            size -= len(chunk)
+        return "".join(chunks)
+
+    def receive(self):
+        """
+        :return: (frame type, payload)
+        :raises EOFError: when the other end closes the connection
+        """
+        frameType, size = FRAME_HEADER.unpack(self._receiveExactly(FRAME_HEADER.size))
+        if size > MAX_FRAME_SIZE:
+            raise ValueError("Frame of %d bytes exceeds the maximum frame size" % size)
+        return frameType, self._receiveExactly(size)
+
+    def close(self):
+        try:
+            self.sock.shutdown(socket.SHUT_RDWR)
+        except socket.error:
+            pass
+        self.sock.close()
+
+
+class FrameWriter(object):
+    """
+    File-like object that sends what is written to it as frames of one type.
+    Output is sent a line at a time so results stream to the client as they are printed.
+
+    :param connection: FrameConnection to send on
+    :param frameType: FRAME_STDOUT or FRAME_STDERR
+    :param bufferSize: Amount of partial-line output buffered before it is sent. Default: 64KB
+    """
+    def __init__(self, connection, frameType, bufferSize=64 * 1024):
+        self.connection = connection
+        self.frameType = frameType
+        self.bufferSize = bufferSize
+        self.softspace = 0
+        self._buffer = []
+        self._size = 0
+        self._lock = threading.Lock()
+
+    def write(self, data):
+        if not data:
+            return
+        if isinstance(data, unicode):
+            data = data.encode('utf-8')
+        with self._lock:
+            self._buffer.append(data)
+            self._size += len(data)
+            if "\n" in data or self._size >= self.bufferSize:
+                self._send()
+
+    def _send(self):
+        if self._buffer:
+            payload = "".join(self._buffer)
+            self._buffer = []
+            self._size = 0
+            self.connection.send(self.frameType, payload)
+
+    def flush(self):
+        with self._lock:
+            self._send()
+
+    def close(self):
+        self.flush()
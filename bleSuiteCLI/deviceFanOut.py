@@ -0,0 +1,75 @@
+import Queue
+import threading
+import traceback
+import logging
+
+logger = logging.getLogger(__name__)
+logger.addHandler(logging.NullHandler())
+
+#Queue.get() without a timeout can not be interrupted with Ctrl-C in Python 2,
+#so block with a (very long) timeout instead
+_BLOCK_TIMEOUT = 60 * 60 * 24 * 365
+
+
+def runForDevices(addresses, task, concurrency=4):
+    """
+    Run task against each address using a pool of worker threads. Each call of
+    task is expected to build its own BLEConnectionManager (as every
+    cmdLineToolWrappers function does), so devices never share a connection.
+    An exception raised for one device is returned with that device's result and
+    does not stop the others.
+
+    :param addresses: List of BD_ADDRs to run the task against
+    :param task: Function called with a single address that returns that device's results
+    :param concurrency: Maximum number of devices handled at once. Default: 4
+    :type addresses: list of str
+    :type concurrency: int
+    :return: generator of (address, result, error) tuples in the order devices finish.
+    error is None on success, otherwise result is None and error is the exception raised.
+    """
+    if concurrency < 1:
+        raise ValueError("%s is not a valid number of workers. Please supply a value of at least 1" % concurrency)
+    pending = Queue.Queue()
+    for address in addresses:
+        pending.put(address)
+    finished = Queue.Queue()
+
+    def worker():
+        while True:
+            try:
+                address = pending.get_nowait()
+            except Queue.Empty:
+                return
+            logger.debug("Worker starting device %s" % address)
+            try:
+                finished.put((address, task(address), None))
+            except Exception as e:
+                logger.debug("Device %s failed: %s" % (address, traceback.format_exc()))
+                finished.put((address, None, e))
+
+    for i in range(min(concurrency, len(addresses))):
+        thread = threading.Thread(target=worker, name="bleSuite-worker-%d" % i)
+        thread.daemon = True
+        thread.start()
+
+    for i in range(len(addresses)):
+        yield finished.get(True, _BLOCK_TIMEOUT)
+
+
+def readAddressFile(path):
+    """
+    Read BD_ADDRs from a file, one per line. Blank lines and lines
+    starting with # are ignored.
+
+    :param path: Path of the address file
+    :type path: str
+    :return: list of addresses
+    :rtype: list of str
+    """
+    addresses = []
+    with open(path, 'r') as f:
+        for line in f:
+            line = line.strip()
+            if line and not line.startswith("#"):
+                addresses.append(line)
+    return addresses
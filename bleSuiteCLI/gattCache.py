@@ -0,0 +1,156 @@
+import cPickle as pickle
+import os
+import time
+import zlib
+import logging
+from bleSuite import bleServiceManager
+from atomicFile import atomicWrite
+
+logger = logging.getLogger(__name__)
+logger.addHandler(logging.NullHandler())
+
+#GATT Database Hash characteristic (Bluetooth Core 5.1+)
+DATABASE_HASH_UUID = "00002b2a-0000-1000-8000-00805f9b34fb"
+DEFAULT_CACHE_DIR = os.path.join(os.path.expanduser("~"), ".bleSuite", "cache")
+#Default time (in seconds) a cached device structure is trusted: 1 day
+DEFAULT_TTL = 24 * 60 * 60
+CACHE_VERSION = 1
+
+
+def readDatabaseHash(connectionManager):
+    """
+    Read the GATT Database Hash characteristic from a device.
+
+    :param connectionManager: BLEConnectionManager for the target device
+    :return: hash value, or None if the device does not expose one
+    :rtype: str
+    """
+    try:
+        if not connectionManager.isConnected():
+            connectionManager.connect()
+        data, handle = bleServiceManager.bleServiceReadByUUID(connectionManager, DATABASE_HASH_UUID)
+    except RuntimeError as e:
+        logger.debug("Unable to read Database Hash: %s" % e)
+        return None
+    if isinstance(data, list):
+        data = "".join(data)
+    return data
+
+
+class GATTCache(object):
+    """
+    On-disk cache of device structures returned by service discovery and smart scans,
+    keyed by BD_ADDR and address type. Each entry is a zlib compressed pickle that
+    holds the device structure, the time it was discovered and the Database Hash
+    read from the device at that time (if any).
+
+    :param cacheDir: Directory cache entries are stored in. Default: ~/.bleSuite/cache
+    :param ttl: Time (in seconds) after which an entry is discarded. Default: 1 day
+    :type cacheDir: str
+    :type ttl: int
+    """
+    def __init__(self, cacheDir=DEFAULT_CACHE_DIR, ttl=DEFAULT_TTL):
+        self.cacheDir = cacheDir
+        self.ttl = ttl
+
+    def _path(self, address, addressType, scanType):
+        name = "%s_%s_%s.gatt" % (address.replace(":", "").lower(), addressType, scanType)
+        return os.path.join(self.cacheDir, name)
+
+    def _read(self, path):
+        try:
+            with open(path, 'rb') as f:
+                entry = pickle.loads(zlib.decompress(f.read()))
+        except (IOError, OSError):
+            return None
+        except Exception as e:
+            logger.debug("Discarding unreadable cache entry %s: %s" % (path, e))
+            return None
+        if not isinstance(entry, dict) or entry.get('version') != CACHE_VERSION:
+            return None
+        return entry
+
+    def load(self, address, addressType, scanType, expire=True):
+        """
+        Load a cache entry if it exists and has not expired.
+
+        :param address: Address of target BTLE device
+        :param addressType: Type of address [public | random]
+        :param scanType: Scan the entry was produced by (serviceScan | smartScan)
+        :param expire: Discard the entry if it is older than the TTL. Default: True
+        :type expire: bool
+        :return: cache entry dictionary (device, timestamp, databaseHash) or None
+        :rtype: dict
+        """
+        entry = self._read(self._path(address, addressType, scanType))
+        if entry is None:
+            return None
+        if expire and time.time() - entry['timestamp'] > self.ttl:
+            logger.debug("Cache entry for %s expired" % address)
+            self.invalidate(address, addressType, scanType)
+            return None
+        return entry
+
+    def lookup(self, address, addressType, scanType, connectionManager):
+        """
+        Return the cached device structure, provided it has not expired and the
+        device's Database Hash (when one was recorded and can be read) still matches.
+
+        :param address: Address of target BTLE device
+        :param addressType: Type of address [public | random]
+        :param scanType: Scan the entry was produced by (serviceScan | smartScan)
+        :param connectionManager: BLEConnectionManager used to read the Database Hash
+        :return: cached device structure or None
+        """
+        entry = self.load(address, addressType, scanType)
+        if entry is None:
+            return None
+        if entry['databaseHash'] is not None:
+            currentHash = readDatabaseHash(connectionManager)
+            #a failed read says nothing about the device, so only a hash that differs invalidates
+            if currentHash is not None and currentHash != entry['databaseHash']:
+                logger.debug("Database Hash for %s changed, invalidating cache" % address)
+                self.invalidate(address, addressType, scanType)
+                return None
+        logger.debug("Using cached device structure for %s" % address)
+        return entry['device']
+
+    def store(self, address, addressType, scanType, device, databaseHash=None):
+        """
+        Write a device structure to the cache. The entry is written to a temporary
+        file and renamed into place so readers never see a partial entry.
+
+        :param address: Address of target BTLE device
+        :param addressType: Type of address [public | random]
+        :param scanType: Scan the entry was produced by (serviceScan | smartScan)
+        :param device: Device structure returned by the scan
+        :param databaseHash: Database Hash read from the device (None if unsupported)
+        :return: Whether the entry was written
+        :rtype: bool
+        """
+        entry = {'version': CACHE_VERSION,
+                 'timestamp': time.time(),
+                 'databaseHash': databaseHash,
+                 'device': device}
+        try:
+            data = zlib.compress(pickle.dumps(entry, pickle.HIGHEST_PROTOCOL))
+        except Exception as e:
+            logger.debug("Unable to cache device structure for %s: %s" % (address, e))
+            return False
+        atomicWrite(self._path(address, addressType, scanType), data)
+        return True
+
+    def invalidate(self, address, addressType, scanType=None):
+        """
+        Remove cache entries for a device.
+
+        :param address: Address of target BTLE device
+        :param addressType: Type of address [public | random]
+        :param scanType: Scan entry to remove (None removes all entries for the device)
+        """
+        scanTypes = [scanType] if scanType is not None else ['serviceScan', 'smartScan']
+        for i in scanTypes:
+            try:
+                os.remove(self._path(address, addressType, i))
+            except OSError:
+                pass
@@ -0,0 +1,146 @@
+import logging
+
+logger = logging.getLogger(__name__)
+logger.addHandler(logging.NullHandler())
+
+#Characteristic property bits, in the order they are printed
+PROPERTY_NAMES = [(0x01, 'broadcast'), (0x02, 'read'), (0x04, 'write without response'), (0x08, 'write'),
+                  (0x10, 'notify'), (0x20, 'indicate'), (0x40, 'authenticated signed write'),
+                  (0x80, 'extended properties')]
+
+
+def propertyNames(properties):
+    """
+    :param properties: Characteristic properties bit field
+    :return: names of the properties set
+    :rtype: list of str
+    """
+    return [name for bit, name in PROPERTY_NAMES if properties & bit]
+
+
+def _printValue(attribute, prefix):
+    from bleSuite import utils
+    if attribute.error is not None:
+        print prefix + "Error:", attribute.error
+    elif attribute.value is not None:
+        utils.printHelper.printDataAndHex(attribute.value, False, prefix=prefix)
+
+
+class GATTDescriptor(object):
+    """
+    Descriptor found by a smart scan, with the value read from it (a list of
+    received data, as for readVal) or the reason it could not be read.
+    """
+    def __init__(self, handle, uuid):
+        self.handle = handle
+        self.uuid = uuid
+        self.value = None
+        self.error = None
+
+
+class GATTCharacteristic(object):
+    """
+    Characteristic found by a smart scan. value and error are left None when the
+    characteristic's properties do not permit reads.
+    """
+    def __init__(self, handle, valueHandle, uuid, properties):
+        self.handle = handle
+        self.valueHandle = valueHandle
+        self.uuid = uuid
+        self.properties = properties
+        self.value = None
+        self.error = None
+        self.descriptors = []
+
+
+class GATTService(object):
+    """
+    Primary service found by a smart scan.
+    """
+    def __init__(self, start, end, uuid):
+        self.start = start
+        self.end = end
+        self.uuid = uuid
+        self.characteristics = []
+
+
+class GATTDevice(object):
+    """
+    Device structure produced by a pipelined smart scan: services, their
+    characteristics and descriptors, and the values read from them.
+    """
+    def __init__(self, address):
+        self.address = address
+        self.services = []
+
+    def attributes(self):
+        """
+        :return: number of characteristics and descriptors in the structure
+        :rtype: int
+        """
+        return sum(len(characteristic.descriptors) + 1 for service in self.services
+                   for characteristic in service.characteristics)
+
+    def printDeviceStructure(self):
+        print "Device:", self.address
+        for service in self.services:
+            print "\nService %s (handles %04x-%04x)" % (service.uuid, service.start, service.end)
+            for characteristic in service.characteristics:
+                print "\tCharacteristic %s" % characteristic.uuid
+                print "\t\tHandle: %04x Value handle: %04x" % (characteristic.handle, characteristic.valueHandle)
+                print "\t\tProperties: 0x%02x (%s)" % (characteristic.properties,
+                                                      ", ".join(propertyNames(characteristic.properties)))
+                _printValue(characteristic, "\t\t")
+                for descriptor in characteristic.descriptors:
+                    print "\t\tDescriptor %s" % descriptor.uuid
+                    print "\t\t\tHandle: %04x" % descriptor.handle
+                    _printValue(descriptor, "\t\t\t")
+
+
+def _structureEntries(device):
+    #(attribute, handle): what a rescan is compared on, leaving out the values read
+    entries = {}
+    for service in device.services:
+        entries[('service', service.start)] = (service.uuid, service.end)
+        for characteristic in service.characteristics:
+            entries[('characteristic', characteristic.handle)] = (characteristic.uuid, characteristic.valueHandle,
+                                                                  characteristic.properties)
+            for descriptor in characteristic.descriptors:
+                entries[('descriptor', descriptor.handle)] = (descriptor.uuid,)
+    return entries
+
+
+def diffDevices(old, new):
+    """
+    Compare the structures found by two scans of a device. Services are matched
+    by start handle, characteristics by declaration handle and descriptors by
+    handle; the values read are not compared.
+
+    :param old: Structure found by the earlier scan
+    :param new: Structure found by the later scan
+    :type old: GATTDevice
+    :type new: GATTDevice
+    :return: dicts (change [added | removed | changed], attribute [service | characteristic | descriptor],
+    handle, uuid, previousUuid) in handle order
+    :rtype: list of dict
+    """
+    oldEntries = _structureEntries(old)
+    newEntries = _structureEntries(new)
+    changes = []
+    for key in set(oldEntries) | set(newEntries):
+        attribute, handle = key
+        before = oldEntries.get(key)
+        after = newEntries.get(key)
+        if before == after:
+            continue
+        if before is None:
+            change = 'added'
+        elif after is None:
+            change = 'removed'
+        else:
+            change = 'changed'
+        changes.append({'change': change, 'attribute': attribute, 'handle': handle,
+                        'uuid': (after or before)[0], 'previousUuid': before[0] if before is not None else None})
+    kinds = ['service', 'characteristic', 'descriptor']
+    changes.sort(key=lambda change: (change['handle'], kinds.index(change['attribute'])))
+    return changes
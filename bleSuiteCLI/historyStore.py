@@ -0,0 +1,295 @@
+import errno
+import json
+import os
+import re
+import sqlite3
+import threading
+import time
+from outputSinks import encodeValue
+import logging
+
+logger = logging.getLogger(__name__)
+logger.addHandler(logging.NullHandler())
+
+DEFAULT_HISTORY_PATH = os.path.join(os.path.expanduser("~"), ".bleSuite", "history.db")
+#Rows buffered before they are written in a single transaction, and the longest (seconds) a row is buffered
+DEFAULT_BATCH_SIZE = 500
+DEFAULT_FLUSH_INTERVAL = 2.0
+#Kind of attribute at each level of a device structure
+ATTRIBUTE_KINDS = ['service', 'characteristic', 'descriptor']
+#Attribute fields a handle is taken from, in order of preference
+_HANDLE_FIELDS = ['handle', 'start', 'valueHandle', 'value_handle']
+BLUETOOTH_BASE_UUID = "-0000-1000-8000-00805f9b34fb"
+#Relative times accepted by parseTime (ie 7d)
+_DURATION = re.compile(r"^(\d+(?:\.\d+)?)([smhdw])$")
+_DURATION_SECONDS = {'s': 1, 'm': 60, 'h': 60 * 60, 'd': 24 * 60 * 60, 'w': 7 * 24 * 60 * 60}
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS sightings (
+    seenAt REAL NOT NULL,
+    address TEXT NOT NULL,
+    addressType TEXT,
+    adapter TEXT,
+    name TEXT,
+    rssi INTEGER,
+    data BLOB,
+    scanResponse BLOB
+);
+CREATE INDEX IF NOT EXISTS sightingsAddress ON sightings (address, seenAt);
+CREATE INDEX IF NOT EXISTS sightingsTime ON sightings (seenAt);
+CREATE TABLE IF NOT EXISTS scans (
+    id INTEGER PRIMARY KEY,
+    scannedAt REAL NOT NULL,
+    address TEXT NOT NULL,
+    addressType TEXT,
+    adapter TEXT,
+    scanType TEXT NOT NULL,
+    structure TEXT
+);
+CREATE INDEX IF NOT EXISTS scansAddress ON scans (address, scannedAt);
+CREATE INDEX IF NOT EXISTS scansTime ON scans (scannedAt);
+CREATE TABLE IF NOT EXISTS attributes (
+    scanId INTEGER NOT NULL REFERENCES scans (id),
+    kind TEXT NOT NULL,
+    handle INTEGER,
+    uuid TEXT NOT NULL,
+    serviceUuid TEXT
+);
+CREATE INDEX IF NOT EXISTS attributesUuid ON attributes (uuid, kind);
+CREATE INDEX IF NOT EXISTS attributesScan ON attributes (scanId);
+"""
+
+
+def normalizeUUID(uuid):
+    """
+    :param uuid: 16, 32 or 128 bit UUID
+    :return: lower case 128 bit UUID (short UUIDs are expanded with the Bluetooth base UUID)
+    :rtype: str
+    """
+    uuid = uuid.strip().lower()
+    if uuid.startswith("0x"):
+        uuid = uuid[2:]
+    if len(uuid) == 4:
+        return "0000" + uuid + BLUETOOTH_BASE_UUID
+    if len(uuid) == 8:
+        return uuid + BLUETOOTH_BASE_UUID
+    return uuid
+
+
+def parseTime(value, now=None):
+    """
+    Parse a --since/--until time: a duration before now (ie 30m, 12h, 7d, 2w) or a
+    local date and time (YYYY-MM-DD, YYYY-MM-DD HH:MM or YYYY-MM-DD HH:MM:SS).
+
+    :param value: Time to parse
+    :param now: Time durations are counted back from. Default: now
+    :return: seconds since the epoch
+    :rtype: float
+    """
+    now = now if now is not None else time.time()
+    match = _DURATION.match(value.strip())
+    if match:
+        return now - float(match.group(1)) * _DURATION_SECONDS[match.group(2)]
+    for timeFormat in ("%Y-%m-%d %H:%M:%S", "%Y-%m-%d %H:%M", "%Y-%m-%d"):
+        try:
+            return time.mktime(time.strptime(value.strip(), timeFormat))
+        except ValueError:
+            pass
+    raise ValueError("%s is not a time. Please use a duration (ie 12h, 7d) or a date (YYYY-MM-DD [HH:MM[:SS]])"
+                     % value)
+
+
+def gattAttributes(structure):
+    """
+    Find the services, characteristics and descriptors in a scan's device structure.
+    Structures are walked generically (see outputSinks.encodeValue): an object with
+    a uuid is a service, one with a uuid inside a service is a characteristic, and
+    anything deeper is a descriptor.
+
+    :param structure: Device structure returned by serviceScan or smartScan
+    :return: list of (kind, handle, uuid, service uuid) tuples
+    """
+    attributes = []
+
+    def walk(value, depth, serviceUUID):
+        if isinstance(value, dict):
+            uuid = value.get('uuid')
+            if isinstance(uuid, basestring) and uuid:
+                uuid = normalizeUUID(uuid)
+                handle = None
+                for field in _HANDLE_FIELDS:
+                    if isinstance(value.get(field), (int, long)):
+                        handle = value[field]
+                        break
+                attributes.append((ATTRIBUTE_KINDS[min(depth, len(ATTRIBUTE_KINDS) - 1)], handle, uuid,
+                                   serviceUUID))
+                if depth == 0:
+                    serviceUUID = uuid
+                depth += 1
+            for key in sorted(value):
+                walk(value[key], depth, serviceUUID)
+        elif isinstance(value, list):
+            for item in value:
+                walk(item, depth, serviceUUID)
+    walk(encodeValue(structure, False), 0, None)
+    return attributes
+
+
+class HistoryStore(object):
+    """
+    SQLite store of scan history: each device sighting (with its advertising data
+    and RSSI when known) and every GATT table discovered, indexed by address,
+    service/characteristic UUID and time. Writes are buffered and committed in
+    batches so recording does not slow scans down; the store may be shared by
+    several threads.
+
+    :param path: Database file. Default: ~/.bleSuite/history.db
+    :param batchSize: Rows buffered before they are written. Default: 500
+    :param flushInterval: Longest time (seconds) a row is buffered. Default: 2
+    :type path: str
+    :type batchSize: int
+    :type flushInterval: float
+    """
+    def __init__(self, path=DEFAULT_HISTORY_PATH, batchSize=DEFAULT_BATCH_SIZE, flushInterval=DEFAULT_FLUSH_INTERVAL):
+        self.path = path
+        self.batchSize = batchSize
+        self.flushInterval = flushInterval
+        directory = os.path.dirname(path)
+        if directory:
+            try:
+                os.makedirs(directory)
+            except OSError as e:
+                if e.errno != errno.EEXIST:
+                    raise
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        self._db.text_factory = str
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("PRAGMA synchronous=NORMAL")
+        self._db.executescript(_SCHEMA)
+        self._lock = threading.Lock()
+        self._sightings = []
+        self._scans = []
+        self._lastFlush = time.time()
+
+    def recordSighting(self, address, addressType=None, adapter=None, name=None, rssi=None, data=None,
+                       scanResponse=None, seenAt=None):
+        """
+        Record that a device was seen advertising.
+
+        :param address: Device address
+        :param adapter: Adapter it was seen on
+        :param seenAt: Time it was seen. Default: now
+        """
+        row = (seenAt if seenAt is not None else time.time(), address.upper(), addressType, adapter or None, name,
+               rssi, sqlite3.Binary(data) if data is not None else None,
+               sqlite3.Binary(scanResponse) if scanResponse is not None else None)
+        with self._lock:
+            self._sightings.append(row)
+            self._flushIfDue()
+
+    def recordScan(self, address, addressType, adapter, scanType, structure, scannedAt=None):
+        """
+        Record a device structure discovered by serviceScan or smartScan.
+
+        :param address: Device address
+        :param addressType: Address type [public | random]
+        :param adapter: Adapter the scan ran on
+        :param scanType: serviceScan or smartScan
+        :param structure: Device structure returned by the scan
+        :param scannedAt: Time of the scan. Default: now
+        """
+        scan = (scannedAt if scannedAt is not None else time.time(), address.upper(), addressType, adapter or None,
+                scanType, json.dumps(encodeValue(structure, False)))
+        attributes = gattAttributes(structure)
+        with self._lock:
+            self._scans.append((scan, attributes))
+            self._flushIfDue()
+
+    def _flushIfDue(self):
+        if len(self._sightings) + len(self._scans) >= self.batchSize or \
+                time.time() - self._lastFlush >= self.flushInterval:
+            self._flush()
+
+    def _flush(self):
+        self._lastFlush = time.time()
+        if not self._sightings and not self._scans:
+            return
+        with self._db:
+            self._db.executemany("INSERT INTO sightings VALUES (?, ?, ?, ?, ?, ?, ?, ?)", self._sightings)
+            for scan, attributes in self._scans:
+                scanId = self._db.execute("INSERT INTO scans (scannedAt, address, addressType, adapter, scanType, "
+                                          "structure) VALUES (?, ?, ?, ?, ?, ?)", scan).lastrowid
+                self._db.executemany("INSERT INTO attributes VALUES (?, ?, ?, ?, ?)",
+                                     [(scanId,) + attribute for attribute in attributes])
+        logger.debug("Wrote %d sightings and %d scans to %s" % (len(self._sightings), len(self._scans), self.path))
+        self._sightings = []
+        self._scans = []
+
+    def flush(self):
+        """
+        Write any buffered rows.
+        """
+        with self._lock:
+            self._flush()
+
+    def devices(self, addresses=None, adapters=None, since=None, until=None, services=None, characteristics=None,
+                limit=None):
+        """
+        Devices seen (advertising or scanned) matching every filter supplied, most
+        recently seen first. Service and characteristic filters match devices whose
+        GATT table contained them in any recorded scan; the other filters apply to
+        when and where the device was seen.
+
+        :param addresses: Device addresses
+        :param adapters: Adapters the device was seen on
+        :param since: Earliest time seen (seconds since the epoch)
+        :param until: Latest time seen (seconds since the epoch)
+        :param services: Service UUIDs the device exposed
+        :param characteristics: Characteristic UUIDs the device exposed
+        :param limit: Maximum number of devices
+        :return: list of dicts (device, addressType, name, adapters, firstSeen, lastSeen, count)
+        """
+        self.flush()
+        conditions = []
+        parameters = []
+        if addresses:
+            conditions.append("address IN (%s)" % ", ".join("?" * len(addresses)))
+            parameters.extend(address.upper() for address in addresses)
+        if adapters:
+            conditions.append("adapter IN (%s)" % ", ".join("?" * len(adapters)))
+            parameters.extend(adapters)
+        if since is not None:
+            conditions.append("seenAt >= ?")
+            parameters.append(since)
+        if until is not None:
+            conditions.append("seenAt <= ?")
+            parameters.append(until)
+        for kind, uuids in (('service', services), ('characteristic', characteristics)):
+            for uuid in uuids or []:
+                conditions.append("address IN (SELECT scans.address FROM attributes JOIN scans ON "
+                                  "scans.id = attributes.scanId WHERE attributes.uuid = ? AND attributes.kind = ?)")
+                parameters.extend([normalizeUUID(uuid), kind])
+        where = (" WHERE " + " AND ".join(conditions)) if conditions else ""
+        #the filters are applied to each source so their indexes can be used
+        query = ("SELECT address, MAX(addressType), MAX(name), GROUP_CONCAT(DISTINCT adapter), MIN(seenAt), "
+                 "MAX(seenAt), COUNT(*) FROM ("
+                 "SELECT * FROM (SELECT address, addressType, name, adapter, seenAt FROM sightings)%s "
+                 "UNION ALL "
+                 "SELECT * FROM (SELECT address, addressType, NULL AS name, adapter, scannedAt AS seenAt "
+                 "FROM scans)%s"
+                 ") GROUP BY address ORDER BY MAX(seenAt) DESC" % (where, where))
+        if limit is not None:
+            query += " LIMIT %d" % limit
+        with self._lock:
+            rows = self._db.execute(query, parameters * 2).fetchall()
+        return [{'device': address, 'addressType': addressType, 'name': name, 'adapters': adapters,
+                 'firstSeen': firstSeen, 'lastSeen': lastSeen, 'count': count}
+                for address, addressType, name, adapters, firstSeen, lastSeen, count in rows]
+
+    def close(self):
+        """
+        Write any buffered rows and close the database.
+        """
+        with self._lock:
+            self._flush()
+            self._db.close()
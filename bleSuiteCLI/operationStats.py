@@ -0,0 +1,240 @@
+import collections
+import json
+import sys
+import threading
+import time
+import logging
+
+logger = logging.getLogger(__name__)
+logger.addHandler(logging.NullHandler())
+
+#Number of bits of each recorded value kept exactly. Latencies are stored in
+#microseconds, so 6 bits gives ~3% worst case error at any magnitude.
+SIGNIFICANT_BITS = 6
+PERCENTILES = [0.5, 0.9, 0.99]
+
+
+class LatencyHistogram(object):
+    """
+    HDR-style latency histogram. Values are split by power of two and each power
+    of two into 2**significantBits linear sub-buckets, so the relative error is
+    bounded at every magnitude while memory grows only with the range of values
+    seen (a few hundred buckets from microseconds to minutes).
+
+    :param significantBits: Bits of precision kept for each value. Default: 6
+    :type significantBits: int
+    """
+    def __init__(self, significantBits=SIGNIFICANT_BITS):
+        self.significantBits = significantBits
+        self.counts = collections.defaultdict(int)
+        self.count = 0
+        self.total = 0
+        self.min = None
+        self.max = 0
+
+    def _bucket(self, value):
+        shift = max(0, value.bit_length() - self.significantBits)
+        return (shift << self.significantBits) + (value >> shift)
+
+    def _bounds(self, bucket):
+        shift = bucket >> self.significantBits
+        mantissa = bucket & ((1 << self.significantBits) - 1)
+        return mantissa << shift, (mantissa + 1) << shift
+
+    def record(self, seconds):
+        """
+        :param seconds: Latency to record
+        :type seconds: float
+        """
+        value = max(0, int(seconds * 1000000))
+        self.counts[self._bucket(value)] += 1
+        self.count += 1
+        self.total += value
+        if self.min is None or value < self.min:
+            self.min = value
+        if value > self.max:
+            self.max = value
+
+    def merge(self, other):
+        """
+        Add the values recorded by another histogram (with the same precision) to this one.
+        """
+        for bucket, count in other.counts.items():
+            self.counts[bucket] += count
+        self.count += other.count
+        self.total += other.total
+        if other.min is not None and (self.min is None or other.min < self.min):
+            self.min = other.min
+        self.max = max(self.max, other.max)
+
+    def percentile(self, fraction):
+        """
+        :param fraction: Percentile as a fraction (ie 0.99)
+        :return: latency (seconds) at the percentile, None if nothing was recorded
+        :rtype: float
+        """
+        if not self.count:
+            return None
+        target = max(1, int(round(fraction * self.count)))
+        seen = 0
+        for bucket in sorted(self.counts):
+            seen += self.counts[bucket]
+            if seen >= target:
+                low, high = self._bounds(bucket)
+                #report the middle of the bucket, never beyond the values actually seen
+                return min(max((low + high - 1) / 2.0, self.min), self.max) / 1000000.0
+        return self.max / 1000000.0
+
+    def summary(self):
+        """
+        :return: count, mean, min, max and PERCENTILES (seconds)
+        :rtype: dict
+        """
+        summary = {'count': self.count,
+                   'mean': self.total / 1000000.0 / self.count if self.count else None,
+                   'min': self.min / 1000000.0 if self.min is not None else None,
+                   'max': self.max / 1000000.0 if self.count else None}
+        for fraction in PERCENTILES:
+            summary['p%g' % (fraction * 100)] = self.percentile(fraction)
+        return summary
+
+
+class _Timer(object):
+    """
+    Context manager that records the time spent in a with block, counting
+    blocks that raise under <name>.error.
+    """
+    __slots__ = ('stats', 'name', 'start')
+
+    def __init__(self, stats, name):
+        self.stats = stats
+        self.name = name
+
+    def __enter__(self):
+        self.start = time.time()
+        return self
+
+    def __exit__(self, excType, excValue, traceback):
+        self.stats.record(self.name, time.time() - self.start)
+        if excType is not None:
+            self.stats.increment(self.name + ".error")
+        return False
+
+
+class _NullTimer(object):
+    def __enter__(self):
+        return self
+
+    def __exit__(self, excType, excValue, traceback):
+        return False
+
+_NULL_TIMER = _NullTimer()
+
+
+class OperationStats(object):
+    """
+    Counters and latency histograms for the operations performed by the wrappers
+    (connects, reads, writes, retries, async completions). Collection is off until
+    enable() is called, and the disabled paths do no more than an attribute check,
+    so instrumentation can stay in place on hot paths. Safe to use from several
+    threads (ie device workers and GATT callbacks).
+    """
+    def __init__(self):
+        self.enabled = False
+        self.started = None
+        self._lock = threading.Lock()
+        self.counters = collections.Counter()
+        self.histograms = {}
+
+    def enable(self):
+        self.enabled = True
+        self.started = time.time()
+
+    def disable(self):
+        self.enabled = False
+
+    def reset(self):
+        """
+        Discard everything collected so far (ie between daemon requests).
+        """
+        with self._lock:
+            self.counters.clear()
+            self.histograms = {}
+            self.started = time.time() if self.enabled else None
+
+    def increment(self, name, count=1):
+        """
+        :param name: Counter name (ie retry.read.handle)
+        :param count: Amount to add. Default: 1
+        """
+        if not self.enabled:
+            return
+        with self._lock:
+            self.counters[name] += count
+
+    def record(self, name, seconds):
+        """
+        :param name: Operation name (ie connect)
+        :param seconds: Time the operation took
+        """
+        if not self.enabled:
+            return
+        with self._lock:
+            histogram = self.histograms.get(name)
+            if histogram is None:
+                histogram = self.histograms[name] = LatencyHistogram()
+            histogram.record(seconds)
+
+    def timed(self, name):
+        """
+        :param name: Operation name
+        :return: context manager recording the time spent in its with block
+        """
+        if not self.enabled:
+            return _NULL_TIMER
+        return _Timer(self, name)
+
+    def snapshot(self):
+        """
+        :return: counters, histogram summaries and raw histogram buckets (for merging runs)
+        :rtype: dict
+        """
+        with self._lock:
+            return {'elapsed': time.time() - self.started if self.started is not None else None,
+                    'counters': dict(self.counters),
+                    'latency': dict((name, histogram.summary()) for name, histogram in self.histograms.items()),
+                    'buckets': dict((name, {'significantBits': histogram.significantBits,
+                                            'counts': dict(histogram.counts)})
+                                    for name, histogram in self.histograms.items())}
+
+    def printReport(self, out=None):
+        """
+        Print a summary table of latencies and counters.
+
+        :param out: File-like object to write to. Default: sys.stderr
+        """
+        out = out if out is not None else sys.stderr
+        snapshot = self.snapshot()
+        columns = ["p%g" % (fraction * 100) for fraction in PERCENTILES]
+        out.write("\nOperation statistics (%.2f seconds)\n" % (snapshot['elapsed'] or 0))
+        out.write("%-24s %8s %10s %10s %s %10s\n" % ("operation (ms)", "count", "mean", "min",
+                                                    " ".join("%10s" % column for column in columns), "max"))
+        for name in sorted(snapshot['latency']):
+            summary = snapshot['latency'][name]
+            values = [summary['mean'], summary['min']] + [summary[column] for column in columns] + [summary['max']]
+            out.write("%-24s %8d %s\n" % (name, summary['count'],
+                                          " ".join("%10.2f" % (value * 1000) for value in values)))
+        if snapshot['counters']:
+            out.write("\n%-24s %8s\n" % ("counter", "count"))
+            for name in sorted(snapshot['counters']):
+                out.write("%-24s %8d\n" % (name, snapshot['counters'][name]))
+
+    def export(self, path):
+        """
+        Write snapshot() to path as JSON.
+        """
+        with open(path, 'w') as f:
+            json.dump(self.snapshot(), f, indent=2, sort_keys=True)
+
+#Statistics shared by every wrapper in the process (see --stats)
+stats = OperationStats()
@@ -0,0 +1,292 @@
+import binascii
+import collections
+import csv
+import json
+import string
+import sys
+import threading
+import logging
+
+logger = logging.getLogger(__name__)
+logger.addHandler(logging.NullHandler())
+
+OUTPUT_FORMATS = ['text', 'jsonl', 'csv']
+#Buffer size used when writing results to a file
+WRITE_BUFFER_SIZE = 1024 * 1024
+#Depth limit when converting scan results (device structures) to plain data
+MAX_STRUCTURE_DEPTH = 8
+
+
+class ThreadOutput(object):
+    """
+    Stand-in for sys.stdout/sys.stderr that sends each thread's output to the stream
+    the thread redirected it to (see redirect), falling back to default. Lets
+    concurrent requests (ie in the daemon) each print to their own client.
+
+    :param default: Stream used by threads that have not redirected their output
+    """
+    def __init__(self, default):
+        self.default = default
+        self._local = threading.local()
+
+    def target(self):
+        """
+        :return: stream the calling thread's output currently goes to
+        """
+        return getattr(self._local, 'out', None) or self.default
+
+    def redirect(self, out):
+        """
+        Send the calling thread's output to out (None restores the default). Returns the previous stream.
+        """
+        previous = getattr(self._local, 'out', None)
+        self._local.out = out
+        return previous
+
+    def write(self, data):
+        self.target().write(data)
+
+    def flush(self):
+        self.target().flush()
+
+    def __getattr__(self, name):
+        return getattr(self.target(), name)
+
+
+_installLock = threading.Lock()
+
+
+def threadStdout():
+    """
+    :return: sys.stdout, first wrapped in a ThreadOutput if it is not one already
+    """
+    with _installLock:
+        if not isinstance(sys.stdout, ThreadOutput):
+            sys.stdout = ThreadOutput(sys.stdout)
+        return sys.stdout
+
+
+def currentStdout():
+    """
+    :return: stream print statements on the calling thread currently write to
+    """
+    if isinstance(sys.stdout, ThreadOutput):
+        return sys.stdout.target()
+    return sys.stdout
+
+
+class ProgressLine(object):
+    """
+    Status line shared by the device workers, showing the progress of every device
+    still running. The line is redrawn under a lock so workers reporting at once do
+    not garble each other's output, and each device's final progress is left on a
+    line of its own.
+
+    :param out: Stream the line is written to (None writes to the current sys.stderr). Default: None
+    """
+    def __init__(self, out=None):
+        self.out = out
+        self._progress = collections.OrderedDict()
+        self._width = 0
+        self._lock = threading.Lock()
+
+    def update(self, key, message, done=False):
+        """
+        :param key: Device (or other task) the message is about
+        :param message: Its progress (ie AA:BB:CC:DD:EE:FF: read 3/10 attributes)
+        :param done: Whether the task finished, leaving message on its own line
+        :type done: bool
+        """
+        out = self.out if self.out is not None else sys.stderr
+        with self._lock:
+            if done:
+                self._progress.pop(key, None)
+                self._draw(out, message)
+                out.write("\n")
+                self._width = 0
+                if self._progress:
+                    self._draw(out, "  ".join(self._progress.values()))
+            else:
+                self._progress[key] = message
+                self._draw(out, "  ".join(self._progress.values()))
+            out.flush()
+
+    def _draw(self, out, line):
+        #pad with spaces to clear what is left of a longer line
+        out.write("\r" + line + " " * max(0, self._width - len(line)))
+        self._width = len(line)
+
+
+def encodeValue(value, binary=True, depth=0):
+    """
+    Convert a result value into something json/csv can represent. Byte strings
+    are hex encoded when binary (ie data read from or written to a device); other
+    strings are kept as is unless they contain unprintable characters. Lists are
+    encoded item by item and other objects (ie the device structures returned by
+    scans) are converted from their attributes.
+
+    :param value: Value to encode
+    :param binary: Whether strings in value are raw data. Default: True
+    :type binary: bool
+    :return: encoded value
+    """
+    if value is None or isinstance(value, (bool, int, long, float)):
+        return value
+    if isinstance(value, str):
+        if binary or any(c not in string.printable for c in value):
+            return binascii.hexlify(value)
+        return value
+    if isinstance(value, unicode):
+        return value
+    if depth >= MAX_STRUCTURE_DEPTH:
+        return repr(value)
+    if isinstance(value, (list, tuple)):
+        return [encodeValue(i, binary, depth + 1) for i in value]
+    if isinstance(value, dict):
+        return dict((str(k), encodeValue(v, False, depth + 1)) for k, v in value.items())
+    if hasattr(value, '__dict__'):
+        return dict((k, encodeValue(v, False, depth + 1)) for k, v in vars(value).items()
+                    if not k.startswith('_') and not callable(v))
+    return repr(value)
+
+
+class OutputSink(object):
+    """
+    Base class for result output. Records are dictionaries; write() may be called
+    from several threads (ie device workers) at once.
+
+    :param out: File-like object results are written to
+    :param fields: Names of the fields each record may contain, in output order
+    :param binaryFields: Fields holding raw device data, which are hex encoded
+    :param closeOutput: Close out when the sink is closed (None closes anything but stdout). Default: None
+    :type fields: list of str
+    :type binaryFields: list of str
+    :type closeOutput: bool
+    """
+    def __init__(self, out, fields, binaryFields=(), closeOutput=None):
+        self.out = out
+        self.fields = fields
+        self.binaryFields = set(binaryFields)
+        self.closeOutput = closeOutput if closeOutput is not None else out is not sys.stdout
+        self._lock = threading.Lock()
+
+    def encode(self, record, field):
+        """
+        :return: encoded value of field in record (None if missing)
+        """
+        return encodeValue(record.get(field), field in self.binaryFields)
+
+    def write(self, record):
+        """
+        Write a single result record.
+
+        :param record: Result fields
+        :type record: dict
+        """
+        with self._lock:
+            self._write(record)
+
+    def _write(self, record):
+        raise NotImplementedError
+
+    def flush(self):
+        """
+        Push written records out (ie for long running commands writing to a pipe).
+        """
+        with self._lock:
+            self.out.flush()
+
+    def close(self):
+        """
+        Flush buffered output, closing the output file unless it is stdout.
+        """
+        with self._lock:
+            self.out.flush()
+            if self.closeOutput:
+                self.out.close()
+
+
+class JSONLSink(OutputSink):
+    """
+    Writes each record as a JSON object on its own line.
+    """
+    def _write(self, record):
+        self.out.write(json.dumps(dict((k, self.encode(record, k)) for k in self.fields
+                                       if record.get(k) is not None)) + "\n")
+
+
+class CSVSink(OutputSink):
+    """
+    Writes records as CSV rows, with a header row of the sink's fields. Nested
+    values (ie scan results) are written as JSON.
+    """
+    def __init__(self, out, fields, binaryFields=(), closeOutput=None):
+        OutputSink.__init__(self, out, fields, binaryFields, closeOutput)
+        self._writer = csv.writer(out)
+        self._writer.writerow(fields)
+
+    def _write(self, record):
+        row = []
+        for k in self.fields:
+            value = self.encode(record, k)
+            if isinstance(value, (list, dict)):
+                value = json.dumps(value)
+            row.append("" if value is None else value)
+        self._writer.writerow(row)
+
+
+class TextSink(OutputSink):
+    """
+    Human readable output. Records are printed by formatter, a function that
+    prints a single record; the calling thread's stdout (see ThreadOutput) is
+    pointed at the sink's output while it runs so formatters can use the bleSuite
+    print helpers.
+
+    :param out: File-like object results are written to
+    :param fields: Names of the fields each record may contain
+    :param formatter: Function that prints a single record
+    :param binaryFields: Fields holding raw device data
+    :param closeOutput: Close out when the sink is closed (None closes anything but stdout). Default: None
+    """
+    def __init__(self, out, fields, formatter, binaryFields=(), closeOutput=None):
+        OutputSink.__init__(self, out, fields, binaryFields, closeOutput)
+        self.formatter = formatter
+
+    def _write(self, record):
+        if self.out is currentStdout():
+            self.formatter(record)
+            return
+        #only redirect this thread, other threads (ie device workers) may be printing elsewhere
+        stdout = threadStdout()
+        previous = stdout.redirect(self.out)
+        try:
+            self.formatter(record)
+        finally:
+            stdout.redirect(previous)
+
+
+def createSink(outputFormat, fields, formatter, path=None, binaryFields=()):
+    """
+    Create the output sink for a command.
+
+    :param outputFormat: text, jsonl or csv
+    :param fields: Names of the fields each record may contain, in output order
+    :param formatter: Function that prints a record in text mode
+    :param path: File to write results to (None writes to stdout)
+    :param binaryFields: Fields holding raw device data, which are hex encoded in jsonl and csv
+    :type outputFormat: str
+    :type fields: list of str
+    :type path: str
+    :type binaryFields: list of str
+    :return: OutputSink
+    """
+    out = currentStdout() if path is None else open(path, 'wb', WRITE_BUFFER_SIZE)
+    closeOutput = path is not None
+    if outputFormat == 'jsonl':
+        return JSONLSink(out, fields, binaryFields, closeOutput)
+    if outputFormat == 'csv':
+        return CSVSink(out, fields, binaryFields, closeOutput)
+    if outputFormat == 'text':
+        return TextSink(out, fields, formatter, binaryFields, closeOutput)
+    raise ValueError("%s is not a supported output format. Please use one of: %s" %
+                     (outputFormat, ", ".join(OUTPUT_FORMATS)))
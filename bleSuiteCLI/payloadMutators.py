@@ -0,0 +1,143 @@
+import collections
+import itertools
+import random
+import logging
+
+logger = logging.getLogger(__name__)
+logger.addHandler(logging.NullHandler())
+
+#Payload lengths either side of the ATT MTU limits (23 byte default MTU, 247/251 byte LE data length
+#extension) and the 512 byte maximum attribute length
+BOUNDARY_LENGTHS = [0, 1, 2, 19, 20, 21, 22, 23, 24, 127, 128, 129, 243, 244, 245, 246, 247, 248, 251, 255, 256,
+                    257, 511, 512, 513]
+#Values parsers commonly mishandle: integer limits in either byte order, format strings and separators
+DICTIONARY = ["\x00", "\x01", "\x7f", "\x80", "\xff", "\x00\x00", "\xff\xff", "\x7f\xff", "\xff\x7f", "\x00\x80",
+              "\x80\x00", "\x00\x00\x00\x00", "\xff\xff\xff\xff", "\xff\xff\xff\x7f", "\x00\x00\x00\x80",
+              "%s%s%s%s", "%x%x%x%x", "%n%n%n%n", "\r\n", "\x00" * 20, "\xff" * 20, "A" * 64]
+#Bytes substituted by random mutations
+_INTERESTING_BYTES = "\x00\x01\x7f\x80\xfe\xff"
+
+
+def seedPayloads(seeds, rng=None):
+    """
+    The seeds themselves, followed by the DICTIONARY values.
+
+    :param seeds: List of seed payloads
+    :return: generator of payload strings
+    """
+    for payload in itertools.chain(seeds, DICTIONARY):
+        yield payload
+
+
+def bitFlips(seeds, rng=None):
+    """
+    Every seed with each of its bits flipped in turn (8 payloads per seed byte).
+
+    :param seeds: List of seed payloads
+    :return: generator of payload strings
+    """
+    for seed in seeds:
+        for index in range(len(seed)):
+            byte = ord(seed[index])
+            for bit in range(8):
+                yield seed[:index] + chr(byte ^ (1 << bit)) + seed[index + 1:]
+
+
+def lengthBoundaries(seeds, rng=None):
+    """
+    Every seed repeated or truncated to each of the BOUNDARY_LENGTHS.
+
+    :param seeds: List of seed payloads
+    :return: generator of payload strings
+    """
+    for seed in seeds:
+        filler = seed or "A"
+        for length in BOUNDARY_LENGTHS:
+            yield (filler * (length // len(filler) + 1))[:length]
+
+
+def randomMutations(seeds, rng=None):
+    """
+    Endless stream of seeds with one to four random byte flips, interesting byte
+    substitutions, insertions, deletions or duplicated chunks applied.
+
+    :param seeds: List of seed payloads
+    :param rng: random.Random to draw mutations from (use a seeded one for repeatable runs). Default: new Random
+    :return: generator of payload strings
+    """
+    rng = rng if rng is not None else random.Random()
+    while True:
+        payload = bytearray(rng.choice(seeds))
+        for i in range(rng.randint(1, 4)):
+            operation = rng.randint(0, 4)
+            index = rng.randint(0, len(payload))
+            if operation == 0 and index < len(payload):
+                payload[index] ^= 1 << rng.randint(0, 7)
+            elif operation == 1 and index < len(payload):
+                payload[index] = ord(rng.choice(_INTERESTING_BYTES))
+            elif operation == 2:
+                payload[index:index] = chr(rng.randint(0, 255))
+            elif operation == 3 and payload:
+                del payload[min(index, len(payload) - 1)]
+            elif operation == 4:
+                end = rng.randint(index, len(payload))
+                payload[end:end] = payload[index:end]
+        yield str(payload)
+
+
+#Mutators selectable by name, in the order their payloads are generated
+MUTATORS = collections.OrderedDict([('seeds', seedPayloads), ('bitflip', bitFlips), ('length', lengthBoundaries),
+                                    ('random', randomMutations)])
+#Mutators that produce a bounded number of payloads
+FINITE_MUTATORS = ['seeds', 'bitflip', 'length']
+
+
+def fuzzPayloads(seeds, mutators=FINITE_MUTATORS, rng=None):
+    """
+    Lazily produce fuzz payloads by running each mutator over the seeds in turn.
+    Payloads are generated as they are consumed, so memory use does not depend
+    on the number of payloads.
+
+    :param seeds: List of seed payloads (an empty list uses a single zero byte)
+    :param mutators: Names of the MUTATORS to apply. Default: seeds, bitflip, length
+    :param rng: random.Random used by the random mutator. Default: new Random
+    :type seeds: list of str
+    :type mutators: list of str
+    :return: generator of payload strings
+    """
+    seeds = list(seeds) or ["\x00"]
+    for name in mutators:
+        if name not in MUTATORS:
+            raise ValueError("%s is not a fuzz mutator. Please use one of: %s" % (name, ", ".join(MUTATORS)))
+    for name in mutators:
+        logger.debug("Generating %s payloads" % name)
+        for payload in MUTATORS[name](seeds, rng):
+            yield payload
+
+
+def minimizePayload(payload, reproduces, maxTests=64):
+    """
+    Shrink a payload that triggers a failure by removing ever smaller chunks of it
+    (delta debugging), keeping each removal after which reproduces() still fails.
+
+    :param payload: Payload that triggers the failure
+    :param reproduces: Function called with a candidate payload, returning whether it still triggers the failure
+    :param maxTests: Maximum number of candidates tried. Default: 64
+    :type payload: str
+    :type maxTests: int
+    :return: (smallest failing payload found, number of candidates tried)
+    :rtype: (str, int)
+    """
+    tests = 0
+    chunk = len(payload) // 2
+    while chunk >= 1 and tests < maxTests:
+        index = 0
+        while index < len(payload) and tests < maxTests:
+            candidate = payload[:index] + payload[index + chunk:]
+            tests += 1
+            if reproduces(candidate):
+                payload = candidate
+            else:
+                index += chunk
+        chunk //= 2
+    return payload, tests
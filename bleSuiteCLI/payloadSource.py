@@ -0,0 +1,71 @@
+import logging
+
+logger = logging.getLogger(__name__)
+logger.addHandler(logging.NullHandler())
+
+#Size of each read from a payload file
+READ_SIZE = 64 * 1024
+
+
+def filePayloads(files, delimiter="EOF", readSize=READ_SIZE):
+    """
+    Lazily produce write payloads from a list of files. Files are read in binary mode
+    in fixed size blocks and payloads are yielded as soon as their closing delimiter
+    is seen, so memory use does not depend on the size of the files and the first
+    payload is available before the rest of the file is read.
+
+    Payloads are split the same way str.split(delimiter) would split the full
+    file contents (including an empty final payload when a file ends in the delimiter).
+
+    :param files: List of file paths (None entries are skipped)
+    :param delimiter: String separating payloads within a file, or EOF to send each file as one payload. Default: EOF
+    :param readSize: Number of bytes read from the file at a time. Default: 64KB
+    :type files: list of str
+    :type delimiter: str
+    :type readSize: int
+    :return: generator of payload strings
+    """
+    if not delimiter:
+        raise ValueError("Payload delimiter can not be empty. Supply EOF to send the entire contents of a file.")
+    for dataFile in files:
+        if dataFile is None:
+            continue
+        logger.debug("Reading file: %s", dataFile)
+        with open(dataFile, 'rb') as f:
+            if delimiter == 'EOF':
+                yield f.read()
+                continue
+            for payload in _splitStream(f, delimiter, readSize):
+                yield payload
+
+
+def _splitStream(f, delimiter, readSize):
+    """
+    Yield delimiter separated payloads from an open file, carrying partial payloads
+    (and delimiters split across block boundaries) over to the next read.
+
+    Each block is searched once: the payload in progress is kept as a list of pieces
+    and only the last len(delimiter) - 1 bytes, which may begin a delimiter, are
+    searched again with the next block, so long payloads cost linear time.
+    """
+    pieces = []
+    tail = b""
+    while True:
+        block = f.read(readSize)
+        if not block:
+            break
+        data = tail + block
+        start = 0
+        while True:
+            index = data.find(delimiter, start)
+            if index == -1:
+                break
+            pieces.append(data[start:index])
+            yield b"".join(pieces)
+            pieces = []
+            start = index + len(delimiter)
+        keep = max(start, len(data) - len(delimiter) + 1)
+        pieces.append(data[start:keep])
+        tail = data[keep:]
+    pieces.append(tail)
+    yield b"".join(pieces)
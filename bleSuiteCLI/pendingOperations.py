@@ -0,0 +1,278 @@
+import collections
+import heapq
+import itertools
+import threading
+import time
+import logging
+
+logger = logging.getLogger(__name__)
+logger.addHandler(logging.NullHandler())
+
+
+class PendingOperation(object):
+    """
+    Bookkeeping for a single outstanding asynchronous GATT request.
+
+    :param opId: Identifier assigned by the owning PendingOperationTable
+    :param key: Caller supplied key (handle or UUID) the request was issued for
+    :param response: Response object returned by the bleServiceManager async call
+    :param deadline: Absolute time (time.time()) after which the request times out
+    :param context: Extra caller data carried through to the result (ie the input value written)
+    :param issued: Time (time.time()) the request was issued. Default: now
+    :type opId: int
+    :type key: str
+    :type deadline: float
+    :type issued: float
+    """
+    __slots__ = ('opId', 'key', 'response', 'deadline', 'context', 'timedOut', 'issued', 'finished')
+
+    def __init__(self, opId, key, response, deadline, context=None, issued=None):
+        self.opId = opId
+        self.key = key
+        self.response = response
+        self.deadline = deadline
+        self.context = context
+        self.timedOut = False
+        self.issued = issued if issued is not None else time.time()
+        #Time the response arrived (or the deadline passed)
+        self.finished = None
+
+    @property
+    def latency(self):
+        """
+        Time (seconds) from issue to completion or timeout, None while outstanding.
+        """
+        if self.finished is None:
+            return None
+        return self.finished - self.issued
+
+    def received(self):
+        """
+        Returns the data received for this operation (if any) from the underlying GATTResponse.
+        """
+        try:
+            return self.response[1].received()
+        except (TypeError, IndexError, AttributeError):
+            return None
+
+
+class PendingOperationTable(object):
+    """
+    Table of outstanding asynchronous requests. Operations are completed by
+    the response callback handed to bleServiceManager (see completionCallback) and
+    deadlines are kept in a min-heap so timeouts fire when due instead of
+    polling every outstanding request.
+
+    Requests that cannot be issued with a completion callback (ie read by UUID) are
+    registered with hooked=False; these are checked with received() each time
+    the table wakes, at most every probeInterval seconds.
+
+    :param probeInterval: Maximum time (seconds) between checks of operations without a completion callback
+    :type probeInterval: float
+    """
+    def __init__(self, probeInterval=0.05):
+        self.probeInterval = probeInterval
+        self._condition = threading.Condition()
+        self._ids = itertools.count()
+        self._pending = {}
+        self._unhooked = set()
+        self._deadlines = []
+        self._completed = collections.deque()
+        self._reserved = set()
+        self._early = set()
+
+    def __len__(self):
+        with self._condition:
+            return len(self._pending)
+
+    def reserve(self):
+        """
+        Reserve an operation id. Must be called before issuing the request so the
+        completion callback can be built ahead of time.
+
+        :return: operation id
+        :rtype: int
+        """
+        opId = next(self._ids)
+        with self._condition:
+            self._reserved.add(opId)
+        return opId
+
+    def completionCallback(self, opId):
+        """
+        Build a response callback that completes opId when the device answers.
+
+        :param opId: Operation id returned by reserve()
+        :return: function to pass as the responseFunction of a bleServiceManager async call
+        """
+        def callback(data=None):
+            logger.debug("Raw callback data: %s" % data)
+            self.complete(opId)
+        return callback
+
+    def add(self, opId, key, response, timeout, context=None, hooked=True):
+        """
+        Register an issued request.
+
+        :param opId: Operation id returned by reserve()
+        :param key: Handle or UUID the request was issued for
+        :param response: Response returned by the bleServiceManager async call
+        :param timeout: Time (in seconds) until the request times out
+        :param context: Extra data returned with the result
+        :param hooked: Whether the request was issued with completionCallback(opId)
+        :type timeout: int
+        :type hooked: bool
+        :return: PendingOperation
+        """
+        now = time.time()
+        op = PendingOperation(opId, key, response, now + timeout, context, now)
+        with self._condition:
+            self._reserved.discard(opId)
+            if opId in self._early:
+                self._early.discard(opId)
+                op.finished = now
+                self._completed.append(op)
+                self._condition.notify()
+                return op
+            self._pending[opId] = op
+            if not hooked:
+                self._unhooked.add(opId)
+            heapq.heappush(self._deadlines, (op.deadline, opId))
+        return op
+
+    def complete(self, opId):
+        """
+        Mark an operation complete. Safe to call from the GATT callback thread.
+
+        :param opId: Operation id
+        """
+        with self._condition:
+            op = self._pending.pop(opId, None)
+            if op is None:
+                # Response arrived before add() registered the request
+                if opId in self._reserved:
+                    self._early.add(opId)
+                return
+            self._unhooked.discard(opId)
+            op.finished = time.time()
+            self._completed.append(op)
+            self._condition.notify()
+
+    def _expire(self, now):
+        while self._deadlines and self._deadlines[0][0] <= now:
+            deadline, opId = heapq.heappop(self._deadlines)
+            op = self._pending.pop(opId, None)
+            if op is None:
+                continue
+            self._unhooked.discard(opId)
+            # Late response that never reached a callback
+            op.timedOut = not op.received()
+            op.finished = now
+            self._completed.append(op)
+
+    def _probe(self):
+        for opId in list(self._unhooked):
+            op = self._pending[opId]
+            if op.received():
+                self._unhooked.discard(opId)
+                del self._pending[opId]
+                op.finished = time.time()
+                self._completed.append(op)
+
+    def waitCompleted(self):
+        """
+        Block until at least one operation completes or times out.
+
+        :return: list of PendingOperation that finished (empty if nothing is outstanding).
+        Check PendingOperation.timedOut for requests that never received a response.
+        :rtype: list of PendingOperation
+        """
+        with self._condition:
+            while True:
+                now = time.time()
+                self._expire(now)
+                if self._unhooked:
+                    self._probe()
+                if self._completed:
+                    finished = list(self._completed)
+                    self._completed.clear()
+                    return finished
+                if not self._pending:
+                    return []
+                wait = self._deadlines[0][0] - now
+                if self._unhooked:
+                    wait = min(wait, self.probeInterval)
+                self._condition.wait(max(wait, 0))
+
+    def takeCompleted(self):
+        """
+        Operations that have completed or timed out so far, without waiting for more.
+
+        :return: list of PendingOperation that finished
+        :rtype: list of PendingOperation
+        """
+        with self._condition:
+            self._expire(time.time())
+            if self._unhooked:
+                self._probe()
+            finished = list(self._completed)
+            self._completed.clear()
+            return finished
+
+    def drain(self):
+        """
+        Generator yielding each operation as it completes or times out until nothing is outstanding.
+        """
+        while True:
+            finished = self.waitCompleted()
+            if not finished:
+                return
+            for op in finished:
+                yield op
+
+
+class InFlightWindow(object):
+    """
+    Limit on the number of requests kept outstanding at once. When adaptive,
+    the window grows by one slot after each successful response and is halved
+    on a timeout or disconnect (additive increase, multiplicative decrease),
+    never leaving the range [minSize, maxSize].
+
+    :param size: Number of outstanding requests allowed at first
+    :param adaptive: Whether the window should adapt to timeouts and disconnects
+    :param minSize: Smallest size an adaptive window will shrink to. Default: 1
+    :param maxSize: Largest size an adaptive window will grow to (None keeps it at or below size). Default: None
+    :type size: int
+    :type adaptive: bool
+    :type minSize: int
+    :type maxSize: int
+    """
+    def __init__(self, size, adaptive=False, minSize=1, maxSize=None):
+        if size < 1:
+            raise ValueError("%s is not a valid window size. Please supply a value of at least 1" % size)
+        if maxSize is None:
+            maxSize = size
+        if maxSize < size:
+            raise ValueError("Maximum window size %s is smaller than the window size %s" % (maxSize, size))
+        self.maxSize = maxSize
+        self.minSize = min(minSize, size)
+        self.adaptive = adaptive
+        self.size = size
+
+    def hasRoom(self, outstanding):
+        """
+        :param outstanding: Number of requests currently in flight
+        :type outstanding: int
+        :return: Whether another request may be issued
+        :rtype: bool
+        """
+        return outstanding < self.size
+
+    def onSuccess(self):
+        if self.adaptive and self.size < self.maxSize:
+            self.size += 1
+
+    def onFailure(self):
+        if self.adaptive:
+            self.size = max(self.minSize, self.size // 2)
+            logger.debug("Shrinking in-flight window to %s" % self.size)
@@ -0,0 +1,80 @@
+import cPickle as pickle
+import collections
+import threading
+from atomicFile import atomicWrite
+import logging
+
+logger = logging.getLogger(__name__)
+logger.addHandler(logging.NullHandler())
+
+
+class PersistedLRUCache(object):
+    """
+    Least recently used map persisted between runs, shared by the caches that only
+    differ in the shape of their keys and values (see UUIDHandleCache and
+    ValueLengthCache). Subclasses build keys with _key and expose get/put in terms
+    of their own arguments. A single cache may be shared between threads.
+
+    :param path: File the cache is loaded from and saved to (None keeps it in memory)
+    :param maxEntries: Number of entries kept before the least recently used is evicted
+    :type path: str
+    :type maxEntries: int
+    """
+    #What the cache holds, used in log messages
+    description = "cache"
+
+    def __init__(self, path, maxEntries):
+        self.path = path
+        self.maxEntries = maxEntries
+        self._entries = collections.OrderedDict()
+        self._dirty = False
+        self._lock = threading.Lock()
+        if path is not None:
+            self._load()
+
+    def _load(self):
+        try:
+            with open(self.path, 'rb') as f:
+                entries = pickle.load(f)
+        except (IOError, OSError):
+            return
+        except Exception as e:
+            logger.debug("Discarding unreadable %s %s: %s" % (self.description, self.path, e))
+            return
+        if isinstance(entries, list):
+            self._entries = collections.OrderedDict(entries[-self.maxEntries:])
+
+    def _get(self, key):
+        with self._lock:
+            value = self._entries.pop(key, None)
+            if value is not None:
+                self._entries[key] = value
+        return value
+
+    def _put(self, key, value):
+        with self._lock:
+            if self._entries.pop(key, None) != value:
+                self._dirty = True
+            self._entries[key] = value
+            while len(self._entries) > self.maxEntries:
+                self._entries.popitem(last=False)
+                self._dirty = True
+
+    def _discard(self, key):
+        with self._lock:
+            if self._entries.pop(key, None) is not None:
+                self._dirty = True
+
+    def __len__(self):
+        return len(self._entries)
+
+    def save(self):
+        """
+        Write the cache to disk if it changed. The file is written to a temporary
+        file and renamed into place so a concurrent run never reads a partial cache.
+        """
+        with self._lock:
+            if self.path is None or not self._dirty:
+                return
+            atomicWrite(self.path, pickle.dumps(list(self._entries.items()), pickle.HIGHEST_PROTOCOL))
+            self._dirty = False
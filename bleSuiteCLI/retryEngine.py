@@ -0,0 +1,297 @@
+import random
+import threading
+import time
+from operationStats import stats
+import logging
+
+logger = logging.getLogger(__name__)
+logger.addHandler(logging.NullHandler())
+
+#Structured error codes for failed GATT operations
+ERROR_INVALID_HANDLE = 'invalid-handle'
+ERROR_NOT_PERMITTED = 'not-permitted'
+ERROR_INSUFFICIENT_SECURITY = 'insufficient-security'
+ERROR_DISCONNECTED = 'disconnected'
+ERROR_TIMEOUT = 'timeout'
+ERROR_CIRCUIT_OPEN = 'circuit-open'
+ERROR_UNKNOWN = 'unknown'
+
+#Errors that are answers from the device, so repeating the operation can not succeed
+PERMANENT_ERRORS = frozenset([ERROR_INVALID_HANDLE, ERROR_NOT_PERMITTED, ERROR_INSUFFICIENT_SECURITY])
+
+#gattlib only raises RuntimeError, so errors are classified from their messages (checked in order)
+_ERROR_MESSAGES = [
+    (ERROR_INVALID_HANDLE, ("invalid handle", "attribute not found", "no attribute found")),
+    (ERROR_NOT_PERMITTED, ("can't be read", "can't be written", "not permitted")),
+    (ERROR_INSUFFICIENT_SECURITY, ("authentication", "authorization", "encryption", "insufficient")),
+    (ERROR_DISCONNECTED, ("disconnect", "not connected", "not ready", "connection refused",
+                          "connection reset", "transport endpoint", "host is down", "no route")),
+    (ERROR_TIMEOUT, ("timeout", "timed out")),
+]
+
+#Defaults for RetryPolicy
+DEFAULT_MAX_TRIES = 5
+DEFAULT_BASE_DELAY = 0.05
+DEFAULT_MAX_DELAY = 2.0
+#Defaults for CircuitBreaker
+DEFAULT_FAILURE_THRESHOLD = 3
+DEFAULT_RESET_TIMEOUT = 30.0
+
+
+def classifyError(error):
+    """
+    Map an error raised by gattlib/bleSuite to one of the ERROR_* codes.
+
+    :param error: Exception (or message) to classify
+    :return: error code
+    :rtype: str
+    """
+    if isinstance(error, BLEOperationError):
+        return error.code
+    message = str(error).lower()
+    for code, fragments in _ERROR_MESSAGES:
+        if any(fragment in message for fragment in fragments):
+            return code
+    return ERROR_UNKNOWN
+
+
+class BLEOperationError(RuntimeError):
+    """
+    Raised when a GATT operation fails permanently, runs out of attempts or is
+    refused because the device's circuit breaker is open.
+
+    :param code: One of the ERROR_* codes
+    :param message: Description of the underlying error
+    :param attempts: Number of attempts made. Default: 1
+    :type code: str
+    :type message: str
+    :type attempts: int
+    """
+    def __init__(self, code, message, attempts=1):
+        RuntimeError.__init__(self, "[%s] %s (after %d attempt%s)" % (code, message, attempts,
+                                                                     "" if attempts == 1 else "s"))
+        self.code = code
+        self.attempts = attempts
+
+    @property
+    def permanent(self):
+        return self.code in PERMANENT_ERRORS
+
+
+class RetryPolicy(object):
+    """
+    How often and how quickly transient failures are retried. The delay before
+    retry n is drawn uniformly from [0, min(maxDelay, baseDelay * 2**n)]
+    ("full jitter"), which spreads out retries from operations that failed together.
+
+    :param maxTries: Number of times a failing operation is retried after its first attempt,
+    as the wrappers always counted it. Default: 5
+    :param baseDelay: Delay (seconds) the backoff starts from. Default: 0.05
+    :param maxDelay: Longest delay (seconds) between attempts. Default: 2.0
+    :type maxTries: int
+    :type baseDelay: float
+    :type maxDelay: float
+    """
+    def __init__(self, maxTries=DEFAULT_MAX_TRIES, baseDelay=DEFAULT_BASE_DELAY, maxDelay=DEFAULT_MAX_DELAY):
+        if maxTries < 0:
+            raise ValueError("%s is not a valid number of tries. Please supply a value of at least 0" % maxTries)
+        self.maxTries = maxTries
+        self.baseDelay = baseDelay
+        self.maxDelay = maxDelay
+        self._random = random.Random()
+
+    def delay(self, attempt):
+        """
+        :param attempt: Number of attempts made so far (1 or more)
+        :return: time (seconds) to wait before the next attempt
+        :rtype: float
+        """
+        if self.baseDelay <= 0:
+            return 0.0
+        return self._random.uniform(0, min(self.maxDelay, self.baseDelay * (2 ** attempt)))
+
+
+class CircuitBreaker(object):
+    """
+    Stops work against a device that keeps failing. After failureThreshold
+    consecutive operations exhaust their retries the breaker opens and further
+    operations fail immediately with ERROR_CIRCUIT_OPEN. Once resetTimeout
+    seconds pass a single trial operation is let through; its success closes
+    the breaker and its failure opens it again.
+
+    :param failureThreshold: Consecutive failed operations before the breaker opens. Default: 3
+    :param resetTimeout: Time (seconds) the breaker stays open. Default: 30
+    :type failureThreshold: int
+    :type resetTimeout: float
+    """
+    def __init__(self, failureThreshold=DEFAULT_FAILURE_THRESHOLD, resetTimeout=DEFAULT_RESET_TIMEOUT):
+        self.failureThreshold = failureThreshold
+        self.resetTimeout = resetTimeout
+        self.failures = 0
+        self.openedAt = None
+        self._trial = False
+        self._lock = threading.Lock()
+
+    def allow(self):
+        """
+        :return: Whether an operation may be attempted now
+        :rtype: bool
+        """
+        with self._lock:
+            if self.openedAt is None:
+                return True
+            if self._trial or time.time() - self.openedAt < self.resetTimeout:
+                return False
+            self._trial = True
+            return True
+
+    def onSuccess(self):
+        with self._lock:
+            self.failures = 0
+            self.openedAt = None
+            self._trial = False
+
+    def onFailure(self):
+        with self._lock:
+            self.failures += 1
+            if self._trial or self.failures >= self.failureThreshold:
+                if self.openedAt is None or self._trial:
+                    stats.increment("circuit.open")
+                self.openedAt = time.time()
+                self._trial = False
+
+
+_breakers = {}
+_breakersLock = threading.Lock()
+
+
+def deviceBreaker(address):
+    """
+    :param address: Device address
+    :return: CircuitBreaker shared by every operation on the device in this process
+    :rtype: CircuitBreaker
+    """
+    with _breakersLock:
+        breaker = _breakers.get(address)
+        if breaker is None:
+            breaker = _breakers[address] = CircuitBreaker()
+        return breaker
+
+
+class ConnectionSession(object):
+    """
+    Connection to a single device shared by every operation issued through it.
+    Reconnects are serialized and counted in generations: operations note the
+    generation they were issued in, and when several of them fail after the same
+    disconnect only the first triggers a reconnect.
+
+    :param connectionManager: BLEConnectionManager for the device
+    """
+    def __init__(self, connectionManager):
+        self.connectionManager = connectionManager
+        self.generation = 0
+        self._lock = threading.Lock()
+
+    def connect(self):
+        """
+        Open the initial connection.
+        """
+        with self._lock:
+            with stats.timed("connect"):
+                self.connectionManager.connect()
+
+    def ensureConnected(self, generation=None, force=False):
+        """
+        Reconnect if the link was lost. With force, reconnect even if the connection
+        manager still reports the link as up, unless another operation has already
+        reconnected since generation.
+
+        :param generation: Generation the caller last saw (None for the current generation)
+        :param force: Reconnect without trusting isConnected(). Default: False
+        :return: whether this call reconnected
+        :rtype: bool
+        """
+        with self._lock:
+            if generation is not None and generation != self.generation:
+                return False
+            if not force and self.connectionManager.isConnected():
+                return False
+            with stats.timed("reconnect"):
+                self.connectionManager.connect()
+            self.generation += 1
+            return True
+
+
+class RetryEngine(object):
+    """
+    Runs GATT operations against a device, retrying transient failures with
+    backoff, sharing reconnects between operations and consulting the device's
+    circuit breaker. Permanent failures (see PERMANENT_ERRORS) are raised straight
+    away as BLEOperationError.
+
+    :param session: ConnectionSession for the device
+    :param policy: RetryPolicy. Default: RetryPolicy()
+    :param breaker: CircuitBreaker for the device (None disables). Default: None
+    :type session: ConnectionSession
+    :type policy: RetryPolicy
+    :type breaker: CircuitBreaker
+    """
+    def __init__(self, session, policy=None, breaker=None):
+        self.session = session
+        self.policy = policy if policy is not None else RetryPolicy()
+        self.breaker = breaker
+
+    @property
+    def connectionManager(self):
+        return self.session.connectionManager
+
+    def call(self, name, function, *args):
+        """
+        Call function(connectionManager, *args) until it succeeds, fails permanently
+        or runs out of attempts.
+
+        :param name: Operation name used in statistics (ie read.handle)
+        :param function: bleServiceManager function to call
+        :return: value returned by function
+        :raises BLEOperationError: when the operation does not succeed
+        """
+        if self.breaker is not None and not self.breaker.allow():
+            stats.increment("circuit.rejected")
+            raise BLEOperationError(ERROR_CIRCUIT_OPEN, "Too many consecutive failures on %s, not attempting %s" %
+                                    (getattr(self.connectionManager, 'address', "device"), name), 0)
+        attempt = 0
+        #generation of a connection that dropped under the last attempt
+        droppedGeneration = None
+        while True:
+            try:
+                if droppedGeneration is not None:
+                    self.session.ensureConnected(droppedGeneration, force=True)
+                    droppedGeneration = None
+                else:
+                    self.session.ensureConnected()
+                with stats.timed(name):
+                    result = function(self.connectionManager, *args)
+            except RuntimeError as e:
+                attempt += 1
+                code = classifyError(e)
+                if code in PERMANENT_ERRORS:
+                    #the device answered, so the link itself is healthy
+                    if self.breaker is not None:
+                        self.breaker.onSuccess()
+                    raise BLEOperationError(code, e, attempt)
+                #the first attempt plus maxTries retries
+                if attempt > self.policy.maxTries:
+                    logger.debug("%s tries exceeded for %s: %s" % (self.policy.maxTries, name, e))
+                    if self.breaker is not None:
+                        self.breaker.onFailure()
+                    raise BLEOperationError(code, e, attempt)
+                logger.debug("Error: %s (%s) Trying Again" % (e, code))
+                stats.increment("retry." + name)
+                stats.increment("error." + code)
+                if code == ERROR_DISCONNECTED and droppedGeneration is None:
+                    droppedGeneration = self.session.generation
+                time.sleep(self.policy.delay(attempt))
+                continue
+            if self.breaker is not None:
+                self.breaker.onSuccess()
+            return result
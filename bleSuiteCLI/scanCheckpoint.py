@@ -0,0 +1,125 @@
+import cPickle as pickle
+import os
+import time
+import zlib
+from gattStructure import GATTDevice
+from atomicFile import atomicWrite
+import logging
+
+logger = logging.getLogger(__name__)
+logger.addHandler(logging.NullHandler())
+
+DEFAULT_CHECKPOINT_DIR = os.path.join(os.path.expanduser("~"), ".bleSuite", "checkpoints")
+#Time (in seconds) after which a checkpoint is too old to resume from: 1 day
+DEFAULT_CHECKPOINT_TTL = 24 * 60 * 60
+#Shortest time (in seconds) between checkpoints written while a scan makes progress
+CHECKPOINT_INTERVAL = 1.0
+CHECKPOINT_VERSION = 1
+
+
+class ScanCheckpoint(object):
+    """
+    Progress of a pipelined serviceScan or smartScan: the device structure found
+    so far and which parts of the discovery are complete. Values already read are
+    kept in the structure itself. Checkpoints are written (as zlib compressed
+    pickles, renamed into place) at most every CHECKPOINT_INTERVAL seconds while
+    the scan runs and whenever save() is called, so a failed scan can be resumed.
+
+    :param address: Address of target BTLE device
+    :param addressType: Type of address [public | random]
+    :param scanType: serviceScan or smartScan
+    :param checkpointDir: Directory checkpoints are written to (None keeps it in memory). Default: ~/.bleSuite/checkpoints
+    :type address: str
+    :type addressType: str
+    :type scanType: str
+    :type checkpointDir: str
+    """
+    def __init__(self, address, addressType, scanType, checkpointDir=DEFAULT_CHECKPOINT_DIR):
+        self.address = address
+        self.addressType = addressType
+        self.scanType = scanType
+        self.checkpointDir = checkpointDir
+        self.device = GATTDevice(address)
+        self.servicesDiscovered = False
+        #start handles of the services whose characteristics have been discovered
+        self.characteristicsDiscovered = set()
+        #declaration handles of the characteristics whose descriptors have been discovered
+        self.descriptorsDiscovered = set()
+        self.timestamp = time.time()
+        self._lastSaved = 0
+
+    def __getstate__(self):
+        state = dict(self.__dict__)
+        del state['_lastSaved']
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._lastSaved = 0
+
+    @staticmethod
+    def _path(checkpointDir, address, addressType, scanType):
+        name = "%s_%s_%s.checkpoint" % (address.replace(":", "").lower(), addressType, scanType)
+        return os.path.join(checkpointDir, name)
+
+    @classmethod
+    def load(cls, address, addressType, scanType, checkpointDir=DEFAULT_CHECKPOINT_DIR, ttl=DEFAULT_CHECKPOINT_TTL):
+        """
+        Load the checkpoint left by an earlier scan of a device, unless it has expired.
+
+        :param address: Address of target BTLE device
+        :param addressType: Type of address [public | random]
+        :param scanType: serviceScan or smartScan
+        :param checkpointDir: Directory checkpoints are written to. Default: ~/.bleSuite/checkpoints
+        :param ttl: Time (in seconds) after which a checkpoint is discarded. Default: 1 day
+        :return: ScanCheckpoint or None
+        """
+        path = cls._path(checkpointDir, address, addressType, scanType)
+        try:
+            with open(path, 'rb') as f:
+                entry = pickle.loads(zlib.decompress(f.read()))
+        except (IOError, OSError):
+            return None
+        except Exception as e:
+            logger.debug("Discarding unreadable checkpoint %s: %s" % (path, e))
+            return None
+        if not isinstance(entry, dict) or entry.get('version') != CHECKPOINT_VERSION:
+            return None
+        checkpoint = entry['checkpoint']
+        if time.time() - checkpoint.timestamp > ttl:
+            logger.debug("Checkpoint for %s expired" % address)
+            checkpoint.discard()
+            return None
+        #later writes go wherever this checkpoint was loaded from
+        checkpoint.checkpointDir = checkpointDir
+        return checkpoint
+
+    def save(self):
+        """
+        Write the checkpoint.
+        """
+        if self.checkpointDir is None:
+            return
+        self._lastSaved = time.time()
+        self.timestamp = self._lastSaved
+        data = zlib.compress(pickle.dumps({'version': CHECKPOINT_VERSION, 'checkpoint': self},
+                                          pickle.HIGHEST_PROTOCOL))
+        atomicWrite(self._path(self.checkpointDir, self.address, self.addressType, self.scanType), data)
+
+    def update(self):
+        """
+        Write the checkpoint if CHECKPOINT_INTERVAL has passed since it was last written.
+        """
+        if time.time() - self._lastSaved >= CHECKPOINT_INTERVAL:
+            self.save()
+
+    def discard(self):
+        """
+        Remove the checkpoint once the scan has completed.
+        """
+        if self.checkpointDir is None:
+            return
+        try:
+            os.remove(self._path(self.checkpointDir, self.address, self.addressType, self.scanType))
+        except OSError:
+            pass
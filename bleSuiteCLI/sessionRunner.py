@@ -0,0 +1,299 @@
+import binascii
+import Queue
+import shlex
+import threading
+import time
+from bleSuite import bleConnectionManager
+from bleSuite import bleServiceManager
+from cmdLineToolWrappers import EventRequester, bleServiceRead, bleServiceReadAsync, bleServiceWrite, \
+    bleServiceWriteAsync, NOTIFICATION_QUEUE_SIZE, LINK_CHECK_INTERVAL
+from retryEngine import RetryEngine, RetryPolicy, ConnectionSession, BLEOperationError, deviceBreaker
+from operationStats import stats
+import logging
+
+logger = logging.getLogger(__name__)
+logger.addHandler(logging.NullHandler())
+
+#Script steps and the options each accepts (as name=value tokens)
+STEP_OPTIONS = {'read': [], 'readUUID': [], 'write': [], 'subscribe': ['for', 'mode'], 'sleep': []}
+#Client characteristic configuration values for each subscribe mode
+_CONFIG_VALUES = {0: "\x00\x00", 1: "\x01\x00", 2: "\x02\x00", 3: "\x03\x00"}
+
+
+class SessionStep(object):
+    """
+    A single parsed script line.
+
+    :param line: Line number in the script
+    :param command: read, readUUID, write, subscribe or sleep
+    :param arguments: Positional arguments
+    :param options: name=value options
+    :type line: int
+    :type command: str
+    :type arguments: list of str
+    :type options: dict
+    """
+    __slots__ = ('line', 'command', 'arguments', 'options')
+
+    def __init__(self, line, command, arguments, options):
+        self.line = line
+        self.command = command
+        self.arguments = arguments
+        self.options = options
+
+
+def _handle(token):
+    #accept 0x prefixed handles, the wrappers expect bare hex
+    try:
+        int(token, 16)
+    except ValueError:
+        raise ValueError("%s is not a valid handle. Please supply a hexadecimal handle (ie 002a)" % token)
+    return token[2:] if token.lower().startswith("0x") else token
+
+
+def _payload(token):
+    #hex: prefixed payloads are decoded, anything else is written as is (like --data)
+    if token.startswith("hex:"):
+        try:
+            return binascii.unhexlify(token[4:])
+        except TypeError:
+            raise ValueError("%s is not valid hex data." % token)
+    return token
+
+
+def parseStep(text, line=0):
+    """
+    Parse a script line. Blank lines and lines starting with # are ignored.
+
+        read <handle> [<handle> ...]
+        readUUID <uuid> [<uuid> ...]
+        write <handle> <data> [<data> ...]     (data prefixed with hex: is hex decoded)
+        subscribe <handle> [<handle> ...] [for=<seconds>] [mode=<0-3>]
+        sleep <seconds>
+
+    :param text: Script line
+    :param line: Line number, used in error messages. Default: 0
+    :return: SessionStep, or None for blank lines and comments
+    :raises ValueError: if the line is not a valid step
+    """
+    tokens = shlex.split(text, comments=True)
+    if not tokens:
+        return None
+    command = tokens[0]
+    if command not in STEP_OPTIONS:
+        raise ValueError("Line %d: %s is not a session step. Please use one of: %s" %
+                         (line, command, ", ".join(sorted(STEP_OPTIONS))))
+    arguments = []
+    options = {}
+    for token in tokens[1:]:
+        name, separator, value = token.partition("=")
+        if separator and name in STEP_OPTIONS[command]:
+            options[name] = value
+        else:
+            arguments.append(token)
+    try:
+        if command in ('read', 'subscribe'):
+            arguments = [_handle(token) for token in arguments]
+        elif command == 'write':
+            arguments = [_handle(arguments[0])] + [_payload(token) for token in arguments[1:]]
+            if len(arguments) < 2:
+                raise IndexError
+        elif command == 'sleep':
+            arguments = [float(arguments[0])]
+        if 'for' in options:
+            options['for'] = float(options['for'])
+        if 'mode' in options:
+            options['mode'] = int(options['mode'])
+            if options['mode'] not in _CONFIG_VALUES:
+                raise ValueError("%s is not a valid mode. Please supply a value between 0 and 3 (inclusive)" %
+                                 options['mode'])
+    except IndexError:
+        raise ValueError("Line %d: %s is missing arguments" % (line, command))
+    except ValueError as e:
+        raise ValueError("Line %d: %s" % (line, e))
+    if not arguments:
+        raise ValueError("Line %d: %s is missing arguments" % (line, command))
+    return SessionStep(line, command, arguments, options)
+
+
+def readSteps(script):
+    """
+    Generator parsing script lines as they are read, so a stream (ie stdin) can
+    be executed while it is still being written.
+
+    :param script: File-like object (or list of lines)
+    :return: generator of SessionStep, or of ValueError (with the line number as .line) for lines that
+    fail to parse
+    """
+    for number, text in enumerate(script, 1):
+        try:
+            step = parseStep(text, number)
+        except ValueError as e:
+            e.line = number
+            yield e
+            continue
+        if step is not None:
+            yield step
+
+
+class DeviceSession(object):
+    """
+    Persistent connection to a single device that script steps run over.
+
+    :param address: Address of target BTLE device
+    :param adapter: Host adapter (Empty string to use host's default adapter)
+    :param addressType: Type of address you want to connect to [public | random]
+    :param securityLevel: Security level [low | medium | high]
+    :param retryPolicy: RetryPolicy for failed operations. Default: RetryPolicy()
+    :type address: str
+    :type adapter: str
+    :type addressType: str
+    :type securityLevel: str
+    :type retryPolicy: RetryPolicy
+    """
+    def __init__(self, address, adapter, addressType, securityLevel, retryPolicy=None):
+        self.address = address
+        self.adapter = adapter
+        self.addressType = addressType
+        self.securityLevel = securityLevel
+        self.events = Queue.Queue(NOTIFICATION_QUEUE_SIZE)
+        connectionManager = bleConnectionManager.BLEConnectionManager(address, adapter, addressType, securityLevel,
+                                                                      createRequester=False)
+        #every step shares this requester, so subscribe steps can receive events
+        self.requester = EventRequester(self.events, threading.Event(), address, False)
+        connectionManager.setRequester(self.requester)
+        session = ConnectionSession(connectionManager)
+        session.connect()
+        self.retryPolicy = retryPolicy if retryPolicy is not None else RetryPolicy()
+        self.engine = RetryEngine(session, self.retryPolicy, deviceBreaker(address))
+
+    def run(self, step, onResult, onEvent, async=False, timeout=5):
+        """
+        Run a single step.
+
+        :param step: SessionStep to run
+        :param onResult: Function called with (step, kind, result) for each read/write result
+        :param onEvent: Function called with (step, kind, handle, data, timestamp) for each subscribe event
+        :param async: Use the asynchronous read/write wrappers. Default: False
+        :param timeout: Timeout (seconds) for asynchronous operations. Default: 5
+        """
+        def stepResult(kind, result):
+            onResult(step, kind, result)
+        common = (self.address, self.adapter, self.addressType, self.securityLevel)
+        maxTries = self.retryPolicy.maxTries
+        if step.command == 'read' or step.command == 'readUUID':
+            handles, UUIDS = (step.arguments, [None]) if step.command == 'read' else ([None], step.arguments)
+            if async:
+                bleServiceReadAsync(*common, handles=handles, UUIDS=UUIDS, maxTries=maxTries, timeout=timeout,
+                                    onResult=stepResult, engine=self.engine)
+            else:
+                bleServiceRead(*common, handles=handles, UUIDS=UUIDS, onResult=stepResult, engine=self.engine)
+        elif step.command == 'write':
+            if async:
+                bleServiceWriteAsync(*common, handles=step.arguments[:1], inputs=step.arguments[1:],
+                                     timeout=timeout, onResult=stepResult, engine=self.engine)
+            else:
+                bleServiceWrite(*common, handles=step.arguments[:1], inputs=step.arguments[1:],
+                                onResult=stepResult, engine=self.engine)
+        elif step.command == 'sleep':
+            time.sleep(step.arguments[0])
+        elif step.command == 'subscribe':
+            self.subscribe(step.arguments, lambda *event: onEvent(step, *event), step.options.get('for', 10.0),
+                           step.options.get('mode', 1))
+
+    def subscribe(self, handles, onEvent, duration=10.0, mode=1, stop=None):
+        """
+        Enable notifications/indications on handles, pass events to onEvent until
+        duration passes (or stop is set) and disable them again. Events are
+        re-enabled if the link drops in the meantime.
+
+        :param handles: Handles (hex strings) to enable events on
+        :param onEvent: Function called with (kind, handle, data, timestamp) for each event
+        :param duration: Time (seconds) to listen for (None listens until stop is set). Default: 10
+        :param mode: 1=notifications, 2=indications, 3=both. Default: 1
+        :param stop: threading.Event that ends the subscription early. Default: None
+        """
+        #drop events left over from earlier steps
+        while True:
+            try:
+                self.events.get_nowait()
+            except Queue.Empty:
+                break
+        configVal = _CONFIG_VALUES[mode]
+
+        def configure(value):
+            for handle in handles:
+                self.engine.call("write", bleServiceManager.bleServiceWriteToHandle, int(handle, 16), value)
+        configure(configVal)
+        try:
+            end = time.time() + duration if duration is not None else None
+            while stop is None or not stop.is_set():
+                wait = LINK_CHECK_INTERVAL
+                if end is not None:
+                    wait = min(wait, end - time.time())
+                    if wait <= 0:
+                        break
+                try:
+                    kind, handle, data, timestamp = self.events.get(True, wait)
+                except Queue.Empty:
+                    if self.requester.disconnected.is_set() or not self.engine.connectionManager.isConnected():
+                        self.requester.disconnected.clear()
+                        logger.debug("Connection Lost, re-enabling events")
+                        try:
+                            self.engine.session.ensureConnected(force=True)
+                        except RuntimeError as e:
+                            #configure() keeps retrying the connection with backoff
+                            logger.debug("Reconnect failed: %s" % e)
+                        configure(configVal)
+                    continue
+                onEvent(kind, handle, data, timestamp)
+        finally:
+            for handle in handles:
+                try:
+                    self.engine.call("write", bleServiceManager.bleServiceWriteToHandle, int(handle, 16),
+                                     _CONFIG_VALUES[0])
+                except BLEOperationError as e:
+                    logger.debug("Could not disable events on handle %s: %s" % (handle, e))
+
+    def close(self):
+        """
+        Disconnect from the device, if the connection manager supports it.
+        """
+        disconnect = getattr(self.engine.connectionManager, 'disconnect', None)
+        if disconnect is not None:
+            try:
+                disconnect()
+            except RuntimeError as e:
+                logger.debug("Disconnect from %s failed: %s" % (self.address, e))
+
+
+def runSession(deviceSession, steps, onResult, onEvent, onError, async=False, timeout=5):
+    """
+    Run script steps over a single device session, streaming results as each step
+    completes. A failing step is reported to onError and the script continues
+    (the retry engine reconnects as needed).
+
+    :param deviceSession: DeviceSession to run the steps on
+    :param steps: Iterable of SessionStep (or ValueError for unparsable lines, see readSteps)
+    :param onResult: Function called with (step, kind, result) for each read/write result
+    :param onEvent: Function called with (step, kind, handle, data, timestamp) for each subscribe event
+    :param onError: Function called with (step, error) for each failed step (step is None for parse errors)
+    :param async: Use the asynchronous read/write wrappers. Default: False
+    :param timeout: Timeout (seconds) for asynchronous operations. Default: 5
+    :return: number of steps that failed
+    :rtype: int
+    """
+    failed = 0
+    for step in steps:
+        if isinstance(step, ValueError):
+            onError(None, step)
+            failed += 1
+            continue
+        try:
+            with stats.timed("session." + step.command):
+                deviceSession.run(step, onResult, onEvent, async, timeout)
+        except RuntimeError as e:
+            logger.debug("Line %d (%s) failed: %s" % (step.line, step.command, e))
+            onError(step, e)
+            failed += 1
+    return failed
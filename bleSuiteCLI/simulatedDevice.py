@@ -0,0 +1,653 @@
+import collections
+import contextlib
+import hashlib
+import heapq
+import itertools
+import random
+import struct
+import sys
+import threading
+import time
+import types
+import logging
+
+logger = logging.getLogger(__name__)
+logger.addHandler(logging.NullHandler())
+
+#Service the simulated device's attributes are grouped under in scan results (further services count down from it)
+SIMULATED_SERVICE_UUID = "0000a000-0000-1000-8000-00805f9b34fb"
+#Database Hash and Service Changed characteristics, and the descriptor configuring indications of the latter
+DATABASE_HASH_UUID = "00002b2a-0000-1000-8000-00805f9b34fb"
+SERVICE_CHANGED_UUID = "00002a05-0000-1000-8000-00805f9b34fb"
+CLIENT_CONFIGURATION_UUID = "00002902-0000-1000-8000-00805f9b34fb"
+#Requester methods lent to requesters set on a simulated connection that lack them
+_SIMULATED_DISCOVERY = ['discover_primary', 'discover_characteristics', 'discover_descriptors']
+
+
+class LatencyModel(object):
+    """
+    Distribution the simulated device draws each operation's response time from.
+
+    :param mean: Mean response time (seconds)
+    :param distribution: constant, uniform (mean +/- jitter), exponential or lognormal. Default: constant
+    :param jitter: Spread of the uniform distribution or sigma of the lognormal distribution. Default: 0
+    :type mean: float
+    :type distribution: str
+    :type jitter: float
+    """
+    def __init__(self, mean, distribution='constant', jitter=0.0):
+        if distribution not in ('constant', 'uniform', 'exponential', 'lognormal'):
+            raise ValueError("%s is not a supported latency distribution." % distribution)
+        self.mean = mean
+        self.distribution = distribution
+        self.jitter = jitter
+        self._random = random.Random(0)
+
+    def sample(self):
+        """
+        :return: response time (seconds)
+        :rtype: float
+        """
+        if self.mean <= 0:
+            return 0.0
+        if self.distribution == 'uniform':
+            return max(0.0, self._random.uniform(self.mean - self.jitter, self.mean + self.jitter))
+        if self.distribution == 'exponential':
+            return self._random.expovariate(1.0 / self.mean)
+        if self.distribution == 'lognormal':
+            return self._random.lognormvariate(0, self.jitter) * self.mean
+        return self.mean
+
+
+class SimulatedAttribute(object):
+    """
+    Single attribute in a simulated device's attribute table.
+
+    :param uuid: Attribute type UUID
+    :param value: Current value
+    :param readable: Whether reads are permitted. Default: True
+    :param writable: Whether writes are permitted. Default: True
+    :param writeWithoutResponse: Whether Write Commands are permitted. Default: True
+    """
+    __slots__ = ('uuid', 'value', 'readable', 'writable', 'writeWithoutResponse')
+
+    def __init__(self, uuid, value, readable=True, writable=True, writeWithoutResponse=True):
+        self.uuid = uuid
+        self.value = value
+        self.readable = readable
+        self.writable = writable
+        self.writeWithoutResponse = writeWithoutResponse
+
+
+class SimulatedResponse(object):
+    """
+    Stand-in for gattlib's GATTResponse.
+    """
+    def __init__(self):
+        self._data = None
+
+    def received(self):
+        return self._data
+
+
+class SimulatedDevice(object):
+    """
+    In-process GATT peripheral used in place of a real device (see simulate()).
+    Operations take a latency drawn from a LatencyModel and may fail through the
+    injected error rates, raising the same RuntimeError messages gattlib does.
+
+    :param attributes: Attribute table (handle: SimulatedAttribute)
+    :param latency: Response time of each operation. Default: no latency
+    :param connectLatency: Time taken by each connection. Default: no latency
+    :param disconnectRate: Probability an operation drops the connection. Default: 0
+    :param dropRate: Probability an async operation never receives a response. Default: 0
+    :param seed: Seed for error injection so runs are repeatable. Default: 0
+    :param crashOn: Function called with each written value; when it returns True the write drops the
+    connection instead of completing (a simulated firmware crash). Default: None
+    :param mtu: ATT_MTU responses are truncated to. Default: 23
+    :param readMultipleVariable: Whether Read Multiple Variable requests are supported. Default: True
+    :param serviceSize: Number of attributes grouped into each primary service (None for a single service).
+    Default: None
+    :param silentErrors: Whether async requests the device refuses go unanswered instead of failing, as
+    gattlib reports no errors for them. Default: False
+    :type attributes: dict
+    :type latency: LatencyModel
+    :type connectLatency: LatencyModel
+    :type disconnectRate: float
+    :type dropRate: float
+    :type crashOn: function
+    :type mtu: int
+    :type readMultipleVariable: bool
+    :type serviceSize: int
+    :type silentErrors: bool
+    """
+    def __init__(self, attributes, latency=None, connectLatency=None, disconnectRate=0.0, dropRate=0.0, seed=0,
+                 crashOn=None, mtu=23, readMultipleVariable=True, serviceSize=None, silentErrors=False):
+        self.attributes = attributes
+        self.silentErrors = silentErrors
+        self.serviceSize = serviceSize
+        self.crashOn = crashOn
+        self.mtu = mtu
+        self.readMultipleVariable = readMultipleVariable
+        self.latency = latency or LatencyModel(0)
+        self.connectLatency = connectLatency or LatencyModel(0)
+        self.disconnectRate = disconnectRate
+        self.dropRate = dropRate
+        self.connected = False
+        self.closed = False
+        self.requester = None
+        self.counters = collections.Counter()
+        #When trace is set, the time each request is issued is queued per handle (see issued)
+        self.trace = False
+        self.issued = collections.defaultdict(collections.deque)
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+        self._responses = []
+        self._responseIds = itertools.count()
+        self._responseReady = threading.Condition(self._lock)
+        self._notifiers = []
+        #handle ranges changed by updateAttributes, indicated on Service Changed once indications are enabled
+        self._serviceChanged = []
+        responder = threading.Thread(target=self._deliverResponses, name="simulated-device-responder")
+        responder.daemon = True
+        responder.start()
+
+    @classmethod
+    def withAttributes(cls, count, valueSize=20, **kwargs):
+        """
+        Build a device with count readable/writable attributes at handles 0x0001 onward,
+        each holding valueSize bytes and a UUID derived from its handle.
+
+        :param count: Number of attributes
+        :param valueSize: Size of each value (bytes). Default: 20
+        :return: SimulatedDevice
+        """
+        attributes = dict((handle, SimulatedAttribute("0000%04x-0000-1000-8000-00805f9b34fb" % (0xa000 + handle),
+                                                      chr(handle & 0xff) * valueSize))
+                          for handle in range(1, count + 1))
+        return cls(attributes, **kwargs)
+
+    def connect(self):
+        if self.closed:
+            raise RuntimeError("Device is not available")
+        time.sleep(self.connectLatency.sample())
+        self.counters['connect'] += 1
+        self.connected = True
+
+    def shutdown(self):
+        """
+        Drop the connection and refuse any further connections, ending
+        long running operations such as subscribe.
+        """
+        self.closed = True
+        self.connected = False
+        for stop in self._notifiers:
+            stop.set()
+        if self.requester is not None:
+            self.requester.on_disconnect()
+
+    def _checkLink(self):
+        if not self.connected:
+            raise RuntimeError("Channel or attrib not ready")
+        if self.disconnectRate and self._random.random() < self.disconnectRate:
+            self.connected = False
+            self.counters['disconnect'] += 1
+            raise RuntimeError("Channel or attrib disconnected")
+
+    def _check(self, handle, permission, trace=True):
+        if self.trace and trace:
+            self.issued[handle].append(time.time())
+        self._checkLink()
+        attribute = self.attributes.get(handle)
+        if attribute is None:
+            raise RuntimeError("Invalid handle")
+        if not getattr(attribute, permission):
+            raise RuntimeError("Attribute can't be read" if permission == 'readable' else "Attribute can't be written")
+        return attribute
+
+    def _findUUID(self, uuid):
+        for handle in sorted(self.attributes):
+            if self.attributes[handle].uuid == uuid.lower():
+                return handle
+        raise RuntimeError("Invalid handle")
+
+    def _checkCrash(self, value):
+        if self.crashOn is not None and self.crashOn(value):
+            self.connected = False
+            self.counters['crash'] += 1
+            raise RuntimeError("Channel or attrib disconnected")
+
+    def read(self, handle):
+        attribute = self._check(handle, 'readable')
+        time.sleep(self.latency.sample())
+        self.counters['read'] += 1
+        return [attribute.value]
+
+    def readMultiple(self, handles, variable=False):
+        """
+        Values of several handles in one response, each prefixed with its little-endian
+        length when variable, truncated to the MTU.
+        """
+        if variable and not self.readMultipleVariable:
+            raise RuntimeError("Request not supported")
+        attributes = [self._check(handle, 'readable', False) for handle in handles]
+        size = 0
+        for handle, attribute in zip(handles, attributes):
+            size += len(attribute.value) + (2 if variable else 0)
+            #only values that fit in the response count as issued
+            if self.trace and size <= self.mtu - 1:
+                self.issued[handle].append(time.time())
+        time.sleep(self.latency.sample())
+        self.counters['readMultiple'] += 1
+        if variable:
+            response = "".join(chr(len(attribute.value) & 0xff) + chr(len(attribute.value) >> 8) + attribute.value
+                               for attribute in attributes)
+        else:
+            response = "".join(attribute.value for attribute in attributes)
+        return response[:self.mtu - 1]
+
+    def write(self, handle, value):
+        attribute = self._check(handle, 'writable')
+        self._checkCrash(value)
+        time.sleep(self.latency.sample())
+        attribute.value = value
+        self.counters['write'] += 1
+        if attribute.uuid == CLIENT_CONFIGURATION_UUID and value[:1] and ord(value[0]) & 0x02:
+            #the configuration descriptor follows the characteristic it configures
+            self._indicateServiceChanged(handle - 1)
+        return ["\x13"]
+
+    def updateAttributes(self, attributes):
+        """
+        Change the attribute table as a firmware update would. The Database Hash (any
+        attribute with its UUID) is recalculated, and the range of handles changed is
+        indicated on the Service Changed characteristic (the attribute before a Client
+        Characteristic Configuration one) when indications are next enabled on it.
+
+        :param attributes: Handles mapped to their new SimulatedAttribute (or None to remove them)
+        :type attributes: dict
+        """
+        for handle, attribute in attributes.items():
+            if attribute is None:
+                self.attributes.pop(handle, None)
+            else:
+                self.attributes[handle] = attribute
+        self._serviceChanged.append((min(attributes), max(attributes)))
+        structure = "".join("%04x%s" % (handle, attribute.uuid) for handle, attribute in sorted(self.attributes.items())
+                            if attribute.uuid != DATABASE_HASH_UUID)
+        for attribute in self.attributes.values():
+            if attribute.uuid == DATABASE_HASH_UUID:
+                attribute.value = hashlib.md5(structure).digest()
+
+    def indicateBonded(self):
+        """
+        Indicate pending Service Changed ranges as on reconnecting a bonded client
+        that left indications enabled on the characteristic.
+        """
+        for handle, attribute in self.attributes.items():
+            configuration = self.attributes.get(handle + 1)
+            if attribute.uuid == SERVICE_CHANGED_UUID and configuration is not None and \
+                    configuration.uuid == CLIENT_CONFIGURATION_UUID and configuration.value[:1] and \
+                    ord(configuration.value[0]) & 0x02:
+                self._indicateServiceChanged(handle)
+
+    def _indicateServiceChanged(self, handle):
+        characteristic = self.attributes.get(handle)
+        onIndication = getattr(self.requester, 'on_indication', None)
+        if characteristic is None or characteristic.uuid != SERVICE_CHANGED_UUID or onIndication is None:
+            return
+        ranges, self._serviceChanged = self._serviceChanged, []
+        for start, end in ranges:
+            onIndication(handle, struct.pack("<HH", start, end))
+            self.counters['indication'] += 1
+
+    def writeCommand(self, handle, value):
+        attribute = self._check(handle, 'writeWithoutResponse')
+        self._checkCrash(value)
+        attribute.value = value
+        self.counters['writeCommand'] += 1
+
+    def serviceRanges(self):
+        """
+        :return: (uuid, first handle, last handle) of each primary service, which group the attributes
+        serviceSize at a time
+        :rtype: list of tuples
+        """
+        handles = sorted(self.attributes)
+        size = self.serviceSize or len(handles) or 1
+        return [("0000%04x-0000-1000-8000-00805f9b34fb" % (int(SIMULATED_SERVICE_UUID[4:8], 16) - i // size),
+                 handles[i], handles[min(i + size, len(handles)) - 1]) for i in range(0, len(handles), size)]
+
+    def _roundTrips(self, count):
+        #each response of a discovery procedure can be lost with the link
+        for i in range(count):
+            self._checkLink()
+            time.sleep(self.latency.sample())
+
+    def services(self):
+        """
+        Primary services of the device (see serviceRanges), taking one round trip per
+        Read By Group Type response (up to 6 services with 16 bit UUIDs at a 23 byte MTU).
+        """
+        found = [{'uuid': uuid, 'start': start, 'end': end} for uuid, start, end in self.serviceRanges()]
+        self._roundTrips(len(found) // 6 + 1)
+        return found
+
+    def characteristics(self, start, end):
+        """
+        Characteristic declarations of the attributes between start and end, taking one round
+        trip per Read By Type response (up to 3 declarations with 16 bit UUIDs at a 23 byte MTU).
+        The simulated table has no declaration attributes, so each value handle stands in for its own.
+        """
+        found = [{'uuid': attribute.uuid, 'handle': handle, 'value_handle': handle,
+                  'properties': (0x02 if attribute.readable else 0) | (0x08 if attribute.writable else 0) |
+                                (0x04 if attribute.writeWithoutResponse else 0)}
+                 for handle, attribute in sorted(self.attributes.items()) if start <= handle <= end]
+        self._roundTrips(len(found) // 3 + 1)
+        return found
+
+    def descriptors(self, start, end):
+        """
+        Handle and UUID of every attribute between start and end, taking one round trip
+        per Find Information response (up to 5 attributes with 16 bit UUIDs at a 23 byte MTU).
+        """
+        found = [{'handle': handle, 'uuid': self.attributes[handle].uuid}
+                 for handle in sorted(self.attributes) if start <= handle <= end]
+        self._roundTrips(len(found) // 5 + 1)
+        self.counters['findInformation'] += len(found) // 5 + 1
+        return found
+
+    def _async(self, handle, permission, data, responseFunction, written=None):
+        try:
+            self._check(handle, permission)
+        except RuntimeError:
+            if not self.silentErrors or not self.connected:
+                raise
+            self.counters['refused'] += 1
+            return (None, SimulatedResponse())
+        if written is not None:
+            self._checkCrash(written)
+        response = SimulatedResponse()
+        self.counters['async'] += 1
+        if self.dropRate and self._random.random() < self.dropRate:
+            self.counters['dropped'] += 1
+            return (None, response)
+        with self._lock:
+            heapq.heappush(self._responses, (time.time() + self.latency.sample(), next(self._responseIds),
+                                             response, data, responseFunction))
+            self._responseReady.notify()
+        return (None, response)
+
+    def _deliverResponses(self):
+        while True:
+            with self._lock:
+                while not self._responses or self._responses[0][0] > time.time():
+                    self._responseReady.wait(self._responses[0][0] - time.time() if self._responses else None)
+                due, i, response, data, responseFunction = heapq.heappop(self._responses)
+            response._data = data
+            if responseFunction is not None:
+                responseFunction(data)
+
+    def readAsync(self, handle, responseFunction=None):
+        return self._async(handle, 'readable', [self.attributes.get(handle, SimulatedAttribute(None, "")).value],
+                           responseFunction)
+
+    def writeAsync(self, handle, value, responseFunction=None):
+        response = self._async(handle, 'writable', ["\x13"], responseFunction, value)
+        self.attributes[handle].value = value
+        return response
+
+    def notify(self, handles, rate, kind='notification'):
+        """
+        Start generating notifications (or indications) from handles at rate events per
+        second, delivered to the requester registered with the connection manager.
+
+        :param handles: Handles the events originate from
+        :param rate: Events per second
+        :param kind: notification or indication. Default: notification
+        :return: threading.Event that stops the generator when set
+        """
+        stop = threading.Event()
+
+        def generate():
+            interval = 1.0 / rate
+            nextEvent = time.time()
+            for handle in itertools.cycle(handles):
+                if stop.is_set():
+                    return
+                nextEvent += interval
+                delay = nextEvent - time.time()
+                if delay > 0:
+                    time.sleep(delay)
+                if self.connected and self.requester is not None:
+                    value = self.attributes[handle].value if handle in self.attributes else ""
+                    if kind == 'indication':
+                        self.requester.on_indication(handle, value)
+                    else:
+                        self.requester.on_notification(handle, value)
+                    self.counters[kind] += 1
+        thread = threading.Thread(target=generate, name="simulated-device-notifier")
+        thread.daemon = True
+        thread.start()
+        self._notifiers.append(stop)
+        return stop
+
+
+class SimulatedRequester(object):
+    """
+    Stand-in for the GATTRequester a BLEConnectionManager creates, for the calls
+    made on it directly rather than through bleServiceManager.
+    """
+    def __init__(self, device):
+        self.device = device
+
+    def write_cmd(self, handle, data):
+        self.device.writeCommand(handle, data)
+
+    def discover_primary(self):
+        return self.device.services()
+
+    def discover_characteristics(self, start=0x0001, end=0xffff, uuid=""):
+        return self.device.characteristics(start, end)
+
+    def discover_descriptors(self, start=0x0001, end=0xffff, uuid=""):
+        return self.device.descriptors(start, end)
+
+    def read_multiple(self, handles):
+        return self.device.readMultiple(handles)
+
+    def read_multiple_variable(self, handles):
+        return self.device.readMultiple(handles, True)
+
+
+class SimulatedConnectionManager(object):
+    """
+    Stand-in for bleConnectionManager.BLEConnectionManager backed by a SimulatedDevice.
+    """
+    def __init__(self, device, address, adapter="", addressType="public", securityLevel="low",
+                 createRequester=True):
+        self.device = device
+        self.address = address
+        self.adapter = adapter
+        self.securityLevel = securityLevel
+        self.requester = SimulatedRequester(device) if createRequester else None
+
+    def connect(self):
+        self.device.connect()
+        if self.securityLevel != "low":
+            #a bonded client's configuration is kept between connections, so pending changes are indicated
+            self.device.indicateBonded()
+
+    def isConnected(self):
+        return self.device.connected
+
+    def setRequester(self, requester):
+        #gattlib requesters run the discovery procedures themselves, so lend them to those that can not
+        simulated = SimulatedRequester(self.device)
+        for name in _SIMULATED_DISCOVERY:
+            if not hasattr(requester, name):
+                setattr(requester, name, getattr(simulated, name))
+        self.requester = requester
+        self.device.requester = requester
+
+
+class SimulatedDeviceStructure(object):
+    """
+    Result of a simulated service discovery or smart scan.
+    """
+    def __init__(self, address, device):
+        self.address = address
+        self.attributes = dict((handle, attribute.uuid) for handle, attribute in device.attributes.items())
+        #every attribute is presented as a characteristic of its primary service
+        self.services = [{'uuid': uuid, 'start': start, 'end': end,
+                          'characteristics': [{'uuid': device.attributes[handle].uuid, 'valueHandle': handle}
+                                              for handle in sorted(device.attributes) if start <= handle <= end]}
+                         for uuid, start, end in device.serviceRanges()]
+
+    def printDeviceStructure(self):
+        print "Device:", self.address
+        for handle in sorted(self.attributes):
+            print "\t%s: %s" % (format(handle, "#06x"), self.attributes[handle])
+
+
+class _SimulatedModule(object):
+    """
+    Namespace with the functions the wrappers call on bleConnectionManager,
+    bleServiceManager and bleSmartScan, routed to a SimulatedDevice.
+    """
+    def __init__(self, device):
+        self.device = device
+
+    def BLEConnectionManager(self, address, adapter, addressType, securityLevel, createRequester=True):
+        return SimulatedConnectionManager(self.device, address, adapter, addressType, securityLevel, createRequester)
+
+    def bleServiceReadByHandle(self, connectionManager, handle):
+        return self.device.read(handle)
+
+    def bleServiceReadByUUID(self, connectionManager, UUID):
+        handle = self.device._findUUID(UUID)
+        return self.device.read(handle), handle
+
+    def bleServiceWriteToHandle(self, connectionManager, handle, data):
+        return self.device.write(handle, data)
+
+    def bleServiceReadByHandleAsync(self, connectionManager, handle, responseFunction):
+        return self.device.readAsync(handle, responseFunction)
+
+    def bleServiceReadByUUIDAsync(self, connectionManager, UUID):
+        handle = self.device._findUUID(UUID)
+        #read by type responses are prefixed with the little-endian handle
+        return self.device._async(handle, 'readable',
+                                  chr(handle & 0xff) + chr(handle >> 8) + self.device.attributes[handle].value, None)
+
+    def bleServiceWriteToHandleAsync(self, connectionManager, handle, data, responseFunction):
+        return self.device.writeAsync(handle, data, responseFunction)
+
+    def bleServiceDiscovery(self, address, connectionManager):
+        connectionManager.connect()
+        #one round trip per attribute, and a dropped link fails the whole discovery
+        self.device._roundTrips(len(self.device.attributes))
+        return SimulatedDeviceStructure(address, self.device)
+
+    def bleSmartScan(self, address, connectionManager):
+        #bleSmartScan discovers the device and then reads each value one request at a time
+        structure = self.bleServiceDiscovery(address, connectionManager)
+        for handle in sorted(self.device.attributes):
+            if self.device.attributes[handle].readable:
+                self.device.read(handle)
+        return structure
+
+
+class _StandInRequester(object):
+    """
+    Stand-in for gattlib.GATTRequester, which subclasses such as EventRequester extend.
+    """
+    def __init__(self, *args):
+        pass
+
+
+def _printDataAndHex(data, isUUID, prefix="", **kwargs):
+    for value in data or []:
+        value = value if isinstance(value, str) else str(value)
+        print prefix + repr(value), value.encode('hex')
+
+
+def _checkValidBTAddr(address):
+    if len(address.split(":")) != 6 or not all(len(part) == 2 for part in address.split(":")):
+        raise ValueError("%s is not a valid Bluetooth address" % address)
+    int(address.replace(":", ""), 16)
+    return address
+
+
+def _noAdapter(*args, **kwargs):
+    raise RuntimeError("No Bluetooth adapter is available to the simulator")
+
+
+def _standInModule(name, **attributes):
+    module = types.ModuleType(name)
+    module.__dict__.update(attributes)
+    sys.modules[name] = module
+    return module
+
+
+def installStandIns():
+    """
+    Make gattlib and BLESuite importable where they are not installed (ie a build
+    machine without BlueZ), by registering stand-in modules for them. The calls the
+    wrappers make through them are routed to a SimulatedDevice by simulate(); any
+    other use raises RuntimeError. Installed modules are left untouched.
+    """
+    try:
+        import bleSuite.bleConnectionManager
+        import bleSuite.bleServiceManager
+        import bleSuite.bleSmartScan
+        import bleSuite.utils
+        import bleSuite.validators
+        import bleSuite.bleScan
+    except ImportError as e:
+        logger.debug("Using stand-in BLESuite modules: %s" % e)
+        for name in [name for name in sys.modules if name == 'bleSuite' or name.startswith('bleSuite.')]:
+            del sys.modules[name]
+        package = _standInModule('bleSuite', __path__=[])
+        package.bleConnectionManager = _standInModule('bleSuite.bleConnectionManager',
+                                                      BLEConnectionManager=_noAdapter)
+        package.bleServiceManager = _standInModule('bleSuite.bleServiceManager')
+        package.bleSmartScan = _standInModule('bleSuite.bleSmartScan', bleSmartScan=_noAdapter)
+        package.bleScan = _standInModule('bleSuite.bleScan', bleScanMain=_noAdapter)
+        package.validators = _standInModule('bleSuite.validators', checkValidBTAddr=_checkValidBTAddr)
+        package.utils = _standInModule('bleSuite.utils',
+                                       printHelper=type('printHelper', (object,),
+                                                        {'printDataAndHex': staticmethod(_printDataAndHex)}))
+    try:
+        import gattlib
+    except ImportError as e:
+        logger.debug("Using a stand-in gattlib module: %s" % e)
+        _standInModule('gattlib', GATTRequester=_StandInRequester)
+
+
+@contextlib.contextmanager
+def simulate(device):
+    """
+    Route every cmdLineToolWrappers call to device instead of a real Bluetooth
+    adapter for the duration of a with block. gattlib and BLESuite need not be
+    installed (see installStandIns).
+
+    :param device: SimulatedDevice to use
+    :type device: SimulatedDevice
+    """
+    installStandIns()
+    import cmdLineToolWrappers
+    import gattCache
+    import sessionRunner
+    module = _SimulatedModule(device)
+    patched = [(cmdLineToolWrappers, 'bleConnectionManager'), (cmdLineToolWrappers, 'bleServiceManager'),
+               (cmdLineToolWrappers, 'bleSmartScan'), (gattCache, 'bleServiceManager'),
+               (sessionRunner, 'bleConnectionManager'), (sessionRunner, 'bleServiceManager')]
+    originals = [getattr(owner, name) for owner, name in patched]
+    for owner, name in patched:
+        setattr(owner, name, module)
+    try:
+        yield device
+    finally:
+        for (owner, name), original in zip(patched, originals):
+            setattr(owner, name, original)
@@ -0,0 +1,72 @@
+import os
+import struct
+from persistedCache import PersistedLRUCache
+import logging
+
+logger = logging.getLogger(__name__)
+logger.addHandler(logging.NullHandler())
+
+DEFAULT_CACHE_PATH = os.path.join(os.path.expanduser("~"), ".bleSuite", "uuidHandles.cache")
+#Maximum number of UUID to handle mappings kept across all devices
+DEFAULT_MAX_ENTRIES = 4096
+
+
+def handleToInt(handle, raw=False):
+    """
+    Convert a handle into an int suitable for bleServiceManager.bleServiceReadByHandle.
+
+    :param handle: Handle as an int, a hex string (ie 002a) or, when raw, the two big-endian
+    bytes a read by UUID resolves it to
+    :param raw: Whether a str handle holds raw bytes (handles from bleServiceReadByUUID and the
+    UUIDHandleCache) rather than hex. Default: False
+    :type raw: bool
+    :return: handle
+    :rtype: int
+    """
+    if isinstance(handle, (int, long)):
+        return handle
+    if raw:
+        if len(handle) != 2:
+            raise ValueError("Raw handle %r is not 2 bytes long" % handle)
+        return struct.unpack(">H", handle)[0]
+    return int(handle, 16)
+
+
+class UUIDHandleCache(PersistedLRUCache):
+    """
+    Least recently used map of (address, address type, UUID) to the handle a read by
+    UUID resolved to, persisted between runs so later UUID reads can be sent as
+    direct handle reads instead of Read By Type requests over the whole handle range.
+    A single cache may be shared between threads working on different devices.
+
+    :param path: File the cache is loaded from and saved to. Default: ~/.bleSuite/uuidHandles.cache
+    :param maxEntries: Number of mappings kept before the least recently used is evicted. Default: 4096
+    :type path: str
+    :type maxEntries: int
+    """
+    description = "UUID handle cache"
+
+    def __init__(self, path=DEFAULT_CACHE_PATH, maxEntries=DEFAULT_MAX_ENTRIES):
+        super(UUIDHandleCache, self).__init__(path, maxEntries)
+
+    @staticmethod
+    def _key(address, addressType, UUID):
+        return address.upper(), addressType, UUID.lower()
+
+    def get(self, address, addressType, UUID):
+        """
+        :return: handle the UUID last resolved to on this device, or None
+        """
+        return self._get(self._key(address, addressType, UUID))
+
+    def put(self, address, addressType, UUID, handle):
+        """
+        Record the handle a UUID resolved to, evicting the least recently used mapping if full.
+        """
+        self._put(self._key(address, addressType, UUID), handle)
+
+    def discard(self, address, addressType, UUID):
+        """
+        Forget a mapping (ie after a direct handle read failed).
+        """
+        self._discard(self._key(address, addressType, UUID))
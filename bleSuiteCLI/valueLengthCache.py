@@ -0,0 +1,45 @@
+import os
+from persistedCache import PersistedLRUCache
+import logging
+
+logger = logging.getLogger(__name__)
+logger.addHandler(logging.NullHandler())
+
+DEFAULT_LENGTH_PATH = os.path.join(os.path.expanduser("~"), ".bleSuite", "valueLengths.cache")
+#Maximum number of handle lengths kept across all devices
+DEFAULT_MAX_ENTRIES = 16384
+
+
+class ValueLengthCache(PersistedLRUCache):
+    """
+    Least recently used map of (address, handle) to the length of the value last
+    read from it, persisted between runs so readVal can size Read Multiple requests
+    from the first request onward. A single cache may be shared between threads
+    working on different devices.
+
+    :param path: File the cache is loaded from and saved to (None keeps it in memory).
+    Default: ~/.bleSuite/valueLengths.cache
+    :param maxEntries: Number of lengths kept before the least recently used is evicted. Default: 16384
+    :type path: str
+    :type maxEntries: int
+    """
+    description = "value length cache"
+
+    def __init__(self, path=DEFAULT_LENGTH_PATH, maxEntries=DEFAULT_MAX_ENTRIES):
+        super(ValueLengthCache, self).__init__(path, maxEntries)
+
+    @staticmethod
+    def _key(address, handle):
+        return address.upper(), handle.lower()
+
+    def get(self, address, handle):
+        """
+        :return: length last recorded for the handle on this device, or None if unknown
+        """
+        return self._get(self._key(address, handle))
+
+    def put(self, address, handle, length):
+        """
+        Record a handle's length, evicting the least recently used length if full.
+        """
+        self._put(self._key(address, handle), length)
@@ -0,0 +1,43 @@
+import itertools
+import os
+import sys
+
+import pytest
+
+#the package is run from the source tree, as bleSuite-runner.py does
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from bleSuiteCLI.simulatedDevice import SimulatedDevice, simulate, installStandIns
+
+#the tests run without gattlib, BLESuite or a Bluetooth adapter
+installStandIns()
+
+_addresses = ("00:00:00:00:00:%02X" % i for i in itertools.count(1))
+
+
+@pytest.fixture
+def address():
+    """
+    A device address of its own, so the circuit breaker one test trips does not affect another.
+    """
+    return next(_addresses)
+
+
+@pytest.fixture
+def simulated():
+    """
+    Function building a SimulatedDevice with attributes at handles 0x0001 onward and
+    routing the wrappers to it for the rest of the test.
+    """
+    contexts = []
+
+    def build(count=8, valueSize=4, **kwargs):
+        device = SimulatedDevice.withAttributes(count, valueSize, **kwargs)
+        context = simulate(device)
+        context.__enter__()
+        contexts.append((device, context))
+        return device
+    yield build
+    for device, context in contexts:
+        context.__exit__(None, None, None)
+        device.shutdown()
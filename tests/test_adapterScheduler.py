@@ -0,0 +1,74 @@
+import threading
+
+import pytest
+
+from bleSuiteCLI import adapterScheduler
+from bleSuiteCLI.adapterScheduler import AdapterScheduler, ERROR_RATE_WEIGHT, listAdapters
+
+
+def test_workGoesToTheLeastLoadedAdapter():
+    scheduler = AdapterScheduler(["hci0", "hci1"], 2)
+    assert scheduler.capacity == 4
+    assert [scheduler.acquire() for _ in range(4)] == ["hci0", "hci1", "hci0", "hci1"]
+    scheduler.release("hci1")
+    assert scheduler.acquire() == "hci1"
+
+
+def test_errorRateIsAnExponentialMovingAverage():
+    scheduler = AdapterScheduler(["hci0"])
+    expected = 0.0
+    for success in [False, False, True]:
+        scheduler.release(scheduler.acquire(), success)
+        expected += ERROR_RATE_WEIGHT * ((0.0 if success else 1.0) - expected)
+        assert scheduler._errorRate["hci0"] == pytest.approx(expected)
+
+
+def test_unhealthyAdapterOnlyTakesOverflow():
+    scheduler = AdapterScheduler(["hci0", "hci1"], 1)
+    #enough failures in a row push hci0 over UNHEALTHY_ERROR_RATE
+    for _ in range(4):
+        scheduler._active["hci0"] += 1
+        scheduler.release("hci0", False)
+    assert scheduler.acquire() == "hci1"
+    #with the healthy adapter busy, the unhealthy one is still used
+    assert scheduler.acquire() == "hci0"
+
+
+def test_acquireWaitsForAFreeSlot():
+    scheduler = AdapterScheduler(["hci0"], 1)
+    scheduler.acquire()
+    acquired = []
+    waiter = threading.Thread(target=lambda: acquired.append(scheduler.acquire()))
+    waiter.start()
+    waiter.join(0.05)
+    assert acquired == []
+    scheduler.release("hci0")
+    waiter.join(5)
+    assert acquired == ["hci0"]
+
+
+def test_runReleasesOnFailure():
+    scheduler = AdapterScheduler(["hci0"], 1)
+
+    def fail(adapter):
+        raise RuntimeError("Channel or attrib disconnected")
+    with pytest.raises(RuntimeError):
+        scheduler.run(fail)
+    assert scheduler.run(lambda adapter: adapter) == "hci0"
+    assert scheduler._errorRate["hci0"] == pytest.approx(ERROR_RATE_WEIGHT * (1 - ERROR_RATE_WEIGHT))
+
+
+def test_invalidSchedulers():
+    with pytest.raises(ValueError):
+        AdapterScheduler([])
+    with pytest.raises(ValueError):
+        AdapterScheduler(["hci0"], 0)
+
+
+def test_listAdapters(tmpdir, monkeypatch):
+    for name in ["hci10", "hci2", "hci0:64", "hci0"]:
+        tmpdir.mkdir(name)
+    monkeypatch.setattr(adapterScheduler, 'SYSFS_BLUETOOTH', str(tmpdir))
+    assert listAdapters() == ["hci0", "hci2", "hci10"]
+    monkeypatch.setattr(adapterScheduler, 'SYSFS_BLUETOOTH', str(tmpdir.join("missing")))
+    assert listAdapters() == []
@@ -0,0 +1,40 @@
+import pytest
+
+from bleSuiteCLI import captureFile
+from bleSuiteCLI.captureFile import CaptureWriter, readCapture, KIND_NOTIFICATION, KIND_INDICATION
+
+
+def _record(path, kind, handle, payload):
+    writer = CaptureWriter(path)
+    writer.write(kind, handle, payload)
+    writer.close()
+
+
+def test_captureAppends(tmpdir, monkeypatch):
+    path = str(tmpdir.join("events.cap"))
+    _record(path, KIND_NOTIFICATION, 5, "a")
+    #the monotonic clock restarts with the host, appended records keep their wall clock time
+    monotonic = captureFile.monotonic
+    monkeypatch.setattr(captureFile, "monotonic", lambda: monotonic() - 1000)
+    _record(path, KIND_INDICATION, 6, "bb")
+    records = list(readCapture(path))
+    assert [(record.kind, record.handle, record.payload) for record in records] == \
+        [(KIND_NOTIFICATION, 5, "a"), (KIND_INDICATION, 6, "bb")]
+    assert abs(records[1].timestamp - records[0].timestamp) < 60
+
+
+def test_captureAppendDropsTruncatedRecord(tmpdir):
+    path = str(tmpdir.join("events.cap"))
+    _record(path, KIND_NOTIFICATION, 5, "a")
+    with open(path, 'ab') as f:
+        f.write("\x20\x00\x00\x00abc")
+    _record(path, KIND_NOTIFICATION, 7, "ccc")
+    assert [record.payload for record in readCapture(path)] == ["a", "ccc"]
+
+
+def test_captureRefusesOtherFiles(tmpdir):
+    path = tmpdir.join("notes.txt")
+    path.write("not a capture")
+    with pytest.raises(ValueError):
+        CaptureWriter(str(path))
+    assert path.read() == "not a capture"
@@ -0,0 +1,44 @@
+from bleSuiteCLI.connectionPool import ConnectionPool
+from bleSuiteCLI.retryEngine import RetryPolicy
+
+
+def test_leaseReusesConnection(simulated, address):
+    device = simulated()
+    pool = ConnectionPool()
+    try:
+        with pool.lease(address, "hci0", "public", "low") as first:
+            pass
+        with pool.lease(address, "hci0", "public", "low") as second:
+            pass
+        assert second is first
+        assert device.counters['connect'] == 1
+    finally:
+        pool.close()
+
+
+def test_leaseReopensOnAnotherAdapter(simulated, address):
+    device = simulated()
+    pool = ConnectionPool()
+    try:
+        with pool.lease(address, "hci0", "public", "low") as first:
+            pass
+        with pool.lease(address, "hci1", "public", "low") as second:
+            assert second.adapter == "hci1"
+        assert second is not first
+        assert device.counters['connect'] == 2
+        assert len(pool) == 1
+    finally:
+        pool.close()
+
+
+def test_leaseAppliesRetryPolicy(simulated, address):
+    simulated()
+    pool = ConnectionPool()
+    try:
+        with pool.lease(address, "", "public", "low", RetryPolicy(2)):
+            pass
+        policy = RetryPolicy(9)
+        with pool.lease(address, "", "public", "low", policy) as deviceSession:
+            assert deviceSession.engine.policy is policy
+    finally:
+        pool.close()
@@ -0,0 +1,98 @@
+import socket
+import struct
+
+import pytest
+
+from bleSuiteCLI.continuousScan import AdvertisingReport, DeviceTable, HCIScanner, ADV_SCAN_RSP, RSSI_SMOOTHING, \
+    advertisedName, parseAdvertisingReports
+
+
+def _name(name, adType=0x09):
+    return chr(len(name) + 1) + chr(adType) + name
+
+
+def _packet(*reports):
+    #reports of (event type, address type, address, data, rssi)
+    body = chr(0x02) + chr(len(reports))
+    for eventType, addressType, address, data, rssi in reports:
+        body += chr(eventType) + chr(addressType) + "".join(chr(int(byte, 16)) for byte in reversed(address.split(":")))
+        body += chr(len(data)) + data + struct.pack("b", rssi)
+    return chr(0x04) + chr(0x3e) + chr(len(body)) + body
+
+
+def _report(address, rssi, timestamp, data="", eventType=0):
+    return AdvertisingReport(address, 'public', eventType, rssi, data, timestamp)
+
+
+def test_parseAdvertisingReports():
+    packet = _packet((0, 0, "AA:BB:CC:DD:EE:01", "\x02\x01\x06" + _name("lamp"), -40),
+                     (ADV_SCAN_RSP, 1, "AA:BB:CC:DD:EE:02", "", -90))
+    first, second = parseAdvertisingReports(packet, 12.5)
+    assert first == AdvertisingReport("AA:BB:CC:DD:EE:01", 'public', 0, -40, "\x02\x01\x06" + _name("lamp"), 12.5)
+    assert (second.address, second.addressType, second.eventType, second.rssi) == \
+        ("AA:BB:CC:DD:EE:02", 'random', ADV_SCAN_RSP, -90)
+    #other events and reports cut short are ignored
+    assert parseAdvertisingReports(chr(0x04) + chr(0x0e) + "\x04\x01\x0c\x20\x00") == []
+    assert parseAdvertisingReports(packet[:-1], 12.5) == [first]
+
+
+def test_advertisedName():
+    assert advertisedName("\x02\x01\x06" + _name("short", 0x08) + _name("complete name")) == "complete name"
+    assert advertisedName(_name("short", 0x08)) == "short"
+    assert advertisedName("\x02\x01\x06") is None
+    #a length running past the data ends parsing
+    assert advertisedName("\x09\x09ab") is None
+
+
+def test_deviceTableSummarizesReports():
+    table = DeviceTable()
+    entry, isNew = table.update(_report("01", -40, 1.0, _name("lamp")))
+    assert isNew
+    entry, isNew = table.update(_report("01", -60, 2.0, eventType=ADV_SCAN_RSP))
+    assert not isNew
+    assert (entry.firstSeen, entry.lastSeen, entry.count) == (1.0, 2.0, 2)
+    assert (entry.rssiMin, entry.rssiMax) == (-60, -40)
+    assert entry.rssiAvg == pytest.approx(-40 - 20 * RSSI_SMOOTHING)
+    #the name is kept when a later report does not carry one
+    assert entry.name == "lamp" and entry.data == _name("lamp") and entry.scanResponse == ""
+
+
+def test_deviceTableEvictsStaleAndOldest():
+    table = DeviceTable(maxDevices=2, staleAfter=10)
+    table.update(_report("01", -40, 0))
+    table.update(_report("02", -40, 1))
+    table.update(_report("01", -40, 2))
+    table.update(_report("03", -40, 3))
+    #02 was the least recently seen
+    assert [entry.address for entry in table] == ["01", "03"]
+    assert table.evict(12.5) == 1
+    assert [entry.address for entry in table] == ["03"] and table.evicted == 2
+    entry, isNew = table.update(_report("01", -40, 20))
+    assert isNew and len(table) == 1
+    with pytest.raises(ValueError):
+        DeviceTable(0)
+
+
+class FakeSocket(object):
+    def __init__(self, packets):
+        self.packets = list(packets)
+
+    def settimeout(self, timeout):
+        pass
+
+    def recv(self, size):
+        packet = self.packets.pop(0)
+        if packet is None:
+            raise socket.timeout()
+        return packet
+
+
+def test_scannerYieldsReportsAndIdleTicks():
+    scanner = HCIScanner("hci1")
+    assert scanner.devId == 1
+    scanner.sock = FakeSocket([_packet((0, 0, "AA:BB:CC:DD:EE:01", "", -40)), None,
+                               _packet((0, 0, "AA:BB:CC:DD:EE:02", "", -50))])
+    reports = scanner.reports()
+    assert next(reports).address == "AA:BB:CC:DD:EE:01"
+    assert next(reports) is None
+    assert next(reports).address == "AA:BB:CC:DD:EE:02"
@@ -0,0 +1,57 @@
+import threading
+import time
+
+import pytest
+
+from bleSuiteCLI import cmdLineToolWrappers
+from bleSuiteCLI.deviceFanOut import runForDevices, readAddressFile
+
+
+def test_devicesRunConcurrently():
+    running = [0]
+    peak = [0]
+    lock = threading.Lock()
+
+    def task(address):
+        with lock:
+            running[0] += 1
+            peak[0] = max(peak[0], running[0])
+        time.sleep(0.02)
+        with lock:
+            running[0] -= 1
+        return address.lower()
+    addresses = ["AA:00:00:00:00:%02X" % i for i in range(10)]
+    results = list(runForDevices(addresses, task, 3))
+    assert sorted(results) == sorted((address, address.lower(), None) for address in addresses)
+    assert peak[0] == 3
+
+
+def test_failingDeviceDoesNotStopTheOthers():
+    def task(address):
+        if address == "bad":
+            raise RuntimeError("Channel or attrib disconnected")
+        return 1
+    results = dict((address, (result, error)) for address, result, error in
+                   runForDevices(["good", "bad", "other"], task, 2))
+    assert results["good"] == (1, None) and results["other"] == (1, None)
+    assert results["bad"][0] is None and isinstance(results["bad"][1], RuntimeError)
+    with pytest.raises(ValueError):
+        list(runForDevices(["good"], task, 0))
+
+
+def test_readAddressFile(tmpdir):
+    path = tmpdir.join("addresses")
+    path.write("# lab devices\nAA:BB:CC:DD:EE:01\n\n  AA:BB:CC:DD:EE:02  \n")
+    assert readAddressFile(str(path)) == ["AA:BB:CC:DD:EE:01", "AA:BB:CC:DD:EE:02"]
+
+
+def test_readFromSeveralSimulatedDevices(simulated):
+    #simulate() routes every address to the same device, each worker with a connection of its own
+    device = simulated()
+    addresses = ["00:00:00:00:01:%02X" % i for i in range(4)]
+    results = list(runForDevices(addresses, lambda address: cmdLineToolWrappers.bleServiceRead(
+        address, "", "public", "low", ["01", "02"], [], batch=False), 4))
+    assert sorted(address for address, result, error in results) == addresses
+    for address, (uuidData, handleData), error in results:
+        assert error is None
+        assert handleData == [("01", [device.attributes[1].value]), ("02", [device.attributes[2].value])]
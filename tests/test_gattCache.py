@@ -0,0 +1,79 @@
+import os
+
+import pytest
+
+from bleSuiteCLI import atomicFile, gattCache
+from bleSuiteCLI.atomicFile import atomicWrite
+from bleSuiteCLI.gattCache import GATTCache
+
+
+class _Unpicklable(object):
+    def __reduce__(self):
+        raise ValueError("not picklable")
+
+
+def _entries(cache):
+    return sorted(os.listdir(cache.cacheDir)) if os.path.isdir(cache.cacheDir) else []
+
+
+def test_lookupUsesCacheWhileHashMatches(tmpdir, monkeypatch):
+    cache = GATTCache(str(tmpdir.join("cache")))
+    assert cache.store("AA:BB:CC:DD:EE:FF", "public", "serviceScan", "device", "hash1")
+    monkeypatch.setattr(gattCache, "readDatabaseHash", lambda connectionManager: "hash1")
+    assert cache.lookup("AA:BB:CC:DD:EE:FF", "public", "serviceScan", None) == "device"
+
+
+def test_lookupInvalidatesOnHashMismatch(tmpdir, monkeypatch):
+    cache = GATTCache(str(tmpdir.join("cache")))
+    cache.store("AA:BB:CC:DD:EE:FF", "public", "serviceScan", "device", "hash1")
+    monkeypatch.setattr(gattCache, "readDatabaseHash", lambda connectionManager: "hash2")
+    assert cache.lookup("AA:BB:CC:DD:EE:FF", "public", "serviceScan", None) is None
+    assert _entries(cache) == []
+
+
+def test_lookupKeepsEntryWhenHashUnreadable(tmpdir, monkeypatch):
+    cache = GATTCache(str(tmpdir.join("cache")))
+    cache.store("AA:BB:CC:DD:EE:FF", "public", "serviceScan", "device", "hash1")
+    monkeypatch.setattr(gattCache, "readDatabaseHash", lambda connectionManager: None)
+    assert cache.lookup("AA:BB:CC:DD:EE:FF", "public", "serviceScan", None) == "device"
+    assert len(_entries(cache)) == 1
+
+
+def test_loadIgnoresCorruptEntry(tmpdir):
+    cache = GATTCache(str(tmpdir.join("cache")))
+    cache.store("AA:BB:CC:DD:EE:FF", "public", "serviceScan", "device")
+    path = os.path.join(cache.cacheDir, _entries(cache)[0])
+    with open(path, 'wb') as f:
+        f.write("not a cache entry")
+    assert cache.load("AA:BB:CC:DD:EE:FF", "public", "serviceScan") is None
+
+
+def test_loadExpiresEntries(tmpdir):
+    cache = GATTCache(str(tmpdir.join("cache")), ttl=-1)
+    cache.store("AA:BB:CC:DD:EE:FF", "public", "serviceScan", "device")
+    assert cache.load("AA:BB:CC:DD:EE:FF", "public", "serviceScan") is None
+    assert cache.load("AA:BB:CC:DD:EE:FF", "public", "serviceScan", expire=False) is None
+    assert _entries(cache) == []
+
+
+def test_storeSkipsUnpicklableStructures(tmpdir):
+    cache = GATTCache(str(tmpdir.join("cache")))
+    assert not cache.store("AA:BB:CC:DD:EE:FF", "public", "serviceScan", _Unpicklable())
+    assert _entries(cache) == []
+
+
+def test_atomicWriteRemovesTemporaryFileOnFailure(tmpdir, monkeypatch):
+    def failingRename(source, destination):
+        raise OSError("rename failed")
+    monkeypatch.setattr(atomicFile.os, "rename", failingRename)
+    with pytest.raises(OSError):
+        atomicWrite(str(tmpdir.join("sub", "file")), "data")
+    assert tmpdir.join("sub").listdir() == []
+
+
+def test_atomicWriteReplacesFile(tmpdir):
+    path = tmpdir.join("sub", "file")
+    atomicWrite(str(path), "first")
+    atomicWrite(str(path), "second")
+    assert path.read() == "second"
+    assert tmpdir.join("sub").listdir() == [path]
@@ -0,0 +1,55 @@
+import argparse
+
+import pytest
+
+from bleSuiteCLI import cmdLineToolWrappers
+from bleSuiteCLI.bleSuiteCLI import checkHandleRange
+from bleSuiteCLI.simulatedDevice import SimulatedAttribute, SimulatedRequester
+
+
+def _sparseDevice(simulated):
+    device = simulated(4)
+    device.attributes[0x30] = SimulatedAttribute("00002a00-0000-1000-8000-00805f9b34fb", "name")
+    device.attributes[0x31] = SimulatedAttribute("00002a01-0000-1000-8000-00805f9b34fb", "", readable=False)
+    device.attributes[0x100] = SimulatedAttribute("00002a02-0000-1000-8000-00805f9b34fb", "far")
+    return device
+
+
+def _sweep(address, start=1, end=0xffff, **kwargs):
+    return sorted(cmdLineToolWrappers.bleHandleSweep(address, "", "public", "low", start, end, **kwargs))
+
+
+def test_sweepReadsDiscoveredAttributes(simulated, address):
+    device = _sparseDevice(simulated)
+    results = _sweep(address, window=2)
+    assert [handle for handle, uuid, data in results] == ["0001", "0002", "0003", "0004", "0030", "0031", "0100"]
+    assert results[4] == ("0030", "00002a00-0000-1000-8000-00805f9b34fb", ["name"])
+    assert results[5][2] == "Attribute can't be read"
+    #only the attributes found are read
+    assert device.counters['async'] == 6
+
+
+def test_sweepWithoutDiscoveryStopsAfterGap(simulated, address, monkeypatch):
+    device = _sparseDevice(simulated)
+    monkeypatch.delattr(SimulatedRequester, 'discover_descriptors')
+    results = _sweep(address, gap=0x40)
+    #0x100 lies more than gap handles past the last attribute found
+    assert [(handle, uuid) for handle, uuid, data in results] == [("0001", None), ("0002", None), ("0003", None),
+                                                                  ("0004", None), ("0030", None), ("0031", None)]
+    assert device.counters['async'] == 5
+
+
+def test_sweepOfPartOfTheRange(simulated, address):
+    _sparseDevice(simulated)
+    assert [handle for handle, uuid, data in _sweep(address, 3, 0x30)] == ["0003", "0004", "0030"]
+
+
+def test_invalidRanges(address):
+    with pytest.raises(ValueError):
+        _sweep(address, 0, 4)
+    with pytest.raises(ValueError):
+        _sweep(address, 5, 4)
+    assert checkHandleRange("0001:ffff") == (1, 0xffff)
+    for handleRange in ["0001", "0005:0004", "zz:0004", "0001:10000"]:
+        with pytest.raises(argparse.ArgumentTypeError):
+            checkHandleRange(handleRange)
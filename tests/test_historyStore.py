@@ -0,0 +1,88 @@
+import time
+
+import pytest
+
+from bleSuiteCLI.gattStructure import GATTDevice, GATTService, GATTCharacteristic, GATTDescriptor
+from bleSuiteCLI.historyStore import HistoryStore, gattAttributes, normalizeUUID, parseTime
+
+HEART_RATE = "0000180d-0000-1000-8000-00805f9b34fb"
+MEASUREMENT = "00002a37-0000-1000-8000-00805f9b34fb"
+CONFIGURATION = "00002902-0000-1000-8000-00805f9b34fb"
+
+
+def _structure(address):
+    device = GATTDevice(address)
+    service = GATTService(0x10, 0x14, "180D")
+    characteristic = GATTCharacteristic(0x11, 0x12, "0x2A37", 0x10)
+    characteristic.descriptors.append(GATTDescriptor(0x13, "2902"))
+    service.characteristics.append(characteristic)
+    device.services.append(service)
+    return device
+
+
+@pytest.fixture
+def store(tmpdir):
+    store = HistoryStore(str(tmpdir.join("history", "history.db")), batchSize=1000, flushInterval=60)
+    yield store
+    store.close()
+
+
+def test_normalizeUUID():
+    assert normalizeUUID("180D") == HEART_RATE
+    assert normalizeUUID("0x2a37") == MEASUREMENT
+    assert normalizeUUID("0000180d") == HEART_RATE
+    assert normalizeUUID(" %s " % HEART_RATE.upper()) == HEART_RATE
+
+
+def test_parseTime():
+    assert parseTime("30m", 10000) == 10000 - 30 * 60
+    assert parseTime("1.5h", 10000) == 10000 - 90 * 60
+    assert parseTime("2w", 10 ** 7) == 10 ** 7 - 14 * 24 * 60 * 60
+    assert parseTime("2026-10-17") == time.mktime((2026, 10, 17, 0, 0, 0, 0, 0, -1))
+    assert parseTime("2026-10-17 08:30") == time.mktime((2026, 10, 17, 8, 30, 0, 0, 0, -1))
+    assert parseTime("2026-10-17 08:30:15") == time.mktime((2026, 10, 17, 8, 30, 15, 0, 0, -1))
+    for value in ["7", "7y", "yesterday", "17/10/2026"]:
+        with pytest.raises(ValueError):
+            parseTime(value)
+
+
+def test_gattAttributes():
+    assert gattAttributes(_structure("AA:BB:CC:DD:EE:01")) == [('service', 0x10, HEART_RATE, None),
+                                                               ('characteristic', 0x11, MEASUREMENT, HEART_RATE),
+                                                               ('descriptor', 0x13, CONFIGURATION, HEART_RATE)]
+
+
+def test_rowsAreBufferedUntilFlushed(store):
+    store.recordSighting("aa:bb:cc:dd:ee:01", seenAt=100)
+    assert store._db.execute("SELECT COUNT(*) FROM sightings").fetchone()[0] == 0
+    #queries see everything recorded so far
+    assert [device['device'] for device in store.devices()] == ["AA:BB:CC:DD:EE:01"]
+    assert store._db.execute("SELECT COUNT(*) FROM sightings").fetchone()[0] == 1
+
+
+def test_devicesFilters(store):
+    store.recordSighting("AA:BB:CC:DD:EE:01", "public", "hci0", "lamp", -40, "\x02\x01\x06", seenAt=100)
+    store.recordSighting("AA:BB:CC:DD:EE:01", "public", "hci1", None, -50, seenAt=200)
+    store.recordSighting("AA:BB:CC:DD:EE:02", "random", "hci1", "tag", -70, seenAt=300)
+    store.recordScan("AA:BB:CC:DD:EE:03", "public", "hci0", "smartScan", _structure("AA:BB:CC:DD:EE:03"),
+                     scannedAt=150)
+    devices = store.devices()
+    assert [device['device'] for device in devices] == ["AA:BB:CC:DD:EE:02", "AA:BB:CC:DD:EE:01",
+                                                        "AA:BB:CC:DD:EE:03"]
+    lamp = devices[1]
+    assert (lamp['name'], lamp['firstSeen'], lamp['lastSeen'], lamp['count']) == ("lamp", 100, 200, 2)
+    assert sorted(lamp['adapters'].split(",")) == ["hci0", "hci1"]
+
+    def matching(**filters):
+        return sorted(device['device'][-2:] for device in store.devices(**filters))
+    assert matching(addresses=["aa:bb:cc:dd:ee:02"]) == ["02"]
+    assert matching(adapters=["hci0"]) == ["01", "03"]
+    assert matching(since=150, until=250) == ["01", "03"]
+    assert matching(services=["180d"]) == ["03"]
+    assert matching(characteristics=["2a37"]) == ["03"]
+    #a service UUID does not match characteristics, and every filter must match
+    assert matching(characteristics=["180d"]) == []
+    assert matching(services=["180d"], adapters=["hci1"]) == []
+    assert matching(limit=1) == ["02"]
+    #sightings counted by the filters are those matching them
+    assert store.devices(addresses=["AA:BB:CC:DD:EE:01"], since=150)[0]['count'] == 1
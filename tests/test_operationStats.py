@@ -0,0 +1,89 @@
+import json
+import StringIO
+
+import pytest
+
+from bleSuiteCLI import cmdLineToolWrappers
+from bleSuiteCLI.operationStats import LatencyHistogram, OperationStats, stats
+
+
+def test_percentilesWithinPrecision():
+    histogram = LatencyHistogram()
+    #1 ms to 1000 ms
+    for i in range(1, 1001):
+        histogram.record(i / 1000.0)
+    for fraction in [0.5, 0.9, 0.99]:
+        assert histogram.percentile(fraction) == pytest.approx(fraction, rel=0.04)
+    assert histogram.percentile(0) == pytest.approx(0.001, rel=0.04)
+    assert histogram.percentile(1) == pytest.approx(1.0, rel=0.04)
+    summary = histogram.summary()
+    assert summary['count'] == 1000
+    assert summary['min'] == 0.001 and summary['max'] == 1.0
+    assert summary['mean'] == pytest.approx(0.5005)
+    assert summary['p50'] == histogram.percentile(0.5)
+    #memory grows with the range of values, not their number
+    assert len(histogram.counts) < 1000
+
+
+def test_percentileNeverBeyondValuesSeen():
+    histogram = LatencyHistogram()
+    for _ in range(10):
+        histogram.record(0.0123)
+    assert histogram.percentile(0.5) == histogram.percentile(0.99) == 0.0123
+    assert LatencyHistogram().percentile(0.5) is None
+    assert LatencyHistogram().summary()['mean'] is None
+
+
+def test_mergeMatchesRecordingTogether():
+    first, second, both = LatencyHistogram(), LatencyHistogram(), LatencyHistogram()
+    for i in range(1, 200):
+        (first if i % 2 else second).record(i / 10000.0)
+        both.record(i / 10000.0)
+    first.merge(second)
+    assert first.summary() == both.summary()
+
+
+def test_disabledStatsCollectNothing():
+    operationStats = OperationStats()
+    operationStats.increment("retry.read.handle")
+    operationStats.record("connect", 0.1)
+    with operationStats.timed("read.handle"):
+        pass
+    snapshot = operationStats.snapshot()
+    assert snapshot['counters'] == {} and snapshot['latency'] == {} and snapshot['elapsed'] is None
+
+
+def test_timedCountsErrors(tmpdir):
+    operationStats = OperationStats()
+    operationStats.enable()
+    with operationStats.timed("read.handle"):
+        pass
+    with pytest.raises(RuntimeError):
+        with operationStats.timed("read.handle"):
+            raise RuntimeError("Attribute can't be read")
+    snapshot = operationStats.snapshot()
+    assert snapshot['latency']['read.handle']['count'] == 2
+    assert snapshot['counters'] == {'read.handle.error': 1}
+    out = StringIO.StringIO()
+    operationStats.printReport(out)
+    assert "read.handle" in out.getvalue() and "read.handle.error" in out.getvalue()
+    path = str(tmpdir.join("stats.json"))
+    operationStats.export(path)
+    with open(path) as f:
+        assert json.load(f)['counters'] == {'read.handle.error': 1}
+    operationStats.reset()
+    assert operationStats.snapshot()['counters'] == {}
+
+
+def test_wrappersAreInstrumented(simulated, address):
+    simulated()
+    stats.enable()
+    stats.reset()
+    try:
+        cmdLineToolWrappers.bleServiceRead(address, "", "public", "low", ["01", "02"], [], batch=False)
+        snapshot = stats.snapshot()
+    finally:
+        stats.reset()
+        stats.disable()
+    assert snapshot['latency']['connect']['count'] == 1
+    assert snapshot['latency']['read.handle']['count'] == 2
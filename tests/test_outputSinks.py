@@ -0,0 +1,84 @@
+import StringIO
+import json
+import sys
+import threading
+
+from bleSuiteCLI.outputSinks import TextSink, JSONLSink, ProgressLine, ThreadOutput, currentStdout
+
+
+def test_textSinkOnlyRedirectsItsOwnThread(monkeypatch):
+    stdout = StringIO.StringIO()
+    monkeypatch.setattr(sys, 'stdout', stdout)
+    out = StringIO.StringIO()
+    formatting = threading.Event()
+    printed = threading.Event()
+
+    def formatter(record):
+        print "sink", record['value']
+        #the other thread prints while this one is redirected to the sink
+        formatting.set()
+        assert printed.wait(5)
+        print "sink done"
+
+    def other():
+        assert formatting.wait(5)
+        print "stdout"
+        printed.set()
+
+    sink = TextSink(out, ['value'], formatter, closeOutput=False)
+    thread = threading.Thread(target=other)
+    thread.start()
+    sink.write({'value': 1})
+    thread.join()
+    assert out.getvalue() == "sink 1\nsink done\n"
+    assert stdout.getvalue() == "stdout\n"
+    #the redirect is undone once the record is written
+    assert isinstance(sys.stdout, ThreadOutput)
+    assert currentStdout() is stdout
+
+
+def test_sinksAcceptRecordsFromSeveralThreads():
+    out = StringIO.StringIO()
+    sink = JSONLSink(out, ['address', 'value'], binaryFields=['value'], closeOutput=False)
+    threads = [threading.Thread(target=lambda i=i: [sink.write({'address': "%02d" % i, 'value': "\x01\x02"})
+                                                     for _ in range(100)])
+               for i in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    #records are never interleaved within a line
+    records = [json.loads(line) for line in out.getvalue().splitlines()]
+    assert len(records) == 400
+    assert sorted(set(record['address'] for record in records)) == ["00", "01", "02", "03"]
+    assert all(record['value'] == "0102" for record in records)
+
+
+def test_progressLineKeepsDevicesApart():
+    out = StringIO.StringIO()
+    progress = ProgressLine(out)
+    progress.update("A", "A: read 1/2 attributes")
+    progress.update("B", "B: read 1/3 attributes")
+    progress.update("A", "A: read 2/2 attributes", True)
+    progress.update("B", "B: read 3/3 attributes", True)
+    lines = out.getvalue().split("\n")
+    #each device's final progress is left on its own line, whatever else was being shown
+    assert lines[0].split("\r")[-1].rstrip() == "A: read 2/2 attributes"
+    assert lines[1].split("\r")[-1].rstrip() == "B: read 3/3 attributes"
+    assert "\rA: read 1/2 attributes  B: read 1/3 attributes" in lines[0]
+
+
+def test_progressLineFromSeveralThreads():
+    out = StringIO.StringIO()
+    progress = ProgressLine(out)
+
+    def scan(address):
+        for finished in range(1, 201):
+            progress.update(address, "%s: read %d/200 attributes" % (address, finished), finished == 200)
+    threads = [threading.Thread(target=scan, args=("%02d" % i,)) for i in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    finals = [line.split("\r")[-1].rstrip() for line in out.getvalue().split("\n")[:-1]]
+    assert sorted(finals) == ["%02d: read 200/200 attributes" % i for i in range(4)]
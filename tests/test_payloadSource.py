@@ -0,0 +1,57 @@
+import sys
+
+import pytest
+
+from bleSuiteCLI.payloadSource import filePayloads, _splitStream
+
+
+class BlockFile(object):
+    """
+    File returning data in fixed size blocks that records, on every read, the
+    longest string _splitStream is holding, ie the most it would search or copy
+    again when the next block arrives.
+    """
+    def __init__(self, data, readSize):
+        self.data = data
+        self.readSize = readSize
+        self.offset = 0
+        self.reads = 0
+        self.held = 0
+
+    def read(self, size):
+        assert size == self.readSize
+        held = [len(value) for value in sys._getframe(1).f_locals.values() if isinstance(value, str)]
+        self.held = max([self.held] + held)
+        self.reads += 1
+        block = self.data[self.offset:self.offset + size]
+        self.offset += size
+        return block
+
+
+@pytest.mark.parametrize("data", ["", "|:|", "a|:|b|:|", "a|:|b|:|c", "||:|:||:" * 7, "|:|:|:" * 5])
+@pytest.mark.parametrize("readSize", [1, 2, 3, 5, 64])
+def test_splitsLikeStrSplit(data, readSize):
+    assert list(_splitStream(BlockFile(data, readSize), "|:|", readSize)) == data.split("|:|")
+
+
+def test_longPayloadIsNotSearchedAgain():
+    readSize = 16
+    data = "x" * (readSize * 4096) + "|:|" + "y" * readSize
+    f = BlockFile(data, readSize)
+    assert list(_splitStream(f, "|:|", readSize)) == data.split("|:|")
+    #a payload spanning thousands of blocks is never held whole between reads, so each block
+    #is searched once instead of the payload in progress being searched again (quadratic time)
+    assert f.reads == len(data) // readSize + 2
+    assert f.held <= readSize + len("|:|")
+
+
+def test_filePayloads(tmpdir):
+    first = tmpdir.join("first")
+    first.write("a|:|b", mode='wb')
+    second = tmpdir.join("second")
+    second.write("c", mode='wb')
+    assert list(filePayloads([str(first), None, str(second)], "|:|", 2)) == ["a", "b", "c"]
+    #EOF sends each file whole
+    assert list(filePayloads([str(first)])) == ["a|:|b"]
+    with pytest.raises(ValueError):
+        list(filePayloads([str(first)], ""))
@@ -0,0 +1,139 @@
+import threading
+import time
+
+import pytest
+
+from bleSuiteCLI import cmdLineToolWrappers
+from bleSuiteCLI.bleSuiteCLI import parseCommand, getMaxWindow
+from bleSuiteCLI.pendingOperations import InFlightWindow, PendingOperationTable
+
+
+class Response(object):
+    """
+    GATTResponse stand-in whose data is set by the test.
+    """
+    def __init__(self, data=None):
+        self.data = data
+
+    def received(self):
+        return self.data
+
+
+def _issue(table, key, timeout, data=None, hooked=True):
+    opId = table.reserve()
+    table.add(opId, key, (None, Response(data)), timeout, hooked=hooked)
+    return opId
+
+
+def test_deadlinesExpireInOrder():
+    table = PendingOperationTable()
+    _issue(table, "late", 0.2)
+    _issue(table, "early", 0.05)
+    started = time.time()
+    first = table.waitCompleted()
+    assert [op.key for op in first] == ["early"] and first[0].timedOut
+    #the table sleeps until the next deadline instead of polling
+    assert 0.04 <= time.time() - started < 0.15
+    assert [op.key for op in table.waitCompleted()] == ["late"]
+    assert table.waitCompleted() == [] and len(table) == 0
+
+
+def test_callbackCompletesBeforeDeadline():
+    table = PendingOperationTable()
+    opId = table.reserve()
+    callback = table.completionCallback(opId)
+    table.add(opId, "01", (None, Response(["\x01"])), 5)
+    threading.Timer(0.02, callback, ["\x01"]).start()
+    started = time.time()
+    op, = table.waitCompleted()
+    assert not op.timedOut and op.received() == ["\x01"]
+    assert op.latency < 1 and time.time() - started < 1
+
+
+def test_responseBeforeAdd():
+    table = PendingOperationTable()
+    opId = table.reserve()
+    #a fast device can answer before the request is registered
+    table.completionCallback(opId)()
+    table.add(opId, "01", (None, Response()), 5)
+    op, = table.takeCompleted()
+    assert op.key == "01" and not op.timedOut
+    assert len(table) == 0
+
+
+def test_unhookedOperationsAreProbed():
+    table = PendingOperationTable(probeInterval=0.01)
+    response = Response()
+    opId = table.reserve()
+    table.add(opId, "uuid", (None, response), 5, hooked=False)
+    assert table.takeCompleted() == []
+    response.data = ["\x01"]
+    op, = table.waitCompleted()
+    assert op.key == "uuid" and not op.timedOut
+
+
+def test_lateResponseAtDeadlineIsNotATimeout():
+    table = PendingOperationTable()
+    #the response arrived but its callback never ran
+    _issue(table, "01", 0.01, ["\x01"])
+    time.sleep(0.02)
+    op, = table.takeCompleted()
+    assert not op.timedOut
+
+
+def test_adaptiveWindowGrowsToItsMaximum():
+    window = InFlightWindow(2, True, maxSize=5)
+    assert window.hasRoom(1) and not window.hasRoom(2)
+    for _ in range(10):
+        window.onSuccess()
+    assert window.size == 5
+    window.onFailure()
+    window.onFailure()
+    window.onFailure()
+    assert window.size == 1
+    window.onSuccess()
+    assert window.size == 2
+
+
+def test_fixedWindow():
+    window = InFlightWindow(4)
+    window.onSuccess()
+    window.onFailure()
+    assert window.size == 4
+    #an adaptive window without a maximum only recovers from failures
+    window = InFlightWindow(4, True)
+    window.onFailure()
+    for _ in range(10):
+        window.onSuccess()
+    assert window.size == 4
+    with pytest.raises(ValueError):
+        InFlightWindow(0)
+    with pytest.raises(ValueError):
+        InFlightWindow(4, True, maxSize=2)
+
+
+def test_maxWindowArgument():
+    args = parseCommand(["writeVal", "--addr", "00:00:00:00:00:01", "--async", "--window", "8"])
+    assert getMaxWindow(args, 8) is None
+    args = parseCommand(["writeVal", "--addr", "00:00:00:00:00:01", "--async", "--window", "8", "--adaptiveWindow"])
+    assert getMaxWindow(args, 8) == 32
+    args = parseCommand(["writeVal", "--addr", "00:00:00:00:00:01", "--async", "--window", "8", "--adaptiveWindow",
+                         "--maxWindow", "12"])
+    assert getMaxWindow(args, 8) == 12
+    assert getMaxWindow(args, None) is None
+
+
+def test_asyncWriteWindowGrows(simulated, address, monkeypatch):
+    device = simulated()
+    windows = []
+
+    class RecordedWindow(InFlightWindow):
+        def __init__(self, *args, **kwargs):
+            InFlightWindow.__init__(self, *args, **kwargs)
+            windows.append(self)
+    monkeypatch.setattr(cmdLineToolWrappers, 'InFlightWindow', RecordedWindow)
+    results = cmdLineToolWrappers.bleServiceWriteAsync(address, "", "public", "low", ["01"], ["\x05"] * 40, 5, 5,
+                                                       2, True, maxWindow=6)
+    assert len(results) == 40
+    assert windows[0].size == 6
+    assert device.attributes[1].value == "\x05"
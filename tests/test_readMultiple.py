@@ -0,0 +1,79 @@
+import pytest
+
+from bleSuiteCLI import cmdLineToolWrappers
+from bleSuiteCLI.cmdLineToolWrappers import _readMultipleGroups, _VARYING
+from bleSuiteCLI.operationStats import stats
+from bleSuiteCLI.simulatedDevice import SimulatedRequester
+from bleSuiteCLI.valueLengthCache import ValueLengthCache
+
+
+def _handles(count):
+    return ["%02x" % handle for handle in range(1, count + 1)]
+
+
+def _lengths(address, handles, length):
+    lengths = ValueLengthCache(None)
+    for handle in handles:
+        lengths.put(address, handle, length)
+    return lengths
+
+
+@pytest.fixture
+def counted():
+    stats.enable()
+    stats.reset()
+    yield stats.counters
+    stats.reset()
+    stats.disable()
+
+
+def test_groupsByCachedLength(address):
+    handles = _handles(6)
+    lengths = _lengths(address, handles, 4)
+    lengths.put(address, "03", 18)
+    lengths.put(address, "05", _VARYING)
+    lengths.put(address, "06", None)
+    #03 only fits a response of its own and 05 is never grouped, so 04 has no partner
+    assert list(_readMultipleGroups(lengths, address, handles, 23, True)) == [(1, [0, 1]), (5, [])]
+    #without length prefixes 01 to 03 fill a 29 byte response, and the unknown 06 is read singly
+    assert list(_readMultipleGroups(lengths, address, handles, 30, False)) == [(2, [0, 1, 2]), (5, [])]
+
+
+def test_batchedReadUsesCachedLengths(simulated, address):
+    device = simulated(8, 4)
+    handles = _handles(8)
+    uuidData, handleData = cmdLineToolWrappers.bleServiceRead(address, "", "public", "low", handles, [],
+                                                              lengthCache=_lengths(address, handles, 4))
+    assert handleData == [(handle, [device.attributes[int(handle, 16)].value]) for handle in handles]
+    #three length prefixed values of 4 bytes fit in each 22 byte response
+    assert device.counters['readMultiple'] == 3
+    assert device.counters['read'] == 0
+
+
+def test_overMTUResponseIsSplit(simulated, address):
+    device = simulated(3, 10)
+    handles = _handles(3)
+    #stale lengths size a single request whose response the device cuts at the MTU
+    lengths = _lengths(address, handles, 4)
+    uuidData, handleData = cmdLineToolWrappers.bleServiceRead(address, "", "public", "low", handles, [],
+                                                              lengthCache=lengths)
+    assert handleData == [(handle, [device.attributes[int(handle, 16)].value]) for handle in handles]
+    assert device.counters['readMultiple'] == 1
+    #the first value was complete, the cut second and unsent third are read singly
+    assert device.counters['read'] == 2
+    #the cut value's length prefix is learned, the stale lengths keep their handles out of later batches
+    assert [lengths.get(address, handle) for handle in handles] == [_VARYING, 10, _VARYING]
+
+
+def test_fallsBackToSingleReads(simulated, address, monkeypatch, counted):
+    device = simulated(8, 4)
+    handles = _handles(8)
+    #gattlib's GATTRequester provides neither form of Read Multiple
+    monkeypatch.delattr(SimulatedRequester, 'read_multiple')
+    monkeypatch.delattr(SimulatedRequester, 'read_multiple_variable')
+    uuidData, handleData = cmdLineToolWrappers.bleServiceRead(address, "", "public", "low", handles, [],
+                                                              lengthCache=_lengths(address, handles, 4))
+    assert handleData == [(handle, [device.attributes[int(handle, 16)].value]) for handle in handles]
+    assert device.counters['readMultiple'] == 0
+    assert device.counters['read'] == 8
+    assert counted["read.multipleUnsupported"] == 1
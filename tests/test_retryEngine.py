@@ -0,0 +1,115 @@
+import pytest
+
+from bleSuiteCLI import retryEngine
+from bleSuiteCLI.retryEngine import RetryEngine, RetryPolicy, CircuitBreaker, ConnectionSession, \
+    BLEOperationError, classifyError, ERROR_DISCONNECTED, ERROR_INVALID_HANDLE, ERROR_TIMEOUT, ERROR_UNKNOWN
+
+
+class _Link(object):
+    def __init__(self):
+        self.connects = 0
+
+    def connect(self):
+        self.connects += 1
+
+    def isConnected(self):
+        return True
+
+
+def _failing(message, calls):
+    def function(connectionManager):
+        calls.append(connectionManager)
+        raise RuntimeError(message)
+    return function
+
+
+@pytest.mark.parametrize("maxTries", [0, 1, 5])
+def test_callRetriesMaxTriesTimes(maxTries):
+    calls = []
+    engine = RetryEngine(ConnectionSession(_Link()), RetryPolicy(maxTries, 0))
+    with pytest.raises(BLEOperationError) as error:
+        engine.call("read", _failing("Channel or attrib disconnected", calls))
+    #the first attempt plus maxTries retries
+    assert len(calls) == maxTries + 1
+    assert error.value.attempts == maxTries + 1
+    assert error.value.code == ERROR_DISCONNECTED
+
+
+def test_callRaisesPermanentErrorsAtOnce():
+    calls = []
+    engine = RetryEngine(ConnectionSession(_Link()), RetryPolicy(5, 0))
+    with pytest.raises(BLEOperationError) as error:
+        engine.call("read", _failing("Invalid handle", calls))
+    assert len(calls) == 1
+    assert error.value.permanent
+
+
+def test_callReconnectsAfterDisconnect():
+    link = _Link()
+    results = iter([RuntimeError("Channel or attrib disconnected"), "data"])
+
+    def function(connectionManager):
+        result = next(results)
+        if isinstance(result, Exception):
+            raise result
+        return result
+    engine = RetryEngine(ConnectionSession(link), RetryPolicy(3, 0))
+    assert engine.call("read", function) == "data"
+    assert link.connects == 1
+    assert engine.session.generation == 1
+
+
+def test_retryPolicyRejectsNegativeTries():
+    with pytest.raises(ValueError):
+        RetryPolicy(-1)
+
+
+def test_retryDelayJitterBounds():
+    policy = RetryPolicy(5, 0.1, 0.5)
+    for attempt in range(1, 8):
+        ceiling = min(0.5, 0.1 * 2 ** attempt)
+        delays = [policy.delay(attempt) for i in range(200)]
+        assert all(0 <= delay <= ceiling for delay in delays)
+        #full jitter spreads the delays over the whole range
+        assert max(delays) > ceiling / 2
+    assert RetryPolicy(5, 0).delay(3) == 0
+
+
+def test_classifyError():
+    assert classifyError(RuntimeError("Invalid handle")) == ERROR_INVALID_HANDLE
+    assert classifyError(RuntimeError("Channel or attrib not ready")) == ERROR_DISCONNECTED
+    assert classifyError(RuntimeError("Operation timed out")) == ERROR_TIMEOUT
+    assert classifyError(RuntimeError("something else")) == ERROR_UNKNOWN
+
+
+def test_circuitBreakerTransitions(monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr(retryEngine.time, "time", lambda: now[0])
+    breaker = CircuitBreaker(failureThreshold=2, resetTimeout=10)
+    breaker.onFailure()
+    assert breaker.allow()
+    breaker.onFailure()
+    #open: operations are refused until the reset timeout passes
+    assert not breaker.allow()
+    now[0] += 10
+    #half open: a single trial is let through
+    assert breaker.allow()
+    assert not breaker.allow()
+    breaker.onFailure()
+    assert not breaker.allow()
+    now[0] += 10
+    assert breaker.allow()
+    breaker.onSuccess()
+    assert breaker.allow() and breaker.allow()
+
+
+def test_openBreakerRejectsCalls():
+    calls = []
+    breaker = CircuitBreaker(failureThreshold=1, resetTimeout=60)
+    engine = RetryEngine(ConnectionSession(_Link()), RetryPolicy(0, 0), breaker)
+    with pytest.raises(BLEOperationError):
+        engine.call("read", _failing("Channel or attrib disconnected", calls))
+    with pytest.raises(BLEOperationError) as error:
+        engine.call("read", _failing("Channel or attrib disconnected", calls))
+    assert error.value.code == retryEngine.ERROR_CIRCUIT_OPEN
+    assert len(calls) == 1
@@ -0,0 +1,90 @@
+import os
+import time
+
+import pytest
+
+from bleSuiteCLI import cmdLineToolWrappers, scanCheckpoint
+from bleSuiteCLI.scanCheckpoint import ScanCheckpoint
+
+
+def _checkpoints(tmpdir):
+    return [name for name in os.listdir(str(tmpdir)) if name.endswith(".checkpoint")]
+
+
+def test_serviceScanResumesFromCheckpoint(simulated, address, tmpdir):
+    device = simulated(12, serviceSize=4)
+    discovered = []
+    characteristics = device.characteristics
+
+    def failOnLastService(start, end):
+        discovered.append(start)
+        if start == 9 and discovered.count(9) == 1:
+            raise RuntimeError("Channel or attrib disconnected")
+        return characteristics(start, end)
+    device.characteristics = failOnLastService
+    scan = lambda resume: cmdLineToolWrappers.bleServiceScan(address, "", "public", "low", printStructure=False,
+                                                              retryPolicy=cmdLineToolWrappers.RetryPolicy(0, 0),
+                                                              resume=resume, checkpointDir=str(tmpdir))
+    with pytest.raises(RuntimeError):
+        scan(False)
+    assert len(_checkpoints(tmpdir)) == 1
+    bleDevice = scan(True)
+    #services discovered before the failure are not discovered again
+    assert discovered == [1, 5, 9, 9]
+    assert [service.start for service in bleDevice.services] == [1, 5, 9]
+    assert sum(len(service.characteristics) for service in bleDevice.services) == 12
+    assert _checkpoints(tmpdir) == []
+
+
+def test_checkpointRoundTrip(tmpdir):
+    checkpoint = ScanCheckpoint("AA:BB:CC:DD:EE:FF", "public", "serviceScan", str(tmpdir))
+    checkpoint.servicesDiscovered = True
+    checkpoint.characteristicsDiscovered.add(1)
+    checkpoint.save()
+    loaded = ScanCheckpoint.load("AA:BB:CC:DD:EE:FF", "public", "serviceScan", str(tmpdir))
+    assert loaded.servicesDiscovered and loaded.characteristicsDiscovered == set([1])
+    assert ScanCheckpoint.load("AA:BB:CC:DD:EE:FF", "public", "smartScan", str(tmpdir)) is None
+
+
+def test_expiredCheckpointIsDiscarded(tmpdir):
+    checkpoint = ScanCheckpoint("AA:BB:CC:DD:EE:FF", "public", "serviceScan", str(tmpdir))
+    checkpoint.save()
+    assert ScanCheckpoint.load("AA:BB:CC:DD:EE:FF", "public", "serviceScan", str(tmpdir), ttl=-1) is None
+    assert _checkpoints(tmpdir) == []
+
+
+def test_checkpointFromOtherVersionIsIgnored(tmpdir, monkeypatch):
+    checkpoint = ScanCheckpoint("AA:BB:CC:DD:EE:FF", "public", "serviceScan", str(tmpdir))
+    monkeypatch.setattr(scanCheckpoint, "CHECKPOINT_VERSION", scanCheckpoint.CHECKPOINT_VERSION + 1)
+    checkpoint.save()
+    monkeypatch.undo()
+    assert ScanCheckpoint.load("AA:BB:CC:DD:EE:FF", "public", "serviceScan", str(tmpdir)) is None
+
+
+def test_corruptCheckpointIsIgnored(tmpdir):
+    ScanCheckpoint("AA:BB:CC:DD:EE:FF", "public", "serviceScan", str(tmpdir)).save()
+    with open(str(tmpdir.join(_checkpoints(tmpdir)[0])), 'wb') as f:
+        f.write("truncated")
+    assert ScanCheckpoint.load("AA:BB:CC:DD:EE:FF", "public", "serviceScan", str(tmpdir)) is None
+
+
+def test_unreadableDescriptorsDoNotWaitForTheFullTimeout(simulated, address):
+    #the device does not answer refused async reads, as with gattlib
+    device = simulated(8, silentErrors=True)
+    device.attributes[3].readable = False
+    characteristics = device.characteristics
+    #handles 2 to 4 and 6 to 8 become descriptors of the characteristics at 1 and 5
+    device.characteristics = lambda start, end: [declaration for declaration in characteristics(start, end)
+                                                 if declaration['handle'] in (1, 5)]
+    engine = cmdLineToolWrappers._openSession(address, "", "public", "low", 5, cmdLineToolWrappers.RetryPolicy(0, 0))
+    started = time.time()
+    bleDevice = cmdLineToolWrappers.blePipelinedSmartScan(engine, address, timeout=5, descriptorTimeout=0.1)
+    assert time.time() - started < 2
+    descriptors = dict((descriptor.handle, descriptor) for service in bleDevice.services
+                       for characteristic in service.characteristics for descriptor in characteristic.descriptors)
+    assert sorted(descriptors) == [2, 3, 4, 6, 7, 8]
+    #the descriptor that timed out was read again synchronously, which reports why it can't be read
+    assert descriptors[3].value is None
+    assert descriptors[3].error == "Attribute can't be read"
+    assert descriptors[4].value == [device.attributes[4].value] and descriptors[4].error is None
+    assert device.counters['refused'] == 1
@@ -0,0 +1,65 @@
+import pytest
+
+from bleSuiteCLI.bleSuiteCLI import parseCommand, runCommand
+from bleSuiteCLI.sessionRunner import DeviceSession, parseStep, readSteps, runSession
+
+
+def _runScript(tmpdir, address, lines):
+    script = tmpdir.join("steps.txt")
+    script.write("\n".join(lines) + "\n")
+    out = tmpdir.join("results.jsonl")
+    args = parseCommand(["session", "--noDaemon", "--addr", address, "--adapter", "hci0", "--script", str(script),
+                         "--output", "jsonl", "--out", str(out)])
+    return runCommand(args), [line for line in out.read().splitlines() if line]
+
+
+def test_sessionSucceeds(simulated, address, tmpdir):
+    simulated()
+    code, records = _runScript(tmpdir, address, ["read 0001", "write 0002 41"])
+    assert code == 0
+    assert len(records) == 2 and '"output": ["01010101"]' in records[0]
+
+
+def test_sessionFailedStepsExitNonZero(simulated, address, tmpdir):
+    simulated()
+    code, records = _runScript(tmpdir, address, ["read 0001", "frobnicate 0001"])
+    assert code == 1
+    assert len(records) == 2
+
+
+def test_parseStep():
+    step = parseStep("write 0x002a hex:4142 plain  # trailing comment", 3)
+    assert (step.line, step.command, step.arguments) == (3, "write", ["002a", "AB", "plain"])
+    step = parseStep("subscribe 0001 0002 for=0.5 mode=2")
+    assert step.arguments == ["0001", "0002"] and step.options == {'for': 0.5, 'mode': 2}
+    assert parseStep("sleep 1.5").arguments == [1.5]
+    assert parseStep("   # comment only") is None
+    for text in ["frobnicate 0001", "read", "read zz", "write 0001", "write 0001 hex:4", "subscribe 0001 mode=4"]:
+        with pytest.raises(ValueError):
+            parseStep(text, 7)
+
+
+def test_readStepsReportsBadLines():
+    steps = list(readSteps(["read 0001\n", "\n", "bad 0001\n", "sleep 0\n"]))
+    assert [getattr(step, 'command', None) for step in steps] == ["read", None, "sleep"]
+    assert isinstance(steps[1], ValueError) and steps[1].line == 3
+
+
+def test_stepsShareOneConnection(simulated, address):
+    device = simulated()
+    results = []
+    errors = []
+    session = DeviceSession(address, "", "public", "low")
+    failed = runSession(session, readSteps(["write 0002 hex:41", "read 0002", "readUUID %s" % device.attributes[3].uuid,
+                                            "subscribe 0004 for=0.05", "read 00ff"]),
+                        lambda step, kind, result: results.append((step.command, result)),
+                        lambda *event: None, lambda step, error: errors.append(step))
+    session.close()
+    assert device.counters['connect'] == 1
+    assert results[1] == ("read", ("0002", ["A"]))
+    assert results[2][0] == "readUUID" and results[2][1][2] == [device.attributes[3].value]
+    #subscribing wrote the configuration value and disabled events again afterwards
+    assert device.attributes[4].value == "\x00\x00"
+    #a read of a missing handle is reported as its result rather than failing the step
+    assert results[-1] == ("read", ("00ff", -1))
+    assert failed == 0 and errors == []
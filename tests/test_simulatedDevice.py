@@ -0,0 +1,188 @@
+import threading
+
+import pytest
+
+from bleSuiteCLI import cmdLineToolWrappers
+from bleSuiteCLI.simulatedDevice import LatencyModel, SimulatedAttribute
+
+
+def _values(device, handles):
+    return [[device.attributes[int(handle, 16)].value] for handle in handles]
+
+
+def _received(value):
+    #async results hold the (None, GATTResponse) pair, or an error message in place of it
+    return value[0] if isinstance(value[0], str) else value[1].received()
+
+
+def test_read(simulated, address):
+    device = simulated()
+    handles = ["0001", "0002", "0005"]
+    uuidData, handleData = cmdLineToolWrappers.bleServiceRead(address, "", "public", "low", handles, [None],
+                                                              batch=False)
+    assert [handle for handle, data in handleData] == handles
+    assert [data for handle, data in handleData] == _values(device, handles)
+
+
+def test_readByUUID(simulated, address):
+    device = simulated()
+    UUID = device.attributes[3].uuid
+    uuidData, handleData = cmdLineToolWrappers.bleServiceRead(address, "", "public", "low", [], [UUID])
+    assert uuidData == [(UUID, 3, [device.attributes[3].value])]
+
+
+def test_readRefused(simulated, address):
+    device = simulated()
+    device.attributes[2].readable = False
+    uuidData, handleData = cmdLineToolWrappers.bleServiceRead(address, "", "public", "low", ["0001", "0002"],
+                                                              [None], batch=False)
+    assert handleData == [("0001", [device.attributes[1].value]), ("0002", -2)]
+
+
+def test_readAsync(simulated, address):
+    device = simulated(latency=LatencyModel(0.002))
+    handles = ["%04x" % handle for handle in range(1, 9)]
+    uuidData, handleData = cmdLineToolWrappers.bleServiceReadAsync(address, "", "public", "low", handles, [None],
+                                                                   timeout=1)
+    assert sorted(handle for handle, data in handleData) == handles
+    assert sorted((handle, _received(data)) for handle, data in handleData) == \
+        zip(handles, _values(device, handles))
+
+
+def test_readAsyncDroppedResponsesTimeOut(simulated, address):
+    simulated(dropRate=1.0)
+    uuidData, handleData = cmdLineToolWrappers.bleServiceReadAsync(address, "", "public", "low", ["0001", "0002"],
+                                                                   [None], timeout=0.2)
+    assert sorted(handleData) == [("0001", [cmdLineToolWrappers.TIMEOUT_MESSAGE]),
+                                  ("0002", [cmdLineToolWrappers.TIMEOUT_MESSAGE])]
+
+
+def test_windowedWrite(simulated, address):
+    device = simulated(latency=LatencyModel(0.002))
+    outstanding = []
+    lock = threading.Lock()
+    issue = device._async
+
+    def tracked(*args, **kwargs):
+        #responses queued by the device are the writes still outstanding
+        with lock:
+            outstanding.append(len(device._responses) + 1)
+        return issue(*args, **kwargs)
+    device._async = tracked
+    inputs = ["%02d" % i for i in range(20)]
+    results = cmdLineToolWrappers.bleServiceWriteAsync(address, "", "public", "low", ["0001", "0002"], inputs,
+                                                       timeout=1, window=4)
+    assert len(results) == 40
+    assert all(_received(data) == ["\x13"] for handle, data, inputVal in results)
+    assert max(outstanding) <= 4
+    assert device.attributes[1].value == device.attributes[2].value == inputs[-1]
+
+
+def test_writeToUnknownHandle(simulated, address):
+    simulated()
+    results = cmdLineToolWrappers.bleServiceWrite(address, "", "public", "low", ["0001", "0040"], ["ab"])
+    assert [(handle, data) for handle, data, inputVal in results] == [("0001", ["\x13"]), ("0040", -1)]
+
+
+def test_readSurvivesDisconnects(simulated, address):
+    device = simulated(disconnectRate=0.2, seed=3)
+    handles = ["%04x" % (1 + i % 8) for i in range(40)]
+    policy = cmdLineToolWrappers.RetryPolicy(20, 0)
+    uuidData, handleData = cmdLineToolWrappers.bleServiceRead(address, "", "public", "low", handles, [None],
+                                                              retryPolicy=policy, batch=False)
+    assert [data for handle, data in handleData] == _values(device, handles)
+    assert device.counters['disconnect'] > 0
+    assert device.counters['connect'] > 1
+
+
+def test_writeSurvivesDisconnects(simulated, address):
+    device = simulated(disconnectRate=0.2, seed=5)
+    inputs = ["%02d" % i for i in range(20)]
+    policy = cmdLineToolWrappers.RetryPolicy(20, 0)
+    results = cmdLineToolWrappers.bleServiceWrite(address, "", "public", "low", ["0003"], inputs,
+                                                  retryPolicy=policy)
+    assert [inputVal for handle, data, inputVal in results] == inputs
+    assert device.attributes[3].value == inputs[-1]
+    assert device.counters['disconnect'] > 0
+
+
+def _serviceChangedDevice(simulated):
+    from bleSuiteCLI.simulatedDevice import SERVICE_CHANGED_UUID, CLIENT_CONFIGURATION_UUID
+    device = simulated(12, serviceSize=4)
+    device.attributes[2] = SimulatedAttribute(SERVICE_CHANGED_UUID, "", readable=False, writable=False)
+    device.attributes[3] = SimulatedAttribute(CLIENT_CONFIGURATION_UUID, "\x00\x00")
+    return device
+
+
+def _incrementalScan(address, securityLevel, cache):
+    changes = []
+    device = cmdLineToolWrappers.bleServiceScan(address, "", "public", securityLevel, cache, printStructure=False,
+                                                incremental=True, onChange=changes.append)
+    return device, [(change['change'], change['attribute'], change['handle']) for change in changes]
+
+
+def test_serviceScanAfterUpdate(simulated, address, tmpdir):
+    from bleSuiteCLI.gattCache import GATTCache
+    device = _serviceChangedDevice(simulated)
+    cache = GATTCache(str(tmpdir))
+    first, changes = _incrementalScan(address, "medium", cache)
+    assert [service.start for service in first.services] == [1, 5, 9]
+    device.updateAttributes({6: SimulatedAttribute("0000beef-0000-1000-8000-00805f9b34fb", "x")})
+    assert _incrementalScan(address, "medium", cache)[1] == [('changed', 'characteristic', 6)]
+    assert device.counters['indication'] == 1
+    #indications stay enabled for a bonded client, so the next change is indicated on connecting
+    device.updateAttributes({10: SimulatedAttribute("0000f00d-0000-1000-8000-00805f9b34fb", "y")})
+    writes = device.counters['write']
+    #the link closes with the last scan's requester, so the next scan connects again
+    device.connected = False
+    assert _incrementalScan(address, "medium", cache)[1] == [('changed', 'characteristic', 10)]
+    assert device.counters['indication'] == 2
+    assert device.counters['write'] == writes
+
+
+def test_serviceScanAfterUpdateUnbonded(simulated, address, tmpdir):
+    from bleSuiteCLI.gattCache import GATTCache
+    device = _serviceChangedDevice(simulated)
+    cache = GATTCache(str(tmpdir))
+    _incrementalScan(address, "low", cache)
+    device.updateAttributes({6: SimulatedAttribute("0000beef-0000-1000-8000-00805f9b34fb", "x")})
+    assert _incrementalScan(address, "low", cache)[1] == [('changed', 'characteristic', 6)]
+    #nothing is indicated to an unbonded client, so the device is scanned again without enabling indications
+    assert device.counters['write'] == 0
+    assert device.counters['indication'] == 0
+
+
+def test_fuzzSavesCrashWhenDeviceStaysDown(simulated, address):
+    def crashOn(value):
+        if value == "\xff":
+            device.shutdown()
+            return True
+        return False
+    device = simulated(crashOn=crashOn)
+    crashes = []
+    policy = cmdLineToolWrappers.RetryPolicy(2, 0)
+    with pytest.raises(cmdLineToolWrappers.BLEOperationError):
+        cmdLineToolWrappers.bleFuzzWrite(address, "", "public", "low", ["0001"], iter(["\x00", "\xff", "\x01"]),
+                                         window=1, onResult=lambda kind, crash: crashes.append(crash),
+                                         retryPolicy=policy, recoveryTimeout=0.2)
+    assert [(crash.payload, crash.reproduced) for crash in crashes] == [("\xff", False)]
+
+
+def test_fuzzSavesReproducedCrashWhenDeviceStaysDown(simulated, address):
+    def crashOn(value):
+        if "\xff" in value:
+            writes['crash'] += 1
+            #the device survives the original crash and the first replay only
+            if writes['crash'] > 1:
+                device.shutdown()
+            return True
+        return False
+    writes = {'crash': 0}
+    device = simulated(crashOn=crashOn)
+    crashes = []
+    policy = cmdLineToolWrappers.RetryPolicy(2, 0)
+    with pytest.raises(cmdLineToolWrappers.BLEOperationError):
+        cmdLineToolWrappers.bleFuzzWrite(address, "", "public", "low", ["0001"], iter(["\x00", "ab\xffcd"]),
+                                         window=1, onResult=lambda kind, crash: crashes.append(crash),
+                                         retryPolicy=policy, recoveryTimeout=0.2)
+    assert [(crash.handle, crash.payload, crash.reproduced) for crash in crashes] == [("0001", "ab\xffcd", True)]
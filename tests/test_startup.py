@@ -0,0 +1,31 @@
+import json
+import subprocess
+import sys
+
+from bleSuiteCLI import benchmark
+from bleSuiteCLI.benchmark import DEFERRED_MODULES
+
+#Parses a command line in a fresh interpreter and prints the DEFERRED_MODULES it loaded as JSON
+_PARSE_PROBE = '''
+import json, sys
+from bleSuiteCLI.bleSuiteCLI import parseCommand
+parseCommand(sys.argv[1:])
+print json.dumps([name for name in %r if name in sys.modules])
+''' % DEFERRED_MODULES
+
+
+def _loaded(argv):
+    output = subprocess.check_output([sys.executable, '-c', _PARSE_PROBE] + argv, env=benchmark._cliEnvironment())
+    return json.loads(output)
+
+
+def test_importLeavesHeavyModulesForTheCommands():
+    breakdown = benchmark.importBreakdown('bleSuiteCLI.bleSuiteCLI', 1)
+    assert breakdown['importMs'] > 0
+    assert [name for name in breakdown['loaded'] if name in DEFERRED_MODULES] == []
+
+
+def test_parsingLeavesHeavyModulesForTheCommands():
+    #--addr is left out, its validation is done by bleSuite
+    assert _loaded(["readVal", "--handles", "01", "--async", "--output", "jsonl"]) == []
+    assert _loaded(["smartScan", "--resume"]) == []
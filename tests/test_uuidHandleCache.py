@@ -0,0 +1,99 @@
+import pytest
+
+from bleSuiteCLI import cmdLineToolWrappers
+from bleSuiteCLI.bleSuiteCLI import _formatHandle
+from bleSuiteCLI.uuidHandleCache import UUIDHandleCache, handleToInt
+from bleSuiteCLI.valueLengthCache import ValueLengthCache
+
+
+def test_handleToInt():
+    assert handleToInt(0x2a) == 0x2a
+    #two character hex handles are not raw bytes
+    assert handleToInt("2a") == 0x2a
+    assert handleToInt("002a") == 0x2a
+    assert handleToInt("\x00\x2a", raw=True) == 0x2a
+    with pytest.raises(ValueError):
+        handleToInt("002a", raw=True)
+
+
+def test_formatHandle():
+    assert _formatHandle("2a") == "0x002a"
+    assert _formatHandle("\x00\x2a", raw=True) == "0x002a"
+    assert _formatHandle(0x2a) == "0x002a"
+    assert _formatHandle(None) is None
+
+
+def _countUUIDLookups(device):
+    lookups = []
+    findUUID = device._findUUID
+
+    def counted(UUID):
+        lookups.append(UUID)
+        return findUUID(UUID)
+    device._findUUID = counted
+    return lookups
+
+
+def test_readByHandleTakesHexHandles(simulated, address):
+    device = simulated(0x30)
+    uuidData, handleData = cmdLineToolWrappers.bleServiceRead(address, "", "public", "low", ["2a"], [None],
+                                                              batch=False)
+    assert handleData == [("2a", [device.attributes[0x2a].value])]
+
+
+def test_readByUUIDUsesCachedRawHandle(simulated, address, tmpdir):
+    device = simulated()
+    UUID = device.attributes[3].uuid
+    cache = UUIDHandleCache(str(tmpdir.join("handles.cache")))
+    #handles are cached as a read by UUID resolves them: two big-endian bytes
+    cache.put(address, "public", UUID, "\x00\x03")
+    lookups = _countUUIDLookups(device)
+    uuidData, handleData = cmdLineToolWrappers.bleServiceRead(address, "", "public", "low", [], [UUID],
+                                                              handleCache=cache)
+    assert uuidData == [(UUID, "\x00\x03", [device.attributes[3].value])]
+    assert lookups == []
+    assert _formatHandle(uuidData[0][1], raw=True) == "0x0003"
+
+
+def test_readByUUIDAsyncCachesRawHandle(simulated, address, tmpdir):
+    device = simulated()
+    UUID = device.attributes[3].uuid
+    cache = UUIDHandleCache(str(tmpdir.join("handles.cache")))
+    lookups = _countUUIDLookups(device)
+    first, handleData = cmdLineToolWrappers.bleServiceReadAsync(address, "", "public", "low", [None], [UUID],
+                                                                handleCache=cache)
+    assert cache.get(address, "public", UUID) == "\x00\x03"
+    second, handleData = cmdLineToolWrappers.bleServiceReadAsync(address, "", "public", "low", [None], [UUID],
+                                                                 handleCache=cache)
+    #the second read goes straight to the cached handle
+    assert len(lookups) == 1
+    assert second[0][2] == "\x00\x03"
+    assert second[0][1][1].received() == [device.attributes[3].value]
+
+
+def test_cachesEvictAndPersist(tmpdir, address):
+    path = str(tmpdir.join("handles.cache"))
+    cache = UUIDHandleCache(path, maxEntries=2)
+    cache.put(address, "public", "A", "\x00\x01")
+    cache.put(address, "public", "B", "\x00\x02")
+    #using A makes B the least recently used
+    assert cache.get(address.lower(), "public", "a") == "\x00\x01"
+    cache.put(address, "public", "C", "\x00\x03")
+    cache.save()
+    cache = UUIDHandleCache(path)
+    assert cache.get(address, "public", "B") is None
+    assert cache.get(address, "public", "A") == "\x00\x01"
+    cache.discard(address, "public", "A")
+    assert cache.get(address, "public", "A") is None
+    lengths = ValueLengthCache(str(tmpdir.join("lengths.cache")))
+    lengths.put(address, "2A", 4)
+    lengths.save()
+    assert ValueLengthCache(str(tmpdir.join("lengths.cache"))).get(address, "2a") == 4
+
+
+def test_memoryCacheIsNotSaved(tmpdir, address):
+    lengths = ValueLengthCache(None)
+    lengths.put(address, "2a", 4)
+    lengths.save()
+    assert lengths.get(address, "2a") == 4
+    assert tmpdir.listdir() == []
@@ -0,0 +1,58 @@
+import pytest
+
+from bleSuiteCLI import adapterScheduler, cmdLineToolWrappers
+
+
+def _write(address, inputs, **kwargs):
+    return cmdLineToolWrappers.bleServiceWriteNoResponse(address, "", "public", "low", ["03"], inputs, **kwargs)
+
+
+def test_writesAreConfirmedInBatches(simulated, address):
+    device = simulated()
+    inputs = ["%02d" % i for i in range(20)]
+    results = _write(address, inputs, credits=6)
+    assert results == [("03", [], value) for value in inputs]
+    assert device.counters['writeCommand'] == 20
+    #one declaration read confirms each batch of 6
+    assert device.counters['async'] == 4
+    assert device.attributes[3].value == "19"
+
+
+def test_creditsComeFromTheController(simulated, address, monkeypatch):
+    device = simulated()
+    monkeypatch.setattr(adapterScheduler, 'controllerBuffers', lambda adapter: (27, 5))
+    _write(address, ["x"] * 10)
+    assert device.counters['async'] == 2
+    #controllers that can not be queried get DEFAULT_WRITE_CREDITS
+    monkeypatch.setattr(adapterScheduler, 'controllerBuffers', lambda adapter: None)
+    _write(address, ["x"] * cmdLineToolWrappers.DEFAULT_WRITE_CREDITS)
+    assert device.counters['async'] == 3
+
+
+def test_unconfirmedBatchesAreResent(simulated, address):
+    device = simulated()
+    writeCommand = device.writeCommand
+
+    def dropOnce(handle, value):
+        writeCommand(handle, value)
+        if value == "07" and not dropOnce.dropped:
+            #the link drops before the batch holding this write is confirmed
+            dropOnce.dropped = True
+            device.connected = False
+    dropOnce.dropped = False
+    device.writeCommand = dropOnce
+    inputs = ["%02d" % i for i in range(12)]
+    results = _write(address, inputs, credits=4, timeout=1)
+    assert sorted(value for handle, data, value in results) == inputs
+    assert device.counters['connect'] == 2
+    #writes after the last confirmation were sent again
+    assert device.counters['writeCommand'] > 12
+    assert device.attributes[3].value == "11"
+
+
+def test_handlesWithoutWriteCommandsAreRefused(simulated, address):
+    device = simulated()
+    device.attributes[3].writeWithoutResponse = False
+    with pytest.raises(ValueError):
+        _write(address, ["x"])
+    assert device.counters['writeCommand'] == 0